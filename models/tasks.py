@@ -296,7 +296,8 @@ if has_module("msg"):
             # Authenticate
             auth.s3_impersonate(user_id)
         # Run the Task & return the result
-        result = msg.process_outbox(contact_method)
+        # Scheduler workers are single-threaded => can pool SMTP connections
+        result = msg.process_outbox(contact_method, smtp_pool=True)
         db.commit()
         return result
 
@@ -412,6 +413,22 @@ if has_module("msg"):
 
     tasks["notify_notify"] = notify_notify
 
+    # -------------------------------------------------------------------------
+    def notify_notify_shared(resource_ids, user_id=None):
+        """
+            Asynchronous task to notify a batch of subscribers about
+            resource updates, sharing lookup queries and messages between
+            them. This task is created by notify_check_subscriptions.
+
+            @param resource_ids: list of pr_subscription_resource record IDs
+        """
+        if user_id:
+            auth.s3_impersonate(user_id)
+        notify = s3base.S3Notifications
+        return notify.notify_shared(resource_ids)
+
+    tasks["notify_notify_shared"] = notify_notify_shared
+
 # -----------------------------------------------------------------------------
 if has_module("req"):
 
@@ -760,6 +777,39 @@ if has_module("sync"):
 
     tasks["sync_synchronize"] = sync_synchronize
 
+    # -------------------------------------------------------------------------
+    def sync_synchronize_all(user_id=None, manual=False):
+        """
+            Run all tasks for all repositories, with concurrent workers,
+            to be called from scheduler
+        """
+
+        auth.s3_impersonate(user_id)
+
+        sync = current.sync
+        status = sync.get_status()
+        if status.running:
+            message = "Synchronization already active - skipping run"
+            sync.log.write(repository_id=None,
+                           resource_name=None,
+                           transmission=None,
+                           mode=None,
+                           action="check",
+                           remote=False,
+                           result=sync.log.ERROR,
+                           message=message)
+            db.commit()
+            return sync.log.ERROR
+        sync.set_status(running=True, manual=manual)
+        try:
+            success = sync.synchronize_all()
+        finally:
+            sync.set_status(running=False, manual=False)
+        db.commit()
+        return s3base.S3SyncLog.SUCCESS if success else s3base.S3SyncLog.ERROR
+
+    tasks["sync_synchronize_all"] = sync_synchronize_all
+
 # -----------------------------------------------------------------------------
 # Instantiate Scheduler instance with the list of tasks
 s3.tasks = tasks
@@ -373,6 +373,17 @@ if len(pop_list) > 0:
     db.executesql("CREATE INDEX %s__idx on %s(%s);" % (field, tablename, field))
     field = "last_name"
     db.executesql("CREATE INDEX %s__idx on %s(%s);" % (field, tablename, field))
+    # Add indexes for lookups in the OU hierarchy closure
+    tablename = "pr_ou_closure"
+    field = "ancestor"
+    db.executesql("CREATE INDEX %s__idx on %s(%s);" % (field, tablename, field))
+    field = "descendant"
+    db.executesql("CREATE INDEX %s__idx on %s(%s);" % (field, tablename, field))
+
+    # Add index for lookups of stored hierarchy nodes
+    tablename = "s3_hierarchy_node"
+    s3db.table(tablename)
+    db.executesql("CREATE INDEX %s__idx on %s(tablename,node_id);" % (tablename, tablename))
 
     # GIS
     # Add extra index on search field
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Bulk ingestion of climate readings with NumPy
+
+    Readings are passed in as arrays (place_id, time_period, month, value),
+    written to the sample table with COPY in chunks, and aggregated
+    per place and month and per place and year with vectorised group-by
+    operations (np.unique + np.bincount).
+
+    Partial aggregates (count, sum, sum of squared deviations, min, max)
+    can be merged, so the data can be fed in chunks in time order. Periods
+    which are complete get written to the aggregate tables and dropped
+    from memory, which keeps the memory use bounded by the chunk size
+    and the number of places.
+
+    Aggregate tables are named like the sample table, with a suffix
+    "_monthly_<function>" (columns place_id, month, value) or
+    "_yearly_<function>" (columns place_id, year, value), for each of
+    the DSL aggregation functions. The values match those of the SQL
+    aggregation in add_monthly_aggregation_table.py, i.e. STDDEV is the
+    sample standard deviation, and 0 if undefined.
+
+    An import replaces the readings and aggregates of the places and periods
+    it covers, so files can be re-imported (e.g. after corrections). Each
+    import is therefore expected to contain complete periods for its places.
+"""
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+import numpy as np
+
+from . import start_month_0_indexed, start_year
+
+# SQL aggregation functions, as in DSL.CodeGeneration
+AGGREGATIONS = ("MAX", "MIN", "AVG", "STDDEV", "SUM", "COUNT")
+
+# Number of rows per COPY
+CHUNK_SIZE = 100000
+
+def is_undefined(values):
+    """
+        Vectorised version of the default is_undefined check
+        in import_NetCDF_readings.py
+
+        @param values: array of values
+        @return: boolean array, True for undefined values
+    """
+    return (
+        ((values > -99.900003) & (values < -99.9)) |
+        (values < -1e8) |
+        (values > 1e8) |
+        np.isnan(values)
+    )
+
+def month_numbers_to_years(month_numbers):
+    """
+        Vectorised version of month_number_to_year_month, returning
+        only the years
+
+        @param month_numbers: array of month numbers
+    """
+    return ((month_numbers + start_month_0_indexed) // 12) + start_year
+
+def aggregate_table_name(sample_table, period, function):
+    return "%s_%s_%s" % (sample_table.table_name, period, function.lower())
+
+def create_aggregate_tables(sample_table, replace=False):
+    """
+        Create the monthly and yearly aggregate tables for a sample table
+
+        @param sample_table: the SampleTable
+        @param replace: drop existing tables first
+    """
+    db = sample_table.db
+    for period, key in (("monthly", "month"), ("yearly", "year")):
+        for function in AGGREGATIONS:
+            table_name = aggregate_table_name(sample_table, period, function)
+            if replace:
+                db.executesql("DROP TABLE IF EXISTS %s;" % table_name)
+            db.executesql("""
+            CREATE TABLE IF NOT EXISTS %(table_name)s (
+              place_id integer NOT NULL,
+              "%(key)s" smallint NOT NULL,
+              "value" real NOT NULL,
+              CONSTRAINT %(table_name)s_primary_key
+                  PRIMARY KEY (place_id, "%(key)s"),
+              CONSTRAINT %(table_name)s_place_id_fkey
+                  FOREIGN KEY (place_id)
+                  REFERENCES climate_place (id) MATCH SIMPLE
+                  ON UPDATE NO ACTION ON DELETE CASCADE
+            );
+            """ % locals())
+
+def copy_rows(db, table_name, columns, place_ids, keys, values,
+              chunk_size=CHUNK_SIZE):
+    """
+        Write rows to a table with COPY (executemany if the database
+        driver does not support COPY), in chunks
+
+        @param db: the database
+        @param table_name: the table name
+        @param columns: the column names (place, key, value)
+        @param place_ids: array of place IDs
+        @param keys: array of time periods/months/years
+        @param values: array of values
+    """
+    cursor = db._adapter.cursor
+    copy_from = getattr(cursor, "copy_from", None)
+    if getattr(db._adapter.driver, "paramstyle", None) == "qmark":
+        marker = "?"
+    else:
+        marker = "%s"
+    for start in xrange(0, len(values), chunk_size):
+        end = start + chunk_size
+        rows = np.column_stack((
+            place_ids[start:end],
+            keys[start:end],
+            values[start:end],
+        ))
+        if copy_from is not None:
+            data = StringIO()
+            np.savetxt(data, rows, fmt=("%d", "%d", "%.9g"), delimiter="\t")
+            data.seek(0)
+            copy_from(data, table_name, columns=columns)
+        else:
+            cursor.executemany(
+                "INSERT INTO %s (%s) VALUES (%s);" % (
+                    table_name,
+                    ", ".join(columns),
+                    ", ".join([marker] * 3)
+                ),
+                [(int(p), int(k), float(v)) for p, k, v in rows]
+            )
+
+def delete_rows(db, table_name, columns, place_ids, keys, chunk_size=1000):
+    """
+        Delete the rows of the given places within the range of keys
+        given for each place, so that they can be replaced
+
+        @param db: the database
+        @param table_name: the table name
+        @param columns: the column names (place, key)
+        @param place_ids: array of place IDs
+        @param keys: array of time periods/months/years
+        @param chunk_size: the maximum number of places per DELETE
+    """
+    if not len(keys):
+        return
+    keys = np.asarray(keys, dtype=np.int64)
+    places, inverse = np.unique(place_ids, return_inverse=True)
+    first = np.empty(len(places), dtype=np.int64)
+    first.fill(keys.max())
+    np.minimum.at(first, inverse, keys)
+    last = np.empty(len(places), dtype=np.int64)
+    last.fill(keys.min())
+    np.maximum.at(last, inverse, keys)
+
+    # Places with the same range (usually all) are deleted together
+    ranges = {}
+    for place_id, start, end in zip(places, first, last):
+        ranges.setdefault((int(start), int(end)), []).append(str(int(place_id)))
+    place_column, key_column = columns
+    for (start, end), place_list in ranges.items():
+        for i in xrange(0, len(place_list), chunk_size):
+            db.executesql(
+                'DELETE FROM %s WHERE %s IN (%s) AND "%s" BETWEEN %d AND %d;' % (
+                    table_name,
+                    place_column,
+                    ",".join(place_list[i:i + chunk_size]),
+                    key_column,
+                    start,
+                    end
+                )
+            )
+
+class GroupedStatistics(object):
+    """
+        Mergeable per-(place, period) statistics
+    """
+    def __init__(self):
+        empty = np.empty(0)
+        self.keys = np.empty(0, dtype=np.int64)
+        self.count = empty
+        self.total = empty
+        self.m2 = empty
+        self.minimum = empty
+        self.maximum = empty
+
+    @staticmethod
+    def encode(place_ids, periods):
+        # periods are smallint
+        return (place_ids.astype(np.int64) << 16) | (periods.astype(np.int64) + 32768)
+
+    @staticmethod
+    def decode(keys):
+        return keys >> 16, (keys & 0xffff) - 32768
+
+    def add(self, place_ids, periods, values):
+        """
+            Add values
+
+            @param place_ids: array of place IDs
+            @param periods: array of periods (months or years)
+            @param values: array of values
+        """
+        values = values.astype(np.float64)
+        self.combine(
+            self.encode(place_ids, periods),
+            np.ones(len(values)),
+            values,
+            np.zeros(len(values)),
+            values,
+            values
+        )
+
+    def combine(self, keys, count, total, m2, minimum, maximum):
+        """
+            Merge partial statistics into the current statistics
+            (parallel algorithm of Chan et al. for the variance)
+        """
+        keys = np.concatenate((self.keys, keys))
+        count = np.concatenate((self.count, count))
+        total = np.concatenate((self.total, total))
+        m2 = np.concatenate((self.m2, m2))
+        minimum = np.concatenate((self.minimum, minimum))
+        maximum = np.concatenate((self.maximum, maximum))
+
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        n = len(unique_keys)
+        if not n:
+            return
+        merged_count = np.bincount(inverse, weights=count, minlength=n)
+        merged_total = np.bincount(inverse, weights=total, minlength=n)
+        mean = merged_total / merged_count
+        deviation = (total / count) - mean[inverse]
+        merged_m2 = np.bincount(
+            inverse,
+            weights=m2 + count * deviation * deviation,
+            minlength=n
+        )
+        order = np.argsort(inverse, kind="mergesort")
+        starts = np.searchsorted(inverse[order], np.arange(n))
+
+        self.keys = unique_keys
+        self.count = merged_count
+        self.total = merged_total
+        self.m2 = merged_m2
+        self.minimum = np.minimum.reduceat(minimum[order], starts)
+        self.maximum = np.maximum.reduceat(maximum[order], starts)
+
+    def pop(self, before=None):
+        """
+            Remove and return the statistics for complete periods
+
+            @param before: return only periods before this one
+                           (default: all periods)
+            @return: tuple (place_ids, periods, statistics), statistics
+                     being a dict {function: array of values}
+        """
+        keys = self.keys
+        place_ids, periods = self.decode(keys)
+        if before is None:
+            complete = np.ones(len(keys), dtype=bool)
+        else:
+            complete = periods < before
+        count = self.count[complete]
+        total = self.total[complete]
+        m2 = self.m2[complete]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            stddev = np.where(count > 1, np.sqrt(m2 / (count - 1)), 0.0)
+        statistics = {
+            "MAX": self.maximum[complete],
+            "MIN": self.minimum[complete],
+            "AVG": total / count,
+            "STDDEV": stddev,
+            "SUM": total,
+            "COUNT": count,
+        }
+        result = (place_ids[complete], periods[complete], statistics)
+
+        remaining = ~complete
+        self.keys = keys[remaining]
+        self.count = self.count[remaining]
+        self.total = self.total[remaining]
+        self.m2 = self.m2[remaining]
+        self.minimum = self.minimum[remaining]
+        self.maximum = self.maximum[remaining]
+        return result
+
+class BulkReadings(object):
+    """
+        Bulk writer for readings of a sample table, with monthly and
+        yearly aggregation
+
+        Readings must be added in time order per place, i.e. once a
+        month has been flushed, no further readings for that month
+        can be added.
+    """
+    def __init__(self, sample_table, chunk_size=CHUNK_SIZE):
+        self.sample_table = sample_table
+        self.chunk_size = chunk_size
+        self.monthly = GroupedStatistics()
+        self.yearly = GroupedStatistics()
+        self.flushed_month = None
+
+    def add(self, place_ids, time_periods, month_numbers, values):
+        """
+            Add readings
+
+            @param place_ids: array of place IDs
+            @param time_periods: array of time periods (as in the sample
+                                 table, i.e. day or month numbers)
+            @param month_numbers: array of month numbers
+            @param values: array of (converted) values
+        """
+        if not len(values):
+            return
+        flushed_month = self.flushed_month
+        if flushed_month is not None and month_numbers.min() < flushed_month:
+            raise Exception(
+                "Readings for %s are not in time order" % self.sample_table
+            )
+        sample_table = self.sample_table
+        # Replace existing readings (re-import)
+        delete_rows(
+            sample_table.db,
+            sample_table.table_name,
+            ("place_id", "time_period"),
+            place_ids,
+            time_periods
+        )
+        copy_rows(
+            sample_table.db,
+            sample_table.table_name,
+            ("place_id", "time_period", "value"),
+            place_ids,
+            time_periods,
+            values,
+            chunk_size = self.chunk_size
+        )
+        self.monthly.add(place_ids, month_numbers, values)
+        self.yearly.add(
+            place_ids,
+            month_numbers_to_years(month_numbers),
+            values
+        )
+
+    def write_aggregates(self, period, key, statistics):
+        """
+            Write aggregates, replacing existing aggregates of the
+            same places and periods (re-import)
+
+            @param period: "monthly" or "yearly"
+            @param key: the period column ("month" or "year")
+            @param statistics: tuple (place_ids, periods, statistics)
+                               as returned from GroupedStatistics.pop
+        """
+        sample_table = self.sample_table
+        place_ids, periods, values = statistics
+        for function in AGGREGATIONS:
+            table_name = aggregate_table_name(sample_table, period, function)
+            delete_rows(
+                sample_table.db,
+                table_name,
+                ("place_id", key),
+                place_ids,
+                periods
+            )
+            copy_rows(
+                sample_table.db,
+                table_name,
+                ("place_id", key, "value"),
+                place_ids,
+                periods,
+                values[function],
+                chunk_size = self.chunk_size
+            )
+
+    def flush(self, before_month=None):
+        """
+            Write the aggregates of all complete months and years
+
+            @param before_month: the first month which is not yet
+                                 complete (default: all are complete)
+        """
+        if before_month is None:
+            before_year = None
+        else:
+            before_year = int(month_numbers_to_years(np.array([before_month]))[0])
+        self.write_aggregates("monthly", "month", self.monthly.pop(before_month))
+        self.write_aggregates("yearly", "year", self.yearly.pop(before_year))
+        if before_month is not None:
+            flushed_month = self.flushed_month
+            if flushed_month is None or before_month > flushed_month:
+                self.flushed_month = before_month
+
+    def done(self):
+        self.flush()
+        self.flushed_month = None
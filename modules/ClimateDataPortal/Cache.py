@@ -1,25 +1,46 @@
 
+"""
+    File cache for generated map images and overlay data
+
+    Generated files are kept in two folders, "recent" and "older":
+    - new and re-used files go into "recent"
+    - when "recent" exceeds half of the maximum cache size, its least
+      recently used files get moved to "older"
+    - when the total size exceeds the maximum, the least recently used
+      files in "older" get deleted
+
+    Access times are tracked as file modification times, and all sizes
+    are read from the file system while holding the cache lock, so
+    that multiple worker processes can share the same cache folder.
+
+    Concurrent requests for the same file are single-flight, i.e. the
+    file is generated only once while the other requests wait for it.
+
+    Configured with:
+        settings.climate.image_cache_folder
+        settings.climate.image_cache_size
+"""
+
 import errno
 import os
+import threading
+import zlib
+from contextlib import contextmanager
 from os.path import join, exists
-from os import stat, makedirs
 
-# create folder for cache:
-# mkdir -p /tmp/climate_data_portal/images/recent/
-# mkdir -p /tmp/climate_data_portal/images/older/
+try:
+    import fcntl
+except ImportError:
+    # No inter-process locking available (e.g. Windows)
+    fcntl = None
 
-MAX_CACHE_FOLDER_SIZE = 2**24 # 16 MiB
+from gluon import current
 
-class TwoStageCache(object):
-    def __init__(self, folder, max_size):
-        self.folder = folder
-        self.max_size
-    
-    def purge(self):
-        pass
-    
-    def retrieve(self, file_name, generate_if_not_found):
-        pass
+# Number of lock files for single-flight generation
+LOCK_STRIPES = 64
+
+# Prefix for files which are still being generated
+TEMP_PREFIX = ".tmp-"
 
 def mkdir_p(path):
     try:
@@ -29,43 +50,211 @@ def mkdir_p(path):
             pass
         else: raise
 
-def get_cached_or_generated_file(cache_file_name, generate):
-    # this needs to become a setting
-    climate_data_image_cache_path = join(
-        "/tmp","climate_data_portal","images"
-    )
-    recent_cache = join(climate_data_image_cache_path, "recent")
-    mkdir_p(recent_cache)
-    older_cache = join(climate_data_image_cache_path, "older")
-    mkdir_p(older_cache)
-    recent_cache_path = join(recent_cache, cache_file_name)
-    if not exists(recent_cache_path):
-        older_cache_path = join(older_cache, cache_file_name)
-        if exists(older_cache_path):
-            # move the older cache to the recent folder
-            rename(older_cache_path, recent_cache_path)
-        else:
-            generate(recent_cache_path)
-        file_path = recent_cache_path
-            
-        # update the folder size file (race condition?)
-        folder_size_file_path = join(climate_data_image_cache_path, "size")
-        folder_size_file = open(folder_size_file_path, "w+")
-        folder_size_file_contents = folder_size_file.read()
+class TwoStageCache(object):
+    """ Size-bounded two-stage (recent/older) file cache """
+
+    def __init__(self, folder, max_size):
+        """
+            @param folder: the cache folder
+            @param max_size: the maximum total size of all cached
+                             files (in bytes)
+        """
+
+        self.folder = folder
+        self.max_size = max_size
+
+        self.recent = join(folder, "recent")
+        self.older = join(folder, "older")
+        self.locks = join(folder, "locks")
+        for path in (self.recent, self.older, self.locks):
+            mkdir_p(path)
+
+        # Thread locks (file locks do not exclude threads everywhere)
+        lock_names = ["cache.lock"]
+        lock_names.extend("%s.lock" % i for i in xrange(LOCK_STRIPES))
+        self.thread_locks = dict((name, threading.Lock())
+                                 for name in lock_names)
+
+    @contextmanager
+    def locked(self, lock_name):
+        """
+            Context manager to hold a lock across threads and processes
+
+            @param lock_name: the name of the lock file
+        """
+
+        with self.thread_locks[lock_name]:
+            if fcntl is None:
+                yield
+            else:
+                lock_file = open(join(self.locks, lock_name), "a")
+                try:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                    yield
+                finally:
+                    # Closing the file releases the lock
+                    lock_file.close()
+
+    @staticmethod
+    def touch(file_path):
+        """ Mark a file as recently used """
+
         try:
-            folder_size = int(folder_size_file_contents)
-        except ValueError:
-            folder_size = 0
-        folder_size_file.seek(0)
-        folder_size_file.truncate()
-        folder_size += stat(file_path).st_size
-        if folder_size > MAX_CACHE_FOLDER_SIZE:
-            rmdir(older_cache)
-
-        folder_size_file.write(str(folder_size))
-        folder_size_file.close()
-    else:
-        # use the existing cached image
-        file_path = recent_cache_path
-    return file_path
+            os.utime(file_path, None)
+        except OSError:
+            # Evicted in the meantime
+            pass
+
+    @staticmethod
+    def scan(folder):
+        """
+            Get all cached files in a folder
+
+            @param folder: the folder
+            @return: list of tuples (mtime, size, file_name)
+        """
+
+        files = []
+        for file_name in os.listdir(folder):
+            if file_name.startswith(TEMP_PREFIX):
+                continue
+            try:
+                info = os.stat(join(folder, file_name))
+            except OSError:
+                # Removed in the meantime
+                continue
+            files.append((info.st_mtime, info.st_size, file_name))
+        return files
+
+    def purge(self):
+        """
+            Demote and evict least recently used files until both
+            stages are within their size limits
+
+            @return: the total size of the cache after purging
+        """
+
+        max_size = self.max_size
+        recent_limit = max_size // 2
+
+        with self.locked("cache.lock"):
+            recent = self.scan(self.recent)
+            older = self.scan(self.older)
+            recent_size = sum(item[1] for item in recent)
+            older_size = sum(item[1] for item in older)
+
+            if recent_size > recent_limit:
+                # Move the least recently used files to "older"
+                recent.sort()
+                for item in recent:
+                    if recent_size <= recent_limit:
+                        break
+                    mtime, size, file_name = item
+                    try:
+                        os.rename(join(self.recent, file_name),
+                                  join(self.older, file_name))
+                    except OSError:
+                        continue
+                    recent_size -= size
+                    older_size += size
+                    older.append(item)
+
+            if recent_size + older_size > max_size:
+                # Delete the least recently used files from "older"
+                older.sort()
+                for mtime, size, file_name in older:
+                    if recent_size + older_size <= max_size:
+                        break
+                    try:
+                        os.unlink(join(self.older, file_name))
+                    except OSError:
+                        continue
+                    older_size -= size
+
+        return recent_size + older_size
+
+    def clear(self):
+        """
+            Remove all cached files, e.g. when readings have been
+            imported (generated files depend on the readings)
+        """
+
+        with self.locked("cache.lock"):
+            for folder in (self.recent, self.older):
+                for mtime, size, file_name in self.scan(folder):
+                    try:
+                        os.unlink(join(folder, file_name))
+                    except OSError:
+                        # Removed in the meantime
+                        pass
+
+    def retrieve(self, file_name, generate_if_not_found):
+        """
+            Get the path of a cached file, generating it if necessary
+
+            @param file_name: the file name (cache key)
+            @param generate_if_not_found: function to generate the file,
+                                          called with the file path
+            @return: the path of the file
+        """
+
+        recent_path = join(self.recent, file_name)
+        if exists(recent_path):
+            self.touch(recent_path)
+            return recent_path
+
+        stripe = (zlib.crc32(file_name) & 0xffffffff) % LOCK_STRIPES
+        generated = False
+        with self.locked("%s.lock" % stripe):
+            if exists(recent_path):
+                # Generated by a concurrent request
+                self.touch(recent_path)
+                return recent_path
+            try:
+                # Promote from "older"
+                os.rename(join(self.older, file_name), recent_path)
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+                # Generate into a temporary file, so that other requests
+                # never see an incomplete file
+                temp_path = join(self.recent, "%s%s-%s-%s" % (
+                    TEMP_PREFIX,
+                    os.getpid(),
+                    threading.current_thread().ident,
+                    file_name
+                ))
+                try:
+                    generate_if_not_found(temp_path)
+                except:
+                    if exists(temp_path):
+                        os.unlink(temp_path)
+                    raise
+                if exists(temp_path):
+                    os.rename(temp_path, recent_path)
+                    generated = True
+            else:
+                self.touch(recent_path)
+
+        if generated:
+            self.purge()
+        return recent_path
+
+# Cache instances per (folder, max_size)
+caches = {}
+
+def get_cache():
+    settings = current.deployment_settings
+    folder = settings.get_climate_image_cache_folder()
+    max_size = settings.get_climate_image_cache_size()
+    key = (folder, max_size)
+    cache = caches.get(key)
+    if cache is None:
+        cache = caches[key] = TwoStageCache(folder, max_size)
+    return cache
+
+def get_cached_or_generated_file(cache_file_name, generate):
+    return get_cache().retrieve(cache_file_name, generate)
 
+def clear_cache():
+    get_cache().clear()
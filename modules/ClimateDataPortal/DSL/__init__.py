@@ -436,3 +436,86 @@ from CodeGeneration import (
 )
 from GridSizing import grid_sizes
 import Stringification
+
+# Query plans
+import threading
+from collections import OrderedDict
+
+# Maximum number of plans in the plan cache
+PLAN_CACHE_SIZE = 256
+# Maximum number of generated codes per plan (e.g. for different places)
+PLAN_CODE_CACHE_SIZE = 32
+
+class Plan(object):
+    """A parsed, checked and built expression, with its units and the
+    code generated for it.
+
+    Plans only depend on the expression, not on the readings, so they
+    remain valid when readings get imported (results are cached
+    separately, see Cache.py).
+    """
+    def __init__(plan, expression):
+        plan.expression = expression
+        plan.understood_expression = str(expression)
+        plan.units = units(expression)
+        plan._grid_size = None
+        plan._analysis = None
+        plan._code = {}
+        plan._lock = threading.Lock()
+
+    def analysis(plan):
+        "Explanation why the units are meaningless"
+        if plan._analysis is None:
+            analysis_strings = []
+            def analysis_out(*things):
+                analysis_strings.append("".join(map(str, things)))
+            analysis(plan.expression, analysis_out)
+            plan._analysis = "\n".join(analysis_strings)
+        return plan._analysis
+
+    def grid_size(plan):
+        if plan._grid_size is None:
+            plan._grid_size = min(grid_sizes(plan.expression))
+        return plan._grid_size
+
+    def R_Code_for_values(plan, attribute, extra_filter = None):
+        "Memoised R code (including the SQL) for the given parameters"
+        key = (attribute, extra_filter)
+        with plan._lock:
+            try:
+                code = plan._code[key]
+            except KeyError:
+                if len(plan._code) >= PLAN_CODE_CACHE_SIZE:
+                    plan._code.clear()
+                code = plan._code[key] = R_Code_for_values(
+                    plan.expression,
+                    attribute,
+                    extra_filter
+                )
+        return code
+
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+
+def plan(expression_string):
+    """Get the plan for an expression, from the plan cache if possible.
+
+    Parsing, checking and building the expression only happens once per
+    process for the same expression, e.g. when the map gets panned.
+    Syntax and type errors are raised as by parse(), and not cached.
+    """
+    key = expression_string.strip()
+    with _plans_lock:
+        query_plan = _plans.pop(key, None)
+        if query_plan is not None:
+            # Re-insert as most recently used
+            _plans[key] = query_plan
+            return query_plan
+
+    query_plan = Plan(parse(expression_string))
+
+    with _plans_lock:
+        _plans[key] = query_plan
+        while len(_plans) > PLAN_CACHE_SIZE:
+            _plans.popitem(last=False)
+    return query_plan
@@ -119,21 +119,15 @@ S3.gis.maps['%s'].registerPlugin(plugin);''' % map.id)
     def get_overlay_data(self, query_expression):
         env = self.env
         DSL = env.DSL
-        expression = DSL.parse(query_expression)
-        understood_expression_string = str(expression)
-        units = DSL.units(expression)
+        plan = DSL.plan(query_expression)
+        understood_expression_string = plan.understood_expression
+        units = plan.units
         if units is None:
-            analysis_strings = []
-            def analysis_out(*things):
-                analysis_strings.append("".join(map(str, things)))
-            DSL.analysis(expression, analysis_out)
-            raise MeaninglessUnitsException(
-                "\n".join(analysis_strings)
-            )
+            raise MeaninglessUnitsException(plan.analysis())
 
         def generate_map_overlay_data(file_path):
             R = self.R
-            code = DSL.R_Code_for_values(expression, "place_id")
+            code = plan.R_Code_for_values("place_id")
             values_by_place_data_frame = R(code)()
             # R willfully removes empty data frame columns
             # which is ridiculous behaviour
@@ -161,7 +155,7 @@ S3.gis.maps['%s'].registerPlugin(plugin);''' % map.id)
                     )
                 )
                 write('"units":"%s",' % units)
-                write('"grid_size":%f,' % min(grid_sizes(expression)))
+                write('"grid_size":%f,' % plan.grid_size())
 
                 write('"keys":[')
                 write(",".join(map(str, keys)))
@@ -194,21 +188,15 @@ S3.gis.maps['%s'].registerPlugin(plugin);''' % map.id)
     def get_csv_location_data(self, query_expression):
         env = self.env
         DSL = env.DSL
-        expression = DSL.parse(query_expression)
-        understood_expression_string = str(expression)
-        units = DSL.units(expression)
+        plan = DSL.plan(query_expression)
+        understood_expression_string = plan.understood_expression
+        units = plan.units
         if units is None:
-            analysis_strings = []
-            def analysis_out(*things):
-                analysis_strings.append("".join(map(str, things)))
-            DSL.analysis(expression, analysis_out)
-            raise MeaninglessUnitsException(
-                "\n".join(analysis_strings)
-            )
+            raise MeaninglessUnitsException(plan.analysis())
 
         def generate_map_csv_data(file_path):
             R = self.R
-            code = DSL.R_Code_for_values(expression, "place_id")
+            code = plan.R_Code_for_values("place_id")
             values_by_place_data_frame = R(code)()
             # R willfully removes empty data frame columns
             # which is ridiculous behaviour
@@ -314,19 +302,13 @@ S3.gis.maps['%s'].registerPlugin(plugin);''' % map.id)
             yearly = []
             for label, spec in specs:
                 query_expression = spec["query_expression"]
-                expression = DSL.parse(query_expression)
-                understood_expression_string = str(expression)
+                plan = DSL.plan(query_expression)
+                understood_expression_string = plan.understood_expression
                 spec_names.append(label)
-                units = DSL.units(expression)
+                units = plan.units
                 unit_string = str(units)
                 if units is None:
-                    analysis_strings = []
-                    def analysis_out(*things):
-                        analysis_strings.append("".join(map(str, things)))
-                    DSL.analysis(expression, analysis_out)
-                    raise MeaninglessUnitsException(
-                        "\n".join(analysis_strings)
-                    )
+                    raise MeaninglessUnitsException(plan.analysis())
                 is_yearly_values = "Months(" in query_expression
                 yearly.append(is_yearly_values)
                 if is_yearly_values:
@@ -337,8 +319,7 @@ S3.gis.maps['%s'].registerPlugin(plugin);''' % map.id)
                         grouping_key = "(time_period - ((time_period + 1000008 + %i) %% 12))" % start_month_0_indexed
                 else:
                     grouping_key = "time_period"
-                code = DSL.R_Code_for_values(
-                    expression,
+                code = plan.R_Code_for_values(
                     grouping_key,
                     "place_id IN (%s)" % ",".join(map(str, spec["place_ids"]))
                 )
@@ -33,6 +33,7 @@ ClimateDataPortal = local_import("ClimateDataPortal")
 InsertChunksWithoutCheckingForExistingReadings = local_import(
     "ClimateDataPortal.InsertChunksWithoutCheckingForExistingReadings"
 ).InsertChunksWithoutCheckingForExistingReadings
+BulkImport = local_import("ClimateDataPortal.BulkImport")
 
 def get_or_create(dict, key, creator):
     try:
@@ -213,16 +214,7 @@ def import_climate_readings(
                         )] = record
                         #print longitude, latitude, record
 
-            #print "up to:", len(times)
-            print "place_id, time_period, value"
-            for time_index, time_step_count in iter_pairs(times):
-                sys.stderr.write(
-                    "%s %s\n" % (
-                        time_index,
-                        "%i%%" % int((time_index * 100) / len(times))
-                    )
-                )
-                #print time_period
+            def to_month_number(time_step_count):
                 if month_mapping_string == "twelfths":
                     year_offset = ((time_step * int(time_step_count)).days) / 360.0
                     month_number = int(
@@ -234,6 +226,31 @@ def import_climate_readings(
                     time_period = start_date_time + (time_step * int(time_step_count))
                     month_number = month_mapping(time_period)
                     #print month_number, time_period
+                return month_number
+
+            if isinstance(add_reading, BulkImport.BulkReadings):
+                import_climate_readings_bulk(
+                    tt,
+                    lat,
+                    lon,
+                    place_ids,
+                    map(to_month_number, times),
+                    add_reading,
+                    converter
+                )
+                return
+
+            #print "up to:", len(times)
+            print "place_id, time_period, value"
+            for time_index, time_step_count in iter_pairs(times):
+                sys.stderr.write(
+                    "%s %s\n" % (
+                        time_index,
+                        "%i%%" % int((time_index * 100) / len(times))
+                    )
+                )
+                #print time_period
+                month_number = to_month_number(time_step_count)
                 values_by_time = tt[time_index]
                 if len(tt[time_index]) == 1:
                     values_by_time = values_by_time[0]
@@ -252,6 +269,59 @@ def import_climate_readings(
         add_reading.done()
         db.commit()
 
+def import_climate_readings_bulk(
+    variable,
+    lat,
+    lon,
+    place_ids,
+    month_numbers,
+    bulk_readings,
+    converter,
+    time_chunk_size = 12
+):
+    """
+    Imports the readings from a NetCDF variable as arrays, a chunk of
+    time steps at a time, and computes monthly and yearly aggregates.
+
+    Assumptions:
+        * the time steps are in time order
+    """
+    import numpy as np
+
+    # Grid of place IDs, in the same order as the values
+    place_grid = np.array([
+        [place_ids[(round(latitude, 6), round(longitude, 6))] for longitude in lon]
+        for latitude in lat
+    ], dtype=np.int64).ravel()
+    cells = len(place_grid)
+
+    month_numbers = np.array(month_numbers, dtype=np.int64)
+    time_count = len(month_numbers)
+    for start in range(0, time_count, time_chunk_size):
+        end = min(start + time_chunk_size, time_count)
+        sys.stderr.write(
+            "%s %s\n" % (start, "%i%%" % int((start * 100) / time_count))
+        )
+        values = np.asarray(variable[start:end], dtype=np.float64)
+        # Drop a single level dimension, if any
+        values = values.reshape(end - start, cells).ravel()
+        chunk_month_numbers = np.repeat(month_numbers[start:end], cells)
+        chunk_place_ids = np.tile(place_grid, end - start)
+
+        defined = ~BulkImport.is_undefined(values)
+        chunk_month_numbers = chunk_month_numbers[defined]
+        bulk_readings.add(
+            chunk_place_ids[defined],
+            chunk_month_numbers,
+            chunk_month_numbers,
+            converter(values[defined])
+        )
+        if end < time_count:
+            # All months before the next time step are complete
+            bulk_readings.flush(before_month = int(month_numbers[end]))
+    bulk_readings.done()
+    db.commit()
+
 import sys
 
 from Scientific.IO import NetCDF
@@ -261,6 +331,7 @@ def main(argv):
     import os
     styles = {
         "quickly": InsertChunksWithoutCheckingForExistingReadings,
+        "bulk": BulkImport.BulkReadings,
     #    "safely": InsertRowsIfNoConflict
     }
 
@@ -299,6 +370,8 @@ python ./run.py %(prog)s --field_name rr --style quickly --parameter_name "Gridd
         default = "safely",
         help="""
             quickly: just insert readings into the database
+            bulk: copy readings into the database in chunks, and compute
+                  monthly and yearly aggregates
             safely: check that data is not overwritten
         """
     )
@@ -352,6 +425,8 @@ python ./run.py %(prog)s --field_name rr --style quickly --parameter_name "Gridd
     args = parser.parse_args(argv[1:])
     sample_table = ClimateDataPortal.SampleTable.with_name(args.parameter_name)
     sample_table.clear()
+    if args.style == "bulk":
+        BulkImport.create_aggregate_tables(sample_table, replace=True)
     db.commit()       
     
     import_climate_readings(
@@ -365,6 +440,9 @@ python ./run.py %(prog)s --field_name rr --style quickly --parameter_name "Gridd
         skip_places = args.skip_places
     )
 
+    # Cached results depend on the readings
+    local_import("ClimateDataPortal.Cache").clear_cache()
+
 if __name__ == "__main__":
     import sys
     sys.exit(main(sys.argv))
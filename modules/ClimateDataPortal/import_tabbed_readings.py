@@ -83,7 +83,8 @@ def import_tabbed_readings(
     fields,
     clear_existing_data,
     separator,
-    missing_data_marker
+    missing_data_marker,
+    bulk = False
 ):
     """
     Expects a folder containing files with name rtXXXX.txt
@@ -92,6 +93,9 @@ def import_tabbed_readings(
 1978\t1\t1\t0\t-99.9\t-99.9
 
 representing year, month, day, rainfall(mm), minimum and maximum temperature
+
+    With bulk=True, files are loaded as arrays, readings are copied into
+    the database in chunks, and monthly and yearly aggregates are computed.
     """
     import os
     assert os.path.isdir(folder), "%s is not a folder!" % folder
@@ -115,6 +119,8 @@ representing year, month, day, rainfall(mm), minimum and maximum temperature
         )
     date_format = {}
     field_positions = []
+    if bulk:
+        BulkImport = local_import("ClimateDataPortal.BulkImport")
     
     for field, position in zip(fields, range(len(fields))):
         sys.stderr.write( field)
@@ -136,9 +142,18 @@ representing year, month, day, rainfall(mm), minimum and maximum temperature
                     if clear_existing_data:
                         sys.stderr.write( "Clearing "+sample_table._tablename+"\n")
                         db(sample_table.id > 0).delete()    
-                    field_positions.append(
-                        (readings_lambda(sample_table), position)
-                    )
+                    if bulk:
+                        BulkImport.create_aggregate_tables(
+                            sample_table,
+                            replace = bool(clear_existing_data)
+                        )
+                        field_positions.append(
+                            (BulkImport.BulkReadings(sample_table), position)
+                        )
+                    else:
+                        field_positions.append(
+                            (readings_lambda(sample_table), position)
+                        )
     
     for field in ("year", "month", "day"):
         assert field+"_pos" in date_format, "%s is not specified in --fields" % field
@@ -165,6 +180,15 @@ representing year, month, day, rainfall(mm), minimum and maximum temperature
             )
             if not os.path.exists(data_file_path):
                 sys.stderr.write( "%s not found\n" % data_file_path)
+            elif bulk:
+                import_data_in_file_bulk(
+                    data_file_path,
+                    tuple(field_positions),
+                    separator,
+                    missing_data_marker,
+                    station.id,
+                    **date_format
+                )
             else:
                 variable_positions = []
                 for field, position in field_positions:
@@ -245,6 +269,80 @@ def import_data_in_file(
         sys.stderr.write( line+"\n")
         raise
 
+def import_data_in_file_bulk(
+    data_file_path,
+    bulk_positions,
+    separator,
+    missing_data_marker,
+    place_id,
+    year_pos,
+    month_pos,
+    day_pos,
+):
+    import numpy as np
+
+    columns = sorted(set(
+        [year_pos, month_pos, day_pos] +
+        [position for bulk_readings, position in bulk_positions]
+    ))
+    data = np.atleast_2d(np.genfromtxt(
+        data_file_path,
+        delimiter = separator,
+        usecols = columns,
+        dtype = np.float64,
+        invalid_raise = False
+    ))
+    column = dict(
+        (position, data[:, index]) for index, position in enumerate(columns)
+    )
+    years = column[year_pos]
+    months = column[month_pos]
+    days = column[day_pos]
+    rows = ~(np.isnan(years) | np.isnan(months) | np.isnan(days))
+    years = years[rows].astype(np.int64)
+    months = months[rows].astype(np.int64)
+    days = days[rows].astype(np.int64)
+
+    # Skip duplicate records for the same day (as import_data_in_file)
+    duplicate = np.zeros(len(years), dtype=bool)
+    duplicate[1:] = (
+        (years[1:] == years[:-1]) &
+        (months[1:] == months[:-1]) &
+        (days[1:] == days[:-1])
+    )
+    if duplicate.any():
+        sys.stderr.write(
+            "%s: %i duplicate records\n" % (data_file_path, duplicate.sum())
+        )
+    unique = ~duplicate
+    years = years[unique]
+    months = months[unique]
+    days = days[unique]
+
+    dates = (
+        (years - 1970).astype("datetime64[Y]") +
+        (months - 1).astype("timedelta64[M]")
+    ).astype("datetime64[D]") + (days - 1).astype("timedelta64[D]")
+    day_numbers = (
+        dates - np.datetime64(ClimateDataPortal.start_date.isoformat())
+    ).astype(np.int64)
+    month_numbers = (
+        ((years - ClimateDataPortal.start_year) * 12) +
+        (months - 1) - ClimateDataPortal.start_month_0_indexed
+    )
+
+    marker = float(missing_data_marker)
+    for bulk_readings, position in bulk_positions:
+        values = column[position][rows][unique]
+        defined = ~np.isnan(values) & (values != marker)
+        bulk_readings.add(
+            np.repeat(place_id, defined.sum()),
+            day_numbers[defined],
+            month_numbers[defined],
+            values[defined]
+        )
+        bulk_readings.done()
+
 def main(argv):
     import argparse
     import os
@@ -348,6 +446,13 @@ Examples: *(IN ROOT OF APP FOLDER)*
         Interpret this as missing data and do not import anything for that date.
         """
     )
+    parser.add_argument(
+        "--bulk",
+        action = "store_true",
+        help = """Load the files as arrays and copy the readings into the
+        database in chunks, computing monthly and yearly aggregates.
+        """
+    )
     parser.add_argument(
         "--fields",
         required = True,
@@ -368,6 +473,9 @@ Examples: *(IN ROOT OF APP FOLDER)*
 
     import_tabbed_readings(**kwargs)
 
+    # Cached results depend on the readings
+    local_import("ClimateDataPortal.Cache").clear_cache()
+
 if __name__ == "__main__":
     import sys
     sys.exit(main(sys.argv))
@@ -5471,6 +5471,9 @@ class S3Permission(object):
 
     TABLENAME = "s3_permission"
 
+    # Maximum lifetime of ACLs cached across requests (seconds)
+    CACHE_EXPIRY = 3600
+
     CREATE = 0x0001     # Permission to create new records
     READ = 0x0002       # Permission to read records
     UPDATE = 0x0004     # Permission to update records
@@ -5568,6 +5571,13 @@ class S3Permission(object):
         else:
             self.table = None
 
+        # Revision counter for the permissions table
+        version_tablename = "%s_version" % self.tablename
+        if version_tablename in db:
+            self.version_table = db[version_tablename]
+        else:
+            self.version_table = None
+
         # Error messages
         T = current.T
         self.INSUFFICIENT_PRIVILEGES = T("Insufficient Privileges")
@@ -5609,6 +5619,87 @@ class S3Permission(object):
         self.permission_cache = {}
         self.query_cache = {}
 
+        # Re-check the ACL version before using ACLs cached across requests
+        self.version = None
+
+    # -------------------------------------------------------------------------
+    def get_version(self):
+        """
+            Get the current version of the ACLs; changes whenever
+            s3_permission is updated (from any process), and thus
+            invalidates all ACLs cached across requests
+
+            - combines the revision counter (incremented upon every write
+              through the DAL) with an aggregate of the table (row count,
+              latest modification and sums of the ACLs), to also detect
+              changes written otherwise
+
+            @return: the version (string), or None if there is
+                     no permissions table
+        """
+
+        version = self.version
+        if version is None:
+            table = self.table
+            if table is None:
+                return None
+            count = table.id.count()
+            modified_on = table.modified_on.max()
+            uacl = table.uacl.sum()
+            oacl = table.oacl.sum()
+            db = current.db
+            row = db(table.id > 0).select(count,
+                                          modified_on,
+                                          uacl,
+                                          oacl,
+                                          ).first()
+            vtable = self.version_table
+            if vtable is not None:
+                # Sum, in case concurrent processes have inserted
+                # more than one counter
+                revision = vtable.revision.sum()
+                revision = db(vtable.id > 0).select(revision).first()[revision]
+            else:
+                revision = None
+            version = self.version = "%s/%s/%s/%s/%s" % (revision,
+                                                         row[count],
+                                                         row[modified_on],
+                                                         row[uacl],
+                                                         row[oacl],
+                                                         )
+        return version
+
+    # -------------------------------------------------------------------------
+    def cached(self, key, lookup):
+        """
+            Cache the result of a lookup in s3_permission across requests,
+            re-using it for as long as the ACLs do not change
+
+            @param key: the cache key (string)
+            @param lookup: the lookup function, must return a cacheable
+                           result (e.g. Rows with cacheable=True)
+
+            @return: the result of the lookup
+        """
+
+        version = self.get_version()
+        if version is None:
+            return lookup()
+
+        cache = current.cache.ram
+        key = "s3_permission_%s_%s" % (self.policy, key)
+        lookup_version = lambda: (version, lookup())
+
+        cached_version, result = cache(key, lookup_version,
+                                       time_expire = self.CACHE_EXPIRY,
+                                       )
+        if cached_version != version:
+            # ACLs have changed => refresh
+            cached_version, result = cache(key, lookup_version,
+                                           time_expire = 0,
+                                           )
+        return result
+
     # -------------------------------------------------------------------------
     def check_settings(self):
         """
@@ -5662,7 +5753,24 @@ class S3Permission(object):
                             migrate=migrate,
                             fake_migrate=fake_migrate,
                             *(s3_uid()+s3_timestamp()+s3_deletion_status()))
-            self.table = db[self.tablename]
+            self.table = table = db[self.tablename]
+
+            # Revision counter, incremented upon every write to the
+            # permissions table (see get_version)
+            vtable = db.define_table("%s_version" % self.tablename,
+                                     Field("revision", "integer",
+                                           default=0),
+                                     migrate=migrate,
+                                     fake_migrate=fake_migrate,
+                                     )
+            self.version_table = vtable
+
+            def increment(*args):
+                if not db(vtable.id > 0).update(revision=vtable.revision + 1):
+                    vtable.insert(revision=1)
+            table._after_insert.append(increment)
+            table._after_update.append(increment)
+            table._after_delete.append(increment)
 
     # -------------------------------------------------------------------------
     # ACL Management
@@ -6816,18 +6924,26 @@ class S3Permission(object):
         else:
             table_restricted = False
 
-        # Retrieve the ACLs
+        # Retrieve the ACLs (cached across requests, per role set and
+        # page/table, as long as the ACLs do not change)
         if q is not None:
             query &= q
-            rows = db(query).select(table.group_id,
-                                    table.controller,
-                                    table.function,
-                                    table.tablename,
-                                    table.unrestricted,
-                                    table.entity,
-                                    table.uacl,
-                                    table.oacl,
-                                    cacheable=True)
+            key = "acls_%s_%s_%s_%s" % (",".join(str(role)
+                                                 for role in sorted(roles)),
+                                        c if page_restricted else "",
+                                        f if page_restricted and self.use_facls else "",
+                                        t if t and self.use_tacls else "",
+                                        )
+            rows = self.cached(key,
+                               lambda: db(query).select(table.group_id,
+                                                        table.controller,
+                                                        table.function,
+                                                        table.tablename,
+                                                        table.unrestricted,
+                                                        table.entity,
+                                                        table.uacl,
+                                                        table.oacl,
+                                                        cacheable=True))
         else:
             rows = []
 
@@ -7079,9 +7195,10 @@ class S3Permission(object):
             query = (table.deleted != True) & \
                     (table.controller == None) & \
                     (table.function == None)
-            rows = current.db(query).select(table.tablename,
-                                            groupby=table.tablename)
-            s3.restricted_tables = [row.tablename for row in rows]
+            lookup = lambda: [row.tablename
+                              for row in current.db(query).select(table.tablename,
+                                                                  groupby=table.tablename)]
+            s3.restricted_tables = self.cached("restricted_tables", lookup)
 
         return str(t) in s3.restricted_tables
 
@@ -53,6 +53,7 @@ class S3Codec(object):
     def get_codec(format):
 
         # Import the codec classes
+        from s3codecs import S3MVT
         from s3codecs import S3SHP
         from s3codecs import S3SVG
         from s3codecs import S3XLS
@@ -60,6 +61,7 @@ class S3Codec(object):
 
         # Register the codec classes
         CODECS = Storage(
+            mvt = S3MVT,
             pdf = S3RL_PDF,
             shp = S3SHP,
             svg = S3SVG,
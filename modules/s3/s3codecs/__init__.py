@@ -28,6 +28,7 @@
 
 """
 
+from mvt import *
 from pdf import *
 from shp import *
 from svg import *
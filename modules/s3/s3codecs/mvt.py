@@ -0,0 +1,987 @@
+# -*- coding: utf-8 -*-
+
+"""
+    S3 Mapbox Vector Tile codec
+
+    @copyright: 2017 (c) Sahana Software Foundation
+    @license: MIT
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation
+    files (the "Software"), to deal in the Software without
+    restriction, including without limitation the rights to use,
+    copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the
+    Software is furnished to do so, subject to the following
+    conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+    OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+    HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+    WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+    OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__all__ = ("S3MVT",
+           "S3VectorTile",
+           )
+
+import json
+import math
+import struct
+
+from gluon import current, HTTP
+from gluon.languages import lazyT
+from gluon.storage import Storage
+
+from ..s3codec import S3Codec
+from ..s3utils import s3_unicode
+
+# Radius of the Web Mercator sphere (EPSG:3857)
+EARTH_RADIUS = 6378137.0
+
+# Maximum latitude of the Web Mercator projection
+MAX_LATITUDE = 85.0511287798
+
+# Geometry types
+UNKNOWN = 0
+POINT = 1
+LINESTRING = 2
+POLYGON = 3
+
+# Geometry commands
+MOVE_TO = 1
+LINE_TO = 2
+CLOSE_PATH = 7
+
+# Protobuf wire types
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+
+# =============================================================================
+class S3MVT(S3Codec):
+    """
+        Mapbox Vector Tile codec, encodes the features of a resource
+        within a tile as Mapbox Vector Tile (version 2)
+
+        URL: /{controller}/{function}.mvt?z={z}&x={x}&y={y}
+
+        - the tile contains the features of all records matching the
+          resource filter (incl. URL filters), with the same attributes
+          and markers as the GeoJSON export for feature layers (i.e. as
+          configured in gis_layer_feature, or from the "attr", "popup"
+          and "markers" URL parameters)
+        - geometries are clipped, simplified and quantised to the tile
+          grid (in PostGIS with ST_AsMVTGeom where available, otherwise
+          in Python, which requires Shapely for lines and polygons)
+        - the number of features per tile is limited separately from
+          GeoJSON exports (settings.gis.mvt_max_features) - tiles with
+          more features contain only the first features in ID order,
+          so that over-full tiles degrade rather than fail - and tiles
+          below a minimum zoom level (settings.gis.mvt_min_zoom) are
+          returned empty
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self):
+        """
+            Constructor
+        """
+
+        pass
+
+    # -------------------------------------------------------------------------
+    def encode(self, resource, **attr):
+        """
+            Encode the features of a resource within a tile
+
+            @param resource: the S3Resource
+            @param attr: dictionary of parameters:
+                 * tile:           the tile coordinates (z, x, y),
+                                   default from the URL parameters
+                 * attr_fields:    list of attribute field selectors,
+                                   default from the URL parameters or
+                                   the feature layer configuration
+
+            @return: the tile (as string)
+        """
+
+        get_vars = current.request.get_vars
+
+        tile = attr.get("tile")
+        if not tile:
+            try:
+                tile = [int(get_vars[k]) for k in ("z", "x", "y")]
+            except (KeyError, TypeError, ValueError):
+                raise HTTP(400, body="Invalid tile coordinates")
+        try:
+            tile = S3VectorTile(*tile)
+        except ValueError:
+            raise HTTP(400, body="Invalid tile coordinates")
+
+        response = current.response
+        if response:
+            response.headers["Content-Type"] = "application/vnd.mapbox-vector-tile"
+
+        settings = current.deployment_settings
+        if tile.z < settings.get_gis_mvt_min_zoom():
+            # Layer not shown at this zoom level
+            return tile.encode()
+
+        # Look up the features in the tile
+        features = tile.features(resource,
+                                 limit = settings.get_gis_mvt_max_features(),
+                                 )
+
+        # Look up the attributes and markers for these features
+        record_ids = set(record_id for record_id, geometry in features)
+        attributes = self.attributes(resource,
+                                     record_ids,
+                                     attr_fields = attr.get("attr_fields"),
+                                     )
+        markers = self.markers(resource, record_ids)
+
+        # Encode the tile
+        layer = resource.tablename
+        for record_id, geometry in features:
+            properties = attributes.get(record_id)
+            if markers:
+                properties = dict(properties) if properties else {}
+                properties.update(markers.get(record_id, ()))
+            tile.add(layer, record_id, geometry, properties)
+
+        return tile.encode()
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def attributes(resource, record_ids, attr_fields=None):
+        """
+            Look up the feature attributes (same as for GeoJSON exports,
+            see GIS.get_location_data)
+
+            @param resource: the S3Resource
+            @param record_ids: the record IDs
+            @param attr_fields: list of attribute field selectors
+
+            @return: dict {record_id: {fieldname: value}}
+        """
+
+        if not record_ids:
+            return {}
+
+        db = current.db
+        get_vars = current.request.get_vars
+
+        # Which attributes to include?
+        if attr_fields is None:
+            attr_fields = get_vars.get("attr")
+            attr_fields = attr_fields.split(",") if attr_fields else []
+            popup_fields = get_vars.get("popup")
+            popup_fields = popup_fields.split(",") if popup_fields else []
+            if not attr_fields and not popup_fields:
+                ftable = current.s3db.gis_layer_feature
+                layer_id = get_vars.get("layer")
+                if layer_id:
+                    query = (ftable.layer_id == layer_id)
+                else:
+                    request = current.request
+                    query = (ftable.controller == request.controller) & \
+                            (ftable.function == request.function) & \
+                            (ftable.style_default != False)
+                layer = db(query).select(ftable.attr_fields,
+                                         ftable.popup_fields,
+                                         limitby = (0, 1),
+                                         ).first()
+                if layer:
+                    attr_fields = layer.attr_fields or []
+                    popup_fields = layer.popup_fields or []
+            attr_fields = list(set(popup_fields + attr_fields))
+        if not attr_fields:
+            return {}
+
+        table = resource.table
+        pkey = table._id.name
+
+        fields = list(attr_fields)
+        if pkey not in fields:
+            fields.insert(0, pkey)
+
+        # Look up the attributes only for the features in the tile
+        resource.add_filter(table._id.belongs(record_ids))
+        data = resource.select(fields,
+                               limit = None,
+                               raw_data = True,
+                               represent = True,
+                               show_links = False,
+                               )
+
+        attr_cols = {}
+        for rfield in data["rfields"]:
+            if rfield.fname in attr_fields or rfield.selector in attr_fields:
+                attr_cols[rfield.colname] = (rfield.ftype, rfield.fname)
+
+        NONE = current.messages["NONE"]
+        colname = str(table._id)
+
+        attributes = {}
+        for row in data["rows"]:
+            attribute = {}
+            for fieldname, (ftype, fname) in attr_cols.items():
+                represent = row[fieldname]
+                if represent is None or represent in (NONE, ""):
+                    # Skip empty fields
+                    continue
+                if ftype == "integer" and not isinstance(represent, lazyT) or \
+                   ftype in ("double", "float"):
+                    # Attributes should be numbers not strings
+                    value = row["_row"][fieldname]
+                else:
+                    value = s3_unicode(represent)
+                attribute[fname] = value
+            attributes[int(row[colname])] = attribute
+
+        return attributes
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def markers(resource, record_ids):
+        """
+            Look up the feature markers, if requested by the "markers"
+            URL parameter (same as for GeoJSON exports)
+
+            @param resource: the S3Resource
+            @param record_ids: the record IDs
+
+            @return: dict {record_id: {property: value}}
+        """
+
+        if not record_ids or not current.request.get_vars.get("markers"):
+            return None
+
+        tablename = resource.tablename
+        marker_fn = current.s3db.get_config(tablename, "marker_fn")
+        if marker_fn:
+            table = resource.table
+            rows = current.db(table._id.belongs(record_ids)).select(table.ALL)
+            markers = dict((row[table._id.name], marker_fn(row)) for row in rows)
+        else:
+            c, f = tablename.split("_", 1)
+            marker = current.gis.get_marker(c, f)
+            markers = dict((record_id, marker) for record_id in record_ids)
+
+        download_url = "/%s/static/img/markers" % current.request.application
+        output = {}
+        for record_id, marker in markers.items():
+            if marker:
+                output[record_id] = {"marker_url": "%s/%s" % (download_url,
+                                                             marker["image"]),
+                                     "marker_height": marker["height"],
+                                     "marker_width": marker["width"],
+                                     }
+        return output
+
+# =============================================================================
+class S3VectorTile(object):
+    """
+        A Mapbox Vector Tile (version 2) in the Web Mercator tile grid,
+        see https://github.com/mapbox/vector-tile-spec
+    """
+
+    # Size of the tile grid
+    EXTENT = 4096
+
+    # Buffer around the tile (in grid units), to render features
+    # which overlap the tile edges correctly
+    BUFFER = 64
+
+    # Whether PostGIS supports ST_AsMVTGeom (PostGIS 2.4+),
+    # determined once per process
+    postgis_mvt = None
+
+    def __init__(self, z, x, y):
+        """
+            Constructor
+
+            @param z: the zoom level
+            @param x: the column of the tile
+            @param y: the row of the tile (from the top)
+        """
+
+        z, x, y = int(z), int(x), int(y)
+        n = 1 << z if z >= 0 else 0
+        if not 0 <= x < n or not 0 <= y < n:
+            raise ValueError("Invalid tile coordinates %s/%s/%s" % (z, x, y))
+
+        self.z = z
+        self.x = x
+        self.y = y
+
+        # Tile bounds in Web Mercator
+        size = 2 * math.pi * EARTH_RADIUS / n
+        origin = math.pi * EARTH_RADIUS
+        self.bounds = (x * size - origin,
+                       origin - (y + 1) * size,
+                       (x + 1) * size - origin,
+                       origin - y * size,
+                       )
+
+        self.layers = Storage()
+
+    # -------------------------------------------------------------------------
+    def lonlat_bounds(self, buffer=True):
+        """
+            Get the bounds of this tile in WGS84
+
+            @param buffer: include the buffer around the tile
+
+            @return: tuple (lon_min, lat_min, lon_max, lat_max)
+        """
+
+        xmin, ymin, xmax, ymax = self.bounds
+        if buffer:
+            b = (xmax - xmin) * self.BUFFER / self.EXTENT
+            xmin, ymin, xmax, ymax = xmin - b, ymin - b, xmax + b, ymax + b
+
+        lon_min, lat_min = self.to_lonlat(xmin, ymin)
+        lon_max, lat_max = self.to_lonlat(xmax, ymax)
+
+        return (max(lon_min, -180.0),
+                max(lat_min, -90.0),
+                min(lon_max, 180.0),
+                min(lat_max, 90.0),
+                )
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def to_lonlat(mx, my):
+        """
+            Convert Web Mercator coordinates to WGS84
+
+            @param mx: the x coordinate (meters)
+            @param my: the y coordinate (meters)
+
+            @return: tuple (lon, lat)
+        """
+
+        lon = math.degrees(mx / EARTH_RADIUS)
+        lat = math.degrees(2 * math.atan(math.exp(my / EARTH_RADIUS)) - math.pi / 2)
+        return lon, lat
+
+    # -------------------------------------------------------------------------
+    def to_grid(self, lon, lat):
+        """
+            Convert WGS84 coordinates to tile grid coordinates
+
+            @param lon: the longitude
+            @param lat: the latitude
+
+            @return: tuple (x, y), with y from the top of the tile
+        """
+
+        lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+        mx = math.radians(lon) * EARTH_RADIUS
+        my = math.log(math.tan(math.pi / 4 + math.radians(lat) / 2)) * EARTH_RADIUS
+
+        xmin, ymin, xmax, ymax = self.bounds
+        extent = self.EXTENT
+        return ((mx - xmin) * extent / (xmax - xmin),
+                (ymax - my) * extent / (ymax - ymin),
+                )
+
+    # -------------------------------------------------------------------------
+    def features(self, resource, limit=None):
+        """
+            Look up the features of a resource within this tile
+
+            @param resource: the S3Resource
+            @param limit: the maximum number of features, if there
+                          are more, only the first features in ID order
+                          are returned (and a warning is logged)
+
+            @return: list of tuples (record_id, geometry), with geometry
+                     being a GeoJSON geometry dict in grid coordinates
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        table = resource.table
+        tablename = table._tablename
+        gtable = s3db.gis_location
+
+        # Which field links the resource to gis_location?
+        if tablename == "gis_location":
+            selector = table._id.name
+        elif "location_id" in table.fields:
+            selector = "location_id"
+        elif "site_id" in table.fields:
+            selector = "site_id$location_id"
+        else:
+            context = resource.get_config("context")
+            selector = context.get("location") if context else None
+            if not selector or "." in selector:
+                # Can't display this resource on the Map
+                return []
+
+        from ..s3query import S3Joins, S3ResourceField
+
+        rfield = S3ResourceField(resource, selector)
+        if rfield.field is None:
+            return []
+
+        # Query for the filtered records (sub-selects one-to-many joins)
+        query, aqueries = resource.get_aggregate_query()
+        if resource.rfilter.get_filter() is not None:
+            # Virtual filter => must extract the matching record IDs
+            data = resource.select([table._id.name],
+                                   limit = None,
+                                   as_rows = True,
+                                   )
+            query &= (table._id.belongs([row[table._id] for row in data]))
+
+        ljoins = S3Joins(tablename)
+        ljoins.extend(rfield.left)
+        left = ljoins.as_list(aqueries=aqueries)
+        if tablename != "gis_location":
+            query &= (rfield.field == gtable.id)
+        query &= (gtable.deleted != True)
+
+        settings = current.deployment_settings
+        if settings.get_gis_spatialdb() and self.has_postgis_mvt():
+            return self._features_postgis(table, query, left, limit=limit)
+        else:
+            return self._features_python(table, query, left, limit=limit)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def has_postgis_mvt(cls):
+        """
+            Check whether the database supports ST_AsMVTGeom (PostGIS 2.4+)
+        """
+
+        supported = cls.postgis_mvt
+        if supported is None:
+            supported = False
+            if current.deployment_settings.get_database_type() == "postgres":
+                try:
+                    version = current.db.executesql("SELECT PostGIS_Lib_Version();")[0][0]
+                    version = tuple(int(v) for v in version.split(".")[:2])
+                except Exception:
+                    current.db.rollback()
+                else:
+                    supported = version >= (2, 4)
+            cls.postgis_mvt = supported
+        return supported
+
+    # -------------------------------------------------------------------------
+    def _features_postgis(self, table, query, left, limit=None):
+        """
+            Look up the features within this tile, clipped, simplified
+            and quantised in PostGIS
+
+            @param table: the resource table
+            @param query: the query for the features
+            @param left: the left joins for the query
+            @param limit: the maximum number of features
+
+            @return: list of tuples (record_id, geometry)
+        """
+
+        db = current.db
+        gtable = current.s3db.gis_location
+
+        sql = db(query)._select(table._id.with_alias("fid"),
+                                gtable.the_geom.with_alias("geom"),
+                                left = left,
+                                )
+        envelope = "ST_MakeEnvelope(%.9f,%.9f,%.9f,%.9f,3857)" % self.bounds
+        # Filter with the buffered bounds (like _features_python), so
+        # that features within the buffer are rendered too
+        bbox = "ST_MakeEnvelope(%.9f,%.9f,%.9f,%.9f,4326)" % self.lonlat_bounds()
+        sql = "SELECT q.fid, ST_AsGeoJSON(ST_AsMVTGeom(" \
+              "ST_Transform(q.geom,3857),%(envelope)s,%(extent)d,%(buffer)d,true)) " \
+              "FROM (%(sql)s) AS q " \
+              "WHERE q.geom && %(bbox)s ORDER BY q.fid%(limit)s;" % \
+              {"sql": sql.rstrip().rstrip(";"),
+               "envelope": envelope,
+               "bbox": bbox,
+               "extent": self.EXTENT,
+               "buffer": self.BUFFER,
+               "limit": " LIMIT %d" % (limit + 1) if limit else "",
+               }
+
+        rows = self.truncate(db.executesql(sql), limit)
+
+        features = []
+        for record_id, geojson in rows:
+            if geojson:
+                features.append((record_id, json.loads(geojson)))
+        return features
+
+    # -------------------------------------------------------------------------
+    def truncate(self, rows, limit):
+        """
+            Reduce the features of an over-full tile to the limit (rather
+            than failing the tile, so that the map still shows something)
+
+            @param rows: the rows for the features, ordered by record ID,
+                         up to limit+1
+            @param limit: the maximum number of features
+
+            @return: the first limit rows
+        """
+
+        if limit and len(rows) > limit:
+            current.log.warning("S3MVT",
+                                "More than %s features in tile %s/%s/%s, "
+                                "only the first %s are encoded" % \
+                                (limit, self.z, self.x, self.y, limit))
+            rows = rows[:limit]
+        return rows
+
+    # -------------------------------------------------------------------------
+    def _features_python(self, table, query, left, limit=None):
+        """
+            Look up the features within this tile, clipped, simplified
+            and quantised in Python
+
+            @param table: the resource table
+            @param query: the query for the features
+            @param left: the left joins for the query
+            @param limit: the maximum number of features
+
+            @return: list of tuples (record_id, geometry)
+        """
+
+        db = current.db
+        gtable = current.s3db.gis_location
+
+        lon_min, lat_min, lon_max, lat_max = bounds = self.lonlat_bounds()
+
+        # Locations with bounds intersecting the tile, or points
+        # without bounds within the tile
+        query &= ((gtable.lon_max >= lon_min) & \
+                  (gtable.lon_min <= lon_max) & \
+                  (gtable.lat_max >= lat_min) & \
+                  (gtable.lat_min <= lat_max)) | \
+                 ((gtable.lon_min == None) & \
+                  (gtable.lon >= lon_min) & \
+                  (gtable.lon <= lon_max) & \
+                  (gtable.lat >= lat_min) & \
+                  (gtable.lat <= lat_max))
+
+        # Pre-select candidates from the spatial index, if available
+        from ..s3gis import S3SpatialIndex
+        candidates = S3SpatialIndex.candidates(*bounds)
+        if candidates is not None:
+            query &= (gtable.id.belongs(candidates))
+
+        rows = db(query).select(table._id,
+                                gtable.gis_feature_type,
+                                gtable.lat,
+                                gtable.lon,
+                                gtable.wkt,
+                                left = left,
+                                orderby = table._id,
+                                limitby = (0, limit + 1) if limit else None,
+                                )
+        if not rows:
+            return []
+        rows = self.truncate(rows, limit)
+
+        try:
+            from shapely.geometry import box
+            from shapely.ops import transform
+            from shapely.wkt import loads as wkt_loads
+        except ImportError:
+            current.log.warning("S3MVT", "Shapely not available, can only encode points")
+            shapely = False
+        else:
+            shapely = True
+            clip_box = box(*bounds)
+            # Half a grid unit (in degrees), to reduce geometries before
+            # clipping (=guard against very detailed geometries at low zoom)
+            size = self.EXTENT + 2 * self.BUFFER
+            tolerance = 0.5 * min((lon_max - lon_min) / size,
+                                  (lat_max - lat_min) / size,
+                                  )
+
+        to_grid = self.to_grid
+        def project(x, y, z=None):
+            # Project into grid coordinates (shapely.ops.transform callback)
+            if isinstance(x, float):
+                return to_grid(x, y)
+            return zip(*[to_grid(lon, lat) for lon, lat in zip(x, y)])
+
+        pkey = str(table._id)
+        colnames = [str(gtable[fn]) for fn in ("gis_feature_type", "lat", "lon", "wkt")]
+
+        features = []
+        append = features.append
+        for row in rows:
+            record_id = row[pkey]
+            feature_type, lat, lon, wkt = [row[colname] for colname in colnames]
+
+            if feature_type not in (None, 1) and wkt and shapely:
+                try:
+                    shape = wkt_loads(wkt)
+                except Exception:
+                    current.log.error("S3MVT", "Invalid WKT in location of %s" % record_id)
+                    continue
+                if not shape.intersects(clip_box):
+                    continue
+                shape = shape.simplify(tolerance).intersection(clip_box)
+                if shape.is_empty:
+                    continue
+                # Simplify to the resolution of the grid
+                shape = transform(project, shape).simplify(1.0)
+                append((record_id, shape.__geo_interface__))
+
+            elif lat is not None and lon is not None:
+                if lon_min <= lon <= lon_max and lat_min <= lat <= lat_max:
+                    append((record_id, {"type": "Point",
+                                        "coordinates": to_grid(lon, lat),
+                                        }))
+
+        return features
+
+    # -------------------------------------------------------------------------
+    def add(self, layer, feature_id, geometry, properties=None):
+        """
+            Add a feature to this tile
+
+            @param layer: the layer name
+            @param feature_id: the feature ID (a non-negative integer)
+            @param geometry: the geometry (GeoJSON geometry dict) in
+                             grid coordinates
+            @param properties: the feature properties (dict)
+
+            @return: True if the feature was added, False if the
+                     geometry was empty after quantising
+        """
+
+        geom_type, commands = self.encode_geometry(geometry)
+        if not commands:
+            return False
+
+        layers = self.layers
+        if layer not in layers:
+            layers[layer] = Storage(features = [],
+                                    key_index = {},
+                                    value_index = {},
+                                    )
+        layer = layers[layer]
+
+        # Encode the properties as indices into the key/value tables
+        tags = []
+        if properties:
+            keys, values = layer.key_index, layer.value_index
+            for key, value in properties.items():
+                if value is None:
+                    continue
+                key = s3_unicode(key)
+                value = self.encode_value(value)
+                if key not in keys:
+                    keys[key] = len(keys)
+                if value not in values:
+                    values[value] = len(values)
+                tags.extend((keys[key], values[value]))
+
+        feature = self.message(1, int(feature_id), VARINT) + \
+                  self.packed(2, tags) + \
+                  self.message(3, geom_type, VARINT) + \
+                  self.packed(4, commands)
+        layer.features.append(feature)
+        return True
+
+    # -------------------------------------------------------------------------
+    def encode(self):
+        """
+            Encode this tile
+
+            @return: the tile (as string)
+        """
+
+        message = self.message
+
+        tile = []
+        for name, layer in self.layers.items():
+
+            keys = sorted(layer.key_index.items(), key=lambda item: item[1])
+            values = sorted(layer.value_index.items(), key=lambda item: item[1])
+
+            data = [message(15, 2, VARINT),
+                    message(1, s3_unicode(name).encode("utf-8")),
+                    ]
+            data.extend(message(2, feature) for feature in layer.features)
+            data.extend(message(3, key.encode("utf-8")) for key, index in keys)
+            data.extend(message(4, value) for value, index in values)
+            data.append(message(5, self.EXTENT, VARINT))
+
+            tile.append(message(3, "".join(data)))
+
+        return "".join(tile)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def encode_geometry(cls, geometry):
+        """
+            Encode a geometry as MVT command sequence, quantising the
+            coordinates to the grid (and dropping degenerate parts)
+
+            @param geometry: the geometry (GeoJSON geometry dict)
+
+            @return: tuple (geometry type, list of command integers)
+        """
+
+        geom_type = geometry.get("type")
+        coordinates = geometry.get("coordinates")
+
+        if geom_type == "GeometryCollection":
+            # Encode only the parts of the highest dimension
+            parts = {}
+            for part in geometry.get("geometries", ()):
+                gtype, commands = cls.encode_geometry(part)
+                if commands:
+                    parts.setdefault(gtype, []).extend(commands)
+            if not parts:
+                return UNKNOWN, []
+            gtype = max(parts)
+            return gtype, parts[gtype]
+
+        if not coordinates:
+            return UNKNOWN, []
+
+        encoder = Storage(cursor=(0, 0), commands=[])
+
+        if geom_type in ("Point", "MultiPoint"):
+            if geom_type == "Point":
+                coordinates = [coordinates]
+            points = cls.quantise(coordinates, unique=False)
+            if points:
+                cls.command(encoder, MOVE_TO, points)
+            return POINT, encoder.commands
+
+        elif geom_type in ("LineString", "MultiLineString"):
+            if geom_type == "LineString":
+                coordinates = [coordinates]
+            for line in coordinates:
+                points = cls.quantise(line)
+                if len(points) < 2:
+                    continue
+                cls.command(encoder, MOVE_TO, points[:1])
+                cls.command(encoder, LINE_TO, points[1:])
+            return LINESTRING, encoder.commands
+
+        elif geom_type in ("Polygon", "MultiPolygon"):
+            if geom_type == "Polygon":
+                coordinates = [coordinates]
+            for polygon in coordinates:
+                for index, ring in enumerate(polygon):
+                    points = cls.quantise(ring)
+                    if len(points) > 1 and points[0] == points[-1]:
+                        points = points[:-1]
+                    if len(points) < 3:
+                        if index == 0:
+                            # Exterior ring vanished => skip polygon
+                            break
+                        continue
+                    area = cls.area(points)
+                    if not area:
+                        if index == 0:
+                            break
+                        continue
+                    # Exterior rings must have a positive area,
+                    # interior rings a negative area (y axis down)
+                    if (area > 0) != (index == 0):
+                        points.reverse()
+                    cls.command(encoder, MOVE_TO, points[:1])
+                    cls.command(encoder, LINE_TO, points[1:])
+                    encoder.commands.append(cls.command_integer(CLOSE_PATH, 1))
+            return POLYGON, encoder.commands
+
+        return UNKNOWN, []
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def quantise(coordinates, unique=True):
+        """
+            Round coordinates to the grid
+
+            @param coordinates: sequence of coordinates
+            @param unique: drop repeated consecutive points
+
+            @return: list of tuples (x, y)
+        """
+
+        points = []
+        append = points.append
+        last = None
+        for coordinate in coordinates:
+            point = (int(round(coordinate[0])), int(round(coordinate[1])))
+            if unique and point == last:
+                continue
+            append(point)
+            last = point
+        return points
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def area(points):
+        """
+            Twice the signed area of a ring (surveyor's formula)
+
+            @param points: the points of the ring (without closing point)
+        """
+
+        area = 0
+        x0, y0 = points[-1]
+        for x1, y1 in points:
+            area += x0 * y1 - x1 * y0
+            x0, y0 = x1, y1
+        return area
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def command(cls, encoder, command, points):
+        """
+            Append a MoveTo or LineTo command to the command sequence
+
+            @param encoder: the encoder state (cursor, commands)
+            @param command: the command ID
+            @param points: the command parameters (points)
+        """
+
+        commands = encoder.commands
+        commands.append(cls.command_integer(command, len(points)))
+
+        zigzag = cls.zigzag
+        cx, cy = encoder.cursor
+        for x, y in points:
+            commands.append(zigzag(x - cx))
+            commands.append(zigzag(y - cy))
+            cx, cy = x, y
+        encoder.cursor = (cx, cy)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def command_integer(command, count):
+        """
+            Encode a command ID and parameter count
+        """
+
+        return (command & 0x7) | (count << 3)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def zigzag(n):
+        """
+            ZigZag-encode a signed integer
+        """
+
+        return (n << 1) ^ (n >> 31)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def encode_value(cls, value):
+        """
+            Encode a property value as Value message
+
+            @param value: the value
+
+            @return: the encoded Value message (as string)
+        """
+
+        message = cls.message
+
+        if isinstance(value, bool):
+            return message(7, int(value), VARINT)
+        elif isinstance(value, (int, long)):
+            if value < 0:
+                return message(6, cls.zigzag64(value), VARINT)
+            else:
+                return message(5, value, VARINT)
+        elif isinstance(value, float):
+            return message(3, struct.pack("<d", value), FIXED64)
+        else:
+            return message(1, s3_unicode(value).encode("utf-8"))
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def zigzag64(n):
+        """
+            ZigZag-encode a signed 64bit integer
+        """
+
+        return ((n << 1) ^ (n >> 63)) & 0xffffffffffffffff
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def varint(n):
+        """
+            Encode a non-negative integer as Protobuf varint
+
+            @param n: the integer
+
+            @return: the encoded integer (as string)
+        """
+
+        output = []
+        append = output.append
+        while True:
+            byte = n & 0x7f
+            n >>= 7
+            if n:
+                append(chr(byte | 0x80))
+            else:
+                append(chr(byte))
+                break
+        return "".join(output)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def message(cls, field, value, wire_type=LENGTH_DELIMITED):
+        """
+            Encode a Protobuf field
+
+            @param field: the field number
+            @param value: the value (integer for varint, string otherwise)
+            @param wire_type: the wire type
+
+            @return: the encoded field (as string)
+        """
+
+        varint = cls.varint
+        key = varint((field << 3) | wire_type)
+        if wire_type == VARINT:
+            return key + varint(value)
+        elif wire_type == LENGTH_DELIMITED:
+            return key + varint(len(value)) + value
+        else:
+            return key + value
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def packed(cls, field, values):
+        """
+            Encode a packed repeated Protobuf field of varints
+
+            @param field: the field number
+            @param values: the values (non-negative integers)
+
+            @return: the encoded field (as string)
+        """
+
+        if not values:
+            return ""
+        varint = cls.varint
+        return cls.message(field, "".join(varint(v) for v in values))
+
+# End =========================================================================
@@ -91,6 +91,9 @@ class S3XLS(S3Codec):
         if orderby is None:
             orderby = resource.get_config("orderby")
 
+        # Extract the data in chunks if so configured
+        chunksize = current.deployment_settings.get_base_export_chunksize()
+
         data = resource.select(list_fields,
                                left = left,
                                limit = None,
@@ -99,6 +102,8 @@ class S3XLS(S3Codec):
                                orderby = orderby,
                                represent = True,
                                show_links = False,
+                               columnar = bool(chunksize),
+                               chunksize = chunksize,
                                )
 
         rfields = data.rfields
@@ -204,8 +209,10 @@ class S3XLS(S3Codec):
                                                                   )
 
         # Verify columns in items
+        # (columnar data are extracted during iteration, so can't verify)
         request = current.request
-        if len(rows) > 0 and len(lfields) > len(rows[0]):
+        if isinstance(rows, (list, tuple)) and \
+           len(rows) > 0 and len(lfields) > len(rows[0]):
             msg = """modules/s3/codecs/xls: There is an error in the list items, a field doesn't exist
 requesting url %s
 Headers = %d, Data Items = %d
@@ -1339,6 +1339,10 @@ class S3CRUD(S3Method):
                             report_formname = report_formname,
                             **attr)
 
+        elif representation == "mvt":
+            exporter = S3Exporter().mvt
+            return exporter(resource, **attr)
+
         elif representation == "shp":
             exporter = S3Exporter().shp
             return exporter(resource,
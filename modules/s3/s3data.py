@@ -65,7 +65,9 @@ class S3DataTable(object):
 
             @param rfields: A list of S3Resourcefield
             @param data: A list of Storages the key is of the form table.field
-                         The value is the data to be displayed in the dataTable
+                         The value is the data to be displayed in the dataTable,
+                         alternatively columnar data (S3ResourceColumns)
+                         which are extracted while iterating over the rows
             @param start: the first row to return from the data
             @param limit: the (maximum) number of records to return
             @param filterString: The string that was used in filtering the records
@@ -794,6 +796,24 @@ class S3DataTable(object):
 
     # -------------------------------------------------------------------------
     # Helper methods
+    # -------------------------------------------------------------------------
+    def iterrows(self, start, end):
+        """
+            Iterate over the rows in the data
+
+            @param start: index of the first row
+            @param end: index of the last row + 1
+
+            @return: an iterator over the rows (Storages)
+        """
+
+        data = self.data
+        if hasattr(data, "records"):
+            # Columnar data, extracted in chunks during iteration
+            return data.records(start, end)
+        else:
+            return (data[i] for i in xrange(start, end))
+
     # -------------------------------------------------------------------------
     def table(self, id, flist=None, action_col=0):
         """
@@ -828,8 +848,7 @@ class S3DataTable(object):
         if data:
             # Build the body rows (the actual data)
             rc = 0
-            for i in xrange(start, end):
-                row = data[i]
+            for row in self.iterrows(start, end):
                 if rc % 2 == 0:
                     _class = "even"
                 else:
@@ -883,7 +902,6 @@ class S3DataTable(object):
                                     after the group title.
         """
 
-        data = self.data
         if not flist:
             flist = self.colnames
         start = self.start
@@ -892,8 +910,7 @@ class S3DataTable(object):
             action_col = attr.get("dt_action_col", 0)
         structure = {}
         aadata = []
-        for i in xrange(start, end):
-            row = data[i]
+        for row in self.iterrows(start, end):
             details = []
             for field in flist:
                 if field == "BULK":
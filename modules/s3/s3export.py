@@ -214,6 +214,12 @@ class S3Exporter(object):
         from gluon.serializers import json as jsons
         return jsons(rows)
 
+    # -------------------------------------------------------------------------
+    def mvt(self, *args, **kwargs):
+
+        codec = S3Codec.get_codec("mvt").encode
+        return codec(*args, **kwargs)
+
     # -------------------------------------------------------------------------
     def pdf(self, *args, **kwargs):
 
@@ -31,6 +31,9 @@
 
 import datetime
 import sys
+import threading
+import time
+from collections import OrderedDict
 from itertools import chain
 from uuid import uuid4
 
@@ -236,6 +239,180 @@ class S3ReusableField(object):
         else:
             return Field(name, self.__type, **ia)
 
+# =============================================================================
+class S3RepresentCache(object):
+    """
+        Bounded LRU cache for representations of foreign keys, shared
+        by all requests in the same process, keyed by lookup table,
+        language and representation configuration (see
+        S3Represent.cache_key)
+
+        - entries are invalidated per table by bumping a version counter,
+          which happens automatically when records in the table get
+          updated or deleted (see S3Model.define_table), outdated entries
+          are then discarded as least recently used
+        - other processes can not see these invalidations, hence entries
+          should expire after a certain time (TTL) in multi-process
+          deployments
+
+        Configured with:
+            settings.base.represent_cache_size (0 = disabled, default)
+            settings.base.represent_cache_ttl (seconds, None = no expiry)
+    """
+
+    # The process-wide instance
+    instance = None
+
+    def __init__(self, size=1000, ttl=None):
+        """
+            Constructor
+
+            @param size: the maximum number of entries
+            @param ttl: the time-to-live for entries (seconds)
+        """
+
+        self.size = size
+        self.ttl = ttl
+
+        self.items = OrderedDict()
+        self.versions = {}
+        self.lock = threading.Lock()
+
+        # Counters for monitoring
+        self.hits = 0
+        self.misses = 0
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def shared(cls):
+        """
+            Get the process-wide instance of the cache
+
+            @return: the S3RepresentCache instance, or None if the
+                     shared representation cache is disabled
+        """
+
+        cache = cls.instance
+        if cache is None:
+            settings = current.deployment_settings
+            size = settings.get_base_represent_cache_size()
+            if not size:
+                return None
+            cache = cls.instance = cls(size = size,
+                                       ttl = settings.get_base_represent_cache_ttl(),
+                                       )
+        return cache
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def invalidate(cls, tablename):
+        """
+            Invalidate all cached representations depending on a table
+
+            @param tablename: the table name
+        """
+
+        cache = cls.instance
+        if cache is not None:
+            with cache.lock:
+                versions = cache.versions
+                versions[tablename] = versions.get(tablename, 0) + 1
+
+    # -------------------------------------------------------------------------
+    def clear(self):
+        """ Remove all entries from the cache """
+
+        with self.lock:
+            self.items.clear()
+
+    # -------------------------------------------------------------------------
+    def stats(self):
+        """
+            Get the cache statistics (e.g. for monitoring)
+
+            @return: a Storage {hits, misses, entries, size, ttl}
+        """
+
+        with self.lock:
+            return Storage(hits = self.hits,
+                           misses = self.misses,
+                           entries = len(self.items),
+                           size = self.size,
+                           ttl = self.ttl,
+                           )
+
+    # -------------------------------------------------------------------------
+    def get(self, key, tablenames, values):
+        """
+            Look up representations in the cache
+
+            @param key: the representation configuration key
+            @param tablenames: the names of the tables the
+                               representations depend on
+            @param values: the values to look up
+
+            @return: dict {value: representation} for all values
+                     found in the cache
+        """
+
+        items = self.items
+        language = current.T.accepted_language
+        now = time.time()
+
+        found = {}
+        with self.lock:
+            versions = self.versions
+            version = tuple(versions.get(tn, 0) for tn in tablenames)
+            for value in values:
+                k = (key, language, version, value)
+                item = items.pop(k, None)
+                if item is None:
+                    self.misses += 1
+                    continue
+                label, expires = item
+                if expires is not None and expires < now:
+                    self.misses += 1
+                    continue
+                # Re-insert as most recently used
+                items[k] = item
+                found[value] = label
+                self.hits += 1
+        return found
+
+    # -------------------------------------------------------------------------
+    def set(self, key, tablenames, labels):
+        """
+            Store representations in the cache
+
+            @param key: the representation configuration key
+            @param tablenames: the names of the tables the
+                               representations depend on
+            @param labels: dict {value: representation}
+        """
+
+        items = self.items
+        language = current.T.accepted_language
+        ttl = self.ttl
+        expires = time.time() + ttl if ttl else None
+
+        with self.lock:
+            versions = self.versions
+            version = tuple(versions.get(tn, 0) for tn in tablenames)
+            for value, label in labels.items():
+                if isinstance(label, lazyT):
+                    label = s3_str(label)
+                elif not isinstance(label, basestring):
+                    # Only share plain strings (not HTML helpers)
+                    continue
+                k = (key, language, version, value)
+                items.pop(k, None)
+                items[k] = (label, expires)
+
+            # Discard least recently used entries
+            size = self.size
+            while len(items) > size:
+                items.popitem(last=False)
+
 # =============================================================================
 class S3Represent(object):
     """
@@ -250,7 +427,8 @@ class S3Represent(object):
                                           render_list
         @group Prototypes (to adapt in subclasses): lookup_rows,
                                                     represent_row,
-                                                    link
+                                                    link,
+                                                    cache_key
         @group Internal Methods: _setup,
                                  _lookup
     """
@@ -310,6 +488,7 @@ class S3Represent(object):
         self.field_sep = field_sep
         self.setup = False
         self.theset = None
+        self.cache = None
         self.queries = 0
         self.lazy = []
         self.lazy_show_link = False
@@ -411,6 +590,64 @@ class S3Represent(object):
 
         return output
 
+    # -------------------------------------------------------------------------
+    def cache_key(self):
+        """
+            Determine the key for this representation configuration in
+            the shared representation cache (S3RepresentCache).
+
+            - representations are only shared if the lookup/represent
+              methods are not overridden, as subclasses may depend on
+              other parameters => subclasses must override this method
+              in order to share their representations
+            - likewise if the link method is overridden, as it may need
+              the looked-up rows (which are not cached)
+
+            @return: tuple (key, tablenames), where key is a hashable
+                     key for the configuration, and tablenames are the
+                     names of all tables the representations depend on;
+                     or None if representations shall not be shared
+        """
+
+        tablename = self.tablename
+        if not tablename or self.custom_lookup:
+            return None
+
+        # Representation methods must not be overridden
+        cls = type(self)
+        for name in ("represent_row", "_lookup", "_represent_path", "link"):
+            if getattr(cls, name).im_func is not getattr(S3Represent, name).im_func:
+                return None
+
+        labels = self.labels
+        if isinstance(labels, lazyT):
+            labels = labels.m
+        elif callable(labels):
+            # Only named module-level functions can be identified
+            name = getattr(labels, "__name__", "<lambda>")
+            if name == "<lambda>" or getattr(labels, "__closure__", None):
+                return None
+            labels = "%s.%s" % (labels.__module__, name)
+
+        tablenames = [tablename]
+        hierarchy = self.hierarchy
+        if hierarchy:
+            from s3hierarchy import S3Hierarchy
+            link = S3Hierarchy(tablename).link
+            if link:
+                tablenames.append(link)
+
+        key = (tablename,
+               self.key,
+               tuple(self.fields) if self.fields else None,
+               labels,
+               self.translate,
+               hierarchy,
+               self.field_sep,
+               s3_str(self.none),
+               )
+        return key, tablenames
+
     # -------------------------------------------------------------------------
     def link(self, k, v, row=None):
         """
@@ -669,6 +906,14 @@ class S3Represent(object):
         else:
             self.htemplate = "%s > %s"
 
+        # Shared representation cache
+        cache = S3RepresentCache.shared() if self.table is not None else None
+        if cache is not None:
+            self.cache_config = self.cache_key()
+            if self.cache_config is None:
+                cache = None
+        self.cache = cache
+
         self.setup = True
 
     # -------------------------------------------------------------------------
@@ -707,6 +952,19 @@ class S3Represent(object):
         if table is None or not lookup:
             return items
 
+        # Look up representations in the shared cache
+        cache = self.cache
+        if cache is not None:
+            cache_key, cache_tables = self.cache_config
+            cached = cache.get(cache_key, cache_tables, lookup.keys())
+            for k, v in cached.items():
+                theset[k] = v
+                items[keys.get(k, k)] = v
+                del lookup[k]
+            if not lookup:
+                return items
+            found = {}
+
         if table and self.hierarchy:
             # Does the lookup table have a hierarchy?
             from s3hierarchy import S3Hierarchy
@@ -784,6 +1042,12 @@ class S3Represent(object):
                 for k, row in rows.items():
                     lookup.pop(k, None)
                     items[keys.get(k, k)] = theset[k] = represent_row(row)
+            if cache is not None:
+                found.update((k, theset[k]) for k in rows if k in theset)
+
+        # Store the new representations in the shared cache
+        if cache is not None and found:
+            cache.set(cache_key, cache_tables, found)
 
         # Anything left gets set to default
         if lookup:
@@ -929,6 +1193,44 @@ class S3RepresentLazy(object):
                 attributes[name] = text
             return
 
+# =============================================================================
+def s3_represent_bulk(renderer, values, show_link=True):
+    """
+        Represent a set of unique values at once (batched representation)
+
+        Renderers implement batched representation by providing a method
+            bulk(values, rows=None, list_type=False, show_link=True)
+        which returns a dict {value: representation} for all values
+        (individual values, i.e. the elements of list-type values), using
+        a single lookup per referenced table - like S3Represent.bulk.
+        Other callables are called once per value.
+
+        @param renderer: the represent callable
+        @param values: the values (individual values, not lists)
+        @param show_link: render the representations as links (if
+                          the renderer supports that)
+
+        @return: dict {value: representation}
+    """
+
+    values = list(values)
+
+    if hasattr(renderer, "bulk"):
+        return renderer.bulk(values, list_type=False, show_link=show_link)
+
+    labels = {}
+    for value in values:
+        try:
+            if isinstance(value, S3RepresentLazy):
+                # Resolves all pending lazy values of its renderer at once
+                text = value.render() if show_link else value.represent()
+            else:
+                text = renderer(value)
+        except:
+            text = s3_str(value)
+        labels[value] = text
+    return labels
+
 # =============================================================================
 # Record identity meta-fields
 
@@ -1130,8 +1432,24 @@ def s3_meta_fields():
     fields = (fields + s3_authorstamp() + s3_ownerstamp())
     return fields
 
+# Names of all meta-fields, see s3_all_meta_field_names
+META_FIELD_NAMES = None
+
 def s3_all_meta_field_names():
-    return [field.name for field in s3_meta_fields()]
+    """
+        Names of all meta-fields (determined only once per process,
+        as they do not depend on the request)
+
+        @return: list of field names
+    """
+
+    global META_FIELD_NAMES
+
+    names = META_FIELD_NAMES
+    if names is None:
+        names = META_FIELD_NAMES = tuple(field.name
+                                         for field in s3_meta_fields())
+    return list(names)
 
 # =============================================================================
 # Reusable roles fields
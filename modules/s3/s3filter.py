@@ -31,6 +31,8 @@
 
 __all__ = ("S3DateFilter",
            "S3Filter",
+           "S3FilterFacetCache",
+           "S3FilterFacets",
            "S3FilterForm",
            "S3FilterString",
            "S3FilterWidget",
@@ -46,8 +48,11 @@ __all__ = ("S3DateFilter",
            )
 
 import datetime
+import hashlib
 import json
 import re
+import threading
+import time
 
 from collections import OrderedDict
 
@@ -56,7 +61,8 @@ from gluon.storage import Storage
 from gluon.tools import callback
 
 from s3datetime import s3_decode_iso_datetime, S3DateTime
-from s3query import FS, S3ResourceField, S3ResourceQuery, S3URLQuery
+from s3query import FS, S3Joins, S3ResourceField, S3ResourceQuery, S3URLQuery
+from s3report import S3PivotTable
 from s3rest import S3Method
 from s3timeplot import S3TimeSeries
 from s3utils import s3_get_foreign_key, s3_str, s3_unicode, S3TypeConverter
@@ -181,6 +187,9 @@ class S3FilterWidget(object):
         self.selector = None
         self.values = Storage()
 
+        # Options looked up by the filter form (see S3FilterFacets)
+        self.facet = None
+
     # -------------------------------------------------------------------------
     def __call__(self, resource, get_vars=None, alias=None):
         """
@@ -1481,6 +1490,7 @@ class S3LocationFilter(S3FilterWidget):
             selector = self.field
 
         filters_added = False
+        rows = None
 
         options = opts.get("options")
         if options:
@@ -1506,40 +1516,47 @@ class S3LocationFilter(S3FilterWidget):
             # Always joined (gis_location foreign key in resource)
             joined = True
 
-            # Reduce multi-table joins by excluding empty FKs
-            resource.add_filter(FS(selector) != None)
+            facet = self.facet
+            if facet is not None and facet.resource is resource:
+                # Options looked up by the filter form (S3FilterFacets)
+                rows = facet.rows
+            else:
+                # Reduce multi-table joins by excluding empty FKs
+                resource.add_filter(FS(selector) != None)
 
-            # Filter out old Locations
-            # @ToDo: Allow override
-            resource.add_filter(FS("%s$end_date" % selector) == None)
+                # Filter out old Locations
+                # @ToDo: Allow override
+                resource.add_filter(FS("%s$end_date" % selector) == None)
 
-            filters_added = True
+                filters_added = True
 
         else:
             # Neither fixed options nor resource to look them up
             return default
 
-        # Prevent unnecessary extraction of extra fields
-        extra_fields = resource.get_config("extra_fields")
-        resource.clear_config("extra_fields")
+        if rows is None:
 
-        # Suppress instantiation of LazySets in rows (we don't need them)
-        db = current.db
-        rname = db._referee_name
-        db._referee_name = None
+            # Prevent unnecessary extraction of extra fields
+            extra_fields = resource.get_config("extra_fields")
+            resource.clear_config("extra_fields")
 
-        # Find the options
-        rows = resource.select(fields = fields,
-                               limit = None,
-                               virtual = False,
-                               as_rows = True,
-                               )
+            # Suppress instantiation of LazySets in rows (we don't need them)
+            db = current.db
+            rname = db._referee_name
+            db._referee_name = None
+
+            # Find the options
+            rows = resource.select(fields = fields,
+                                   limit = None,
+                                   virtual = False,
+                                   as_rows = True,
+                                   )
 
-        # Restore extra fields
-        resource.configure(extra_fields=extra_fields)
+            # Restore extra fields
+            resource.configure(extra_fields=extra_fields)
 
-        # Restore referee name
-        db._referee_name = rname
+            # Restore referee name
+            db._referee_name = rname
 
         if filters_added:
             # Remove them
@@ -1763,7 +1780,8 @@ class S3LocationFilter(S3FilterWidget):
 class S3MapFilter(S3FilterWidget):
     """
         Map filter widget
-         Normally configured for "~.location_id$the_geom"
+         Normally configured for "~.location_id$the_geom", or for
+         "~.location_id$wkt" if using the spatial index (no spatial DB)
 
         Configuration options:
 
@@ -1787,7 +1805,8 @@ class S3MapFilter(S3FilterWidget):
 
         settings = current.deployment_settings
 
-        if not settings.get_gis_spatialdb():
+        if not settings.get_gis_spatialdb() and \
+           not settings.get_gis_spatial_index():
             current.log.warning("No Spatial DB => Cannot do Intersects Query yet => Disabling S3MapFilter")
             return ""
 
@@ -1909,6 +1928,8 @@ class S3OptionsFilter(S3FilterWidget):
         @keyword translate: translate the option labels in the fixed set
                             (looked-up option sets will use the
                             field representation method instead)
+        @keyword counts: show the number of matching records for each
+                         looked-up option (where available)
     """
 
     _class = "options-filter"
@@ -2104,6 +2125,7 @@ class S3OptionsFilter(S3FilterWidget):
 
         # Find the options
         opt_keys = []
+        counts = None
 
         multiple = ftype[:5] == "list:"
         if opts.options is not None:
@@ -2117,9 +2139,20 @@ class S3OptionsFilter(S3FilterWidget):
         elif resource:
             # Determine the options from the field type
             options = None
+
+            # Options looked up by the filter form (S3FilterFacets)
+            facet = self.facet
+            if facet is not None and facet.resource is not resource:
+                facet = None
+            if facet is not None:
+                counts = facet.counts
+
             if ftype == "boolean":
                 opt_keys = (True, False)
 
+            elif facet is not None:
+                opt_keys = list(facet.keys)
+
             elif field or rfield.virtual:
 
                 groupby = field if field and not multiple else None
@@ -2194,12 +2227,20 @@ class S3OptionsFilter(S3FilterWidget):
                             #else:
                             #    query &= (ktable.organisation_id == None)
 
-                        rows = current.db(query).select(key_field,
-                                                        resource._id.min(),
-                                                        groupby = key_field,
+                        fields = [key_field, resource._id.min()]
+                        if opts.get("counts"):
+                            numrecords = resource._id.count(distinct=True)
+                            fields.append(numrecords)
+                        else:
+                            numrecords = None
+
+                        rows = current.db(query).select(groupby = key_field,
                                                         join = join,
                                                         left = left,
-                                                        )
+                                                        *fields)
+                        if numrecords is not None:
+                            counts = dict((row[key_field], row[numrecords])
+                                          for row in rows)
 
                 # If we can not perform a reverse lookup, then we need
                 # to do a forward lookup of all unique values of the
@@ -2334,6 +2375,11 @@ class S3OptionsFilter(S3FilterWidget):
             opt_list = [(opt_value, s3_unicode(opt_value))
                         for opt_value in opt_keys if opt_value]
 
+        # Show the number of matching records per option
+        if counts is not None and opts.get("counts"):
+            opt_list = [(opt, "%s (%s)" % (s3_unicode(label), counts.get(opt, 0)))
+                        for opt, label in opt_list]
+
         if opts.get("sort", True):
             try:
                 opt_list.sort(key=lambda item: item[1])
@@ -2541,6 +2587,17 @@ class S3FilterForm(object):
         self.attr = attributes
         self.opts = options
 
+    # -------------------------------------------------------------------------
+    def facets(self, resource):
+        """
+            Look up the options for the widgets of this form (where
+            possible with GROUP BY queries, see S3FilterFacets)
+
+            @param resource: the S3Resource
+        """
+
+        S3FilterFacets(resource, self.widgets).apply()
+
     # -------------------------------------------------------------------------
     def html(self, resource, get_vars=None, target=None, alias=None):
         """
@@ -2783,6 +2840,9 @@ class S3FilterForm(object):
             @return: a list of form rows
         """
 
+        if resource:
+            self.facets(resource)
+
         rows = []
         rappend = rows.append
         advanced = False
@@ -3064,6 +3124,494 @@ class S3FilterForm(object):
 
         return default_filters
 
+# =============================================================================
+class S3FilterFacets(object):
+    """
+        Facet engine for filter forms: looks up the options for the
+        option filter widgets of a form, and the number of matching
+        records per option, with one GROUP BY query per filter field
+        over the filtered resource (rather than extracting the options
+        from the records)
+
+        - applies to S3OptionsFilters and S3LocationFilters for real
+          fields with only one value per record (i.e. fields in the
+          master table, or in tables referenced by foreign keys), other
+          widgets look up their options themselves
+        - the results can be shared between requests (S3FilterFacetCache),
+          per query, i.e. per resource filter and accessible records (realms)
+          of the user, until any of the tables involved gets written to
+    """
+
+    # Location fields for S3LocationFilter options
+    LOCATION_FIELDS = ("L0", "L1", "L2", "L3", "L4", "L5", "path")
+
+    def __init__(self, resource, widgets):
+        """
+            Constructor
+
+            @param resource: the S3Resource
+            @param widgets: the filter widgets
+        """
+
+        self.resource = resource
+        self.widgets = widgets
+
+    # -------------------------------------------------------------------------
+    def apply(self):
+        """
+            Look up the facets, and provide them to the widgets (as
+            widget.facet, used by widget._options instead of looking
+            up the options separately)
+        """
+
+        widgets = self.widgets
+        for widget in widgets:
+            widget.facet = None
+
+        resource = self.resource
+        if resource is None or \
+           not current.deployment_settings.get_search_facets():
+            return
+
+        # Virtual and extra filters require the records
+        resource.get_query()
+        rfilter = resource.rfilter
+        if rfilter is None or \
+           rfilter.get_filter() is not None or \
+           rfilter.get_extra_filters():
+            return
+
+        # Collect the facet fields
+        facets, rfields = self._facet_fields()
+        if not facets:
+            return
+
+        query, aqueries = resource.get_aggregate_query()
+
+        table = resource.table
+        tablename = table._tablename
+
+        # Columns and left joins per facet (grouping all facets
+        # in one query would produce all combinations of values)
+        groups = OrderedDict()
+        for widget, kind, rfield, colnames in facets:
+            colname = rfield.colname
+            if colname in groups:
+                continue
+            ljoins = S3Joins(tablename)
+            columns = []
+            for c in colnames:
+                ljoins.extend(rfields[c].left)
+                columns.append(rfields[c].field)
+            groups[colname] = (columns, ljoins.as_list(aqueries=aqueries))
+
+        # Look-up tables of foreign keys, with the constraints
+        # for their options
+        lookups = {}
+        for widget, kind, rfield, colnames in facets:
+            if kind == "options" and rfield.colname not in lookups:
+                lookup = self._lookup_constraint(widget, rfield)
+                if lookup:
+                    lookups[rfield.colname] = lookup
+
+        db = current.db
+        numrecords = table._id.count()
+
+        # Look up the facets (or re-use them from the cache)
+        cache = S3FilterFacetCache.shared()
+        if cache:
+            tablenames = set([tablename])
+            joins = []
+            for columns, left in groups.values():
+                joins.extend(left)
+            if rfilter:
+                joins.extend(rfilter.get_joins())
+                joins.extend(rfilter.get_joins(left=True))
+            for join in joins:
+                jtable = join.first
+                tablenames.add(getattr(jtable, "_ot", None) or jtable._tablename)
+            for ktable, key_field, constraint in lookups.values():
+                tablenames.add(ktable._tablename)
+
+            sql = [db(query)._select(numrecords,
+                                     left = left,
+                                     groupby = columns,
+                                     *columns)
+                   for columns, left in groups.values()]
+            for colname in sorted(lookups):
+                sql.append(str(lookups[colname][2]))
+            key = hashlib.md5("|".join(s3_str(item) for item in sql)).hexdigest()
+
+            version = cache.version(tablenames)
+            data = cache.get(key, version)
+        else:
+            data = None
+
+        if data is None:
+            data = self._lookup(query, groups, facets, numrecords, lookups)
+            if cache:
+                cache.set(key, version, data)
+
+        # Provide the facets to the widgets
+        for widget, kind, rfield, colnames in facets:
+            colname = rfield.colname
+            if kind == "options":
+                values = data.get(colname, ())
+                widget.facet = Storage(resource = resource,
+                                       keys = [value for value, count in values],
+                                       counts = dict(values),
+                                       )
+            else:
+                rows = []
+                for item in data.get(colname, ()):
+                    location = Storage(zip(self.LOCATION_FIELDS, item[1:]))
+                    rows.append(Storage({colname: item[0],
+                                         "gis_location": location,
+                                         }))
+                widget.facet = Storage(resource = resource,
+                                       rows = rows,
+                                       )
+
+    # -------------------------------------------------------------------------
+    def _facet_fields(self):
+        """
+            Determine which widgets can use facets, and the fields
+            to look up
+
+            @return: tuple (facets, rfields), with facets being a list
+                     of tuples (widget, kind, rfield, colnames), and rfields
+                     an OrderedDict {colname: S3ResourceField} of all fields
+                     to group by
+        """
+
+        resource = self.resource
+
+        facets = []
+        rfields = OrderedDict()
+
+        def resolve(selector):
+            # Resolve a selector, return None if it isn't suitable
+            if not isinstance(selector, basestring):
+                return None
+            try:
+                rfield = S3ResourceField(resource, selector)
+            except (AttributeError, SyntaxError):
+                return None
+            if rfield.field is None or \
+               not S3PivotTable.single_valued(resource, selector):
+                return None
+            return rfield
+
+        for widget in self.widgets:
+
+            opts = widget.opts
+
+            if isinstance(widget, S3LocationFilter):
+                if opts.get("options"):
+                    continue
+                selector = widget.field
+                rfield = resolve(selector)
+                if not rfield or rfield.ftype != "reference gis_location":
+                    continue
+                lfields = [rfield]
+                gtable = current.s3db.gis_location
+                for fname in self.LOCATION_FIELDS + ("end_date",):
+                    if fname not in gtable.fields:
+                        break
+                    lfield = resolve("%s$%s" % (selector, fname))
+                    if not lfield:
+                        break
+                    lfields.append(lfield)
+                else:
+                    colnames = []
+                    for lfield in lfields:
+                        colname = lfield.colname
+                        rfields[colname] = lfield
+                        colnames.append(colname)
+                    facets.append((widget, "location", rfield, colnames))
+
+            elif isinstance(widget, S3OptionsFilter):
+                if opts.options is not None:
+                    continue
+                selector = widget.field
+                if isinstance(selector, (tuple, list)):
+                    selector = selector[0]
+                rfield = resolve(selector)
+                if not rfield or rfield.ftype[:5] == "list:":
+                    continue
+                colname = rfield.colname
+                rfields[colname] = rfield
+                facets.append((widget, "options", rfield, [colname]))
+
+        return facets, rfields
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _lookup_constraint(widget, rfield):
+        """
+            Get the constraint for the options of a foreign key filter
+            field in the look-up table (same as S3OptionsFilter._options
+            applies for reverse look-ups)
+
+            @param widget: the S3OptionsFilter
+            @param rfield: the S3ResourceField for the filter field
+
+            @return: tuple (ktable, key_field, query), or None if the
+                     filter field is not a foreign key
+        """
+
+        ktablename, key, multiple = s3_get_foreign_key(rfield.field, m2m=False)
+        if not ktablename:
+            return None
+
+        ktable = current.s3db.table(ktablename)
+        if ktable is None:
+            return None
+        key_field = ktable[key]
+
+        query = current.auth.s3_accessible_query("read", ktable)
+
+        opts = widget.opts
+
+        # Filter options by location?
+        location_filter = opts.get("location_filter")
+        if location_filter and "location_id" in ktable:
+            location = current.session.s3.location_filter
+            if location:
+                query &= (ktable.location_id == location)
+
+        # Filter options by organisation?
+        org_filter = opts.get("org_filter")
+        if org_filter and "organisation_id" in ktable:
+            root_org = current.auth.root_org()
+            if root_org:
+                query &= ((ktable.organisation_id == root_org) | \
+                          (ktable.organisation_id == None))
+
+        return ktable, key_field, query
+
+    # -------------------------------------------------------------------------
+    def _lookup(self, query, groups, facets, numrecords, lookups):
+        """
+            Run the facet queries
+
+            @param query: the query for the filtered records
+            @param groups: the columns to group by and the left joins
+                           per facet, {colname: (columns, left)}
+            @param facets: the facets, as returned from _facet_fields
+            @param numrecords: the count-expression
+            @param lookups: the look-up constraints for foreign keys,
+                            {colname: (ktable, key_field, query)}
+
+            @return: dict {colname: [(value, count), ...]} for options,
+                     and {colname: [(location_id, L0, ..., path), ...]}
+                     for locations
+        """
+
+        db = current.db
+        table = self.resource.table
+
+        data = {}
+        for widget, kind, rfield, colnames in facets:
+
+            colname = rfield.colname
+            if colname in data:
+                continue
+
+            columns, left = groups[colname]
+
+            # Suspend old-style virtual fields
+            vf = table.virtualfields
+            object.__setattr__(table, "virtualfields", [])
+            try:
+                rows = db(query).select(numrecords,
+                                        left = left,
+                                        groupby = columns,
+                                        cacheable = True,
+                                        *columns)
+            finally:
+                object.__setattr__(table, "virtualfields", vf)
+
+            if kind == "options":
+                # Number of records per value
+                counts = OrderedDict()
+                for row in rows:
+                    value = row[colname]
+                    count = row[numrecords]
+                    if value in counts:
+                        counts[value] += count
+                    else:
+                        counts[value] = count
+
+                if colname in lookups:
+                    # Foreign key => only accessible options in the look-up
+                    # table (like the reverse look-up in S3OptionsFilter)
+                    ktable, key_field, constraint = lookups[colname]
+                    keys = [k for k in counts if k is not None]
+                    if keys:
+                        krows = db(constraint & key_field.belongs(keys)).select(key_field)
+                        valid = set(krow[key_field] for krow in krows)
+                    else:
+                        valid = set()
+                    values = [(k, v) for k, v in counts.items() if k in valid]
+                else:
+                    values = counts.items()
+
+                data[colname] = values
+
+            else:
+                # Distinct current locations
+                lcolnames = colnames[1:]
+                locations = OrderedDict()
+                for row in rows:
+                    location_id = row[colname]
+                    if location_id is None or location_id in locations:
+                        continue
+                    item = [row[c] for c in lcolnames]
+                    if item[-1] is not None:
+                        # Old location
+                        continue
+                    locations[location_id] = tuple([location_id] + item[:-1])
+                data[colname] = locations.values()
+
+        return data
+
+# =============================================================================
+class S3FilterFacetCache(object):
+    """
+        Bounded LRU cache for filter options looked up by S3FilterFacets,
+        shared by all requests in the same process
+
+        - entries are invalidated per table by bumping a version counter,
+          which happens automatically when records in the table get
+          written to (see S3Model.register_invalidator)
+        - other processes can not see these invalidations, hence entries
+          expire after a certain time (TTL)
+
+        Configured with:
+            settings.search.facet_cache_size (0 = disabled, default)
+            settings.search.facet_cache_ttl (seconds, None = no expiry)
+    """
+
+    # The process-wide instance
+    instance = None
+
+    def __init__(self, size=100, ttl=None):
+        """
+            Constructor
+
+            @param size: the maximum number of entries
+            @param ttl: the time-to-live for entries (seconds)
+        """
+
+        self.size = size
+        self.ttl = ttl
+
+        self.items = OrderedDict()
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def shared(cls):
+        """
+            Get the process-wide instance of the cache
+
+            @return: the S3FilterFacetCache instance, or None if sharing
+                     of filter options is disabled
+        """
+
+        cache = cls.instance
+        if cache is None:
+            settings = current.deployment_settings
+            size = settings.get_search_facet_cache_size()
+            if not size:
+                return None
+            cache = cls.instance = cls(size = size,
+                                       ttl = settings.get_search_facet_cache_ttl(),
+                                       )
+            current.s3db.register_invalidator(cls.invalidate)
+        return cache
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def invalidate(cls, tablename):
+        """
+            Invalidate all cached filter options depending on a table
+
+            @param tablename: the table name
+        """
+
+        cache = cls.instance
+        if cache is not None:
+            with cache.lock:
+                versions = cache.versions
+                versions[tablename] = versions.get(tablename, 0) + 1
+
+    # -------------------------------------------------------------------------
+    def version(self, tablenames):
+        """
+            Get the current version of a set of tables (to be read
+            before looking up the options from these tables)
+
+            @param tablenames: the table names
+
+            @return: the version (tuple)
+        """
+
+        with self.lock:
+            versions = self.versions
+            return tuple((tn, versions.get(tn, 0)) for tn in sorted(tablenames))
+
+    # -------------------------------------------------------------------------
+    def get(self, key, version):
+        """
+            Look up filter options in the cache
+
+            @param key: the cache key
+            @param version: the version of the tables
+
+            @return: the cached filter options, or None if not found
+        """
+
+        k = (key, version)
+        with self.lock:
+            items = self.items
+            item = items.pop(k, None)
+            if item is None:
+                return None
+            data, expires = item
+            if expires is not None and expires < time.time():
+                return None
+            # Re-insert as most recently used
+            items[k] = item
+        return data
+
+    # -------------------------------------------------------------------------
+    def set(self, key, version, data):
+        """
+            Store filter options in the cache
+
+            @param key: the cache key
+            @param version: the version of the tables (as read before
+                            looking up the options)
+            @param data: the filter options
+        """
+
+        ttl = self.ttl
+        expires = time.time() + ttl if ttl else None
+
+        k = (key, version)
+        with self.lock:
+            items = self.items
+            items.pop(k, None)
+            items[k] = (data, expires)
+
+            # Discard least recently used entries
+            size = self.size
+            while len(items) > size:
+                items.popitem(last=False)
+
 # =============================================================================
 class S3Filter(S3Method):
     """ Back-end for filter forms """
@@ -3139,6 +3687,7 @@ class S3Filter(S3Method):
             fresource = current.s3db.resource(resource.tablename,
                                               filter = current.response.s3.filter,
                                               )
+            S3FilterForm(filter_widgets).facets(fresource)
 
             for widget in filter_widgets:
                 if hasattr(widget, "ajax_options"):
@@ -33,13 +33,16 @@ __all__ = ("GIS",
            "S3Map",
            "S3ExportPOI",
            "S3ImportPOI",
+           "S3SpatialIndex",
            )
 
 import datetime         # Needed for Feed Refresh checks & web2py version check
 import json
+import math
 import os
 import re
 import sys
+import threading
 #import logging
 import urllib           # Needed for urlencoding
 import urllib2          # Needed for quoting & error handling on fetch
@@ -1913,6 +1916,11 @@ class GIS(object):
             query &= (table.deleted == False)
         # @ToDo: Check AAA (do this as a resource filter?)
 
+        # Pre-select candidates from the spatial index, if available
+        candidates = S3SpatialIndex.candidates(*polygon.bounds)
+        if candidates is not None:
+            query &= (locations.id.belongs(candidates))
+
         features = db(query).select(locations.wkt,
                                     locations.lat,
                                     locations.lon,
@@ -2162,6 +2170,15 @@ class GIS(object):
             empty = (locations.lat != None) & (locations.lon != None)
             query = deleted & empty & query
 
+            # Pre-select candidates from the spatial index, if available
+            candidates = S3SpatialIndex.candidates(bbox["lon_min"],
+                                                   bbox["lat_min"],
+                                                   bbox["lon_max"],
+                                                   bbox["lat_max"],
+                                                   )
+            if candidates is not None:
+                query &= (locations.id.belongs(candidates))
+
             if tablename:
                 # Lookup the resource
                 table = current.s3db[tablename]
@@ -4641,6 +4658,8 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
             returns the path of the feature
 
             Called onaccept for locations (async, where-possible)
+
+            NB updates of the whole tree use update_location_tree_bulk
         """
 
         # During prepopulate, for efficiency, we don't update the location
@@ -4734,30 +4753,8 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
 
 
         if not feature:
-            # We are updating all locations.
-            all_locations = True
-            # Do in chunks to save memory and also do in correct order
-            all_fields = (table.id, table.name, table.gis_feature_type,
-                          table.L0, table.L1, table.L2, table.L3, table.L4,
-                          table.lat, table.lon, table.wkt, table.inherited,
-                          # Handle Countries which start with Bounds set, yet are Points
-                          table.lat_min, table.lon_min, table.lat_max, table.lon_max,
-                          table.path, table.parent)
-            for level in ("L0", "L1", "L2", "L3", "L4", "L5", None):
-                query = (table.level == level) & (table.deleted == False)
-                try:
-                    features = db(query).select(*all_fields)
-                except MemoryError:
-                    current.log.error("S3GIS: Unable to update Location Tree for level %s: MemoryError" % level)
-                else:
-                    for feature in features:
-                        feature["level"] = level
-                        wkt = feature["wkt"]
-                        if wkt and not wkt.startswith("POI"):
-                            # Polygons aren't inherited
-                            feature["inherited"] = False
-                        update_location_tree(feature)  # all_locations is False here
-            # All Done!
+            # We are updating all locations => use bulk mode
+            GIS.update_location_tree_bulk(commit=False)
             return
 
 
@@ -5765,6 +5762,262 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
 
         return _path
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def update_location_tree_bulk(start="L0",
+                                  batch_size=500,
+                                  progress=None,
+                                  commit=True):
+        """
+            Update GIS Locations' Materialized path, Lx locations, Lat/Lon
+            & the_geom for the whole tree (bulk mode of update_location_tree)
+
+            Processes the tree level by level, computing paths, Lx names
+            and inherited Lat/Lon from the (in-memory) results for the
+            previous levels rather than looking up the ancestors of each
+            location, and writes back only the changes, in batches.
+            Geometries are only (re-)calculated where Lat/Lon are inherited
+            or the WKT is missing.
+
+            Commits after each batch (unless disabled), so an interrupted
+            run can be resumed with the level it was processing.
+
+            @param start: the level to start with: "L0" (default) to update
+                          all locations, "L1".."L5" to resume with that
+                          level, None to resume with specific locations
+            @param batch_size: the number of locations to process at a time
+            @param progress: callback function(level, done, total) to report
+                             the progress of each level, defaults to logging
+            @param commit: commit after each batch
+
+            @return: dict {level: number of updated locations}
+        """
+
+        if GIS.disable_update_location_tree:
+            return None
+
+        db = current.db
+        table = current.s3db.gis_location
+        wkt_centroid = GIS.wkt_centroid
+
+        hierarchy_levels = ("L0", "L1", "L2", "L3", "L4", "L5")
+        levels = hierarchy_levels + (None,)
+        if start not in levels:
+            raise ValueError("Invalid start level: %s" % start)
+        start = levels.index(start)
+
+        if progress is None:
+            def progress(level, done, total):
+                current.log.info("S3GIS",
+                                 "Location Tree %s: %s of %s locations done" % \
+                                 (level or "specific", done, total))
+
+        fields = [table.id,
+                  table.name,
+                  table.parent,
+                  table.path,
+                  table.inherited,
+                  table.lat,
+                  table.lon,
+                  table.wkt,
+                  # Handle Countries which start with Bounds set, yet are Points
+                  table.lat_min,
+                  table.lon_min,
+                  table.lat_max,
+                  table.lon_max,
+                  ] + [table[l] for l in hierarchy_levels]
+        geometry = ("gis_feature_type", "lat", "lon", "wkt", "the_geom",
+                    "lat_min", "lon_min", "lat_max", "lon_max")
+
+        # Results for the processed hierarchy levels
+        # {location_id: (level index, path, [L0..L5], lat, lon)}
+        tree = {}
+
+        results = {}
+        for index, level in enumerate(levels):
+
+            query = (table.level == level) & (table.deleted == False)
+
+            if index < start:
+                # Already done => just read the results
+                rows = db(query).select(*fields)
+                for row in rows:
+                    tree[row.id] = (index,
+                                    row.path,
+                                    [row[l] for l in hierarchy_levels],
+                                    row.lat,
+                                    row.lon,
+                                    )
+                continue
+
+            total = db(query).count()
+            done = updated = 0
+            last_id = 0
+            while True:
+                rows = db(query & (table.id > last_id)).select(orderby = table.id,
+                                                               limitby = (0, batch_size),
+                                                               *fields)
+                if not rows:
+                    break
+                last_id = rows.last().id
+
+                updates = {}
+                for row in rows:
+                    record_id = row.id
+                    name = row.name
+                    lat = row.lat
+                    lon = row.lon
+                    wkt = row.wkt
+
+                    # Polygons aren't inherited
+                    inherited = row.inherited
+                    if wkt and not wkt.startswith("POI"):
+                        inherited = False
+
+                    names = [None] * len(hierarchy_levels)
+                    if level == "L0":
+                        path = str(record_id)
+                        names[0] = name
+                        fixup_required = inherited or \
+                                         row.path != path or \
+                                         row.L0 != name or \
+                                         not wkt or lat is None
+                        inherited = False
+                    else:
+                        parent = row.parent
+                        if parent:
+                            ancestor = tree.get(parent)
+                            if not ancestor or ancestor[0] >= index:
+                                current.log.error("Parent of %s Location ID %s has invalid level: %s" % \
+                                                  (level or "specific", record_id, parent))
+                                continue
+                            path = "%s/%s" % (ancestor[1], record_id)
+                            names = list(ancestor[2])
+                            parent_lat, parent_lon = ancestor[3:]
+                        else:
+                            path = str(record_id)
+                            parent_lat = parent_lon = None
+                        if level:
+                            names[index] = name
+
+                        if inherited or lat is None or lon is None:
+                            fixup_required = True
+                            inherited = True
+                            lat = parent_lat
+                            lon = parent_lon
+                            if level != "L1":
+                                wkt = None
+                        else:
+                            fixup_required = row.path != path or not wkt or \
+                                             names != [row[l] for l in hierarchy_levels]
+
+                    if fixup_required:
+                        form_vars = Storage(inherited = inherited,
+                                            path = path,
+                                            lat = lat,
+                                            lon = lon,
+                                            wkt = wkt or None,
+                                            lat_min = row.lat_min,
+                                            lon_min = row.lon_min,
+                                            lat_max = row.lat_max,
+                                            lon_max = row.lon_max,
+                                            )
+                        for i, l in enumerate(hierarchy_levels):
+                            form_vars[l] = names[i]
+
+                        if inherited or not wkt or row.lat is None:
+                            # Calculate Bounds / Centroid / WKT / the_geom
+                            if not wkt:
+                                # Point
+                                form_vars.gis_feature_type = "1"
+                            form = Storage(vars = form_vars,
+                                           errors = Storage(),
+                                           )
+                            wkt_centroid(form)
+                            if form.errors:
+                                # Keep the geometry, but still update path
+                                # and Lx, so that the descendants get processed
+                                current.log.error("S3GIS: Location ID %s: %s" % \
+                                                  (record_id, form.errors))
+                                for fn in geometry + ("inherited",):
+                                    form_vars.pop(fn, None)
+                            else:
+                                wkt = form_vars.wkt
+                                if wkt and not wkt.startswith("POI"):
+                                    # Polygons aren't inherited
+                                    form_vars.inherited = False
+                        else:
+                            # Geometry unchanged
+                            for fn in geometry:
+                                form_vars.pop(fn, None)
+
+                        # Write only what has changed
+                        update = {}
+                        for fn, value in form_vars.items():
+                            if fn in geometry or row[fn] != value:
+                                update[fn] = value
+                        if update:
+                            updates[record_id] = update
+
+                        lat = form_vars.get("lat", lat)
+                        lon = form_vars.get("lon", lon)
+
+                    if level:
+                        tree[record_id] = (index, path, names, lat, lon)
+
+                GIS._update_locations(updates)
+                if commit:
+                    db.commit()
+
+                updated += len(updates)
+                done += len(rows)
+                progress(level, done, total)
+
+            results[level] = updated
+
+        return results
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _update_locations(updates):
+        """
+            Write a batch of location updates, using one UPDATE for all
+            locations with the same values, and one for all paths
+
+            @param updates: dict {location_id: {fieldname: value}}
+        """
+
+        if not updates:
+            return
+
+        db = current.db
+        table = current.s3db.gis_location
+
+        paths = {}
+        groups = {}
+        for record_id, update in updates.items():
+            if "path" in update:
+                paths[record_id] = update.pop("path")
+            if update:
+                key = tuple(sorted(update.items()))
+                if key in groups:
+                    groups[key].append(record_id)
+                else:
+                    groups[key] = [record_id]
+
+        for key, record_ids in groups.items():
+            db(table.id.belongs(record_ids)).update(**dict(key))
+
+        if paths:
+            # CASE expression (nested, so limit the depth)
+            record_ids = paths.keys()
+            for i in xrange(0, len(record_ids), 100):
+                chunk = record_ids[i:i+100]
+                path = table.path
+                for record_id in chunk:
+                    path = (table.id == record_id).case(paths[record_id], path)
+                db(table.id.belongs(chunk)).update(path = path)
+
     # -------------------------------------------------------------------------
     @staticmethod
     def wkt_centroid(form):
@@ -5917,6 +6170,16 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
         """
 
         table = current.s3db.gis_location
+
+        # Use the spatial index, if available
+        candidates = S3SpatialIndex.candidates(lon_min,
+                                               lat_min,
+                                               lon_max,
+                                               lat_max,
+                                               )
+        if candidates is not None:
+            return table.id.belongs(candidates)
+
         query = (table.lat_min <= lat_max) & \
                 (table.lat_max >= lat_min) & \
                 (table.lon_min <= lon_max) & \
@@ -6337,6 +6600,319 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
                    plugins = plugins,
                    )
 
+# =============================================================================
+class S3SpatialIndex(object):
+    """
+        In-process spatial index of the bounding boxes of all locations,
+        used to pre-select candidates for spatial queries where the
+        database has no spatial extensions (=no PostGIS)
+
+        - shared by all requests in the same process, built lazily
+          on first use
+        - uses an R-tree (rtree module) if available, otherwise a
+          simple grid index
+        - records written in this process are updated immediately
+          (see gis_location_onaccept), records written by other
+          processes are picked up by a delta query on modified_on
+          before every lookup
+
+        Configured with:
+            settings.gis.spatial_index (default False)
+    """
+
+    # The process-wide instance
+    instance = None
+
+    # Cell size (degrees) of the grid index
+    CELL_SIZE = 1.0
+
+    # Items spanning more cells than this are checked linearly
+    MAX_CELLS = 64
+
+    # Overlap for delta queries (to tolerate transactions which were
+    # committed after the last refresh, but have earlier timestamps)
+    REFRESH_OVERLAP = datetime.timedelta(minutes=5)
+
+    def __init__(self):
+        """ Constructor """
+
+        self.bounds = {}
+        self.refreshed = None
+        self.lock = threading.RLock()
+
+        try:
+            from rtree import index as rtree_index
+        except ImportError:
+            current.log.info("S3GIS",
+                             "Install rtree for a faster spatial index")
+            self.rtree = None
+            self.cells = {}
+            self.large = set()
+        else:
+            self.rtree = rtree_index.Index()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def shared(cls):
+        """
+            Get the process-wide instance of the spatial index, build
+            it if necessary and bring it up to date
+
+            @return: the S3SpatialIndex instance, or None if the spatial
+                     index is disabled or not needed (spatial DB)
+        """
+
+        settings = current.deployment_settings
+        if settings.get_gis_spatialdb() or \
+           not settings.get_gis_spatial_index():
+            return None
+
+        index = cls.instance
+        if index is None:
+            index = cls.instance = cls()
+        index.refresh()
+        return index
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def candidates(cls, lon_min, lat_min, lon_max, lat_max, limit=5000):
+        """
+            Get the IDs of all locations with bounds intersecting a bbox
+
+            @param lon_min: the western boundary of the bbox
+            @param lat_min: the southern boundary of the bbox
+            @param lon_max: the eastern boundary of the bbox
+            @param lat_max: the northern boundary of the bbox
+            @param limit: the maximum number of candidates to return
+
+            @return: a set of location IDs, or None if the spatial index
+                     is not available or there are more than limit
+                     candidates (=better to filter in the database)
+        """
+
+        index = cls.shared()
+        if index is None:
+            return None
+        ids = index.intersection(lon_min, lat_min, lon_max, lat_max)
+        if limit and len(ids) > limit:
+            return None
+        return ids
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def update(cls, location_id):
+        """
+            Update the index entry for a location (onaccept)
+
+            @param location_id: the location record ID
+        """
+
+        index = cls.instance
+        if index is not None:
+            table = current.s3db.gis_location
+            query = (table.id == location_id)
+            index.load(query, refresh=False)
+
+    # -------------------------------------------------------------------------
+    def refresh(self):
+        """
+            Load the bounds of all locations modified since the
+            last refresh (or all locations if not loaded yet)
+        """
+
+        table = current.s3db.gis_location
+        now = datetime.datetime.utcnow()
+
+        with self.lock:
+            refreshed = self.refreshed
+            if refreshed is None:
+                query = (table.deleted != True)
+            else:
+                query = (table.modified_on >= refreshed - self.REFRESH_OVERLAP)
+            self.load(query)
+            self.refreshed = now
+
+    # -------------------------------------------------------------------------
+    def load(self, query, refresh=True):
+        """
+            Load the bounds of locations into the index
+
+            @param query: the query to select the locations
+            @param refresh: this is a (full or delta) refresh
+        """
+
+        table = current.s3db.gis_location
+        rows = current.db(query).select(table.id,
+                                        table.lat,
+                                        table.lon,
+                                        table.lat_min,
+                                        table.lon_min,
+                                        table.lat_max,
+                                        table.lon_max,
+                                        table.deleted,
+                                        )
+        with self.lock:
+            if not refresh and self.refreshed is None:
+                # Not loaded yet
+                return
+            insert = self.insert
+            remove = self.remove
+            for row in rows:
+                location_id = row.id
+                if row.deleted:
+                    remove(location_id)
+                    continue
+                lat_min, lat_max = row.lat_min, row.lat_max
+                lon_min, lon_max = row.lon_min, row.lon_max
+                if None in (lat_min, lat_max, lon_min, lon_max):
+                    lat, lon = row.lat, row.lon
+                    if lat is None or lon is None:
+                        remove(location_id)
+                        continue
+                    lat_min = lat_max = lat
+                    lon_min = lon_max = lon
+                insert(location_id, (lon_min, lat_min, lon_max, lat_max))
+
+    # -------------------------------------------------------------------------
+    def insert(self, location_id, bounds):
+        """
+            Add or replace an entry in the index
+
+            @param location_id: the location record ID
+            @param bounds: the bounds (lon_min, lat_min, lon_max, lat_max)
+        """
+
+        current_bounds = self.bounds.get(location_id)
+        if current_bounds == bounds:
+            return
+        elif current_bounds is not None:
+            self.remove(location_id)
+
+        self.bounds[location_id] = bounds
+        if self.rtree is not None:
+            self.rtree.insert(location_id, bounds)
+        else:
+            cells = self.cells_for(bounds)
+            if cells is None:
+                self.large.add(location_id)
+            else:
+                index = self.cells
+                for cell in cells:
+                    if cell in index:
+                        index[cell].add(location_id)
+                    else:
+                        index[cell] = set([location_id])
+
+    # -------------------------------------------------------------------------
+    def remove(self, location_id):
+        """
+            Remove an entry from the index
+
+            @param location_id: the location record ID
+        """
+
+        bounds = self.bounds.pop(location_id, None)
+        if bounds is None:
+            return
+        if self.rtree is not None:
+            self.rtree.delete(location_id, bounds)
+        else:
+            cells = self.cells_for(bounds)
+            if cells is None:
+                self.large.discard(location_id)
+            else:
+                index = self.cells
+                for cell in cells:
+                    items = index.get(cell)
+                    if items:
+                        items.discard(location_id)
+                        if not items:
+                            del index[cell]
+
+    # -------------------------------------------------------------------------
+    def intersection(self, lon_min, lat_min, lon_max, lat_max):
+        """
+            Find all entries with bounds intersecting a bbox
+
+            @param lon_min: the western boundary of the bbox
+            @param lat_min: the southern boundary of the bbox
+            @param lon_max: the eastern boundary of the bbox
+            @param lat_max: the northern boundary of the bbox
+
+            @return: a set of location IDs
+        """
+
+        if lon_min > lon_max or lat_min > lat_max:
+            return set()
+
+        with self.lock:
+            if self.rtree is not None:
+                return set(self.rtree.intersection((lon_min,
+                                                    lat_min,
+                                                    lon_max,
+                                                    lat_max)))
+
+            # Collect candidates from the grid
+            cells = self.cells
+            candidates = set(self.large)
+            x0, y0, x1, y1 = self.cell_range((lon_min, lat_min, lon_max, lat_max))
+            if (x1 - x0 + 1) * (y1 - y0 + 1) > len(cells):
+                # Cheaper to check all non-empty cells
+                for (x, y), items in cells.items():
+                    if x0 <= x <= x1 and y0 <= y <= y1:
+                        candidates |= items
+            else:
+                for x in xrange(x0, x1 + 1):
+                    for y in xrange(y0, y1 + 1):
+                        items = cells.get((x, y))
+                        if items:
+                            candidates |= items
+
+            # Exact bbox check
+            bounds = self.bounds
+            ids = set()
+            for location_id in candidates:
+                b = bounds[location_id]
+                if b[0] <= lon_max and b[2] >= lon_min and \
+                   b[1] <= lat_max and b[3] >= lat_min:
+                    ids.add(location_id)
+            return ids
+
+    # -------------------------------------------------------------------------
+    def cell_range(self, bounds):
+        """
+            Get the range of grid cells covered by a bbox
+
+            @param bounds: the bounds (lon_min, lat_min, lon_max, lat_max)
+
+            @return: tuple (x_min, y_min, x_max, y_max)
+        """
+
+        size = self.CELL_SIZE
+        lon_min, lat_min, lon_max, lat_max = bounds
+        return (int(math.floor(lon_min / size)),
+                int(math.floor(lat_min / size)),
+                int(math.floor(lon_max / size)),
+                int(math.floor(lat_max / size)),
+                )
+
+    # -------------------------------------------------------------------------
+    def cells_for(self, bounds):
+        """
+            Get the grid cells covered by the bounds of an entry
+
+            @param bounds: the bounds (lon_min, lat_min, lon_max, lat_max)
+
+            @return: list of cells (x, y), or None if the entry spans
+                     more than MAX_CELLS cells
+        """
+
+        x0, y0, x1, y1 = self.cell_range(bounds)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > self.MAX_CELLS:
+            return None
+        return [(x, y) for x in xrange(x0, x1 + 1)
+                       for y in xrange(y0, y1 + 1)]
+
 # =============================================================================
 class MAP(DIV):
     """
@@ -427,6 +427,10 @@ class S3HierarchyCRUD(S3Method):
 class S3Hierarchy(object):
     """ Class representing an object hierarchy """
 
+    # Process-wide snapshots of the stored hierarchies, {tablename: (version, nodes)},
+    # the nodes are shared between requests and must never be modified in-place
+    snapshots = {}
+
     # -------------------------------------------------------------------------
     def __init__(self,
                  tablename=None,
@@ -457,6 +461,7 @@ class S3Hierarchy(object):
 
         self.__theset = None
         self.__flags = None
+        self.__labels = None
 
         self.__nodes = None
         self.__roots = None
@@ -479,6 +484,9 @@ class S3Hierarchy(object):
                              "c": <category>,
                              "s": set(child nodes)
                 }}
+
+            NB the nodes can be shared with the process-wide snapshot,
+               so use add/move/remove rather than modifying them directly
         """
 
         if self.__theset is None:
@@ -527,6 +535,21 @@ class S3Hierarchy(object):
         nodes = self.nodes
         return self.__roots
 
+    # -------------------------------------------------------------------------
+    @property
+    def persistent(self):
+        """
+            Whether this hierarchy can be stored in the database, i.e.
+            whether all writes affecting it are tracked - which for
+            link table hierarchies requires the link table to be
+            configured with hierarchy_of=<tablename>
+        """
+
+        link = self.link
+        if link is None:
+            return True
+        return current.s3db.get_config(link, "hierarchy_of") == self.tablename
+
     # -------------------------------------------------------------------------
     @property
     def pkey(self):
@@ -595,16 +618,21 @@ class S3Hierarchy(object):
                 hierarchy = hierarchies[tablename]
                 self.__theset = hierarchy["nodes"]
                 self.__flags = hierarchy["flags"]
+                self.__labels = hierarchy.setdefault("labels", {})
             else:
                 self.__theset = dict()
                 self.__flags = dict()
+                self.__labels = dict()
                 self.load()
                 hierarchy = {"nodes": self.__theset,
-                             "flags": self.__flags}
+                             "flags": self.__flags,
+                             "labels": self.__labels,
+                             }
                 hierarchies[tablename] = hierarchy
         else:
             self.__theset = dict()
             self.__flags = dict()
+            self.__labels = dict()
         return
 
     # -------------------------------------------------------------------------
@@ -632,7 +660,12 @@ class S3Hierarchy(object):
 
     # -------------------------------------------------------------------------
     def load(self):
-        """ Try loading the hierarchy from s3_hierarchy """
+        """
+            Try loading the hierarchy from s3_hierarchy_node; re-uses the
+            process-wide snapshot if it is current, or else applies only
+            the changes since the snapshot (unless the snapshot predates
+            the last full save, which replaces all stored nodes)
+        """
 
         if not self.config:
             return
@@ -643,35 +676,83 @@ class S3Hierarchy(object):
             self.__status(dirty=True)
             return
 
-        htable = current.s3db.s3_hierarchy
-        query = (htable.tablename == tablename)
-        row = current.db(query).select(htable.dirty,
-                                       htable.hierarchy,
-                                       limitby=(0, 1)).first()
-        if row and not row.dirty:
-            data = row.hierarchy
-            theset = self.__theset
-            theset.clear()
-            for node_id, item in data["nodes"].items():
-                theset[long(node_id)] = {"p": item["p"],
-                                         "c": item["c"],
-                                         "s": set(item["s"]) \
-                                              if item["s"] else set()}
-            self.__status(dirty=False,
-                          dbupdate=None,
-                          dbstatus=True)
+        if not self.persistent:
+            # Not stored, must be read from the target table
+            self.__status(dirty=True, dbupdate=None, dbstatus=False)
             return
-        else:
+
+        db = current.db
+        s3db = current.s3db
+
+        htable = s3db.s3_hierarchy
+        query = (htable.tablename == tablename)
+        row = db(query).select(htable.dirty,
+                               htable.version,
+                               htable.base_version,
+                               limitby=(0, 1)).first()
+        if not row or row.dirty or not row.version:
+            # Not stored yet, dirty, or stored in legacy format
             self.__status(dirty=True,
                           dbupdate=None,
                           dbstatus=False if row else None)
+            return
+
+        version = row.version
+        snapshot = self.snapshots.get(tablename)
+        if snapshot and not (row.base_version or 0) <= snapshot[0] <= version:
+            # Stored nodes have been replaced since the snapshot
+            snapshot = None
+
+        theset = self.__theset
+        theset.clear()
+
+        flags = self.__flags
+        if snapshot and snapshot[0] == version:
+            # Snapshot is current
+            theset.update(snapshot[1])
+            flags["shared"] = snapshot[1]
+        else:
+            ntable = s3db.s3_hierarchy_node
+            query = (ntable.tablename == tablename)
+            if snapshot:
+                # Apply only the changes since the snapshot
+                theset.update(snapshot[1])
+                flags["shared"] = snapshot[1]
+                query &= (ntable.version > snapshot[0])
+            else:
+                query &= (ntable.deleted != True)
+            rows = db(query).select(ntable.node_id,
+                                    ntable.parent_id,
+                                    ntable.category,
+                                    ntable.deleted,
+                                    orderby = ntable.version,
+                                    )
+            move = self.move
+            remove = self.remove
+            for row in rows:
+                if row.deleted:
+                    remove(row.node_id)
+                else:
+                    move(row.node_id, row.parent_id, row.category)
+
+            # Update the snapshot
+            nodes = dict(theset)
+            self.snapshots[tablename] = (version, nodes)
+            flags["shared"] = nodes
+
+        self.__status(dirty=False,
+                      dbupdate=None,
+                      dbstatus=True)
         return
 
     # -------------------------------------------------------------------------
     def save(self):
-        """ Save this hierarchy in s3_hierarchy """
+        """
+            Save this hierarchy in s3_hierarchy_node (replacing all stored
+            nodes, so that other processes must fully reload it, see load)
+        """
 
-        if not self.config:
+        if not self.config or not self.persistent:
             return
         tablename = self.tablename
 
@@ -679,35 +760,94 @@ class S3Hierarchy(object):
         if not self.__status("dbupdate"):
             return
 
-        # Serialize the theset
-        nodes_dict = dict()
-        for node_id, node in theset.items():
-            nodes_dict[node_id] = {"p": node["p"],
-                                   "c": node["c"],
-                                   "s": list(node["s"]) \
-                                        if node["s"] else []}
-
-        # Generate record
-        data = {"tablename": tablename,
-                "dirty": False,
-                "hierarchy": {"nodes": nodes_dict}
-                }
+        version = self.__version(clean=True)
+
+        # Replace all stored nodes
+        ntable = current.s3db.s3_hierarchy_node
+        current.db(ntable.tablename == tablename).delete()
+        ntable.bulk_insert([{"tablename": tablename,
+                             "node_id": node_id,
+                             "parent_id": node["p"],
+                             "category": node["c"],
+                             "version": version,
+                             } for node_id, node in theset.items()])
+
+        # Update status
+        self.__status(dirty=False, dbupdate=None, dbstatus=True)
+        return
 
-        # Get current entry
+    # -------------------------------------------------------------------------
+    def __version(self, clean=False):
+        """
+            Increment the version number of the stored hierarchy
+
+            @param clean: also remove the dirty-flag and set the base
+                          version (full save)
+
+            @return: the new version number, or None if the stored
+                     hierarchy is dirty or does not exist (unless clean)
+        """
+
+        tablename = self.tablename
+
+        db = current.db
         htable = current.s3db.s3_hierarchy
+
         query = (htable.tablename == tablename)
-        row = current.db(query).select(htable.id,
-                                       limitby=(0, 1)).first()
+        data = {"version": htable.version.coalesce(0) + 1}
+        if clean:
+            data["base_version"] = data["version"]
+            data["dirty"] = False
+            data["hierarchy"] = None
+            if not db(query).update(**data):
+                htable.insert(tablename = tablename,
+                              dirty = False,
+                              version = 1,
+                              base_version = 1,
+                              )
+        elif not db(query & (htable.dirty != True)).update(**data):
+            return None
 
-        if row:
-            # Update record
-            row.update_record(**data)
-        else:
-            # Create new record
-            htable.insert(**data)
+        row = db(query).select(htable.version, limitby=(0, 1)).first()
+        return row.version if row else None
 
-        # Update status
-        self.__status(dirty=False, dbupdate=None, dbstatus=True)
+    # -------------------------------------------------------------------------
+    def __persist(self, node_ids):
+        """
+            Write changes of particular nodes to s3_hierarchy_node
+
+            @param node_ids: the IDs of the changed nodes (nodes which
+                             are no longer in the hierarchy will be
+                             marked as deleted)
+        """
+
+        if not self.__status("dbstatus", True) or not self.persistent:
+            # Stored hierarchy is dirty, or not stored at all
+            return
+        version = self.__version()
+        if version is None:
+            return
+
+        tablename = self.tablename
+        theset = self.__theset
+
+        db = current.db
+        ntable = current.s3db.s3_hierarchy_node
+
+        for node_id in node_ids:
+            node = theset.get(node_id)
+            if node:
+                data = {"parent_id": node["p"],
+                        "category": node["c"],
+                        "deleted": False,
+                        }
+            else:
+                data = {"deleted": True}
+            data["version"] = version
+            query = (ntable.tablename == tablename) & \
+                    (ntable.node_id == node_id)
+            if not db(query).update(**data) and node:
+                ntable.insert(tablename=tablename, node_id=node_id, **data)
         return
 
     # -------------------------------------------------------------------------
@@ -752,6 +892,152 @@ class S3Hierarchy(object):
             flags["dbstatus"] = False
         return
 
+    # -------------------------------------------------------------------------
+    @classmethod
+    def register(cls, table):
+        """
+            Register write hooks with a table, to update stored
+            hierarchies incrementally (called from S3Model.define_table)
+
+            @param table: the Table
+        """
+
+        tablename = table._tablename
+
+        table._after_insert.append(
+            lambda fields, record_id: \
+                cls._after_insert(tablename, fields, record_id))
+        table._before_update.append(
+            lambda dbset, fields: cls._before_update(tablename, dbset, fields))
+        table._after_update.append(
+            lambda dbset, fields: cls._after_update(tablename, dbset, fields))
+        table._after_delete.append(
+            lambda dbset: cls._after_delete(tablename, dbset))
+        return
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def _watch(cls, tablename):
+        """
+            Find the hierarchy affected by writes to a table
+
+            @param tablename: the name of the table
+
+            @return: tuple (hierarchy, key, fieldnames) with the hierarchy,
+                     the name of the field holding the node ID, and the
+                     names of the fields relevant for the hierarchy; or
+                     None if the table does not belong to any hierarchy
+        """
+
+        get_config = current.s3db.get_config
+
+        try:
+            if get_config(tablename, "hierarchy"):
+                # Hierarchical table
+                hierarchy = cls(tablename)
+                key = hierarchy.pkey.name
+                fieldnames = set((key, "deleted"))
+                if hierarchy.link is None:
+                    fieldnames.add(hierarchy.fkey.name)
+                if hierarchy.ckey:
+                    fieldnames.add(hierarchy.ckey)
+            else:
+                # Link table of a hierarchy?
+                target = get_config(tablename, "hierarchy_of")
+                if not target or not get_config(target, "hierarchy"):
+                    return None
+                hierarchy = cls(target)
+                if hierarchy.link != tablename:
+                    return None
+                key = hierarchy.lkey
+                fieldnames = set((key, hierarchy.fkey.name, "deleted"))
+        except (AttributeError, SyntaxError):
+            # Invalid hierarchy configuration
+            return None
+
+        return hierarchy, key, fieldnames
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def _after_insert(cls, tablename, fields, record_id):
+        """
+            Add a new node to the hierarchy
+
+            @param tablename: the name of the table
+            @param fields: the inserted fields
+            @param record_id: the record ID
+        """
+
+        watch = cls._watch(tablename)
+        if watch:
+            hierarchy, key, fieldnames = watch
+            if key == current.s3db[tablename]._id.name:
+                node_id = long(record_id)
+            else:
+                node_id = fields.get(key)
+            if node_id:
+                hierarchy.refresh([node_id])
+        return
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def _before_update(cls, tablename, dbset, fields):
+        """
+            Capture the node IDs affected by an update (before the
+            update, because the update could change the node keys)
+
+            @param tablename: the name of the table
+            @param dbset: the Set to be updated
+            @param fields: the fields to update
+        """
+
+        watch = cls._watch(tablename)
+        if watch:
+            hierarchy, key, fieldnames = watch
+            if fieldnames.intersection(fields):
+                field = current.s3db[tablename][key]
+                node_ids = set(row[field] for row in dbset.select(field))
+                if fields.get(key):
+                    node_ids.add(fields[key])
+                dbset._hierarchy_update = (hierarchy, node_ids)
+        return False
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def _after_update(cls, tablename, dbset, fields):
+        """
+            Move or remove the nodes affected by an update
+
+            @param tablename: the name of the table
+            @param dbset: the updated Set
+            @param fields: the updated fields
+        """
+
+        update = getattr(dbset, "_hierarchy_update", None)
+        if update:
+            del dbset._hierarchy_update
+            hierarchy, node_ids = update
+            hierarchy.refresh(node_ids)
+        return
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def _after_delete(cls, tablename, dbset):
+        """
+            Rebuild the hierarchy after a hard delete (the deleted
+            node IDs can no longer be determined)
+
+            @param tablename: the name of the table
+            @param dbset: the Set deleted
+        """
+
+        watch = cls._watch(tablename)
+        if watch:
+            hierarchy = watch[0]
+            cls.dirty(hierarchy.tablename)
+            hierarchy.save()
+        return
+
     # -------------------------------------------------------------------------
     def read(self):
         """ Rebuild this hierarchy from the target table """
@@ -778,6 +1064,7 @@ class S3Hierarchy(object):
         rows = current.db(query).select(left = self.left, *fields)
 
         self.__theset.clear()
+        self.__flags.pop("shared", None)
 
         add = self.add
         cfield = table[ckey]
@@ -799,6 +1086,68 @@ class S3Hierarchy(object):
 
         return
 
+    # -------------------------------------------------------------------------
+    def refresh(self, node_ids):
+        """
+            Re-read particular nodes from the target table and patch them
+            into the hierarchy (incremental alternative to dirty() after
+            updating the target table)
+
+            @param node_ids: iterable of node IDs
+        """
+
+        if not self.config:
+            return
+        node_ids = set(node_id for node_id in node_ids if node_id)
+        if not node_ids:
+            return
+
+        tablename = self.tablename
+        theset = self.theset
+
+        table = current.s3db[tablename]
+
+        pkey = self.pkey
+        fkey = self.fkey
+        ckey = self.ckey
+
+        fields = [pkey, fkey]
+        if ckey is not None:
+            cfield = table[ckey]
+            fields.append(cfield)
+
+        query = pkey.belongs(node_ids)
+        if "deleted" in table:
+            query &= (table.deleted != True)
+        rows = current.db(query).select(left = self.left, *fields)
+
+        found = {}
+        for row in rows:
+            found[row[pkey]] = (row[fkey], row[cfield] if ckey else None)
+
+        changed = set(node_ids)
+        for node_id in node_ids:
+            if node_id in found:
+                parent_id, category = found[node_id]
+                if parent_id and parent_id not in theset:
+                    # Store the new parent node, too
+                    changed.add(parent_id)
+                self.move(node_id, parent_id=parent_id, category=category)
+            else:
+                self.remove(node_id)
+
+        if self.__status("dbupdate"):
+            # Stored hierarchy was dirty => replace it
+            self.save()
+        else:
+            self.__persist(changed)
+
+        # Remove subset
+        self.__roots = None
+        self.__nodes = None
+
+        return
+
     # -------------------------------------------------------------------------
     def __keys(self):
         """ Introspect the key fields in the hierarchical table """
@@ -825,6 +1174,9 @@ class S3Hierarchy(object):
 
             # Assume self-reference
             pkey = table._id
+            self.__link = None
+            self.__lkey = None
+            self.__left = None
 
             for field in table:
                 ftype = str(field.type)
@@ -995,6 +1347,8 @@ class S3Hierarchy(object):
                 if result is None:
                     if not cascade:
                         current.db.rollback()
+                        # Re-read the hierarchy after rollback
+                        self.__status(dirty=True)
                     return None
                 else:
                     total += result
@@ -1010,10 +1364,15 @@ class S3Hierarchy(object):
             else:
                 if not cascade:
                     current.db.rollback()
+                    # Re-read the hierarchy after rollback
+                    self.__status(dirty=True)
                 return None
 
         if not cascade and total:
-            self.dirty(tablename)
+            # Stored hierarchy has been updated by the write hooks,
+            # just remove the subset
+            self.__roots = None
+            self.__nodes = None
 
         return total
 
@@ -1030,7 +1389,7 @@ class S3Hierarchy(object):
         theset = self.__theset
 
         if node_id in theset:
-            node = theset[node_id]
+            node = self.__writable(node_id)
             if category is not None:
                 node["c"] = category
         elif node_id:
@@ -1042,13 +1401,55 @@ class S3Hierarchy(object):
             if parent_id not in theset:
                 parent = self.add(parent_id, None, None)
             else:
-                parent = theset[parent_id]
+                parent = self.__writable(parent_id)
             parent["s"].add(node_id)
         node["p"] = parent_id
 
         theset[node_id] = node
         return node
 
+    # -------------------------------------------------------------------------
+    def move(self, node_id, parent_id=None, category=DEFAULT):
+        """
+            Move a node to another parent node (or add it if it does
+            not exist yet), updating only the affected nodes
+
+            @param node_id: the node ID
+            @param parent_id: the new parent node ID
+            @param category: the new category (default: keep the current
+                             category)
+        """
+
+        theset = self.__theset
+
+        if node_id not in theset:
+            if category is DEFAULT:
+                category = None
+            return self.add(node_id, parent_id=parent_id, category=category)
+
+        node = self.__writable(node_id)
+        if category is not DEFAULT:
+            node["c"] = category
+
+        previous = node["p"]
+        if previous == parent_id and \
+           (not parent_id or
+            parent_id in theset and node_id in theset[parent_id]["s"]):
+            # Parent unchanged
+            return node
+
+        if previous and previous in theset:
+            self.__writable(previous)["s"].discard(node_id)
+        if parent_id:
+            if parent_id not in theset:
+                parent = self.add(parent_id, None, None)
+            else:
+                parent = self.__writable(parent_id)
+            parent["s"].add(node_id)
+        node["p"] = parent_id
+
+        return node
+
     # -------------------------------------------------------------------------
     def remove(self, node_id):
         """
@@ -1065,12 +1466,34 @@ class S3Hierarchy(object):
             return False
 
         parent_id = node["p"]
-        if parent_id:
-            parent = theset[parent_id]
-            parent["s"].discard(node_id)
+        if parent_id and parent_id in theset:
+            self.__writable(parent_id)["s"].discard(node_id)
         del theset[node_id]
+        self.__labels.pop(node_id, None)
         return True
 
+    # -------------------------------------------------------------------------
+    def __writable(self, node_id):
+        """
+            Get a node for update, copying it first if it is shared
+            with the process-wide snapshot (copy-on-write)
+
+            @param node_id: the node ID
+
+            @return: the node
+        """
+
+        theset = self.__theset
+        node = theset[node_id]
+
+        shared = self.__flags.get("shared")
+        if shared and shared.get(node_id) is node:
+            node = theset[node_id] = {"p": node["p"],
+                                      "c": node["c"],
+                                      "s": set(node["s"]),
+                                      }
+        return node
+
     # -------------------------------------------------------------------------
     def __subset(self):
         """ Generate the subset of accessible nodes which match the filter """
@@ -1078,7 +1501,7 @@ class S3Hierarchy(object):
         theset = self.theset
 
         roots = set()
-        subset = {}
+        subset = set()
 
         resource = current.s3db.resource(self.tablename,
                                          filter = self.filter)
@@ -1112,15 +1535,22 @@ class S3Hierarchy(object):
                     ids.add(parent_id)
                 elif not parent_id:
                     roots.add(node_id)
-                subset[node_id] = dict(node)
+                subset.add(node_id)
 
-            # Update the descendants
-            for node in subset.values():
-                node["s"] = set(node_id for node_id in node["s"]
-                                        if node_id in subset)
+        if len(subset) == len(theset):
+            # Subset is complete, so no need to copy the nodes
+            nodes = theset
+        else:
+            nodes = {}
+            for node_id in subset:
+                node = dict(theset[node_id])
+                # Update the descendants
+                node["s"] = set(child_id for child_id in node["s"]
+                                         if child_id in subset)
+                nodes[node_id] = node
 
         self.__roots = roots
-        self.__nodes = subset
+        self.__nodes = nodes
         return
 
     # -------------------------------------------------------------------------
@@ -1379,8 +1809,8 @@ class S3Hierarchy(object):
     # -------------------------------------------------------------------------
     def _represent(self, node_ids=None, renderer=None):
         """
-            Represent nodes as labels, the labels are stored in the
-            nodes as attribute "l".
+            Represent nodes as labels, the labels are stored per request
+            (separately from the nodes, which can be shared)
 
             @param node_ids: the node IDs (None for all nodes)
             @param renderer: the representation method (falls back
@@ -1389,17 +1819,14 @@ class S3Hierarchy(object):
         """
 
         theset = self.theset
-        LABEL = "l"
+        labels = self.__labels
 
         if node_ids is None:
             node_ids = self.nodes.keys()
 
         pending = set()
         for node_id in node_ids:
-            node = theset.get(node_id)
-            if not node:
-                continue
-            if LABEL not in node:
+            if node_id in theset and node_id not in labels:
                 pending.add(node_id)
 
         if renderer is None:
@@ -1414,17 +1841,17 @@ class S3Hierarchy(object):
             else:
                 renderer = s3_unicode
         if hasattr(renderer, "bulk"):
-            labels = renderer.bulk(list(pending), list_type = False)
-            for node_id, label in labels.items():
+            represented = renderer.bulk(list(pending), list_type = False)
+            for node_id, label in represented.items():
                 if node_id in theset:
-                    theset[node_id][LABEL] = label
+                    labels[node_id] = label
         else:
             for node_id in pending:
                 try:
                     label = renderer(node_id)
                 except:
                     label = s3_unicode(node_id)
-                theset[node_id][LABEL] = label
+                labels[node_id] = label
         return
 
     # -------------------------------------------------------------------------
@@ -1436,17 +1863,12 @@ class S3Hierarchy(object):
             @param represent: the node ID representation method
         """
 
-        LABEL = "l"
-
         theset = self.theset
-        node = theset.get(node_id)
-        if node:
-            if LABEL in node:
-                label = node[LABEL]
-            else:
+        if node_id in theset:
+            labels = self.__labels
+            if node_id not in labels:
                 self._represent(node_ids=[node_id], renderer=represent)
-            if LABEL in node:
-                label = node[LABEL]
+            label = labels.get(node_id)
             if type(label) is unicode:
                 try:
                     label = label.encode("utf-8")
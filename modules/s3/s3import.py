@@ -58,10 +58,11 @@ from gluon import *
 from gluon.storage import Storage, Messages
 from gluon.tools import callback, fetch
 
+from s3dal import Row
 from s3datetime import s3_utc
 from s3rest import S3Method, S3Request
 from s3resource import S3Resource
-from s3utils import s3_mark_required, s3_has_foreign_key, s3_get_foreign_key, s3_unicode, s3_auth_user_represent_name
+from s3utils import s3_mark_required, s3_has_foreign_key, s3_get_foreign_key, s3_reconnect_forked, s3_unicode, s3_auth_user_represent_name
 from s3xml import S3XML
 
 # =============================================================================
@@ -2421,6 +2422,11 @@ class S3ImportItem(object):
                 if MCI in table.fields:
                     data[MCI] = self.mci
 
+                # Defer the insert in bulk commit mode
+                if job.bulk is not None:
+                    job.bulk.add(self, dict(data))
+                    return True
+
                 # Insert the new record
                 try:
                     success = table.insert(**dict(data))
@@ -2526,53 +2532,9 @@ class S3ImportItem(object):
 
         # Audit + onaccept on successful commits
         if self.committed:
-
-            # Create a pseudo-form for callbacks
-            form = Storage()
-            form.method = method
-            form.vars = self.data
-            prefix, name = tablename.split("_", 1)
-            if self.id:
-                form.vars.id = self.id
-
-            # Audit
-            current.audit(method, prefix, name,
-                          form = form,
-                          record = self.id,
-                          representation = "xml",
-                          )
-
-            # Prevent that record post-processing breaks time-delayed
-            # synchronization by implicitly updating "modified_on"
-            if MTIME in table.fields:
-                modified_on = table[MTIME]
-                modified_on_update = modified_on.update
-                modified_on.update = None
-            else:
-                modified_on_update = None
-
-            # Update super entity links
-            s3db.update_super(table, form.vars)
-            if method == CREATE:
-                # Set record owner
-                current.auth.s3_set_record_owner(table, self.id)
-            elif method == UPDATE:
-                # Update realm
-                update_realm = enforce_realm_update or \
-                               s3db.get_config(table, "update_realm")
-                if update_realm:
-                    current.auth.set_realm_entity(table, self.id,
-                                                  force_update = True,
-                                                  )
-            # Onaccept
-            key = "%s_onaccept" % method
-            onaccept = current.deployment_settings.get_import_callback(tablename, key)
-            if onaccept:
-                callback(onaccept, form, tablename=tablename)
-
-            # Restore modified_on.update
-            if modified_on_update is not None:
-                modified_on.update = modified_on_update
+            self._postprocess(method,
+                              enforce_realm_update = enforce_realm_update,
+                              )
 
         # Update referencing items
         if self.update and self.id:
@@ -2598,6 +2560,81 @@ class S3ImportItem(object):
 
         return True
 
+    # -------------------------------------------------------------------------
+    def _postprocess(self, method, enforce_realm_update=False, onaccept=True):
+        """
+            Audit and post-process a committed item (super-entity links,
+            record owner/realm and onaccept)
+
+            @param method: the import method
+            @param enforce_realm_update: always update the realm entity
+            @param onaccept: run the onaccept callback (False if the
+                             caller runs it for multiple items at once)
+
+            @return: the pseudo-form for callbacks
+        """
+
+        s3db = current.s3db
+
+        METHOD = self.METHOD
+        CREATE = METHOD.CREATE
+        UPDATE = METHOD.UPDATE
+
+        MTIME = current.xml.MTIME
+
+        table = self.table
+        tablename = self.tablename
+
+        # Create a pseudo-form for callbacks
+        form = Storage()
+        form.method = method
+        form.vars = self.data
+        prefix, name = tablename.split("_", 1)
+        if self.id:
+            form.vars.id = self.id
+
+        # Audit
+        current.audit(method, prefix, name,
+                      form = form,
+                      record = self.id,
+                      representation = "xml",
+                      )
+
+        # Prevent that record post-processing breaks time-delayed
+        # synchronization by implicitly updating "modified_on"
+        if MTIME in table.fields:
+            modified_on = table[MTIME]
+            modified_on_update = modified_on.update
+            modified_on.update = None
+        else:
+            modified_on_update = None
+
+        # Update super entity links
+        s3db.update_super(table, form.vars)
+        if method == CREATE:
+            # Set record owner
+            current.auth.s3_set_record_owner(table, self.id)
+        elif method == UPDATE:
+            # Update realm
+            update_realm = enforce_realm_update or \
+                           s3db.get_config(table, "update_realm")
+            if update_realm:
+                current.auth.set_realm_entity(table, self.id,
+                                              force_update = True,
+                                              )
+        # Onaccept
+        if onaccept:
+            key = "%s_onaccept" % method
+            onaccept = current.deployment_settings.get_import_callback(tablename, key)
+            if onaccept:
+                callback(onaccept, form, tablename=tablename)
+
+        # Restore modified_on.update
+        if modified_on_update is not None:
+            modified_on.update = modified_on_update
+
+        return form
+
     # -------------------------------------------------------------------------
     def _dynamic_defaults(self, data):
         """
@@ -2918,7 +2955,8 @@ class S3ImportJob():
                  update_policy=None,
                  conflict_policy=None,
                  last_sync=None,
-                 onconflict=None):
+                 onconflict=None,
+                 tuids=None):
         """
             Constructor
 
@@ -2930,6 +2968,10 @@ class S3ImportJob():
             @param conflict_policy: the conflict resolution policy
             @param last_sync: the last synchronization time stamp (datetime)
             @param onconflict: custom conflict resolver function
+            @param tuids: map {(tablename, tuid): record_id} of records
+                          imported by previous jobs, to resolve tuid
+                          references across jobs (streaming import),
+                          will be updated with the records of this job
         """
 
         self.error = None # the last error
@@ -2947,6 +2989,15 @@ class S3ImportJob():
         self.items = Storage()
         self.references = []
 
+        # Duplicate indexes {tablename: S3DuplicateIndex}
+        self.duplicates = {}
+
+        # Bulk commit (during commit)
+        self.bulk = None
+
+        # Records imported by previous jobs
+        self.tuids = tuids
+
         self.job_table = None
         self.item_table = None
 
@@ -3337,6 +3388,20 @@ class S3ImportJob():
                         else:
                             # No element found, see if original record exists
                             _uid = import_uid(uid)
+                            if attr != UID:
+                                # Record imported by a previous job?
+                                tuids = self.tuids
+                                if tuids and (tablename, uid) in tuids:
+                                    _id = tuids[(tablename, uid)]
+                                    entry = Storage(tablename=tablename,
+                                                    element=None,
+                                                    uid=uid,
+                                                    id=_id,
+                                                    item_id=None)
+                                    reference_list.append(Storage(field=field,
+                                                                  element=reference,
+                                                                  entry=entry))
+                                continue
                             if _uid and _uid in id_map:
                                 _id = id_map[_uid]
                                 entry = Storage(tablename=tablename,
@@ -3439,6 +3504,11 @@ class S3ImportJob():
             self.resolve(item_id, import_list)
             if item_id not in import_list:
                 import_list.append(item_id)
+
+        # Look up duplicates in bulk
+        self.deduplicate(import_list)
+        duplicates = self.duplicates
+
         # Commit the items
         items = self.items
         count = 0
@@ -3450,10 +3520,17 @@ class S3ImportJob():
         tablename = self.table._tablename
 
         self.log = log_items
-        failed = False
+
+        # Bulk commit mode?
+        bulk = self.bulk = self.bulk_commit(import_list)
+
+        results = []
         for item_id in import_list:
             item = items[item_id]
-            error = None
+
+            if bulk is not None and bulk.conflicts(item):
+                # Item may depend on pending inserts
+                bulk.flush()
 
             if item.accepted is not False:
                 logged = False
@@ -3462,7 +3539,26 @@ class S3ImportJob():
                 # Field validation failed
                 logged = True
                 success = ignore_errors
+            results.append((item, success, logged))
+
+            # Keep the duplicate index in sync with the database
+            index = duplicates.get(item.tablename)
+            if index is not None:
+                index.update(item)
+
+            if bulk is not None and bulk.full():
+                bulk.flush()
 
+        if bulk is not None:
+            bulk.flush()
+            self.bulk = None
+
+        failed = False
+        for item, success, logged in results:
+
+            if bulk is not None and item.item_id in bulk.failed:
+                # Deferred insert failed
+                success = ignore_errors
             if not success:
                 failed = True
 
@@ -3492,6 +3588,17 @@ class S3ImportJob():
         if failed:
             return False
 
+        # Remember the records for tuid references from subsequent jobs
+        tuids = self.tuids
+        if tuids is not None:
+            TUID = current.xml.ATTRIBUTE.tuid
+            for item, success, logged in results:
+                element = item.element
+                if item.id and element is not None:
+                    tuid = element.get(TUID)
+                    if tuid:
+                        tuids[(item.tablename, tuid)] = item.id
+
         self.count = count
         self.mtime = mtime
         self.created = created
@@ -3499,6 +3606,93 @@ class S3ImportJob():
         self.deleted = deleted
         return True
 
+    # -------------------------------------------------------------------------
+    def bulk_commit(self, import_list):
+        """
+            Check whether this job can be committed in bulk commit mode,
+            i.e. with deferred multi-row inserts for new records: all
+            items must belong to the master table, without components
+            or references, and the table must not have a deduplicator
+            which can not use a duplicate index
+
+            @param import_list: the item IDs in commit order
+
+            @return: an S3BulkCommit instance, or None for normal
+                     (item-by-item) commit
+        """
+
+        chunksize = current.deployment_settings \
+                           .get_base_import_commit_chunksize()
+        if not chunksize or self.table is None:
+            return None
+
+        table = self.table
+        tablename = table._tablename
+        if table._before_insert:
+            return None
+
+        items = self.items
+        for item_id in import_list:
+            item = items[item_id]
+            if item.tablename != tablename or \
+               item.components or item.references or \
+               item.parent is not None:
+                return None
+
+        if current.s3db.get_config(tablename, "deduplicate") and \
+           tablename not in self.duplicates:
+            return None
+
+        return S3BulkCommit(self, table, chunksize=chunksize)
+
+    # -------------------------------------------------------------------------
+    def deduplicate(self, import_list):
+        """
+            Look up the duplicates for all items of this job with bulk
+            queries, per table, if the deduplicator of the table supports
+            it (i.e. has a prefetch method, like S3Duplicate); the item
+            deduplication will then use the resulting index instead of
+            querying the database for each item
+
+            @param import_list: the item IDs in commit order
+        """
+
+        chunksize = current.deployment_settings \
+                           .get_base_import_deduplicate_chunksize()
+        if not chunksize:
+            return
+
+        UID = current.xml.UID
+        synchronise_uuids = current.response.s3.synchronise_uuids
+
+        # Group the items that need deduplication by table
+        items = self.items
+        tables = {}
+        for item_id in import_list:
+            item = items[item_id]
+            if item.table is None or item.id or item.original is not None or \
+               not item.data or item.accepted is False:
+                continue
+            if UID in item.data and not synchronise_uuids:
+                # Identified by UID rather than by the deduplicator
+                continue
+            tablename = item.tablename
+            if tablename in tables:
+                tables[tablename].append(item)
+            else:
+                tables[tablename] = [item]
+
+        get_config = current.s3db.get_config
+        duplicates = self.duplicates
+        for tablename, titems in tables.items():
+            resolve = get_config(tablename, "deduplicate")
+            prefetch = getattr(resolve, "prefetch", None)
+            if prefetch is None:
+                continue
+            index = prefetch(titems, chunksize=chunksize)
+            if index is not None:
+                duplicates[tablename] = index
+
     # -------------------------------------------------------------------------
     def __define_tables(self):
         """
@@ -3687,6 +3881,263 @@ class S3ImportJob():
                     item.parent = parent
                 item.load_parent = None
 
+# =============================================================================
+class S3BulkCommit(object):
+    """
+        Bulk commit of new records for an import job: the inserts are
+        deferred, and then written in chunks (with multi-row INSERTs on
+        PostgreSQL), followed by the post-processing of the items
+
+        Onaccept-callbacks are run per item, unless the table configures
+        a batch-aware onaccept (create_bulk_onaccept or bulk_onaccept),
+        which is called once per chunk with a list of pseudo-forms.
+    """
+
+    def __init__(self, job, table, chunksize=500):
+        """
+            Constructor
+
+            @param job: the S3ImportJob
+            @param table: the table
+            @param chunksize: the maximum number of deferred inserts
+        """
+
+        self.job = job
+        self.table = table
+        self.chunksize = chunksize
+
+        # Deferred inserts [(item, data)]
+        self.pending = []
+        # Keys of the pending items (to detect dependencies)
+        self.keys = set()
+
+        # IDs of items whose insert failed
+        self.failed = set()
+
+        # Unique fields
+        self.unique = [fn for fn in table.fields
+                       if fn != table._id.name and table[fn].unique]
+
+    # -------------------------------------------------------------------------
+    def item_keys(self, item):
+        """
+            Get the keys by which an item could be identified as
+            duplicate of a pending item
+
+            @param item: the S3ImportItem
+
+            @return: a set of keys, or None if the item can not be
+                     keyed (=could depend on any pending item)
+        """
+
+        data = item.data
+        if not data:
+            return set()
+
+        keys = set()
+        UID = current.xml.UID
+        for fname in [UID] + self.unique:
+            value = data.get(fname)
+            if value is not None:
+                keys.add((fname, s3_unicode(value).lower()))
+
+        index = self.job.duplicates.get(item.tablename)
+        if index is not None:
+            key = index.primary_key(data)
+            if key is None:
+                return None
+            keys.add(("deduplicate", key))
+
+        return keys
+
+    # -------------------------------------------------------------------------
+    def conflicts(self, item):
+        """
+            Check whether an item may depend on pending inserts
+
+            @param item: the S3ImportItem
+        """
+
+        if not self.pending:
+            return False
+
+        keys = self.item_keys(item)
+        if keys is None:
+            return True
+
+        index = self.job.duplicates.get(item.tablename)
+        if index is not None and not index.valid:
+            # Deduplication must query the database
+            return True
+
+        return bool(keys & self.keys)
+
+    # -------------------------------------------------------------------------
+    def full(self):
+        """ Check whether the maximum number of pending inserts is reached """
+
+        return len(self.pending) >= self.chunksize
+
+    # -------------------------------------------------------------------------
+    def add(self, item, data):
+        """
+            Defer the insert of a new record
+
+            @param item: the S3ImportItem
+            @param data: the data to insert
+        """
+
+        self.pending.append((item, data))
+
+        keys = self.item_keys(item)
+        if keys:
+            self.keys |= keys
+
+    # -------------------------------------------------------------------------
+    def flush(self):
+        """
+            Write all pending inserts to the database and post-process
+            the items
+        """
+
+        pending = self.pending
+        if not pending:
+            return
+        self.pending = []
+        self.keys = set()
+
+        table = self.table
+        tablename = table._tablename
+        CREATE = S3ImportItem.METHOD.CREATE
+
+        onaccept = current.deployment_settings \
+                          .get_import_callback(tablename, "create_bulk_onaccept")
+
+        results = self.insert([data for item, data in pending])
+
+        index = self.job.duplicates.get(tablename)
+        forms = []
+        for (item, data), (record_id, error) in zip(pending, results):
+            if error is not None:
+                item.error = error
+                item.skip = True
+                self.failed.add(item.item_id)
+                continue
+
+            item.id = record_id
+            item.committed = True
+
+            forms.append(item._postprocess(CREATE, onaccept=not onaccept))
+
+            if index is not None:
+                index.update(item)
+
+        if onaccept and forms:
+
+            # Prevent that record post-processing breaks time-delayed
+            # synchronization by implicitly updating "modified_on"
+            MTIME = current.xml.MTIME
+            if MTIME in table.fields:
+                modified_on = table[MTIME]
+                modified_on_update = modified_on.update
+                modified_on.update = None
+            else:
+                modified_on_update = None
+
+            callback(onaccept, forms, tablename=tablename)
+
+            # Restore modified_on.update
+            if modified_on_update is not None:
+                modified_on.update = modified_on_update
+
+    # -------------------------------------------------------------------------
+    def insert(self, rows):
+        """
+            Insert records
+
+            @param rows: the records to insert, list of dicts
+
+            @return: list of tuples (record_id, error), in the same
+                     order as rows
+        """
+
+        if len(rows) > 1 and current.db._dbname == "postgres":
+            record_ids = self.insert_many(rows)
+            if record_ids is not None:
+                return [(record_id, None) for record_id in record_ids]
+
+        # Insert one by one
+        table = self.table
+        results = []
+        for row in rows:
+            try:
+                record_id = table.insert(**row)
+            except:
+                results.append((None, sys.exc_info()[1]))
+            else:
+                results.append((record_id, None))
+        return results
+
+    # -------------------------------------------------------------------------
+    def insert_many(self, rows):
+        """
+            Insert records with a single multi-row INSERT (PostgreSQL)
+
+            @param rows: the records to insert, list of dicts
+
+            @return: the record IDs in the same order as rows, or None
+                     if the records need to be inserted one by one (e.g.
+                     due to different fields, upload fields, or errors)
+        """
+
+        db = current.db
+        table = self.table
+
+        head = None
+        values = []
+        for row in rows:
+            for value in row.values():
+                if hasattr(value, "file"):
+                    # Upload => let table.insert store the file
+                    return None
+
+            # SQL for this row, including defaults and computed fields
+            sql = table._insert(**row)
+            pos = sql.find(" VALUES ")
+            if pos == -1:
+                return None
+            if head is None:
+                head = sql[:pos]
+            elif sql[:pos] != head:
+                # Different fields
+                return None
+            values.append(sql[pos + 8:].strip().rstrip(";"))
+
+        pkey = table._id
+        sql = "%s VALUES %s RETURNING %s;" % (head,
+                                              ",".join(values),
+                                              getattr(pkey, "sqlsafe_name", pkey.name),
+                                              )
+
+        # Use a savepoint, so that rows can be inserted one by one
+        # (to report the errors per item) if the insert fails
+        db.executesql("SAVEPOINT s3_bulk_commit;")
+        try:
+            record_ids = [row[0] for row in db.executesql(sql)]
+        except:
+            db.executesql("ROLLBACK TO SAVEPOINT s3_bulk_commit;")
+            return None
+        db.executesql("RELEASE SAVEPOINT s3_bulk_commit;")
+
+        # Call the after-insert hooks as table.insert would
+        after_insert = table._after_insert
+        if after_insert:
+            for row, record_id in zip(rows, record_ids):
+                for hook in after_insert:
+                    hook(row, record_id)
+
+        return record_ids
+
 # =============================================================================
 class S3Duplicate(object):
     """ Standard deduplicator method """
@@ -3739,6 +4190,22 @@ class S3Duplicate(object):
         data = item.data
         table = item.table
 
+        # Look up the duplicate in the index of the import job
+        job = getattr(item, "job", None)
+        if job is not None:
+            index = job.duplicates.get(table._tablename)
+            if index is not None and index.deduplicator is self:
+                indexed, record_id = index.lookup(data)
+                if indexed:
+                    if record_id:
+                        duplicate = Row(**{table._id.name: record_id})
+                        item.id = record_id
+                        if not data.deleted:
+                            item.method = item.METHOD.UPDATE
+                    else:
+                        duplicate = None
+                    return duplicate
+
         query = None
         error = "Invalid field for duplicate detection: %s (%s)"
         match = self.match
@@ -3785,6 +4252,29 @@ class S3Duplicate(object):
         # For uses outside of imports:
         return duplicate
 
+    # -------------------------------------------------------------------------
+    def prefetch(self, items, chunksize=500):
+        """
+            Look up the potential duplicates for multiple import items
+            of the same table with bulk queries
+
+            @param items: the import items
+            @param chunksize: the maximum number of items per query
+
+            @return: an S3DuplicateIndex, or None if bulk lookup is not
+                     possible for this table (=deduplicate per item)
+        """
+
+        if not items:
+            return None
+
+        index = S3DuplicateIndex(self, items[0].table)
+        if not index.valid:
+            return None
+
+        index.load([item.data for item in items], chunksize=chunksize)
+        return index
+
     # -------------------------------------------------------------------------
     def match(self, field, value):
         """
@@ -3813,6 +4303,315 @@ class S3Duplicate(object):
             query = (field == value)
         return query
 
+# =============================================================================
+class S3DuplicateIndex(object):
+    """
+        In-memory index of the potential duplicates for the items of an
+        import job (per table), as looked up by S3Duplicate.prefetch,
+        matching the same way as the S3Duplicate queries
+
+        Records written by the import job are added to (or updated in)
+        the index as the items get committed, so that later items can
+        match them; lookups for values which have not been prefetched
+        fall back to per-item queries.
+    """
+
+    # Field types supported for bulk lookups
+    STRING_TYPES = ("string", "text")
+    INTEGER_TYPES = ("id", "integer")
+
+    def __init__(self, deduplicator, table):
+        """
+            Constructor
+
+            @param deduplicator: the S3Duplicate instance
+            @param table: the table
+        """
+
+        self.deduplicator = deduplicator
+        self.table = table
+
+        self.primary = tuple(deduplicator.primary)
+        self.secondary = tuple(deduplicator.secondary)
+
+        # Prefetched primary keys
+        self.keys = set()
+
+        # Indexed records, {primary key: {record_id: secondary values}}
+        self.records = {}
+        # Indexed field values, {record_id: {fieldname: value}}
+        self.values = {}
+
+        # Field types
+        self.valid = True
+        ignore_case = deduplicator.ignore_case
+        types = {}
+        for fname in self.primary + self.secondary:
+            if fname not in table.fields:
+                # Let the deduplicator raise the error
+                self.valid = False
+                break
+            ftype = str(table[fname].type)
+            if ftype in self.STRING_TYPES:
+                types[fname] = "lower" if ignore_case else "string"
+            elif ftype in self.INTEGER_TYPES or ftype[:9] == "reference":
+                types[fname] = "integer"
+            else:
+                # Matching of other types depends on the database
+                self.valid = False
+                break
+        self.types = types
+
+    # -------------------------------------------------------------------------
+    def normalize(self, fname, value):
+        """
+            Normalize a field value for comparison
+
+            @param fname: the field name
+            @param value: the value
+
+            @raise ValueError: if the value can not be normalized
+        """
+
+        if value is None:
+            return None
+
+        ftype = self.types[fname]
+        if ftype == "integer":
+            try:
+                value = int(value)
+            except TypeError:
+                raise ValueError("Invalid value: %s" % value)
+        else:
+            value = s3_unicode(value)
+            if ftype == "lower":
+                value = value.lower()
+        return value
+
+    # -------------------------------------------------------------------------
+    def primary_key(self, data):
+        """
+            Get the normalized primary key for a data dict
+
+            @param data: the data dict
+
+            @return: a tuple of normalized values, or None if the
+                     values can not be normalized
+        """
+
+        normalize = self.normalize
+        try:
+            return tuple(normalize(fname, data.get(fname))
+                         for fname in self.primary)
+        except ValueError:
+            return None
+
+    # -------------------------------------------------------------------------
+    def add(self, record_id, values):
+        """
+            Add a record to the index
+
+            @param record_id: the record ID
+            @param values: the field values of the record, a dict
+                           {fieldname: value}
+        """
+
+        self.remove(record_id)
+
+        key = self.primary_key(values)
+        if key is None:
+            self.valid = False
+            return
+
+        normalize = self.normalize
+        try:
+            secondary = dict((fname, normalize(fname, values.get(fname)))
+                             for fname in self.secondary)
+        except ValueError:
+            self.valid = False
+            return
+
+        records = self.records
+        if key in records:
+            records[key][record_id] = secondary
+        else:
+            records[key] = {record_id: secondary}
+
+        self.values[record_id] = dict((fname, values.get(fname))
+                                      for fname in self.types)
+
+    # -------------------------------------------------------------------------
+    def remove(self, record_id):
+        """
+            Remove a record from the index
+
+            @param record_id: the record ID
+        """
+
+        values = self.values.pop(record_id, None)
+        if values is not None:
+            key = self.primary_key(values)
+            records = self.records.get(key)
+            if records:
+                records.pop(record_id, None)
+
+    # -------------------------------------------------------------------------
+    def load(self, items, chunksize=500):
+        """
+            Look up all records matching the primary keys of the items
+
+            @param items: the data dicts of the items
+            @param chunksize: the maximum number of keys per query
+        """
+
+        deduplicator = self.deduplicator
+        table = self.table
+
+        keys = set()
+        for data in items:
+            key = self.primary_key(data)
+            if key is not None and key not in self.keys:
+                keys.add(key)
+        if not keys:
+            return
+
+        primary = self.primary
+        types = self.types
+
+        fields = [table._id] + [table[fname] for fname in types]
+        if deduplicator.ignore_deleted and "deleted" in table.fields:
+            filter_deleted = (table.deleted != True)
+        else:
+            filter_deleted = None
+
+        db = current.db
+        keys = list(keys)
+        for i in xrange(0, len(keys), chunksize):
+            chunk = keys[i:i+chunksize]
+
+            # Query for all values of each primary field (the combinations
+            # are matched by the index)
+            query = filter_deleted
+            for position, fname in enumerate(primary):
+                field = table[fname]
+                values = set(key[position] for key in chunk)
+                if types[fname] == "lower":
+                    expr = field.lower()
+                    values = [v.encode("utf-8")
+                              for v in values if v is not None]
+                elif types[fname] == "string":
+                    expr = field
+                    values = [v.encode("utf-8")
+                              for v in values if v is not None]
+                else:
+                    expr = field
+                    values = [v for v in values if v is not None]
+                q = expr.belongs(values) if values else None
+                if any(key[position] is None for key in chunk):
+                    if q is None:
+                        q = (field == None)
+                    else:
+                        q |= (field == None)
+                query = q if query is None else query & q
+
+            rows = db(query).select(*fields)
+            for row in rows:
+                self.add(row[table._id], row)
+            self.keys.update(chunk)
+
+    # -------------------------------------------------------------------------
+    def lookup(self, data):
+        """
+            Find the duplicate for an import item in the index
+
+            @param data: the item data
+
+            @return: tuple (indexed, record_id), indexed being False if
+                     the item must be deduplicated with a query instead
+        """
+
+        if not self.valid:
+            return False, None
+
+        key = self.primary_key(data)
+        if key is None or key not in self.keys:
+            return False, None
+
+        candidates = self.records.get(key)
+        if not candidates:
+            return True, None
+
+        normalize = self.normalize
+        for fname in self.secondary:
+            value = data.get(fname)
+            if value:
+                try:
+                    value = normalize(fname, value)
+                except ValueError:
+                    return False, None
+                candidates = dict((record_id, secondary)
+                                  for record_id, secondary in candidates.items()
+                                  if secondary[fname] == value)
+
+        # Same as the query (=ordered by ID with limitby)
+        return True, min(candidates) if candidates else None
+
+    # -------------------------------------------------------------------------
+    def update(self, item):
+        """
+            Update the index after an item has been committed
+
+            @param item: the S3ImportItem
+        """
+
+        if not self.valid or not item.committed or not item.id:
+            return
+
+        METHOD = item.METHOD
+        method = item.method
+
+        record_id = item.id
+        data = item.data
+        types = self.types
+
+        if method == METHOD.CREATE:
+            values = {}
+            for fname in types:
+                if fname in data:
+                    values[fname] = data[fname]
+                else:
+                    default = self.table[fname].default
+                    if callable(default):
+                        self.valid = False
+                        return
+                    values[fname] = default
+            self.add(record_id, values)
+
+        elif method == METHOD.UPDATE:
+            if not any(fname in data for fname in types):
+                # Matching values unchanged
+                return
+            values = self.values.get(record_id)
+            if values is not None:
+                values = dict(values)
+            elif all(fname in data for fname in types):
+                values = {}
+            else:
+                # Record not indexed, and new values incomplete
+                self.valid = False
+                return
+            for fname in types:
+                if fname in data:
+                    values[fname] = data[fname]
+            self.add(record_id, values)
+
+        elif self.deduplicator.ignore_deleted:
+            self.remove(record_id)
+
+        else:
+            # Deletion may change the matching values
+            self.valid = False
+
 # =============================================================================
 class S3BulkImporter(object):
     """
@@ -4673,10 +5472,339 @@ class S3BulkImporter(object):
         """
 
         self.load_descriptor(path)
+
+        workers = current.deployment_settings.get_base_prepopulate_workers()
+        if workers and workers > 1 and self.parallel_supported():
+            self.perform_tasks_parallel(workers)
+            return
+
         for task in self.tasks:
             if task[0] == 1:
                 self.execute_import_task(task)
             elif task[0] == 2:
                 self.execute_special_task(task)
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def parallel_supported():
+        """
+            Check whether import tasks can be executed in parallel worker
+            processes: requires PostgreSQL (SQLite does not support
+            concurrent writes), os.fork, and a DAL which keeps database
+            connections per process, so that forked workers open their
+            own connection
+        """
+
+        if current.db._dbname != "postgres" or not hasattr(os, "fork"):
+            return False
+        return hasattr(current.db._adapter, "_connection_uname_")
+
+    # -------------------------------------------------------------------------
+    def task_tables(self, task):
+        """
+            Determine the tables an import task writes to (=the target
+            table, all resources in the stylesheet, and the tables written
+            by their onaccept callbacks), and the tables it reads from
+            (=all references in the stylesheet)
+
+            @param task: the task
+
+            @return: tuple (writes, reads) of sets of table names, or None
+                     if the tables can not be determined (e.g. for special
+                     tasks)
+        """
+
+        if task[0] != 1:
+            return None
+
+        tablename = "%s_%s" % (task[1], task[2])
+        details = self.alternateTables.get(tablename)
+        if details and "tablename" in details:
+            tablename = details["tablename"]
+
+        path = task[4]
+        writes = self.stylesheet_resources(path)
+        if writes is None:
+            return None
+        reads = self.stylesheet_references(path)
+        if reads is None:
+            return None
+        writes.add(tablename)
+        writes |= self.onaccept_tables(writes)
+
+        return writes, reads
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def onaccept_tables(tablenames):
+        """
+            Determine the tables which are written when importing records
+            into particular tables, besides those tables themselves
+            (super-entities, OU affiliations, stored hierarchies)
+
+            @param tablenames: the names of the tables
+
+            @return: a set of table names
+        """
+
+        s3db = current.s3db
+        get_config = s3db.get_config
+
+        # Tables whose onaccept updates OU affiliations (see
+        # pr_update_affiliations)
+        affiliation_types = set(("hrm_human_resource",
+                                 "pr_group_membership",
+                                 "org_group_membership",
+                                 "org_organisation_branch",
+                                 "org_organisation_team",
+                                 "org_site",
+                                 ))
+        affiliation_types.update(current.auth.org_site_types)
+        affiliation_tables = ("pr_affiliation",
+                              "pr_role",
+                              "pr_ou_closure",
+                              )
+
+        tables = set()
+        for tablename in tablenames:
+            if not s3db.table(tablename):
+                continue
+
+            supertables = get_config(tablename, "super_entity")
+            if supertables:
+                if not isinstance(supertables, (list, tuple)):
+                    supertables = [supertables]
+                for supertable in supertables:
+                    if hasattr(supertable, "_tablename"):
+                        supertable = supertable._tablename
+                    tables.add(supertable)
+                    if supertable == "pr_pentity":
+                        # Default affiliations and roles
+                        tables.update(affiliation_tables)
+
+            if tablename in affiliation_types:
+                tables.update(affiliation_tables)
+
+            if get_config(tablename, "hierarchy") or \
+               get_config(tablename, "hierarchy_of"):
+                tables.update(("s3_hierarchy", "s3_hierarchy_node"))
+
+        return tables
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def stylesheet_resources(cls, path):
+        """
+            Find the names of all resources an XSLT stylesheet produces,
+            including imported/included stylesheets
+
+            @param path: the path of the stylesheet
+
+            @return: a set of table names, or None if the stylesheet
+                     produces resources with names that can not be
+                     determined
+        """
+
+        return cls.stylesheet_tables(path, "resource", "name")
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def stylesheet_references(cls, path):
+        """
+            Find the names of all resources an XSLT stylesheet references
+            (i.e. looks up by UUID/TUID), including imported/included
+            stylesheets
+
+            @param path: the path of the stylesheet
+
+            @return: a set of table names, or None if the stylesheet
+                     references resources with names that can not be
+                     determined
+        """
+
+        return cls.stylesheet_tables(path, "reference", "resource")
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def stylesheet_tables(cls, path, tag, attr, seen=None):
+        """
+            Find the table names in a particular attribute of all
+            elements with a particular tag an XSLT stylesheet produces,
+            including imported/included stylesheets
+
+            @param path: the path of the stylesheet
+            @param tag: the element tag name
+            @param attr: the attribute name
+            @param seen: set of the stylesheets already inspected
+
+            @return: a set of table names, or None if the table names
+                     can not be determined
+        """
+
+        import re
+
+        if seen is None:
+            seen = set()
+        path = os.path.abspath(path)
+        if path in seen:
+            return set()
+        seen.add(path)
+
+        try:
+            with open(path, "r") as stylesheet:
+                text = stylesheet.read()
+        except IOError:
+            return None
+
+        tables = set()
+        dynamic = False
+        name = re.compile(r"\b%s=\"([a-z][a-z0-9_]*)\"" % attr)
+        for element in re.findall(r"<%s\b[^>]*>" % tag, text):
+            match = name.search(element)
+            if match:
+                tables.add(match.group(1))
+            else:
+                dynamic = True
+        if dynamic:
+            # Dynamic table names are usually chosen from literal
+            # table names in xsl:choose => assume all of them
+            choices = re.findall(r">\s*([a-z]+_[a-z0-9_]+)\s*</xsl:(?:when|otherwise)>",
+                                 text)
+            if not choices:
+                return None
+            tables.update(choices)
+
+        folder = os.path.dirname(path)
+        for href in re.findall(r"<xsl:(?:import|include)\s+href=\"([^\"]+)\"", text):
+            included = cls.stylesheet_tables(os.path.join(folder, href),
+                                             tag,
+                                             attr,
+                                             seen = seen,
+                                             )
+            if included is None:
+                return None
+            tables |= included
+
+        return tables
+
+    # -------------------------------------------------------------------------
+    def perform_tasks_parallel(self, workers):
+        """
+            Execute the import tasks in parallel worker processes
+
+            Tasks depend on all previous tasks (in the order of tasks.cfg)
+            which write to any of the tables they read or write, or read
+            any of the tables they write; special tasks depend on all
+            previous tasks; all other tasks are executed concurrently,
+            up to the given number of workers. Special tasks are executed
+            in this process.
+
+            @param workers: the maximum number of worker processes
+        """
+
+        import multiprocessing
+        import Queue
+
+        db = current.db
+        tasks = self.tasks
+
+        # Build the dependency graph
+        tables = [self.task_tables(task) for task in tasks]
+        def conflict(a, b):
+            if a is None or b is None:
+                return True
+            return a[0] & (b[0] | b[1]) or a[1] & b[0]
+        depends = []
+        for i, t in enumerate(tables):
+            depends.append(set(j for j in xrange(i) if conflict(t, tables[j])))
+
+        start = datetime.now()
+
+        queue = multiprocessing.Queue()
+        pending = range(len(tasks))
+        running = {}
+        done = set()
+        while pending or running:
+
+            # Start all tasks which are ready
+            for i in list(pending):
+                if len(running) >= workers:
+                    break
+                if not depends[i] <= done:
+                    continue
+                pending.remove(i)
+
+                task = tasks[i]
+                if task[0] == 2:
+                    # Special task (all previous tasks are done)
+                    self.execute_special_task(task)
+                    db.commit()
+                    done.add(i)
+                    continue
+
+                # Workers must see all data committed so far
+                db.commit()
+                process = multiprocessing.Process(target = self._execute_task_process,
+                                                  args = (i, task, queue),
+                                                  )
+                process.start()
+                running[i] = process
+
+            if not running:
+                if pending and not any(depends[i] <= done for i in pending):
+                    # Should never happen (tasks only depend on previous tasks)
+                    raise RuntimeError("prepopulate: unresolvable task dependencies")
+                continue
+
+            # Wait for the next task to complete
+            try:
+                index, errors, results = queue.get(timeout=5)
+            except Queue.Empty:
+                # Check for crashed workers
+                for index, process in running.items():
+                    if not process.is_alive() and process.exitcode:
+                        del running[index]
+                        done.add(index)
+                        self.errorList.append("prepopulate error: worker for %s exited with code %s" %
+                                              (tasks[index][3], process.exitcode))
+                continue
+
+            process = running.pop(index, None)
+            if process is not None:
+                process.join()
+            done.add(index)
+            self.errorList.extend(errors)
+            self.resultList.extend(results)
+
+        duration = datetime.now() - start
+        msg = "%s import tasks with %s workers completed in %s mins" % \
+              (len(tasks), workers, '{:.2f}'.format(duration.total_seconds() / 60))
+        self.resultList.append(msg)
+        current.log.debug(msg)
+
+    # -------------------------------------------------------------------------
+    def _execute_task_process(self, index, task, queue):
+        """
+            Execute an import task in a worker process
+
+            @param index: the index of the task
+            @param task: the task
+            @param queue: the queue to report the results to
+        """
+
+        db = current.db
+
+        # Open a new database connection for this process
+        s3_reconnect_forked()
+
+        errors = len(self.errorList)
+        results = len(self.resultList)
+        try:
+            self.execute_import_task(task)
+        except:
+            db.rollback()
+            self.errorList.append("prepopulate error: %s (file: %s)" %
+                                  (sys.exc_info()[1], task[3]))
+        queue.put((index, self.errorList[errors:], self.resultList[results:]))
+
 # END =========================================================================
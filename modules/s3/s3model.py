@@ -42,6 +42,8 @@ from gluon.storage import Storage
 from gluon.tools import callback
 
 from s3dal import Table, Field
+from s3fields import S3RepresentCache
+from s3hierarchy import S3Hierarchy
 from s3navigation import S3ScriptItem
 from s3resource import S3Resource
 from s3validators import IS_ONE_OF
@@ -74,6 +76,13 @@ class S3Model(object):
     LOAD = "s3_model_load"
     DELETED = "deleted"
 
+    # Per-process index of the names defined by models, see index()
+    _index = None
+
+    # Per-process callbacks to invalidate cached data depending on
+    # a table when it gets written to, see register_invalidator()
+    _invalidators = []
+
     def __init__(self, module=None):
         """ Constructor """
 
@@ -227,28 +236,33 @@ class S3Model(object):
                     pass
             elif hasattr(models, prefix):
                 module = models.__dict__[prefix]
-                loaded = False
-                generic = []
-                for n in module.__all__:
-                    model = module.__dict__[n]
-                    if hasattr(model, "_s3model"):
-                        if loaded:
-                            continue
-                        if hasattr(model, "names"):
-                            if tablename in model.names:
-                                model(prefix)
-                                loaded = True
-                            else:
+                index = cls.index()
+                if index and tablename in index:
+                    # Load only the model defining this name
+                    module.__dict__[index[tablename]](prefix)
+                else:
+                    loaded = False
+                    generic = []
+                    for n in module.__all__:
+                        model = module.__dict__[n]
+                        if hasattr(model, "_s3model"):
+                            if loaded:
                                 continue
+                            if hasattr(model, "names"):
+                                if tablename in model.names:
+                                    model(prefix)
+                                    loaded = True
+                                else:
+                                    continue
+                            else:
+                                generic.append(n)
                         else:
-                            generic.append(n)
-                    else:
-                        if n == tablename:
-                            s3db.classes[tablename] = (prefix, n)
-                            found = model
-                            loaded = True
-                if not loaded:
-                    [module.__dict__[n](prefix) for n in generic]
+                            if n == tablename:
+                                s3db.classes[tablename] = (prefix, n)
+                                found = model
+                                loaded = True
+                    if not loaded:
+                        [module.__dict__[n](prefix) for n in generic]
         if found:
             return found
         if not db_only and tablename in s3:
@@ -263,6 +277,55 @@ class S3Model(object):
         else:
             return default
 
+    # -------------------------------------------------------------------------
+    @classmethod
+    def index(cls):
+        """
+            Get the index of the names (tables and globals) defined by
+            the models, to find the model class for a name without
+            scanning the model module
+
+            - built only once per process, as the names of the model
+              classes do not depend on the request
+            - not used in debug mode, where model modules can be reloaded
+
+            @return: dict {name: classname}, or None if not available
+        """
+
+        if current.response.s3.debug:
+            return None
+
+        index = S3Model._index
+        if index is None:
+            models = current.models
+            if models is None:
+                return None
+
+            index = {}
+            objects = set()
+            for prefix, module in models.__dict__.items():
+                if type(module).__name__ != "module":
+                    continue
+                for n in getattr(module, "__all__", ()):
+                    model = module.__dict__.get(n)
+                    if not hasattr(model, "_s3model"):
+                        # Other objects are looked up by their name
+                        objects.add(n)
+                    elif hasattr(model, "names"):
+                        for name in model.names:
+                            # Same as in table(): the first model in the
+                            # module of the name prefix is loaded
+                            if name.split("_", 1)[0] == prefix and \
+                               name not in index:
+                                index[name] = n
+            for name in objects:
+                index.pop(name, None)
+
+            # Shared by all subclasses (not cls._index)
+            S3Model._index = index
+
+        return index
+
     # -------------------------------------------------------------------------
     @classmethod
     def get(cls, name, default=None):
@@ -388,8 +451,36 @@ class S3Model(object):
             table = ogetattr(db, tablename)
         else:
             table = db.define_table(tablename, *fields, **args)
+
+            # Invalidate shared representations and other caches upon write
+            def invalidate(*args):
+                S3RepresentCache.invalidate(tablename)
+                for invalidator in S3Model._invalidators:
+                    invalidator(tablename)
+            table._after_insert.append(invalidate)
+            table._after_update.append(invalidate)
+            table._after_delete.append(invalidate)
+
+            # Maintain stored hierarchies upon write
+            S3Hierarchy.register(table)
+
         return table
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def register_invalidator(invalidator):
+        """
+            Register a callback to invalidate cached data depending on
+            a table whenever records in that table get written to (for
+            process-wide caches of higher layers)
+
+            @param invalidator: the callback, invalidator(tablename)
+        """
+
+        invalidators = S3Model._invalidators
+        if invalidator not in invalidators:
+            invalidators.append(invalidator)
+
     # -------------------------------------------------------------------------
     # Resource configuration
     # -------------------------------------------------------------------------
@@ -44,6 +44,8 @@ import datetime
 import json
 import re
 import string
+import threading
+import time
 import urllib
 import urllib2
 import os
@@ -471,17 +473,26 @@ class S3Msg(object):
         return message_id
 
     # -------------------------------------------------------------------------
-    def process_outbox(self, contact_method="EMAIL"):
+    def process_outbox(self, contact_method="EMAIL", smtp_pool=False):
         """
             Send pending messages from outbox (usually called from scheduler)
 
+            Messages are processed in chunks (settings.msg.outbox_chunksize),
+            with the contact details of all recipients of a chunk looked up
+            at once; the status of each message is committed as soon as it
+            has been sent
+
             @param contact_method: the output channel (see pr_contact.method)
+            @param smtp_pool: re-use SMTP connections for all emails of
+                              the run (see S3SMTPPool - only for single-
+                              threaded processes, i.e. the scheduler task)
 
             @todo: contact_method = "ALL"
         """
 
         db = current.db
         s3db = current.s3db
+        settings = current.deployment_settings
 
         lookup_org = False
         channels = {}
@@ -511,7 +522,7 @@ class S3Msg(object):
                 channel_id = row["msg_sms_outbound_gateway.channel_id"]
             else:
                 lookup_org = True
-                org_branches = current.deployment_settings.get_org_branches()
+                org_branches = settings.get_org_branches()
                 if org_branches:
                     org_parents = s3db.org_parents
                 for row in rows:
@@ -526,23 +537,23 @@ class S3Msg(object):
                 # task fail permanently
                 raise ValueError("No Twitter API available!")
 
-        def dispatch_to_pe_id(pe_id,
-                              subject,
-                              message,
-                              outbox_id,
-                              message_id,
-                              attachments = [],
-                              organisation_id = None,
-                              contact_method = contact_method,
-                              channel_id = channel_id,
-                              from_address = None,
-                              outgoing_sms_handler = outgoing_sms_handler,
-                              lookup_org = lookup_org,
-                              channels = channels):
+        def dispatch_to_address(address,
+                                subject,
+                                message,
+                                outbox_id,
+                                message_id,
+                                attachments = [],
+                                organisation_id = None,
+                                contact_method = contact_method,
+                                channel_id = channel_id,
+                                from_address = None,
+                                outgoing_sms_handler = outgoing_sms_handler,
+                                lookup_org = lookup_org,
+                                channels = channels):
             """
-                Helper method to send messages by pe_id
+                Helper method to send messages to a recipient address
 
-                @param pe_id: the pe_id
+                @param address: the recipient address (pr_contact.value)
                 @param subject: the message subject
                 @param message: the message body
                 @param outbox_id: the outbox record ID
@@ -551,17 +562,8 @@ class S3Msg(object):
                 @param contact_method: the contact method
             """
 
-            # Get the recipient's contact info
-            table = s3db.pr_contact
-            query = (table.pe_id == pe_id) & \
-                    (table.contact_method == contact_method) & \
-                    (table.deleted == False)
-            contact_info = db(query).select(table.value,
-                                            orderby=table.priority,
-                                            limitby=(0, 1)).first()
             # Send the message
-            if contact_info:
-                address = contact_info.value
+            if address:
                 if contact_method == "EMAIL":
                     return self.send_email(address,
                                            subject,
@@ -702,6 +704,29 @@ class S3Msg(object):
                                    (ptable.deleted != True))
                          ]
 
+        def requeue(query, left, message_id):
+            """
+                Re-queue a message for each person matching a query
+
+                @param query: the query
+                @param left: the left joins for the query
+                @param message_id: the message_id
+
+                @return: True if the message was re-queued, else False
+            """
+
+            recipients = db(query).select(ptable.pe_id, left=left)
+            pe_ids = set(r.pe_id for r in recipients)
+            pe_ids.discard(None)
+            if pe_ids:
+                outbox.bulk_insert([{"message_id": message_id,
+                                     "pe_id": pe_id,
+                                     "contact_method": contact_method,
+                                     "system_generated": True,
+                                     } for pe_id in pe_ids])
+                return True
+            return False
+
         # chainrun: used to fire process_outbox again,
         # when messages are sent to groups or organisations
         chainrun = False
@@ -717,157 +742,176 @@ class S3Msg(object):
             retrieve_file_properties = file_field.retrieve_file_properties
         mail_attachment = current.mail.Attachment
 
-        for row in rows:
-            attachments = []
-            status = True
-            message_id = row.msg_outbox.message_id
-
-            if contact_method == "EMAIL":
-                subject = row["msg_email.subject"] or ""
-                message = row["msg_email.body"] or ""
-                from_address = row["msg_email.from_address"] or ""
-                query = (attachment_table.message_id == message_id) & \
-                        (attachment_table.deleted != True) & \
-                        (attachment_table.document_id == document_table.id) & \
-                        (document_table.deleted != True)
-                arows = db(query).select(file_field)
-                for arow in arows:
-                    file = arow.file
-                    prop = retrieve_file_properties(file)
-                    _file_path = os.path.join(prop["path"], file)
-                    attachments.append(mail_attachment(_file_path))
-            elif contact_method == "SMS":
-                subject = None
-                message = row["msg_sms.body"] or ""
-                from_address = None
-                if lookup_org:
-                    organisation_id = row["msg_sms.organisation_id"]
-            elif contact_method == "TWITTER":
-                subject = None
-                message = row["msg_twitter.body"] or ""
-                from_address = None
-            else:
-                # @ToDo
-                continue
+        # Attachments per message_id (the same message usually goes
+        # to many recipients)
+        message_attachments = {}
 
-            entity_type = row["pr_pentity"].instance_type
-            if not entity_type:
-                current.log.warning("s3msg", "Entity type unknown")
-                continue
+        ctable = s3db.pr_contact
 
-            row = row["msg_outbox"]
-            pe_id = row.pe_id
-            message_id = row.message_id
+        # Rate limit (messages per second)
+        rate_limit = settings.get_msg_outbox_rate_limit().get(contact_method)
+        interval = 1.0 / rate_limit if rate_limit else None
+        last_send = None
 
-            if entity_type == "pr_person":
-                # Send the message to this person
-                try:
-                    status = dispatch_to_pe_id(
-                                    pe_id,
-                                    subject,
-                                    message,
-                                    row.id,
-                                    message_id,
-                                    organisation_id = organisation_id,
-                                    from_address = from_address,
-                                    attachments = attachments,
-                                    )
-                except:
-                    status = False
-
-            elif entity_type == "pr_group":
-                # Re-queue the message for each member in the group
-                gquery = (gtable.pe_id == pe_id)
-                recipients = db(gquery).select(ptable.pe_id, left=gleft)
-                pe_ids = set(r.pe_id for r in recipients)
-                pe_ids.discard(None)
-                if pe_ids:
-                    for pe_id in pe_ids:
-                        outbox.insert(message_id=message_id,
-                                      pe_id=pe_id,
-                                      contact_method=contact_method,
-                                      system_generated=True)
-                    chainrun = True
-                status = True
-
-            elif entity_type == "pr_forum":
-                # Re-queue the message for each member in the group
-                fquery = (ftable.pe_id == pe_id)
-                recipients = db(fquery).select(ptable.pe_id, left=fleft)
-                pe_ids = set(r.pe_id for r in recipients)
-                pe_ids.discard(None)
-                if pe_ids:
-                    for pe_id in pe_ids:
-                        outbox.insert(message_id=message_id,
-                                      pe_id=pe_id,
-                                      contact_method=contact_method,
-                                      system_generated=True)
-                    chainrun = True
-                status = True
-
-            elif htable and entity_type == "org_organisation":
-                # Re-queue the message for each HR in the organisation
-                oquery = (otable.pe_id == pe_id)
-                recipients = db(oquery).select(ptable.pe_id, left=oleft)
-                pe_ids = set(r.pe_id for r in recipients)
-                pe_ids.discard(None)
-                if pe_ids:
-                    for pe_id in pe_ids:
-                        outbox.insert(message_id=message_id,
-                                      pe_id=pe_id,
-                                      contact_method=contact_method,
-                                      system_generated=True)
-                    chainrun = True
-                status = True
-
-            elif entity_type == "hrm_training_event":
-                # Re-queue the message for each participant
-                equery = (etable.pe_id == pe_id)
-                recipients = db(equery).select(ptable.pe_id, left=tleft)
-                pe_ids = set(r.pe_id for r in recipients)
-                pe_ids.discard(None)
-                if pe_ids:
-                    for pe_id in pe_ids:
-                        outbox.insert(message_id=message_id,
-                                      pe_id=pe_id,
-                                      contact_method=contact_method,
-                                      system_generated=True)
-                    chainrun = True
-                status = True
-
-            elif atable and entity_type == "deploy_alert":
-                # Re-queue the message for each HR in the group
-                aquery = (atable.pe_id == pe_id)
-                recipients = db(aquery).select(ptable.pe_id, left=aleft)
-                pe_ids = set(r.pe_id for r in recipients)
-                pe_ids.discard(None)
-                if pe_ids:
-                    for pe_id in pe_ids:
-                        outbox.insert(message_id=message_id,
-                                      pe_id=pe_id,
-                                      contact_method=contact_method,
-                                      system_generated=True)
-                    chainrun = True
-                status = True
+        start = time.time()
+        sent = failed = 0
 
-            else:
-                # Unsupported entity type
-                row.update_record(status = 4) # Invalid
-                db.commit()
-                continue
+        rows = list(rows)
+        chunksize = settings.get_msg_outbox_chunksize() or len(rows)
 
-            if status:
-                row.update_record(status = 2) # Sent
-                db.commit()
-            else:
-                if row.retries > 0:
-                    row.update_record(retries = row.retries - 1)
+        with S3SMTPPool(active=smtp_pool):
+
+            for index in xrange(0, len(rows), chunksize):
+
+                chunk = rows[index:index + chunksize]
+
+                # Look up the contact details for all persons in the chunk
+                pe_ids = set(row["msg_outbox.pe_id"] for row in chunk
+                             if row["pr_pentity.instance_type"] == "pr_person")
+                addresses = {}
+                if pe_ids:
+                    query = (ctable.pe_id.belongs(pe_ids)) & \
+                            (ctable.contact_method == contact_method) & \
+                            (ctable.deleted == False)
+                    contacts = db(query).select(ctable.pe_id,
+                                                ctable.value,
+                                                orderby=ctable.priority,
+                                                )
+                    for contact in contacts:
+                        if contact.pe_id not in addresses:
+                            addresses[contact.pe_id] = contact.value
+
+                for row in chunk:
+                    attachments = []
+                    status = True
+                    message_id = row.msg_outbox.message_id
+
+                    if contact_method == "EMAIL":
+                        subject = row["msg_email.subject"] or ""
+                        message = row["msg_email.body"] or ""
+                        from_address = row["msg_email.from_address"] or ""
+                        attachments = message_attachments.get(message_id)
+                        if attachments is None:
+                            attachments = []
+                            query = (attachment_table.message_id == message_id) & \
+                                    (attachment_table.deleted != True) & \
+                                    (attachment_table.document_id == document_table.id) & \
+                                    (document_table.deleted != True)
+                            arows = db(query).select(file_field)
+                            for arow in arows:
+                                file = arow.file
+                                prop = retrieve_file_properties(file)
+                                _file_path = os.path.join(prop["path"], file)
+                                attachments.append(mail_attachment(_file_path))
+                            message_attachments[message_id] = attachments
+                    elif contact_method == "SMS":
+                        subject = None
+                        message = row["msg_sms.body"] or ""
+                        from_address = None
+                        if lookup_org:
+                            organisation_id = row["msg_sms.organisation_id"]
+                    elif contact_method == "TWITTER":
+                        subject = None
+                        message = row["msg_twitter.body"] or ""
+                        from_address = None
+                    else:
+                        # @ToDo
+                        continue
+
+                    entity_type = row["pr_pentity"].instance_type
+                    if not entity_type:
+                        current.log.warning("s3msg", "Entity type unknown")
+                        continue
+
+                    row = row["msg_outbox"]
+                    pe_id = row.pe_id
+                    message_id = row.message_id
+
+                    if entity_type == "pr_person":
+                        # Throttle to the rate limit
+                        if interval:
+                            if last_send is not None:
+                                wait = last_send + interval - time.time()
+                                if wait > 0:
+                                    time.sleep(wait)
+                            last_send = time.time()
+                        # Send the message to this person
+                        try:
+                            status = dispatch_to_address(
+                                            addresses.get(pe_id),
+                                            subject,
+                                            message,
+                                            row.id,
+                                            message_id,
+                                            organisation_id = organisation_id,
+                                            from_address = from_address,
+                                            attachments = attachments,
+                                            )
+                        except:
+                            status = False
+
+                    elif entity_type == "pr_group":
+                        # Re-queue the message for each member in the group
+                        if requeue(gtable.pe_id == pe_id, gleft, message_id):
+                            chainrun = True
+                        status = True
+
+                    elif entity_type == "pr_forum":
+                        # Re-queue the message for each member in the group
+                        if requeue(ftable.pe_id == pe_id, fleft, message_id):
+                            chainrun = True
+                        status = True
+
+                    elif htable and entity_type == "org_organisation":
+                        # Re-queue the message for each HR in the organisation
+                        if requeue(otable.pe_id == pe_id, oleft, message_id):
+                            chainrun = True
+                        status = True
+
+                    elif entity_type == "hrm_training_event":
+                        # Re-queue the message for each participant
+                        if requeue(etable.pe_id == pe_id, tleft, message_id):
+                            chainrun = True
+                        status = True
+
+                    elif atable and entity_type == "deploy_alert":
+                        # Re-queue the message for each HR in the group
+                        if requeue(atable.pe_id == pe_id, aleft, message_id):
+                            chainrun = True
+                        status = True
+
+                    else:
+                        # Unsupported entity type
+                        row.update_record(status = 4) # Invalid
+                        db.commit()
+                        failed += 1
+                        continue
+
+                    # Commit the status of each message immediately, so
+                    # that a crash does not send it again in the next run
+                    if status:
+                        row.update_record(status = 2) # Sent
+                        sent += 1
+                    else:
+                        if row.retries > 0:
+                            row.update_record(retries = row.retries - 1)
+                        elif row.retries is not None:
+                            row.update_record(status = 5) # Failed
+                        failed += 1
                     db.commit()
-                elif row.retries is not None:
-                    row.update_record(status = 5) # Failed
+
+        # Log the throughput
+        duration = time.time() - start
+        current.log.info("S3Msg", "process_outbox %s: %s messages processed, %s failed, in %.1f sec (%.1f/sec)" %
+                                  (contact_method,
+                                   sent,
+                                   failed,
+                                   duration,
+                                   (sent + failed) / duration if duration else 0,
+                                   ))
 
         if chainrun:
-            self.process_outbox(contact_method)
+            self.process_outbox(contact_method, smtp_pool=smtp_pool)
 
     # -------------------------------------------------------------------------
     # Google Cloud Messaging Push
@@ -2565,6 +2609,220 @@ class S3Msg(object):
         else:
             return hashdef["defs"]["def"]["text"]
 
+# =============================================================================
+class S3SMTPPool(object):
+    """
+        Context manager to re-use SMTP connections for consecutive
+        emails: gluon.tools.Mail opens (and logs in to) a new SMTP
+        connection for every single email - within this context,
+        smtplib.SMTP and smtplib.SMTP_SSL return a pooled connection
+        per server instead, which is only set up once and kept open
+        until the end of the context
+
+        @note: this replaces the smtplib classes process-wide, and
+               must therefore only be activated in single-threaded
+               processes (e.g. scheduler workers); if another pool is
+               already active, the context does nothing
+    """
+
+    # Lock and flag to prevent concurrent/nested activation
+    lock = threading.Lock()
+    active = False
+
+    def __init__(self, max_messages=100, active=True):
+        """
+            Constructor
+
+            @param max_messages: the maximum number of messages to send
+                                 per connection (servers often limit
+                                 the number of messages per session)
+            @param active: whether to activate the pool (False to
+                           make the context a no-op)
+        """
+
+        self.max_messages = max_messages
+        self.connections = {}
+        self.classes = None
+        self.activate = active
+
+    # -------------------------------------------------------------------------
+    def __enter__(self):
+
+        if not self.activate:
+            return self
+
+        cls = self.__class__
+        with cls.lock:
+            if cls.active:
+                # Another pool is active
+                return self
+            cls.active = True
+
+        import smtplib
+
+        self.classes = SMTP, SMTP_SSL = smtplib.SMTP, smtplib.SMTP_SSL
+
+        smtplib.SMTP = lambda *args, **kwargs: \
+                              self.connect(SMTP, args, kwargs)
+        smtplib.SMTP_SSL = lambda *args, **kwargs: \
+                                  self.connect(SMTP_SSL, args, kwargs)
+        return self
+
+    # -------------------------------------------------------------------------
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if not self.classes:
+            # Not activated
+            return
+
+        import smtplib
+
+        smtplib.SMTP, smtplib.SMTP_SSL = self.classes
+        self.classes = None
+        with self.__class__.lock:
+            self.__class__.active = False
+
+        for connection in self.connections.values():
+            connection.close()
+        self.connections = {}
+
+    # -------------------------------------------------------------------------
+    def connect(self, cls, args, kwargs):
+        """
+            Get the pooled connection for a server
+
+            @param cls: the original SMTP class
+            @param args: the arguments for the class constructor
+            @param kwargs: the keyword arguments for the class constructor
+
+            @return: the S3PooledSMTP instance
+        """
+
+        key = (cls, args)
+        connection = self.connections.get(key)
+        if connection is None:
+            connection = S3PooledSMTP(cls, args, kwargs, self.max_messages)
+            self.connections[key] = connection
+        return connection.begin()
+
+# =============================================================================
+class S3PooledSMTP(object):
+    """
+        A pooled SMTP connection (see S3SMTPPool): connection setup
+        (EHLO, STARTTLS, login) is only performed for a new connection,
+        and ignored when re-using it; QUIT only closes the connection
+        when the maximum number of messages has been sent with it
+    """
+
+    SETUP = ("ehlo", "helo", "ehlo_or_helo_if_needed", "starttls", "login")
+
+    def __init__(self, cls, args, kwargs, max_messages):
+        """
+            Constructor
+
+            @param cls: the SMTP class
+            @param args: the arguments for the class constructor
+            @param kwargs: the keyword arguments for the class constructor
+            @param max_messages: the maximum number of messages to send
+                                 per connection
+        """
+
+        self.cls = cls
+        self.args = args
+        self.kwargs = kwargs
+        self.max_messages = max_messages
+
+        self.server = None
+        self.setup = []
+        self.established = False
+        self.count = 0
+
+    # -------------------------------------------------------------------------
+    def begin(self):
+        """
+            Begin a new session (=the caller has asked for a new
+            connection), connect if necessary
+        """
+
+        if self.server is not None and not self.established:
+            # Previous setup failed => start over
+            self.close()
+        if self.server is None:
+            self.server = self.cls(*self.args, **self.kwargs)
+            self.setup = []
+            self.count = 0
+        return self
+
+    # -------------------------------------------------------------------------
+    def __getattr__(self, name):
+
+        attr = getattr(self.server, name)
+        if name in self.SETUP:
+            def setup(*args, **kwargs):
+                if self.established:
+                    # Already done for this connection
+                    return (250, "OK")
+                self.setup.append((name, args, kwargs))
+                return attr(*args, **kwargs)
+            return setup
+        return attr
+
+    # -------------------------------------------------------------------------
+    def sendmail(self, *args, **kwargs):
+        """
+            Send a message, re-connecting once if the server has
+            closed the connection in the meantime
+        """
+
+        import smtplib
+        import socket
+
+        try:
+            result = self.server.sendmail(*args, **kwargs)
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            if not self.established:
+                raise
+            # Re-connect and replay the setup
+            setup = self.setup
+            self.close()
+            self.server = self.cls(*self.args, **self.kwargs)
+            for name, a, kw in setup:
+                getattr(self.server, name)(*a, **kw)
+            self.setup = setup
+            self.count = 0
+            result = self.server.sendmail(*args, **kwargs)
+
+        self.established = True
+        self.count += 1
+        return result
+
+    # -------------------------------------------------------------------------
+    def quit(self):
+        """
+            End the session, only closes the connection when the
+            maximum number of messages has been reached
+        """
+
+        if not self.established or self.count >= self.max_messages:
+            self.close()
+        return (221, "OK")
+
+    # -------------------------------------------------------------------------
+    def close(self):
+        """ Close the connection """
+
+        server = self.server
+        if server is not None:
+            try:
+                server.quit()
+            except Exception:
+                try:
+                    server.close()
+                except Exception:
+                    pass
+        self.server = None
+        self.established = False
+
 # =============================================================================
 class S3Compose(S3CRUD):
     """ RESTful method for messaging """
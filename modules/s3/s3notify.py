@@ -68,11 +68,28 @@ class S3Notifications(object):
 
         subscriptions = cls._subscriptions(now)
         if subscriptions:
+            rtable = current.s3db.pr_subscription_resource
             async = current.s3task.async
-            for row in subscriptions:
-                # Create asynchronous notification task.
-                row.update_record(locked=True)
-                async("notify_notify", args=[row.id])
+
+            # Lock all subscriptions
+            resource_ids = [row.id for row in subscriptions]
+            current.db(rtable.id.belongs(resource_ids)).update(locked=True)
+
+            if current.deployment_settings.get_msg_notify_shared_queries():
+                # Create one asynchronous notification task per resource
+                batches = {}
+                for row in subscriptions:
+                    tablename = row.resource
+                    if tablename in batches:
+                        batches[tablename].append(row.id)
+                    else:
+                        batches[tablename] = [row.id]
+                for batch in batches.values():
+                    async("notify_notify_shared", args=[batch])
+            else:
+                # Create one asynchronous notification task per subscription
+                for resource_id in resource_ids:
+                    async("notify_notify", args=[resource_id])
             message = "%s notifications scheduled." % len(subscriptions)
         else:
             message = "No notifications to schedule."
@@ -233,6 +250,248 @@ class S3Notifications(object):
         # Done
         return message
 
+    # -------------------------------------------------------------------------
+    @classmethod
+    def notify_shared(cls, resource_ids):
+        """
+            Asynchronous task to notify a batch of subscribers about
+            updates, without lookup requests: subscriptions to the same
+            URL with the same filter, language and read permissions share
+            a single lookup query, and subscribers with the same options
+            share the rendered messages.
+
+            NB the lookup does not run the controller of the subscription
+               URL, so filters set in its prep are not applied (see
+               settings.msg.notify_shared_queries)
+
+            @param resource_ids: list of pr_subscription_resource record IDs
+        """
+
+        _debug = current.log.debug
+        _debug("S3Notifications.notify_shared(resource_ids=%s)" % resource_ids)
+
+        db = current.db
+        s3db = current.s3db
+        auth = current.auth
+
+        stable = s3db.pr_subscription
+        rtable = db.pr_subscription_resource
+        ftable = s3db.pr_filter
+        ltable = s3db.pr_person_user
+
+        # Time stamp for the next check, taken before the lookup so
+        # that updates during the lookup will be found next time
+        now = datetime.datetime.utcnow()
+
+        # Extract the subscription data
+        join = stable.on(rtable.subscription_id == stable.id)
+        left = [ftable.on(ftable.id == stable.filter_id),
+                ltable.on(ltable.pe_id == stable.pe_id),
+                ]
+        rows = db(rtable.id.belongs(resource_ids)).select(stable.id,
+                                                          stable.pe_id,
+                                                          stable.frequency,
+                                                          stable.notify_on,
+                                                          stable.method,
+                                                          stable.email_format,
+                                                          stable.attachment,
+                                                          rtable.id,
+                                                          rtable.resource,
+                                                          rtable.url,
+                                                          rtable.last_check_time,
+                                                          ftable.query,
+                                                          ltable.user_id,
+                                                          join=join,
+                                                          left=left)
+
+        user = auth.user
+        current_user_id = user.id if user else None
+
+        # Group the subscriptions by lookup query
+        success = {}
+        queries = {}
+        signatures = {}
+        tables = {}
+        for row in rows:
+
+            s = row.pr_subscription
+            r = row.pr_subscription_resource
+            if r.id in success:
+                # Subscriber with multiple user accounts
+                continue
+
+            if not s.notify_on or not s.method:
+                # No notifications configured for this subscription
+                success[r.id] = (s.frequency, True)
+                continue
+            if not s.pe_id or not r.url or s3db.table(r.resource) is None:
+                success[r.id] = (s.frequency, False)
+                continue
+            success[r.id] = (s.frequency, False)
+
+            # Language and read permissions of the subscriber
+            user_id = row.pr_person_user.user_id
+            c, f = cls._controller(r.url)
+            skey = (user_id, r.resource, c, f)
+            if skey in signatures:
+                signature = signatures[skey]
+            else:
+                try:
+                    language = cls._impersonate(user_id)
+                    tkey = (r.resource, r.url)
+                    if tkey not in tables:
+                        tables[tkey] = cls._tables(r.resource, r.url)
+                    signature = [language]
+                    for tablename in tables[tkey]:
+                        accessible = auth.s3_accessible_query("read",
+                                                              tablename,
+                                                              c=c,
+                                                              f=f)
+                        signature.append(str(accessible))
+                except:
+                    exc_info = sys.exc_info()[:2]
+                    _debug("%s: %s" % (exc_info[0].__name__, exc_info[1]))
+                    signature = None
+                else:
+                    signature = tuple(signature)
+                signatures[skey] = signature
+            if signature is None:
+                continue
+
+            key = (r.resource,
+                   r.url,
+                   row.pr_filter.query,
+                   "upd" in s.notify_on,
+                   ) + signature
+            if key in queries:
+                queries[key].append((user_id, s, r))
+            else:
+                queries[key] = [(user_id, s, r)]
+
+        _debug("%s subscriptions, %s lookups" % (len(success), len(queries)))
+
+        sent = 0
+        for key, subscriptions in queries.items():
+
+            tablename, url, filter_query, updates = key[:4]
+            timestamp = "modified_on" if updates else "created_on"
+
+            # Look up all records updated since the oldest check
+            last_check_times = [r.last_check_time for _, s, r in subscriptions]
+            if None in last_check_times:
+                since = None
+            else:
+                since = min(last_check_times)
+
+            try:
+                cls._impersonate(subscriptions[0][0])
+                resource, page_url, query_nice = cls._lookup(tablename,
+                                                             url,
+                                                             filter_query,
+                                                             timestamp,
+                                                             since,
+                                                             )
+                data = cls._extract(resource, hidden=[timestamp])
+            except:
+                exc_info = sys.exc_info()[:2]
+                _debug("%s: %s" % (exc_info[0].__name__, exc_info[1]))
+                continue
+
+            colname = resource.resolve_selector(timestamp).colname
+            pkey = str(resource._id)
+
+            # Render once per set of options, and send to all subscribers
+            messages = {}
+            for user_id, s, r in subscriptions:
+
+                last_check_time = r.last_check_time
+                if last_check_time is None or last_check_time == since:
+                    records = data.rows
+                else:
+                    records = [record for record in data.rows
+                               if record["_row"][colname] is not None and
+                                  record["_row"][colname] >= last_check_time]
+                if not records:
+                    # No updates for this subscriber
+                    success[r.id] = (s.frequency, True)
+                    continue
+
+                options = (tuple(s.notify_on),
+                           tuple(s.method),
+                           s.email_format,
+                           s.attachment,
+                           last_check_time,
+                           )
+                try:
+                    if options in messages:
+                        composed = messages[options]
+                    else:
+                        subscription = {
+                            "pe_id": s.pe_id,
+                            "notify_on": s.notify_on,
+                            "method": s.method,
+                            "email_format": s.email_format,
+                            "attachment": s.attachment,
+                            "resource": tablename,
+                            "last_check_time": s3_encode_iso_datetime(last_check_time),
+                            "filter_query": query_nice,
+                            "page_url": page_url,
+                            "item_url": None,
+                            }
+                        subset = Storage(rfields = data.rfields,
+                                         numrows = len(records),
+                                         ids = [record["_row"][pkey]
+                                                for record in records],
+                                         rows = records,
+                                         )
+                        composed = cls._compose(resource, subset, subscription)
+                        messages[options] = composed
+                    delivered, message = cls._deliver(s.pe_id, s.method, composed)
+                except:
+                    exc_info = sys.exc_info()[:2]
+                    delivered = False
+                    message = "%s: %s" % (exc_info[0].__name__, exc_info[1])
+                if delivered:
+                    sent += 1
+                else:
+                    _debug(message)
+                success[r.id] = (s.frequency, delivered)
+
+        # Restore the original user
+        auth.s3_impersonate(current_user_id)
+
+        # Update time stamps and unlock
+        intervals = s3db.pr_subscription_check_intervals
+        failed = []
+        due = {}
+        for resource_id, (frequency, delivered) in success.items():
+            if not delivered:
+                failed.append(resource_id)
+            elif frequency in due:
+                due[frequency].append(resource_id)
+            else:
+                due[frequency] = [resource_id]
+        for frequency, ids in due.items():
+            interval = datetime.timedelta(minutes=intervals.get(frequency, 0))
+            db(rtable.id.belongs(ids)).update(auth_token=None,
+                                              locked=False,
+                                              last_check_time=now,
+                                              next_check_time=now + interval,
+                                              )
+        if failed:
+            db(rtable.id.belongs(failed)).update(auth_token=None,
+                                                 locked=False,
+                                                 )
+        # Unlock subscriptions which no longer exist or are deleted
+        missing = set(resource_ids) - set(success)
+        if missing:
+            db(rtable.id.belongs(missing)).update(locked=False)
+        db.commit()
+
+        message = "%s notifications sent, %s failed." % (sent, len(failed))
+        _debug(message)
+        return message
+
     # -------------------------------------------------------------------------
     @classmethod
     def send(cls, r, resource):
@@ -277,23 +536,77 @@ class S3Notifications(object):
         if not pe_id:
             r.unauthorised()
 
+        # Extract the data
+        data = cls._extract(resource)
+
+        # How many records do we have?
+        numrows = len(data["rows"])
+        if not numrows:
+            return json_message(message="No records found")
+
+        #_debug("%s rows:" % numrows)
+
+        # Render and send the message(s)
+        composed = cls._compose(resource, data, subscription)
+        success, message = cls._deliver(pe_id, methods, composed)
+
+        # Done
+        return json_message(success=success,
+                            statuscode=200 if success else 403,
+                            message=message)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _extract(resource, hidden=None):
+        """
+            Extract the data for a notification
+
+            @param resource: the S3Resource
+            @param hidden: selectors of additional fields to extract,
+                           which shall not be rendered (unless they
+                           are notify_fields anyway)
+
+            @return: the data as returned from S3Resource.select
+        """
+
         # Fields to extract
         fields = resource.list_fields(key="notify_fields")
         if "created_on" not in fields:
             fields.append("created_on")
 
+        hide = set()
+        if hidden:
+            for selector in hidden:
+                if selector not in fields:
+                    fields.append(selector)
+                    hide.add(resource.prefix_selector(selector))
+
         # Extract the data
         data = resource.select(fields,
                                represent=True,
                                raw_data=True)
-        rows = data["rows"]
+        if hide:
+            data.rfields = [rfield for rfield in data.rfields
+                            if rfield.selector not in hide]
+        return data
 
-        # How many records do we have?
-        numrows = len(rows)
-        if not numrows:
-            return json_message(message="No records found")
+    # -------------------------------------------------------------------------
+    @classmethod
+    def _compose(cls, resource, data, subscription):
+        """
+            Render the notification message(s) for a subscription
 
-        #_debug("%s rows:" % numrows)
+            @param resource: the S3Resource
+            @param data: the data returned from S3Resource.select
+            @param subscription: the subscription data (dict)
+
+            @return: Storage with the subject, the messages
+                     {method: message}, the rendering errors, and
+                     the document_ids and send_data for send_by_pe_id
+        """
+
+        notify_on = subscription["notify_on"]
+        methods = subscription["method"]
 
         # Prepare meta-data
         get_config = resource.get_config
@@ -322,7 +635,7 @@ class S3Notifications(object):
                      "notify_on": notify_on,
                      "last_check_time": last_check_time,
                      "filter_query": filter_query,
-                     "total_rows": numrows,
+                     "total_rows": len(data["rows"]),
                      }
 
         # Render contents for the message template(s)
@@ -379,19 +692,15 @@ class S3Notifications(object):
                         pass
             return None
 
-        # Render and send the message(s)
+        # Render the message(s)
         themes = settings.get_template()
         prefix = resource.get_config("notify_template", "notify")
 
-        send = current.msg.send_by_pe_id
-
-        success = False
+        messages = {}
         errors = []
 
         for method in methods:
 
-            error = None
-
             # Get the message template
             template = None
             filenames = ["%s_%s.html" % (prefix, method.lower())]
@@ -427,20 +736,54 @@ class S3Notifications(object):
                 errors.append(error)
                 continue
 
+            if message:
+                messages[method] = message
+
+        return Storage(subject = s3_truncate(subject, 78),
+                       messages = messages,
+                       errors = errors,
+                       document_ids = document_ids,
+                       send_data = send_data,
+                       )
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _deliver(pe_id, methods, composed):
+        """
+            Send the rendered notification message(s) to a subscriber
+
+            @param pe_id: the subscriber's person entity ID
+            @param methods: the notification methods (contact methods)
+            @param composed: the rendered messages (see _compose)
+
+            @return: tuple (success, message), success being True if
+                     at least one notification went out
+        """
+
+        send = current.msg.send_by_pe_id
+
+        success = False
+        errors = list(composed.errors)
+
+        for method in methods:
+
+            message = composed.messages.get(method)
             if not message:
                 continue
 
+            error = None
+
             # Send the message
             #_debug("Sending message per %s" % method)
             #_debug(message)
             try:
                 sent = send(pe_id,
-                            subject=s3_truncate(subject, 78),
+                            subject=composed.subject,
                             message=message,
                             contact_method=method,
                             system_generated=True,
-                            document_ids=document_ids,
-                            **send_data)
+                            document_ids=composed.document_ids,
+                            **composed.send_data)
             except:
                 exc_info = sys.exc_info()[:2]
                 error = ("%s: %s" % (exc_info[0].__name__, exc_info[1]))
@@ -457,14 +800,149 @@ class S3Notifications(object):
                 if error:
                     errors.append(error)
 
-        # Done
         if errors:
             message = ", ".join(errors)
         else:
             message = "Success"
-        return json_message(success=success,
-                            statuscode=200 if success else 403,
-                            message=message)
+        return success, message
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _controller(url):
+        """
+            Get the controller and function of a subscription URL
+
+            @param url: the subscription URL (relative to the application)
+
+            @return: tuple (controller, function)
+        """
+
+        path = urlparse.urlparse(url)[2].strip("/").split("/")
+        c = path[0] or None
+        f = path[1].split(".", 1)[0] if len(path) > 1 else None
+        return c, f
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def _tables(cls, tablename, url):
+        """
+            Get the names of all tables the notification data for a
+            subscription are extracted from (i.e. the subscribed table
+            and the tables joined for its notify_fields), so that the
+            lookup is only shared between subscribers who can read the
+            same records in all of them
+
+            @param tablename: the subscribed resource
+            @param url: the subscription URL (relative to the application)
+
+            @return: list of table names, the subscribed table first
+        """
+
+        resource = cls._lookup(tablename, url, None, "modified_on", None)[0]
+
+        fields = resource.list_fields(key="notify_fields")
+        rfields = resource.resolve_selectors(fields)[0]
+
+        tablenames = [tablename]
+        for rfield in rfields:
+            field = rfield.field
+            if field is None:
+                # Virtual field
+                continue
+            # Original name of aliased tables (components)
+            table = field.table
+            tname = getattr(table, "_ot", None) or table._tablename
+            if tname not in tablenames:
+                tablenames.append(tname)
+        return tablenames
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _impersonate(user_id):
+        """
+            Impersonate a subscriber for the lookup and rendering
+
+            @param user_id: the subscriber's user ID, None for anonymous
+
+            @return: the language of the subscriber
+        """
+
+        T = current.T
+        if not current.auth.s3_impersonate(user_id):
+            # Anonymous subscriber
+            T.force(current.deployment_settings.get_L10n_default_language())
+        return T.accepted_language
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _lookup(tablename, url, filter_query, timestamp, since):
+        """
+            Construct the resource for a subscription lookup in-process,
+            like the POST?format=msg request to the subscription URL
+            would (except that the controller does not run)
+
+            @param tablename: the subscribed resource
+            @param url: the subscription URL (relative to the application)
+            @param filter_query: the subscription filter query (pr_filter)
+            @param timestamp: the time stamp field to look up updates
+            @param since: look up updates since this datetime
+
+            @return: tuple (resource, page_url, filter_query_nice)
+        """
+
+        settings = current.deployment_settings
+        public_url = settings.get_base_public_url()
+        page_url = "%s/%s/%s" % (public_url,
+                                 current.request.application,
+                                 url.lstrip("/"))
+
+        # URL query of the subscription
+        purl = urlparse.urlparse(url)
+        get_vars = Storage()
+        for k, v in urlparse.parse_qs(purl[4]).items():
+            get_vars[k] = v[0] if len(v) == 1 else v
+
+        # Subscription parameters
+        if since is not None:
+            get_vars["~.%s__ge" % timestamp] = s3_encode_iso_datetime(since)
+
+        # Filters
+        if filter_query:
+            from s3filter import S3FilterString
+            resource = current.s3db.resource(tablename)
+            fstring = S3FilterString(resource, filter_query)
+            for k, v in fstring.get_vars.iteritems():
+                if v is not None:
+                    if k in get_vars:
+                        value = get_vars[k]
+                        if type(value) is list:
+                            value.append(v)
+                        else:
+                            get_vars[k] = [value, v]
+                    else:
+                        get_vars[k] = v
+            query_nice = s3_unicode(fstring.represent())
+        else:
+            query_nice = None
+
+        # Request for the subscription URL
+        path = purl[2].strip("/").split("/")
+        prefix, name = tablename.split("_", 1)
+        current.response.s3.filter = None
+        from s3rest import s3_request
+        r = s3_request(prefix, name,
+                       c = path[0],
+                       f = path[1] if len(path) > 1 else "index",
+                       args = path[2:],
+                       get_vars = get_vars,
+                       extension = "msg",
+                       http = "POST",
+                       catch_errors = False,
+                       )
+        r.customise_resource()
+
+        resource = r.component if r.component else r.resource
+        return resource, page_url, query_nice
 
     # -------------------------------------------------------------------------
     @classmethod
@@ -540,7 +1018,7 @@ class S3Notifications(object):
                     ((rtable.next_check_time == None) | \
                      (rtable.next_check_time <= now)) & \
                     query
-            return db(query).select(rtable.id, join=join)
+            return db(query).select(rtable.id, rtable.resource, join=join)
         else:
             return None
 
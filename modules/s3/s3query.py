@@ -1805,14 +1805,16 @@ class S3ResourceQuery(object):
     # -------------------------------------------------------------------------
     def _query_intersects(self, l, r):
         """
-            Resolve INTERSECTS into a DAL expression;
-            will be ignored for non-spatial DBs
+            Resolve INTERSECTS into a DAL expression; will be ignored
+            for non-spatial DBs unless the spatial index is enabled
 
             @param l: the left operand (Field)
             @param r: the right operand
         """
 
-        if current.deployment_settings.get_gis_spatialdb():
+        settings = current.deployment_settings
+
+        if settings.get_gis_spatialdb():
 
             expr = None
 
@@ -1839,6 +1841,22 @@ class S3ResourceQuery(object):
                 # Invalid operand => fail by default
                 return l.belongs(set())
 
+        elif settings.get_gis_spatial_index() and \
+             l.tablename == "gis_location" and isinstance(r, basestring):
+
+            # Use the in-process spatial index
+            from shapely.wkt import loads as wkt_loads
+            try:
+                shape = wkt_loads(r)
+            except Exception:
+                # Invalid WKT => log and fail
+                current.log.error("INTERSECTS: %s" % sys.exc_info()[1])
+                return l.belongs(set())
+
+            features = current.gis.get_features_by_shape(shape)
+            table = current.s3db.gis_location
+            expr = table.id.belongs([row.id for row in features])
+
         else:
             # Ignore sub-query for non-spatial DB
             expr = False
@@ -48,9 +48,9 @@ from gluon.languages import regex_translate
 from gluon.sqlhtml import OptionsWidget
 from gluon.validators import IS_IN_SET, IS_EMPTY_OR
 
-from s3query import FS
+from s3query import FS, S3Joins
 from s3rest import S3Method
-from s3utils import s3_flatlist, s3_has_foreign_key, s3_unicode, S3MarkupStripper, s3_represent_value
+from s3utils import s3_flatlist, s3_get_foreign_key, s3_has_foreign_key, s3_unicode, S3MarkupStripper, s3_represent_value
 from s3xml import S3XMLFormat
 from s3validators import IS_NUMBER
 
@@ -1162,6 +1162,51 @@ class S3PivotTableFact(object):
             total = self.compute(totals)
         return total
 
+    # -------------------------------------------------------------------------
+    def compute_partials(self, partials):
+        """
+            Aggregate partial aggregates as computed by the database (for
+            all methods except list), produces the same result as compute()
+            for the underlying values (distinct values per cell for count)
+
+            @param partials: iterable of partial aggregates as dicts
+                             {"count": number of non-None values,
+                              "distinct": number of distinct values,
+                              "sum"|"min"|"max": aggregate value}
+        """
+
+        method = self.method
+
+        partials = [p for p in partials if p["count"]]
+
+        if method == "count":
+            return sum(p["distinct"] for p in partials)
+
+        elif method in ("min", "max"):
+            try:
+                values = [p[method] for p in partials]
+                return min(values) if method == "min" else max(values)
+            except (TypeError, ValueError):
+                return None
+
+        elif method == "sum":
+            try:
+                return sum(p["sum"] for p in partials)
+            except (TypeError, ValueError):
+                return None
+
+        elif method == "avg":
+            try:
+                count = sum(p["count"] for p in partials)
+                if count:
+                    return sum(p["sum"] for p in partials) / float(count)
+                else:
+                    return 0.0
+            except (TypeError, ValueError):
+                return None
+
+        return None
+
     # -------------------------------------------------------------------------
     @classmethod
     def parse(cls, fact):
@@ -1400,6 +1445,14 @@ class S3PivotTable(object):
 
         self.values = {}
 
+        self.numrecords = None
+        """ The number of records in the pivot table, if the records
+            have not been extracted (aggregated in the database)
+        """
+
+        self.aggregation = None
+        """ The grouping used by _aggregate (for the lookup of fact values) """
+
         # Get the fields ------------------------------------------------------
         #
         tablename = resource.tablename
@@ -1428,6 +1481,12 @@ class S3PivotTable(object):
                 if axis in exclude_empty:
                     resource.add_filter(FS(axis) != None)
 
+        # Aggregate in the database -------------------------------------------
+        #
+        if self._pushdown():
+            self._aggregate()
+            return
+
         # Retrieve the records ------------------------------------------------
         #
         data = resource.select(self.rfields.keys(), limit=None)
@@ -1510,7 +1569,7 @@ class S3PivotTable(object):
 
         items = self.records
         if items is None:
-            return 0
+            return self.numrecords or 0
         else:
             return len(self.records)
 
@@ -1567,7 +1626,10 @@ class S3PivotTable(object):
                 if is_numeric is None:
                     is_numeric = numeric(total)
                 if not is_numeric:
-                    total = len(irow.records)
+                    if irow.records is None:
+                        total = irow.numrecords
+                    else:
+                        total = len(irow.records)
                 header = Storage(value = irow.value,
                                  text = irow.text if "text" in irow
                                                   else row_repr(irow.value))
@@ -1741,8 +1803,6 @@ class S3PivotTable(object):
                     cell = irow[j]
                     cidx = (j, OTHER) if cothers and j in cothers else (j,)
 
-                    cell_records = cell["records"]
-
                     for layer_index, layer in enumerate(layers):
 
                         # Get cell items for the layer
@@ -1766,15 +1826,15 @@ class S3PivotTable(object):
                                     # Create a new output cell
                                     ocell = orow[ci] = {"values": [],
                                                         "items": [],
-                                                        "records": [],
+                                                        "cells": [],
                                                         }
                                 else:
                                     ocell = orow[ci]
 
 
                                 if layer_index == 0:
-                                    # Extend the list of records
-                                    ocell["records"].extend(cell_records)
+                                    # Extend the list of source cells
+                                    ocell["cells"].append(cell)
 
                                 value_array = ocell["values"]
                                 items_array = ocell["items"]
@@ -1855,14 +1915,8 @@ class S3PivotTable(object):
                         # Build a lookup table for field values if counting
                         if method in ("count", "list"):
                             keys = []
-                            for record_id in cell["records"]:
-                                record = self.records[record_id]
-                                try:
-                                    fvalue = record[rfield.colname]
-                                except AttributeError:
-                                    continue
-                                if fvalue is None:
-                                    continue
+                            cell_values = self._cell_values(cell["cells"], rfield)
+                            for fvalue in cell_values:
                                 if type(fvalue) is not list:
                                     fvalue = [fvalue]
                                 for v in fvalue:
@@ -1999,6 +2053,9 @@ class S3PivotTable(object):
                f is not None and \
                hasattr(f.represent, "bulk"):
                 all_values = values[(selector, method)]
+                if all_values is None and self.records is None:
+                    # Aggregated in the database => look up the values
+                    all_values = self._fact_values(rfield)
                 if all_values:
                     f.represent.bulk(list(s3_flatlist(all_values)))
 
@@ -2296,6 +2353,438 @@ class S3PivotTable(object):
         self.totals[layer] = fact.compute(all_values, totals=True)
         self.values[layer] = all_values
 
+    # -------------------------------------------------------------------------
+    def _pushdown(self):
+        """
+            Check whether the pivot table can be computed with GROUP BY
+            queries in the database rather than from the extracted
+            records, i.e. whether all dimensions and facts are real,
+            single-valued fields, and the resource has no virtual or
+            extra filters
+
+            @return: True|False
+        """
+
+        if not current.deployment_settings.get_ui_report_pushdown():
+            return False
+
+        resource = self.resource
+
+        # Virtual and extra filters require the records
+        resource.get_query()
+        rfilter = resource.rfilter
+        if rfilter is None or \
+           rfilter.get_filter() is not None or \
+           rfilter.get_extra_filters():
+            return False
+
+        rfields = self.rfields
+
+        # Fields and the aggregation methods to apply to them
+        # (None = GROUP BY)
+        fields = [(selector, None)
+                  for selector in (self.rows, self.cols) if selector]
+        fields.extend(fact.layer for fact in self.facts)
+
+        for selector, method in fields:
+
+            rfield = rfields.get(selector)
+            if not rfield or rfield.field is None:
+                return False
+
+            ftype = rfield.ftype
+            if ftype[:5] == "list:" or ftype in ("json", "blob"):
+                return False
+
+            numeric = ftype in ("integer", "bigint", "double", "float") or \
+                      ftype[:7] == "decimal"
+            if method in ("sum", "avg") and not numeric or \
+               method in ("min", "max") and \
+               not (numeric or ftype in ("date", "datetime", "time")):
+                # Aggregation in the database could differ
+                # (e.g. collation of strings)
+                return False
+
+            if not self.single_valued(self.resource, rfield.selector):
+                return False
+
+        return True
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def single_valued(cls, resource, selector, context=True):
+        """
+            Check whether a field selector refers to a field in the master
+            table, or in a table referenced by a chain of foreign keys,
+            i.e. to a field with only one value per record
+
+            @param resource: the S3Resource
+            @param selector: the field selector
+            @param context: resolve context selectors
+        """
+
+        if "." in selector.split("$", 1)[0]:
+            alias, selector = selector.split(".", 1)
+            if alias not in ("~", resource.alias):
+                # Component or free join
+                return False
+
+        path = selector.split("$")
+
+        head = path[0]
+        if head[:1] == "(" and head[-1:] == ")":
+            # Context selector
+            expression = None
+            if context:
+                config = resource.get_config("context")
+                if config:
+                    expression = config.get(head[1:-1])
+            if not isinstance(expression, basestring):
+                return False
+            selector = "$".join([expression] + path[1:])
+            return cls.single_valued(resource, selector, context=False)
+
+        s3db = current.s3db
+
+        table = resource.table
+        for fname in path[:-1]:
+            if fname not in table.fields:
+                return False
+            tablename, key, multiple = s3_get_foreign_key(table[fname],
+                                                          m2m = False,
+                                                          )
+            if not tablename or multiple:
+                return False
+            table = s3db.table(tablename)
+            if not table or key not in table.fields or \
+               key != table._id.name and not table[key].unique:
+                return False
+
+        return path[-1] in table.fields
+
+    # -------------------------------------------------------------------------
+    def _aggregate(self):
+        """
+            Compute the pivot table with GROUP BY queries in the database
+            (alternative to _pivot and _add_layer), sets the same cells,
+            rows, columns and totals, but does not retain the records
+
+            Rows and columns are ordered by the lowest record ID per
+            dimension value, and the fact values in each cell by the
+            lowest record ID per value
+
+            Counts are computed with COUNT(DISTINCT) in the database; the
+            distinct values per cell (for list facts, and for the lookup
+            keys of count facts in JSON) are looked up separately, see
+            _fact_values
+        """
+
+        db = current.db
+
+        table = self.resource.table
+        rfields = self.rfields
+        facts = self.facts
+
+        query, left = self._aggregate_query()
+
+        # The dimension fields
+        rows_colname = cols_colname = None
+        groupby = []
+        if self.rows:
+            rfield = rfields[self.rows]
+            rows_colname = rfield.colname
+            groupby.append(rfield.field)
+        if self.cols:
+            rfield = rfields[self.cols]
+            cols_colname = rfield.colname
+            if cols_colname != rows_colname:
+                groupby.append(rfield.field)
+
+        first = table._id.min()
+        numrecords = table._id.count()
+
+        # Partial aggregates for the numeric and count facts
+        partials = {}
+        expressions = [first, numrecords]
+        for fact in facts:
+            method = fact.method
+            if method == "list":
+                continue
+            field = rfields[fact.selector].field
+            colname = str(field)
+            if colname not in partials:
+                aggregates = partials[colname] = {"count": field.count()}
+            else:
+                aggregates = partials[colname]
+            if method == "count":
+                op = "distinct"
+                if op not in aggregates:
+                    aggregates[op] = field.count(distinct=True)
+                    expressions.append(aggregates[op])
+                continue
+            op = "sum" if method == "avg" else method
+            if op not in aggregates:
+                aggregates[op] = getattr(field, op)()
+                expressions.append(aggregates[op])
+        for aggregates in partials.values():
+            expressions.append(aggregates["count"])
+
+        # Suspend old-style virtual fields
+        vf = table.virtualfields
+        object.__setattr__(table, "virtualfields", [])
+
+        try:
+            # Group the records
+            rows = db(query).select(left = left,
+                                    groupby = groupby,
+                                    cacheable = True,
+                                    *(expressions + groupby))
+            if not rows:
+                self.empty = True
+                return
+
+            groups = []
+            rfirst = {}
+            cfirst = {}
+            for row in rows:
+                rvalue = row[rows_colname] if rows_colname else None
+                cvalue = row[cols_colname] if cols_colname else None
+                record_id = row[first]
+                if rvalue not in rfirst or record_id < rfirst[rvalue]:
+                    rfirst[rvalue] = record_id
+                if cvalue not in cfirst or record_id < cfirst[cvalue]:
+                    cfirst[cvalue] = record_id
+                groups.append((rvalue, cvalue, row))
+
+            # Initialize rows, columns and cells
+            rnames = sorted(rfirst, key=lambda v: rfirst[v])
+            cnames = sorted(cfirst, key=lambda v: cfirst[v])
+            rindex = dict((v, i) for i, v in enumerate(rnames))
+            cindex = dict((v, i) for i, v in enumerate(cnames))
+
+            self.numrows = numrows = len(rnames)
+            self.numcols = numcols = len(cnames)
+            self.row = irows = [Storage(value = v,
+                                        records = None,
+                                        numrecords = 0,
+                                        ) for v in rnames]
+            self.col = icols = [Storage(value = v,
+                                        records = None,
+                                        numrecords = 0,
+                                        ) for v in cnames]
+            self.cell = cells = [[Storage(records = None,
+                                          numrecords = 0,
+                                          fvalues = {},
+                                          partials = {},
+                                          )
+                                  for c in xrange(numcols)]
+                                 for r in xrange(numrows)]
+
+            self.numrecords = 0
+            for rvalue, cvalue, row in groups:
+                r, c = rindex[rvalue], cindex[cvalue]
+                cell = cells[r][c]
+                count = row[numrecords]
+                cell.numrecords = count
+                irows[r].numrecords += count
+                icols[c].numrecords += count
+                self.numrecords += count
+                for colname, aggregates in partials.items():
+                    cell.partials[colname] = dict((op, row[expression])
+                                                  for op, expression in aggregates.items())
+
+            # Retain the grouping for the distinct values lookup
+            self.aggregation = Storage(query = query,
+                                       left = left,
+                                       groupby = groupby,
+                                       rows_colname = rows_colname,
+                                       cols_colname = cols_colname,
+                                       rindex = rindex,
+                                       cindex = cindex,
+                                       )
+        finally:
+            # Restore virtual fields
+            object.__setattr__(table, "virtualfields", vf)
+
+        # Compute the layers
+        for fact in facts:
+
+            layer = fact.layer
+            rfield = rfields[fact.selector]
+            colname = rfield.colname
+
+            if fact.method == "list":
+                # Aggregate the distinct values per cell
+                self._fact_values(rfield)
+                compute = fact.compute
+                get_values = lambda cell: cell.fvalues[colname]
+            else:
+                # Aggregate the partial aggregates per cell
+                compute = lambda values, totals=False: \
+                                 fact.compute_partials(values)
+                get_values = lambda cell: [cell.partials[colname]] \
+                                          if colname in cell.partials else []
+
+            all_values = []
+            col_values = [[] for c in xrange(numcols)]
+            for r in xrange(numrows):
+                row_values = []
+                for c in xrange(numcols):
+                    cell = cells[r][c]
+                    values = get_values(cell)
+                    cell[layer] = compute(values)
+                    row_values.extend(values)
+                    col_values[c].extend(values)
+                all_values.extend(row_values)
+                irows[r][layer] = compute(row_values, totals=True)
+            for c in xrange(numcols):
+                icols[c][layer] = compute(col_values[c], totals=True)
+
+            self.totals[layer] = compute(all_values, totals=True)
+            if fact.method == "count":
+                # Distinct values are looked up on demand
+                self.values[layer] = None
+            else:
+                self.values[layer] = all_values
+
+    # -------------------------------------------------------------------------
+    def _fact_values(self, rfield):
+        """
+            Look up the distinct values of a fact field per cell (after
+            _aggregate), ordered by the lowest record ID per value
+
+            @param rfield: the fact field (S3ResourceField)
+
+            @return: the distinct values of all cells (list)
+        """
+
+        colname = rfield.colname
+        cells = self.cell
+
+        if colname in cells[0][0].fvalues:
+            # Already looked up
+            return [value for row in cells
+                          for cell in row
+                          for value in cell.fvalues[colname]]
+
+        db = current.db
+        table = self.resource.table
+
+        aggregation = self.aggregation
+        rows_colname = aggregation.rows_colname
+        cols_colname = aggregation.cols_colname
+        rindex = aggregation.rindex
+        cindex = aggregation.cindex
+
+        fields = list(aggregation.groupby)
+        if colname not in (rows_colname, cols_colname):
+            fields.append(rfield.field)
+
+        if str(rfield.field) == str(table._id):
+            # Record IDs are distinct anyway
+            first = table._id
+            groupby = None
+        else:
+            first = table._id.min()
+            groupby = fields
+
+        # Suspend old-style virtual fields
+        vf = table.virtualfields
+        object.__setattr__(table, "virtualfields", [])
+        try:
+            rows = db(aggregation.query).select(first,
+                                                left = aggregation.left,
+                                                groupby = groupby,
+                                                cacheable = True,
+                                                *fields)
+        finally:
+            # Restore virtual fields
+            object.__setattr__(table, "virtualfields", vf)
+
+        items = {}
+        for row in rows:
+            value = row[colname]
+            if value is None:
+                continue
+            r = rindex[row[rows_colname] if rows_colname else None]
+            c = cindex[row[cols_colname] if cols_colname else None]
+            key = (r, c)
+            if key in items:
+                items[key].append((row[first], value))
+            else:
+                items[key] = [(row[first], value)]
+
+        all_values = []
+        for r, row in enumerate(cells):
+            for c, cell in enumerate(row):
+                values = items.get((r, c))
+                if values:
+                    values = [v for i, v in sorted(values)]
+                else:
+                    values = []
+                cell.fvalues[colname] = values
+                all_values.extend(values)
+
+        return all_values
+
+    # -------------------------------------------------------------------------
+    def _aggregate_query(self):
+        """
+            Get the query and the left joins for the GROUP BY queries
+
+            @return: tuple (query, left)
+        """
+
+        resource = self.resource
+        query, aqueries = resource.get_aggregate_query()
+
+        # Left joins for dimensions and facts (all many-to-one)
+        rfields = self.rfields
+        selectors = [self.rows, self.cols]
+        selectors.extend(fact.selector for fact in self.facts)
+        ljoins = S3Joins(resource.tablename)
+        for selector in selectors:
+            if selector:
+                ljoins.extend(rfields[selector].left)
+        left = ljoins.as_list(aqueries=aqueries)
+
+        return query, left
+
+    # -------------------------------------------------------------------------
+    def _cell_values(self, cells, rfield):
+        """
+            Get the values of a fact field in pivot table cells, in
+            order of the records (or of the lowest record ID per value
+            with _aggregate)
+
+            @param cells: the cells (items of self.cell)
+            @param rfield: the fact field (S3ResourceField)
+
+            @return: generator of field values (skipping None)
+        """
+
+        records = self.records
+        colname = rfield.colname
+
+        for cell in cells:
+
+            if records is None:
+                # Distinct values per cell from _aggregate
+                if colname not in cell["fvalues"]:
+                    self._fact_values(rfield)
+                for value in cell["fvalues"][colname]:
+                    yield value
+                continue
+
+            for record_id in cell["records"]:
+                record = records[record_id]
+                try:
+                    fvalue = record[colname]
+                except AttributeError:
+                    continue
+                if fvalue is not None:
+                    yield fvalue
+
     # -------------------------------------------------------------------------
     def _get_fields(self, fields=None):
         """
@@ -28,7 +28,7 @@
 
     @group Resource API: S3Resource,
     @group Filter API: S3ResourceFilter
-    @group Helper Classes: S3AxisFilter, S3ResourceData
+    @group Helper Classes: S3AxisFilter, S3ResourceData, S3ResourceColumns
 """
 
 __all__ = ("S3AxisFilter",
@@ -61,7 +61,7 @@ from gluon.tools import callback
 from s3dal import Expression, Field, Row, Rows, Table, S3DAL
 from s3data import S3DataTable, S3DataList
 from s3datetime import s3_format_datetime
-from s3fields import S3Represent, s3_all_meta_field_names
+from s3fields import S3Represent, s3_all_meta_field_names, s3_represent_bulk
 from s3query import FS, S3ResourceField, S3ResourceQuery, S3Joins, S3URLQuery
 from s3utils import s3_get_foreign_key, s3_get_last_record_id, s3_has_foreign_key, s3_remove_last_record_id, s3_str, s3_unicode
 from s3validators import IS_ONE_OF
@@ -318,6 +318,7 @@ class S3Resource(object):
         # Export meta data
         self.muntil = None      # latest mtime of the exported records
         self.results = None     # number of exported records
+        self.cursor = None      # continuation cursor for keyset paging
 
         # Standard methods ----------------------------------------------------
 
@@ -583,6 +584,61 @@ class S3Resource(object):
 
         return self.rfilter.get_filter()
 
+    # -------------------------------------------------------------------------
+    def get_aggregate_query(self):
+        """
+            Get a query for the records matching the resource filter,
+            which can be combined with many-to-one left joins in GROUP BY
+            queries (without duplicating records)
+
+            @return: tuple (query, aqueries), with aqueries being the
+                     accessible queries for joined tables (as required
+                     by S3Joins.as_list)
+        """
+
+        table = self.table
+        tablename = table._tablename
+
+        # Accessible queries for differential authorization of
+        # joined tables (retaining the accessible-context of the
+        # parent resource in reverse component joins)
+        aqueries = {}
+        parent = self.parent
+        if parent and parent.accessible_query is not None:
+            method = []
+            if parent._approved:
+                method.append("read")
+            if parent._unapproved:
+                method.append("review")
+            aqueries[parent.tablename] = parent.accessible_query(method,
+                                                                 parent.table,
+                                                                 )
+
+        query = self.get_query()
+
+        # Joins for the filter query => sub-select the record IDs,
+        # as one-to-many joins could duplicate the records
+        rfilter = self.rfilter
+        ijoins = S3Joins(tablename)
+        ljoins = S3Joins(tablename)
+        filter_tables = set(ijoins.add(rfilter.get_joins(left=False)))
+        filter_tables.update(ljoins.add(rfilter.get_joins(left=True)))
+        if filter_tables:
+            join = ijoins.as_list(tablenames = filter_tables,
+                                  aqueries = aqueries,
+                                  prefer = ljoins,
+                                  )
+            left = ljoins.as_list(tablenames = filter_tables,
+                                  aqueries = aqueries,
+                                  )
+            subselect = current.db(query)._select(table._id,
+                                                  join = join,
+                                                  left = left,
+                                                  )
+            query = table._id.belongs(subselect)
+
+        return query, aqueries
+
     # -------------------------------------------------------------------------
     def clear_query(self):
         """
@@ -629,7 +685,9 @@ class S3Resource(object):
                as_rows=False,
                represent=False,
                show_links=True,
-               raw_data=False):
+               raw_data=False,
+               columnar=False,
+               chunksize=None):
         """
             Extract data from this resource
 
@@ -646,7 +704,29 @@ class S3Resource(object):
             @param as_rows: return the rows (don't extract)
             @param represent: render field value representations
             @param raw_data: include raw data in the result
-        """
+            @param columnar: extract the data in chunks as column arrays,
+                             returns an S3ResourceColumns instance where
+                             the records are extracted during iteration
+                             (not with as_rows or groupby)
+            @param chunksize: maximum number of records per chunk in
+                              columnar mode
+        """
+
+        if columnar and not (as_rows or groupby):
+            return S3ResourceColumns(self,
+                                     fields,
+                                     start=start,
+                                     limit=limit,
+                                     left=left,
+                                     orderby=orderby,
+                                     distinct=distinct,
+                                     virtual=virtual,
+                                     count=count,
+                                     getids=getids,
+                                     represent=represent,
+                                     show_links=show_links,
+                                     raw_data=raw_data,
+                                     chunksize=chunksize)
 
         data = S3ResourceData(self,
                               fields,
@@ -1359,6 +1439,12 @@ class S3Resource(object):
         id_repr = table_id.represent
         table_id.represent = None
 
+        # Extract unpaginated data in chunks if so configured
+        if limit is None:
+            chunksize = current.deployment_settings.get_base_export_chunksize()
+        else:
+            chunksize = None
+
         # Extract the data
         data = self.select(selectors,
                            start = start,
@@ -1369,11 +1455,15 @@ class S3Resource(object):
                            count = True,
                            getids = getids,
                            represent = True,
+                           columnar = bool(chunksize),
+                           chunksize = chunksize,
                            )
 
         rows = data.rows
 
         # Restore ID representation
+        # (in columnar mode, records are represented during iteration,
+        # but the renderers have already been resolved at this point)
         table_id.represent = id_repr
 
         # Empty table - or just no match?
@@ -1905,6 +1995,7 @@ class S3Resource(object):
                    start=None,
                    limit=None,
                    msince=None,
+                   after=None,
                    fields=None,
                    dereference=True,
                    maxdepth=MAXDEPTH,
@@ -1930,6 +2021,8 @@ class S3Resource(object):
 
             @param msince: export only records which have been modified
                             after this datetime
+            @param after: continuation cursor for keyset paging, see
+                          export_tree
 
             @param fields: data fields to include (default: all)
 
@@ -1971,6 +2064,7 @@ class S3Resource(object):
         tree = self.export_tree(start = start,
                                 limit = limit,
                                 msince = msince,
+                                after = after,
                                 fields = fields,
                                 dereference = dereference,
                                 maxdepth = maxdepth,
@@ -2015,6 +2109,7 @@ class S3Resource(object):
                     start=0,
                     limit=None,
                     msince=None,
+                    after=None,
                     fields=None,
                     references=None,
                     dereference=True,
@@ -2035,6 +2130,13 @@ class S3Resource(object):
             @param start: index of the first record to export
             @param limit: maximum number of records to export
             @param msince: minimum modification date of the records
+            @param after: continuation cursor for keyset paging, i.e. a
+                          tuple (mtime, id) of the last master record of
+                          the previous page, or an empty tuple for the
+                          first page; orders the master records by
+                          modification date and ID, and sets self.cursor
+                          to the cursor for the next page if there are
+                          more records (otherwise self.cursor is None)
             @param fields: data fields to include (default: all)
             @param references: foreign keys to include (default: all)
             @param dereference: also export referenced records
@@ -2070,6 +2172,7 @@ class S3Resource(object):
         # Initialize export metadata
         self.muntil = None
         self.results = 0
+        self.cursor = None
 
         # Use lazy representations
         lazy = []
@@ -2091,7 +2194,32 @@ class S3Resource(object):
             [add_filter(q) for a in queries for q in queries[a]]
 
         # Order by modified_on if msince is requested
-        if msince is not None and "modified_on" in table.fields:
+        keyset = after is not None
+        if keyset:
+            # Keyset paging: order by modified_on and ID, and continue
+            # after the last record of the previous page
+            orderby = "%s ASC" % table._id
+            if "modified_on" in table.fields:
+                mtime_field = table["modified_on"]
+                # Records without modified_on first (explicitly, as the
+                # default position of NULLs differs between databases)
+                orderby = "CASE WHEN %s IS NULL THEN 0 ELSE 1 END, %s ASC, %s" % \
+                          (mtime_field, mtime_field, orderby)
+            else:
+                mtime_field = None
+            if after:
+                mtime, record_id = after
+                query = (table._id > record_id)
+                if mtime_field is None:
+                    pass
+                elif mtime is None:
+                    query = ((mtime_field == None) & query) | \
+                            (mtime_field != None)
+                else:
+                    query = (mtime_field > mtime) | \
+                            ((mtime_field == mtime) & query)
+                self.add_filter(query)
+        elif msince is not None and "modified_on" in table.fields:
             orderby = "%s ASC" % table["modified_on"]
         else:
             orderby = None
@@ -2145,6 +2273,11 @@ class S3Resource(object):
                   cacheable = True,
                   )
 
+        # Continuation cursor for the next page
+        if keyset and limit and self._rows and len(self._rows) >= limit:
+            last = self._rows[-1]
+            self.cursor = (last.get("modified_on"), last[table._id.name])
+
         # Total number of results
         results = self.count()
 
@@ -2806,6 +2939,7 @@ class S3Resource(object):
                    conflict_policy=None,
                    last_sync=None,
                    onconflict=None,
+                   stream=None,
                    **args):
         """
             XML Importer
@@ -2827,6 +2961,12 @@ class S3Resource(object):
             @param conflict_policy: policy for conflict resolution (sync)
             @param last_sync: last synchronization datetime (sync)
             @param onconflict: callback hook for conflict resolution (sync)
+            @param stream: import XML or CSV sources incrementally, in chunks
+                           of this number of elements/rows, committing each
+                           chunk separately (only for new jobs without
+                           target record ID); references to elements in other
+                           chunks can only be resolved if they have been
+                           imported before (i.e. appear earlier in the source)
             @param args: parameters to pass to the transformation stylesheet
         """
 
@@ -2841,6 +2981,10 @@ class S3Resource(object):
         tree = None
         self.job = None
 
+        if job_id or not commit_job or id:
+            # Can only stream new jobs that get committed
+            stream = None
+
         if not job_id:
 
             # Additional stylesheet parameters
@@ -2850,47 +2994,19 @@ class S3Resource(object):
                         name=self.name,
                         utcnow=s3_format_datetime())
 
-            # Build import tree
-            if not isinstance(source, (list, tuple)):
-                source = [source]
-            for item in source:
-                if isinstance(item, (list, tuple)):
-                    resourcename, s = item[:2]
-                else:
-                    resourcename, s = None, item
-                if isinstance(s, etree._ElementTree):
-                    t = s
-                elif format == "json":
-                    if isinstance(s, basestring):
-                        source = StringIO(s)
-                        t = xml.json2tree(s)
-                    else:
-                        t = xml.json2tree(s)
-                elif format == "csv":
-                    t = xml.csv2tree(s,
-                                     resourcename=resourcename,
-                                     extra_data=extra_data)
-                elif format == "xls":
-                    t = xml.xls2tree(s,
-                                     resourcename=resourcename,
-                                     extra_data=extra_data)
-                else:
-                    t = xml.parse(s)
-                if not t:
-                    if xml.error:
-                        raise SyntaxError(xml.error)
+            # Build import tree(s)
+            trees = self.import_trees(source,
+                                      format = format,
+                                      stylesheet = stylesheet,
+                                      extra_data = extra_data,
+                                      chunksize = stream,
+                                      **args)
+            if not stream:
+                for t in trees:
+                    if not tree:
+                        tree = t
                     else:
-                        raise SyntaxError("Invalid source")
-
-                if stylesheet is not None:
-                    t = xml.transform(t, stylesheet, **args)
-                    if not t:
-                        raise SyntaxError(xml.error)
-
-                if not tree:
-                    tree = t.getroot()
-                else:
-                    tree.extend(list(t.getroot()))
+                        tree.extend(list(t))
 
             if files is not None and isinstance(files, dict):
                 self.files = Storage(files)
@@ -2902,16 +3018,25 @@ class S3Resource(object):
         response = current.response
         # Flag to let onvalidation/onaccept know this is coming from a Bulk Import
         response.s3.bulk = True
-        success = self.import_tree(id, tree,
-                                   ignore_errors=ignore_errors,
-                                   job_id=job_id,
-                                   commit_job=commit_job,
-                                   delete_job=delete_job,
-                                   strategy=strategy,
-                                   update_policy=update_policy,
-                                   conflict_policy=conflict_policy,
-                                   last_sync=last_sync,
-                                   onconflict=onconflict)
+        if stream:
+            success = self.import_stream(trees,
+                                         ignore_errors=ignore_errors,
+                                         strategy=strategy,
+                                         update_policy=update_policy,
+                                         conflict_policy=conflict_policy,
+                                         last_sync=last_sync,
+                                         onconflict=onconflict)
+        else:
+            success = self.import_tree(id, tree,
+                                       ignore_errors=ignore_errors,
+                                       job_id=job_id,
+                                       commit_job=commit_job,
+                                       delete_job=delete_job,
+                                       strategy=strategy,
+                                       update_policy=update_policy,
+                                       conflict_policy=conflict_policy,
+                                       last_sync=last_sync,
+                                       onconflict=onconflict)
         response.s3.bulk = False
 
         self.files = Storage()
@@ -2964,6 +3089,123 @@ class S3Resource(object):
         return xml.json_message(False, 400,
                                 message=self.error, tree=tree)
 
+    # -------------------------------------------------------------------------
+    def import_trees(self, source,
+                     format="xml",
+                     stylesheet=None,
+                     extra_data=None,
+                     chunksize=None,
+                     **args):
+        """
+            Parse and transform import sources
+
+            @param source: the data source(s), see import_xml
+            @param format: type of source = "xml", "json", "csv" or "xls"
+            @param stylesheet: stylesheet to use for transformation
+            @param extra_data: for CSV imports, dict of extra cols to add
+                               to each row
+            @param chunksize: parse XML and CSV sources incrementally, in
+                              chunks of this number of elements/rows
+            @param args: parameters to pass to the transformation stylesheet
+
+            @return: a generator of (transformed) root elements
+
+            @raise SyntaxError: if a source can not be parsed or transformed
+        """
+
+        xml = current.xml
+
+        if chunksize and isinstance(stylesheet, basestring):
+            # Parse the stylesheet only once
+            stylesheet = xml.parse(stylesheet)
+            if stylesheet is None:
+                raise SyntaxError(xml.error)
+
+        if not isinstance(source, (list, tuple)):
+            source = [source]
+        for item in source:
+            if isinstance(item, (list, tuple)):
+                resourcename, s = item[:2]
+            else:
+                resourcename, s = None, item
+            if isinstance(s, etree._ElementTree):
+                trees = [s]
+            elif format == "json":
+                trees = [xml.json2tree(s)]
+            elif format == "csv":
+                trees = xml.csv2trees(s,
+                                      resourcename=resourcename,
+                                      extra_data=extra_data,
+                                      chunksize=chunksize)
+            elif format == "xls":
+                trees = [xml.xls2tree(s,
+                                      resourcename=resourcename,
+                                      extra_data=extra_data)]
+            elif chunksize:
+                trees = xml.iterparse(s, chunksize=chunksize)
+            else:
+                trees = [xml.parse(s)]
+
+            for t in trees:
+                if not t:
+                    if xml.error:
+                        raise SyntaxError(xml.error)
+                    else:
+                        raise SyntaxError("Invalid source")
+
+                if stylesheet is not None:
+                    t = xml.transform(t, stylesheet, **args)
+                    if not t:
+                        raise SyntaxError(xml.error)
+
+                yield t.getroot()
+
+    # -------------------------------------------------------------------------
+    def import_stream(self, trees, ignore_errors=False, **args):
+        """
+            Import data from a sequence of S3XML element trees, each in a
+            separate import job and transaction, so that the memory use
+            does not depend on the total size of the source
+
+            @param trees: iterable of element trees (chunks)
+            @param ignore_errors: continue at errors (=skip invalid elements)
+            @param args: parameters for import_tree
+
+            @return: True if successful, otherwise False (all chunks
+                     before the failing chunk remain committed)
+        """
+
+        db = current.db
+
+        # Records imported from previous chunks, for tuid references
+        tuids = {}
+
+        success = True
+        error = None
+        error_tree = None
+        for tree in trees:
+            success = self.import_tree(None, tree,
+                                       ignore_errors=ignore_errors,
+                                       tuids=tuids,
+                                       **args)
+
+            # Collect the errors of all chunks
+            if self.error:
+                error = self.error
+            if self.error_tree is not None:
+                if error_tree is None:
+                    error_tree = self.error_tree
+                else:
+                    error_tree.extend(list(self.error_tree))
+
+            if success is not True:
+                break
+            db.commit()
+
+        self.error = error
+        self.error_tree = error_tree
+        return success
+
     # -------------------------------------------------------------------------
     def import_tree(self, id, tree,
                     job_id=None,
@@ -2974,7 +3216,8 @@ class S3Resource(object):
                     update_policy=None,
                     conflict_policy=None,
                     last_sync=None,
-                    onconflict=None):
+                    onconflict=None,
+                    tuids=None):
         """
             Import data from an S3XML element tree.
 
@@ -2985,6 +3228,8 @@ class S3Resource(object):
             @param job_id: restore a job from the job table (ID or UID)
             @param delete_job: delete the import job from the job table
             @param commit_job: commit the job (default)
+            @param tuids: map of records imported by previous jobs, to
+                          resolve tuid references (see S3ImportJob)
 
             @todo: update for link table support
         """
@@ -3127,7 +3372,8 @@ class S3Resource(object):
                                      update_policy=update_policy,
                                      conflict_policy=conflict_policy,
                                      last_sync=last_sync,
-                                     onconflict=onconflict)
+                                     onconflict=onconflict,
+                                     tuids=tuids)
             add_item = import_job.add_item
             for element in elements:
                 success = add_item(element=element,
@@ -5545,6 +5791,18 @@ class S3ResourceData(object):
                                                orderby = orderby_aggr,
                                                )
 
+        # Stream the post-filter?
+        # => for paginated requests with virtual filter, extract and filter
+        #    the master rows in chunks (in order of the filter query) until
+        #    the page is filled, rather than extracting all matching rows
+        stream = False
+        if ids and vfilter and not efilter and not getids and \
+           limit is not None and not groupby:
+            settings = current.deployment_settings
+            chunksize = settings.get_base_vfilter_chunksize()
+            if chunksize:
+                stream = True
+
         # Simplify the master query if possible
         empty = False
         limitby = None
@@ -5558,6 +5816,9 @@ class S3ResourceData(object):
                 # No records matching the filter query, so we
                 # can skip the master query too
                 empty = True
+            elif stream:
+                # Master query per chunk
+                orderby = None
             else:
                 # Which records do we need to extract?
                 if pagination and (efilter or vfilter):
@@ -5653,15 +5914,37 @@ class S3ResourceData(object):
 
             # Execute master query
             db = current.db
-            rows = db(master_query).select(join = master_ijoins,
-                                           left = master_ljoins,
-                                           distinct = distinct,
-                                           groupby = groupby,
-                                           orderby = orderby,
-                                           limitby = limitby,
-                                           orderby_on_limitby = orderby_on_limitby,
-                                           cacheable = not as_rows,
-                                           *qfields.values())
+            if stream:
+                def select(chunk):
+                    if not ljoins or ijoins:
+                        limitby = (0, len(chunk))
+                    else:
+                        limitby = None
+                    return db(table._id.belongs(chunk)).select(
+                                            join = master_ijoins,
+                                            left = master_ljoins,
+                                            distinct = distinct,
+                                            limitby = limitby,
+                                            orderby_on_limitby = False,
+                                            cacheable = not as_rows,
+                                            *qfields.values())
+                rows, page, totalrows = self.stream_filter(select,
+                                                           ids,
+                                                           start = start,
+                                                           limit = limit,
+                                                           chunksize = chunksize,
+                                                           count = count,
+                                                           )
+            else:
+                rows = db(master_query).select(join = master_ijoins,
+                                               left = master_ljoins,
+                                               distinct = distinct,
+                                               groupby = groupby,
+                                               orderby = orderby,
+                                               limitby = limitby,
+                                               orderby_on_limitby = orderby_on_limitby,
+                                               cacheable = not as_rows,
+                                               *qfields.values())
 
             # Restore virtual fields
             if not virtual:
@@ -5671,7 +5954,12 @@ class S3ResourceData(object):
             rows = Rows(current.db)
 
         # Apply any virtual/extra filters, determine the subset
-        if not len(rows) and not ids:
+        if stream:
+
+            # Already filtered and paginated (stream_filter)
+            pass
+
+        elif not len(rows) and not ids:
 
             # Empty set => empty subset (no point to filter/count)
             page = []
@@ -6358,6 +6646,40 @@ class S3ResourceData(object):
 
         colname = rfield.colname
 
+        representations = self.represent_records(rfield,
+                                                 none = none,
+                                                 show_links = show_links,
+                                                 )
+        for record_id, text, value in representations:
+
+            if record_id not in results:
+                results[record_id] = Storage() \
+                                     if not raw_data \
+                                     else Storage(_row=Storage())
+
+            result = results[record_id]
+            result[colname] = text
+            if raw_data:
+                result["_row"][colname] = value
+
+        return results
+
+    # -------------------------------------------------------------------------
+    def represent_records(self, rfield, none="-", show_links=True):
+        """
+            Generator to render the representations of the values for
+            rfield in all extracted records
+
+            @param rfield: the field (S3ResourceField)
+            @param none: default representation of None
+            @param show_links: allow representation functions to render
+                               links as HTML
+
+            @return: generator of tuples (RecordID, Representation, RawValue)
+        """
+
+        colname = rfield.colname
+
         field_data = self.field_data
         fvalues, frecords, joined, list_type, virtual, json_type = field_data[colname]
 
@@ -6374,85 +6696,74 @@ class S3ResourceData(object):
         else:
             show_link = None
 
-        per_row_lookup = list_type and \
-                         self.effort[colname] < len(fvalues) * 30
-
-        # Render all unique values
-        if hasattr(renderer, "bulk") and not list_type:
-            per_row_lookup = False
-            fvalues = renderer.bulk(fvalues.keys(), list_type=False)
-        elif not per_row_lookup:
-            for value in fvalues:
-                try:
-                    text = renderer(value)
-                except:
-                    text = s3_str(value)
-                fvalues[value] = text
-
-        # Write representations into result
-        for record_id in frecords:
-
-            if record_id not in results:
-                results[record_id] = Storage() \
-                                     if not raw_data \
-                                     else Storage(_row=Storage())
-
-            record = frecords[record_id]
-            result = results[record_id]
-
-            # List type with per-row lookup?
-            if per_row_lookup:
-                value = record.keys()
-                if None in value and len(value) > 1:
-                    value = [v for v in value if v is not None]
-                try:
-                    text = renderer(value)
-                except:
-                    text = s3_str(value)
-                result[colname] = text
-                if raw_data:
-                    result["_row"][colname] = value
-
-            # Single value (master record)
-            elif len(record) == 1 or \
-                not joined and not list_type:
-                value = record.keys()[0]
-                result[colname] = fvalues[value] \
-                                  if value in fvalues else none
-                if raw_data:
-                    result["_row"][colname] = value
-                continue
-
-            # Multiple values (joined or list-type)
-            else:
-                vlist = []
-                for value in record:
-                    if value is None and not list_type:
-                        continue
-                    value = fvalues[value] \
-                            if value in fvalues else none
-                    vlist.append(value)
-
-                # Concatenate multiple values
-                if any([hasattr(v, "xml") for v in vlist]):
-                    data = TAG[""](
-                            list(
-                                chain.from_iterable(
-                                    [(v, ", ") for v in vlist])
-                                )[:-1]
-                            )
+        try:
+            # Renderers without bulk-method may expect the whole list
+            # for list-types => render per row if that is cheaper
+            per_row_lookup = list_type and \
+                             not hasattr(renderer, "bulk") and \
+                             self.effort[colname] < len(fvalues) * 30
+
+            # Render all unique values (for list-types and joined
+            # values: all unique elements, with one lookup if the
+            # renderer supports bulk representation)
+            if not per_row_lookup:
+                fvalues = s3_represent_bulk(renderer, fvalues.keys())
+
+            # Produce the representations per record
+            for record_id in frecords:
+
+                record = frecords[record_id]
+
+                # List type with per-row lookup?
+                if per_row_lookup:
+                    value = record.keys()
+                    if None in value and len(value) > 1:
+                        value = [v for v in value if v is not None]
+                    try:
+                        text = renderer(value)
+                    except:
+                        text = s3_str(value)
+                    yield record_id, text, value
+
+                # Empty list
+                elif list_type and not record:
+                    yield record_id, none, []
+
+                # Single value (master record)
+                elif len(record) == 1 or \
+                    not joined and not list_type:
+                    value = record.keys()[0]
+                    text = fvalues[value] \
+                           if value in fvalues else none
+                    yield record_id, text, value
+
+                # Multiple values (joined or list-type)
                 else:
-                    data = ", ".join([s3_str(v) for v in vlist])
-
-                result[colname] = data
-                if raw_data:
-                    result["_row"][colname] = record.keys()
+                    vlist = []
+                    for value in record:
+                        if value is None and not list_type:
+                            continue
+                        value = fvalues[value] \
+                                if value in fvalues else none
+                        vlist.append(value)
+
+                    # Concatenate multiple values
+                    if any([hasattr(v, "xml") for v in vlist]):
+                        data = TAG[""](
+                                list(
+                                    chain.from_iterable(
+                                        [(v, ", ") for v in vlist])
+                                    )[:-1]
+                                )
+                    else:
+                        data = ", ".join([s3_str(v) for v in vlist])
 
-        # Restore linkto
-        if show_link is not None:
-            renderer.show_link = show_link
+                    yield record_id, data, record.keys()
 
-        return results
+        finally:
+            # Restore linkto
+            if show_link is not None:
+                renderer.show_link = show_link
 
     # -------------------------------------------------------------------------
     def __getitem__(self, key):
@@ -6470,6 +6781,83 @@ class S3ResourceData(object):
         else:
             raise AttributeError
 
+    # -------------------------------------------------------------------------
+    def stream_filter(self,
+                      select,
+                      ids,
+                      start=0,
+                      limit=None,
+                      chunksize=500,
+                      count=True):
+        """
+            Apply the virtual filter to the master rows chunk by chunk,
+            in the order of the record IDs, and stop as soon as the
+            requested page is filled (streaming post-filter)
+
+            @param select: function to select the master rows for a
+                           list of record IDs
+            @param ids: the record IDs matching the filter query, ordered
+            @param start: index of the first record of the page
+            @param limit: maximum number of records in the page
+            @param chunksize: number of record IDs per chunk
+            @param count: continue filtering all remaining chunks in
+                          order to establish the number of matching
+                          records, otherwise stop when the page is filled
+
+            @return: tuple (rows, page, totalrows), with:
+                        rows = the Rows in the page, in order
+                        page = the record IDs in the page, in order
+                        totalrows = the number of matching records
+                                    (None if count is False)
+        """
+
+        rfilter = self.resource.rfilter
+        pkey = str(self.table._id)
+
+        if start is None:
+            start = 0
+        end = start + limit
+
+        result = []
+        colnames = None
+        page = []
+
+        matches = 0
+        total = len(ids)
+        scanned = 0
+        while scanned < total:
+
+            if matches >= end and not count:
+                # Page filled
+                break
+
+            chunk = ids[scanned:scanned + chunksize]
+            scanned += len(chunk)
+
+            rows = select(chunk)
+            if colnames is None:
+                colnames = rows.colnames
+
+            # Restore the order of the chunk
+            position = dict((record_id, i) for i, record_id in enumerate(chunk))
+            rows = rows.sort(lambda row: position[row[pkey]])
+
+            seen = set()
+            for row in rfilter(rows):
+                record_id = row[pkey]
+                if record_id not in seen:
+                    seen.add(record_id)
+                    if start <= matches < end:
+                        page.append(record_id)
+                    matches += 1
+                if page and page[-1] == record_id:
+                    result.append(row)
+
+        totalrows = matches if count else None
+
+        rows = Rows(current.db, result, colnames=colnames or [], compact=False)
+        return rows, page, totalrows
+
     # -------------------------------------------------------------------------
     def getids(self, rows, pkey):
         """
@@ -6585,4 +6973,304 @@ class S3ResourceData(object):
             items = expr
         return items
 
+# =============================================================================
+class S3ResourceColumns(S3ResourceData):
+    """
+        Columnar data extraction from a resource (for large exports):
+        rather than extracting all matching records at once into nested
+        dicts per record, the data are extracted in chunks of records,
+        and each chunk is delivered as per-column value arrays along with
+        the array of record IDs (=the record index) of the chunk
+
+        @note: the constructor only determines the record IDs (in order),
+               the field data are extracted when iterating over the chunks
+               (or records), so peak memory is bounded by the chunk size
+    """
+
+    # Default number of records per chunk
+    CHUNKSIZE = 1000
+
+    def __init__(self,
+                 resource,
+                 fields,
+                 start=0,
+                 limit=None,
+                 left=None,
+                 orderby=None,
+                 distinct=False,
+                 virtual=True,
+                 count=False,
+                 getids=False,
+                 represent=False,
+                 show_links=True,
+                 raw_data=False,
+                 chunksize=None):
+        """
+            Constructor, determines the IDs of the records to extract
+
+            @param resource: the resource
+            @param fields: the fields to extract (selector strings)
+            @param start: index of the first record
+            @param limit: maximum number of records
+            @param left: additional left joins required for custom filters
+            @param orderby: orderby-expression for DAL
+            @param distinct: select distinct rows
+            @param virtual: include mandatory virtual fields
+            @param count: include the total number of matching records
+            @param getids: include the IDs of all matching records
+            @param represent: render field value representations
+            @param show_links: allow representation functions to render
+                               links as HTML
+            @param raw_data: include raw data in the result
+            @param chunksize: maximum number of records to extract per query
+        """
+
+        # The resource
+        self.resource = resource
+        self.table = table = resource.table
+
+        tablename = table._tablename
+        pkey = str(table._id)
+
+        # Determine the IDs of the records to extract, in order (this
+        # applies filters, orderby and pagination just like for a regular
+        # select, but only extracts the record IDs)
+        data = S3ResourceData(resource,
+                              [table._id.name],
+                              start = start,
+                              limit = limit,
+                              left = left,
+                              orderby = orderby,
+                              distinct = distinct,
+                              virtual = virtual,
+                              count = count,
+                              getids = getids,
+                              )
+        self.page = [row[pkey] for row in data.rows]
+        self.numrows = data.numrows
+        self.ids = data.ids
+
+        # Accessible queries for differential field authorization
+        self.aqueries = aqueries = {}
+        parent = resource.parent
+        if parent and parent.accessible_query is not None:
+            method = []
+            if parent._approved:
+                method.append("read")
+            if parent._unapproved:
+                method.append("review")
+            aqueries[parent.tablename] = parent.accessible_query(method,
+                                                                 parent.table,
+                                                                 )
+
+        # Resolve the display fields
+        if fields is None:
+            fields = [f.name for f in resource.readable_fields()]
+        dfields, dijoins, dljoins = resource.resolve_selectors(fields,
+                                                               extra_fields = False,
+                                                               )[:3]
+        self.ijoins = ijoins = S3Joins(tablename)
+        self.ljoins = ljoins = S3Joins(tablename)
+        ijoins.extend(dijoins)
+        ljoins.extend(dljoins)
+        self.rfields = dfields
+
+        # Fields in the master table (all others are extracted with
+        # separate queries per joined table, see joined_query)
+        qfields, mfields = self.master_fields(dfields, [], set())[1:3]
+        if pkey not in qfields:
+            qfields[pkey] = table._id
+        self.qfields = qfields
+        self.mfields = list(mfields)
+
+        self.virtual = virtual
+        self.represent = represent
+        self.show_links = show_links
+        self.raw_data = raw_data
+        self.chunksize = chunksize or self.CHUNKSIZE
+
+        self.field_data = self.effort = None
+
+    # -------------------------------------------------------------------------
+    def __len__(self):
+        """ The number of records to extract """
+
+        return len(self.page)
+
+    # -------------------------------------------------------------------------
+    def __iter__(self):
+        """ Iterate over all records (see records()) """
+
+        return self.records()
+
+    # -------------------------------------------------------------------------
+    @property
+    def rows(self):
+        """
+            Access to the records for callers expecting S3ResourceData,
+            the records are extracted lazily during iteration
+        """
+
+        return self
+
+    # -------------------------------------------------------------------------
+    def chunks(self, start=None, end=None):
+        """
+            Generator to extract the data in chunks
+
+            @param start: index of the first record (in the page)
+            @param end: index of the last record + 1 (in the page)
+
+            @return: generator of Storages
+                     {ids: [RecordID, ...],
+                      columns: {ColumnName: [Value, ...]},
+                      raw: {ColumnName: [RawValue, ...]},
+                      }
+                     where the value arrays are in the order of the ids
+                     array, and raw is None unless raw_data was requested
+        """
+
+        page = self.page[start:end]
+        chunksize = self.chunksize
+
+        for index in xrange(0, len(page), chunksize):
+            yield self.extract_chunk(page[index:index + chunksize])
+
+    # -------------------------------------------------------------------------
+    def records(self, start=None, end=None):
+        """
+            Generator to produce the extracted data record by record,
+            in the same format as S3ResourceData.rows
+
+            @param start: index of the first record (in the page)
+            @param end: index of the last record + 1 (in the page)
+
+            @return: generator of Storages {ColumnName: Value}
+        """
+
+        for chunk in self.chunks(start=start, end=end):
+
+            columns = chunk.columns.items()
+            raw = chunk.raw.items() if chunk.raw is not None else None
+
+            for index in xrange(len(chunk.ids)):
+                record = Storage((colname, values[index])
+                                 for colname, values in columns)
+                if raw is not None:
+                    record["_row"] = Storage((colname, values[index])
+                                             for colname, values in raw)
+                yield record
+
+    # -------------------------------------------------------------------------
+    def extract_chunk(self, ids):
+        """
+            Extract (and represent) the data for a chunk of records
+
+            @param ids: the record IDs
+
+            @return: a Storage {ids, columns, raw}, see chunks()
+        """
+
+        db = current.db
+        table = self.table
+        tablename = table._tablename
+        pkey = str(table._id)
+
+        represent = self.represent
+        raw_data = self.raw_data
+
+        columns = {}
+        raw = {} if raw_data else None
+        result = Storage(ids=ids, columns=columns, raw=raw)
+        if not ids:
+            return result
+
+        # Fresh field data for each chunk
+        rfields = self.rfields
+        self.init_field_data(rfields)
+
+        if len(ids) == 1:
+            query = table._id == ids[0]
+        else:
+            query = table._id.belongs(set(ids))
+
+        # Suspend (mandatory) virtual fields if so requested
+        if not self.virtual:
+            vf = table.virtualfields
+            osetattr(table, "virtualfields", [])
+
+        # Extract the master rows
+        qfields = self.qfields
+        rows = db(query).select(limitby = (0, len(ids)),
+                                orderby_on_limitby = False,
+                                cacheable = True,
+                                *qfields.values())
+
+        # Restore virtual fields
+        if not self.virtual:
+            osetattr(table, "virtualfields", vf)
+
+        records = self.extract(rows,
+                               pkey,
+                               self.mfields,
+                               join = hasattr(rows.first(), tablename),
+                               represent = represent,
+                               )
+        rows = None
+
+        # Extract the fields in joined tables
+        joined_fields = self.joined_fields(rfields, qfields)
+        for jtablename, jfields in joined_fields.items():
+            records = self.joined_query(jtablename,
+                                        query,
+                                        jfields,
+                                        records,
+                                        represent = represent,
+                                        )
+
+        # Build the column arrays
+        field_data = self.field_data
+        if represent:
+            NONE = current.messages["NONE"]
+        for rfield in rfields:
+
+            colname = rfield.colname
+
+            if represent:
+                texts = {}
+                values = {} if raw_data else None
+                representations = self.represent_records(rfield,
+                                                         none = NONE,
+                                                         show_links = self.show_links,
+                                                         )
+                for record_id, text, value in representations:
+                    texts[record_id] = text
+                    if raw_data:
+                        values[record_id] = value
+                columns[colname] = [texts.get(record_id, NONE)
+                                    for record_id in ids]
+                if raw_data:
+                    raw[colname] = [values.get(record_id)
+                                    for record_id in ids]
+            else:
+                fdata = field_data[colname]
+                frecords = fdata[1]
+                list_type = fdata[3]
+                column = []
+                append = column.append
+                for record_id in ids:
+                    data = frecords[record_id].keys() \
+                           if record_id in frecords else [None]
+                    if len(data) == 1 and not list_type:
+                        data = data[0]
+                    append(data)
+                columns[colname] = column
+                if raw_data:
+                    raw[colname] = column
+
+        # Release the field data
+        self.field_data = self.effort = None
+
+        return result
+
 # END =========================================================================
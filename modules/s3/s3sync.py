@@ -31,6 +31,8 @@ import json
 import sys
 import datetime
 
+from contextlib import contextmanager
+
 try:
     from cStringIO import StringIO # Faster, where available
 except:
@@ -40,9 +42,11 @@ from gluon import *
 from gluon.storage import Storage
 
 from s3datetime import s3_parse_datetime, s3_utc
+from s3fields import s3_all_meta_field_names
 from s3rest import S3Method
-from s3import import S3ImportItem
+from s3import import S3BulkImporter, S3ImportItem
 from s3query import S3URLQuery
+from s3utils import s3_get_foreign_key, s3_reconnect_forked
 
 # =============================================================================
 class S3Sync(S3Method):
@@ -56,6 +60,11 @@ class S3Sync(S3Method):
         self.log = S3SyncLog()
         self._config = None
 
+        # Per-table locks for concurrent synchronization, and the
+        # tables to lock per resource
+        self.locks = None
+        self.lock_tables = None
+
     # -------------------------------------------------------------------------
     def apply_method(self, r, **attr):
         """
@@ -258,6 +267,7 @@ class S3Sync(S3Method):
         msince = vars_get("msince", None)
         if msince is not None:
             msince = s3_parse_datetime(msince)
+        cursor = vars_get("cursor", None)
 
         # Sync filters from peer
         filters = {}
@@ -289,6 +299,7 @@ class S3Sync(S3Method):
                                     start = start,
                                     limit = limit,
                                     msince = msince,
+                                    cursor = cursor,
                                     filters = filters,
                                     mixed = mixed,
                                     )
@@ -495,6 +506,10 @@ class S3Sync(S3Method):
         success = True
         for task in tasks:
 
+            # Commit the status of previous tasks (a failed import
+            # gets rolled back by the adapter)
+            db.commit()
+
             # Pull
             mtime = None
             if task.mode in (1, 3):
@@ -528,6 +543,293 @@ class S3Sync(S3Method):
 
         return success
 
+    # -------------------------------------------------------------------------
+    def synchronize_all(self, repository_ids=None, workers=None):
+        """
+            Synchronize with multiple repositories, called from scheduler
+            task
+
+            With PostgreSQL, each repository is synchronized in a worker
+            process of its own (up to the given number of workers at a
+            time), so that the network I/O for different repositories
+            overlaps; imports into the same tables are serialized with
+            per-table locks (see table_lock)
+
+            @param repository_ids: the repository record IDs (default:
+                                   all repositories)
+            @param workers: the maximum number of concurrent worker
+                            processes (default: settings.sync.workers)
+
+            @return: True if all repositories were synchronized
+                     successfully, otherwise False
+        """
+
+        db = current.db
+        log = self.log
+
+        rtable = current.s3db.sync_repository
+        query = (rtable.deleted != True)
+        if repository_ids is not None:
+            query &= (rtable.id.belongs(repository_ids))
+        repositories = db(query).select(orderby=rtable.id)
+        if not repositories:
+            return True
+
+        if workers is None:
+            workers = current.deployment_settings.get_sync_workers()
+
+        start = datetime.datetime.utcnow()
+
+        if workers > 1 and len(repositories) > 1 and \
+           S3BulkImporter.parallel_supported():
+            results = self.synchronize_parallel(repositories, workers)
+        else:
+            workers = 1
+            results = {}
+            for repository in repositories:
+                try:
+                    success = self.synchronize(repository)
+                except:
+                    db.rollback()
+                    results[repository.id] = (False, sys.exc_info()[1])
+                else:
+                    results[repository.id] = (success, None)
+                db.commit()
+
+        # Log the overall result
+        failed = []
+        for repository in repositories:
+            success, error = results.get(repository.id, (False, None))
+            if not success:
+                name = repository.name or repository.url
+                if error:
+                    failed.append("%s (%s)" % (name, error))
+                else:
+                    failed.append(name)
+        duration = datetime.datetime.utcnow() - start
+        message = "%s repositories synchronized with %s workers in %s seconds" % \
+                  (len(repositories), workers, duration.seconds)
+        if failed:
+            result = log.ERROR
+            message = "%s, failed: %s" % (message, ", ".join(failed))
+        else:
+            result = log.SUCCESS
+        log.write(repository_id = None,
+                  resource_name = None,
+                  transmission = None,
+                  mode = log.NONE,
+                  action = "synchronize",
+                  remote = False,
+                  result = result,
+                  message = message,
+                  )
+
+        return not failed
+
+    # -------------------------------------------------------------------------
+    def synchronize_parallel(self, repositories, workers):
+        """
+            Synchronize with multiple repositories in parallel worker
+            processes
+
+            @param repositories: the repositories (sync_repository Rows)
+            @param workers: the maximum number of worker processes
+
+            @return: dict {repository_id: (success, error)}
+        """
+
+        import multiprocessing
+        import Queue
+
+        db = current.db
+        s3db = current.s3db
+
+        # Create a lock for each table the tasks can write to, to be
+        # inherited by the workers
+        ttable = s3db.sync_task
+        query = (ttable.repository_id.belongs([r.id for r in repositories])) & \
+                (ttable.deleted != True)
+        rows = db(query).select(ttable.resource_name,
+                                ttable.components,
+                                distinct=True,
+                                )
+        lock_tables = {}
+        for row in rows:
+            resource_name = row.resource_name
+            tablenames = self.task_tables(resource_name,
+                                          components = row.components is not False,
+                                          )
+            if resource_name in lock_tables:
+                lock_tables[resource_name] |= tablenames
+            else:
+                lock_tables[resource_name] = tablenames
+        tablenames = set()
+        for names in lock_tables.values():
+            tablenames |= names
+        self.locks = dict((tablename, multiprocessing.Lock())
+                          for tablename in tablenames)
+        self.lock_tables = lock_tables
+
+        # Workers must see all data committed so far
+        db.commit()
+
+        queue = multiprocessing.Queue()
+        pending = list(repositories)
+        running = {}
+        results = {}
+        try:
+            while pending or running:
+
+                # Start workers
+                while pending and len(running) < workers:
+                    repository = pending.pop(0)
+                    process = multiprocessing.Process(target = self._synchronize_process,
+                                                      args = (repository, queue),
+                                                      )
+                    process.start()
+                    running[repository.id] = process
+
+                # Wait for the next worker to complete
+                try:
+                    repository_id, success, error = queue.get(timeout=5)
+                except Queue.Empty:
+                    # Check for crashed workers
+                    for repository_id, process in running.items():
+                        if not process.is_alive() and process.exitcode:
+                            del running[repository_id]
+                            results[repository_id] = (False,
+                                                      "worker exited with code %s" %
+                                                      process.exitcode)
+                    continue
+
+                process = running.pop(repository_id, None)
+                if process is not None:
+                    process.join()
+                results[repository_id] = (success, error)
+        finally:
+            self.locks = None
+            self.lock_tables = None
+
+        return results
+
+    # -------------------------------------------------------------------------
+    def _synchronize_process(self, repository, queue):
+        """
+            Synchronize with a repository in a worker process
+
+            @param repository: the repository (sync_repository Row)
+            @param queue: the queue to report the result to
+        """
+
+        db = current.db
+
+        # Open a new database connection for this process
+        s3_reconnect_forked()
+
+        # Adapters use current.sync for the table locks
+        current.sync = self
+
+        error = None
+        try:
+            success = self.synchronize(repository)
+        except:
+            db.rollback()
+            success = False
+            error = "%s" % sys.exc_info()[1]
+        db.commit()
+        queue.put((repository.id, success, error))
+
+    # -------------------------------------------------------------------------
+    @contextmanager
+    def table_lock(self, tablename):
+        """
+            Context manager to serialize imports into a resource across
+            concurrent synchronization workers (no-op outside of
+            synchronize_parallel); imports must be committed (or rolled
+            back) before the lock is released
+
+            @param tablename: the name of the master table of the resource
+
+            @note: locks all tables the import can write to (see
+                   task_tables), so that imports which share any of
+                   them are serialized
+        """
+
+        locks = self.locks
+        if not locks:
+            yield
+            return
+
+        lock_tables = self.lock_tables
+        if lock_tables and tablename in lock_tables:
+            tablenames = lock_tables[tablename]
+        else:
+            tablenames = [tablename]
+
+        # Acquire in a consistent order to prevent deadlocks
+        acquired = []
+        try:
+            for tn in sorted(tablenames):
+                lock = locks.get(tn)
+                if lock is not None:
+                    lock.acquire()
+                    acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def task_tables(tablename, components=True):
+        """
+            Determine the tables an import into a resource can write
+            records to: the master table, its components, and all tables
+            referenced by them (as referenced records are included in the
+            import)
+
+            @param tablename: the name of the master table
+            @param components: include components
+
+            @return: a set of table names
+
+            @note: tables which are only written implicitly (super-entities,
+                   affiliations etc.) are not included, as their records
+                   are created per instance record rather than deduplicated
+        """
+
+        s3db = current.s3db
+
+        pending = [tablename]
+        if components:
+            hooks = s3db.get_components(tablename)
+            if hooks:
+                for hook in hooks.values():
+                    pending.append(hook.tablename)
+                    if hook.linktable:
+                        pending.append(hook.linktable)
+
+        # Meta-fields reference auth tables, but are not exported as references
+        meta_fields = set(s3_all_meta_field_names())
+
+        tablenames = set()
+        while pending:
+            tn = pending.pop()
+            if tn in tablenames:
+                continue
+            table = s3db.table(tn)
+            if table is None:
+                continue
+            tablenames.add(tn)
+            for field in table:
+                if field.name in meta_fields:
+                    continue
+                ktablename = s3_get_foreign_key(field, m2m=False)[0]
+                if ktablename and ktablename not in tablenames:
+                    pending.append(ktablename)
+
+        return tablenames
+
     # -------------------------------------------------------------------------
     @classmethod
     def onconflict(cls, item, repository, resource):
@@ -960,6 +1262,7 @@ class S3SyncBaseAdapter(object):
              start=None,
              limit=None,
              msince=None,
+             cursor=None,
              filters=None,
              mixed=False):
         """
@@ -969,6 +1272,7 @@ class S3SyncBaseAdapter(object):
             @param start: index of the first record to send
             @param limit: maximum number of records to send
             @param msince: minimum modification date/time for records to send
+            @param cursor: continuation token from the previous page
             @param filters: URL filters for record extraction
             @param mixed: negotiate resource with peer (disregard resource)
 
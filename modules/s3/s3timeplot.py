@@ -37,13 +37,23 @@ __all__ = ("S3TimePlot",
 
 import datetime
 import dateutil.tz
+import heapq
 import json
 import re
 import sys
 
+from bisect import bisect_left, bisect_right
+from itertools import product
+
 from dateutil.relativedelta import *
 from dateutil.rrule import *
 
+try:
+    import numpy
+except ImportError:
+    # Aggregation falls back to pure Python
+    numpy = None
+
 from gluon import current
 from gluon.storage import Storage
 from gluon.html import *
@@ -766,14 +776,14 @@ class S3TimeSeries(object):
             cols_keys = None
             cols_data = None
 
-        # Iterate over the event frame to collect aggregates
+        # Aggregate the facts for all periods
         event_frame = self.event_frame
+        event_frame.aggregate(self.facts)
+
+        # Iterate over the event frame to collect aggregates
         periods_data = []
         append = periods_data.append
-        #fact = self.facts[0]
         for period in event_frame:
-            # Aggregate
-            period.aggregate(self.facts)
             # Extract
             item = period.as_dict(rows = rows_keys,
                                   cols = cols_keys,
@@ -1494,7 +1504,7 @@ class S3TimeSeriesFact(object):
 
         if method == "cumulate":
 
-            slope = self.slope_column
+            interval = self.interval
             duration = period.duration
 
             for event in events:
@@ -1502,39 +1512,11 @@ class S3TimeSeriesFact(object):
                 if event.start == None:
                     continue
 
-                if base:
-                    base_value = event[base]
-                else:
-                    base_value = None
-
-                if slope:
-                    slope_value = event[slope]
-                else:
-                    slope_value = None
-
-                if base_value is None:
-                    if not slope or slope_value is None:
-                        continue
-                    else:
-                        base_value = 0
-                elif type(base_value) is list:
-                    try:
-                        base_value = sum(base_value)
-                    except (TypeError, ValueError):
-                        continue
-
-                if slope_value is None:
-                    if not base or base_value is None:
-                        continue
-                    else:
-                        slope_value = 0
-                elif type(slope_value) is list:
-                    try:
-                        slope_value = sum(slope_value)
-                    except (TypeError, ValueError):
-                        continue
+                item = self.cumulate_values(event)
+                if item is None:
+                    continue
+                base_value, slope_value = item
 
-                interval = self.interval
                 if slope_value and interval:
                     event_duration = duration(event, interval)
                 else:
@@ -1547,13 +1529,7 @@ class S3TimeSeriesFact(object):
         elif base:
 
             for event in events:
-                value = event[base]
-                if value is None:
-                    continue
-                elif type(value) is list:
-                    values.extend([v for v in value if v is not None])
-                else:
-                    values.append(value)
+                values.extend(self.base_values(event))
 
             if method == "count":
                 result = len(values)
@@ -1565,6 +1541,70 @@ class S3TimeSeriesFact(object):
 
         return result
 
+    # -------------------------------------------------------------------------
+    def base_values(self, event):
+        """
+            Get the base values of an event
+
+            @param event: the S3TimeSeriesEvent
+            @return: list of values (excluding None)
+        """
+
+        value = event[self.base_column]
+        if value is None:
+            return []
+        elif type(value) is list:
+            return [v for v in value if v is not None]
+        else:
+            return [value]
+
+    # -------------------------------------------------------------------------
+    def cumulate_values(self, event):
+        """
+            Get the base and slope values of an event for cumulation
+
+            @param event: the S3TimeSeriesEvent
+            @return: tuple (base_value, slope_value), or None if the
+                     event has no values to cumulate
+        """
+
+        base = self.base_column
+        slope = self.slope_column
+
+        if base:
+            base_value = event[base]
+        else:
+            base_value = None
+
+        if slope:
+            slope_value = event[slope]
+        else:
+            slope_value = None
+
+        if base_value is None:
+            if not slope or slope_value is None:
+                return None
+            else:
+                base_value = 0
+        elif type(base_value) is list:
+            try:
+                base_value = sum(base_value)
+            except (TypeError, ValueError):
+                return None
+
+        if slope_value is None:
+            if not base or base_value is None:
+                return None
+            else:
+                slope_value = 0
+        elif type(slope_value) is list:
+            try:
+                slope_value = sum(slope_value)
+            except (TypeError, ValueError):
+                return None
+
+        return base_value, slope_value
+
     # -------------------------------------------------------------------------
     def compute(self, values):
         """
@@ -1843,12 +1883,58 @@ class S3TimeSeriesPeriod(object):
         self.start = tp_tzsafe(start)
         self.end = tp_tzsafe(end)
 
-        # Event sets
-        self.pevents = {}
-        self.cevents = {}
+        # The event frame and the index of this period in it
+        self.frame = None
+        self.index = None
+
+        # Event sets (looked up from the event frame when needed)
+        self._pevents = None
+        self._cevents = None
 
         self._reset()
 
+    # -------------------------------------------------------------------------
+    @property
+    def cevents(self):
+        """ The current events in this period, {event_id: event} """
+
+        if self._cevents is None:
+            self._lookup_events()
+        return self._cevents
+
+    # -------------------------------------------------------------------------
+    @property
+    def pevents(self):
+        """ The previous events of this period, {event_id: event} """
+
+        if self._pevents is None:
+            self._lookup_events()
+        return self._pevents
+
+    # -------------------------------------------------------------------------
+    def _lookup_events(self):
+        """
+            Look up the current and previous events of this period
+            from the event frame
+        """
+
+        cevents = self._cevents = {}
+        pevents = self._pevents = {}
+
+        frame = self.frame
+        if frame is None:
+            return
+
+        index = self.index
+        for event, first, last in frame.events:
+            if first > index:
+                # Event starts only after this period
+                continue
+            elif last >= index:
+                cevents[event.event_id] = event
+            else:
+                pevents[event.event_id] = event
+
     # -------------------------------------------------------------------------
     def _reset(self):
         """ Reset the event matrix """
@@ -1952,7 +2038,6 @@ class S3TimeSeriesPeriod(object):
         rows = {}
         cols = {}
         matrix = {}
-        from itertools import product
         for index, events in enumerate(event_sets):
             for event_id, event in events.items():
                 for key in event.rows:
@@ -2018,7 +2103,7 @@ class S3TimeSeriesPeriod(object):
             for key, event_sets in self._rows.items():
                 event_ids = event_sets[0]
                 if cumulative:
-                    event_ids |= event_sets[1]
+                    event_ids = event_ids | event_sets[1]
                 items = [events[event_id] for event_id in event_ids]
                 if key not in rows:
                     rows[key] = [aggregate(items)]
@@ -2029,7 +2114,7 @@ class S3TimeSeriesPeriod(object):
             for key, event_sets in self._cols.items():
                 event_ids = event_sets[0]
                 if cumulative:
-                    event_ids |= event_sets[1]
+                    event_ids = event_ids | event_sets[1]
                 items = [events[event_id] for event_id in event_ids]
                 if key not in cols:
                     cols[key] = [aggregate(items)]
@@ -2040,7 +2125,7 @@ class S3TimeSeriesPeriod(object):
             for key, event_sets in self._matrix.items():
                 event_ids = event_sets[0]
                 if cumulative:
-                    event_ids |= event_sets[1]
+                    event_ids = event_ids | event_sets[1]
                 items = [events[event_id] for event_id in event_ids]
                 if key not in matrix:
                     matrix[key] = [aggregate(items)]
@@ -2110,6 +2195,141 @@ class S3TimeSeriesPeriod(object):
         else:
             return None
 
+# =============================================================================
+class S3TimeSeriesInterval(object):
+    """
+        Helper to compute the duration of events in number of time
+        intervals (i.e. the count of the S3TimeSeriesPeriod.get_rule
+        recurrence rule) without iterating over the rule
+
+        Datetimes are split into the index of the interval they fall
+        into (counting from the epoch) and their offset within that
+        interval, so that the number of recurrences from start until
+        end is:
+
+            index(end) - index(start) + 1, minus 1 if offset(start) > offset(end)
+
+        Monthly rules starting after the 28th day of a month, and
+        yearly rules starting on Feb 29, skip the months (years)
+        without that day - durations for such start dates are counted
+        with the rule instead.
+    """
+
+    EPOCH = tp_datetime(1970, 1, 1)
+
+    # Interval lengths in seconds
+    SECONDS = {"h": 3600,
+               "d": 86400,
+               "w": 604800,
+               }
+
+    # Microseconds per day
+    DAY = 86400000000
+
+    def __init__(self, interval):
+        """
+            Constructor
+
+            @param interval: time interval expression, like "days" or "2 weeks"
+        """
+
+        self.interval = interval
+
+        self.unit = None
+        self.num = 1
+
+        if interval:
+            match = re.match(r"\s*(\d*)\s*([hdwmy]{1}).*", interval)
+            if match:
+                num, unit = match.groups()
+                self.unit = unit
+                self.num = int(num) if num else 1
+
+    # -------------------------------------------------------------------------
+    def regular(self, start):
+        """
+            Check whether durations from the given start date can be
+            computed from interval indices and offsets
+
+            @param start: the start date (datetime)
+        """
+
+        unit = self.unit
+        if not unit or self.num < 1:
+            return False
+        elif unit == "m":
+            return start.day <= 28
+        elif unit == "y":
+            return start.month != 2 or start.day != 29
+        else:
+            return True
+
+    # -------------------------------------------------------------------------
+    def split(self, dt):
+        """
+            Split a datetime into interval index and offset
+
+            @param dt: the datetime
+            @return: tuple (index, offset), both integers
+        """
+
+        unit = self.unit
+        num = self.num
+
+        if unit in self.SECONDS:
+            delta = dt - self.EPOCH
+            us = (delta.days * 86400 + delta.seconds) * 1000000 + \
+                 delta.microseconds
+            return divmod(us, self.SECONDS[unit] * num * 1000000)
+
+        time = ((dt.hour * 60 + dt.minute) * 60 + dt.second) * 1000000 + \
+               dt.microsecond
+        if unit == "m":
+            index, rest = divmod(dt.year * 12 + dt.month - 1, num)
+            offset = (rest * 32 + dt.day) * self.DAY + time
+        else:
+            index, rest = divmod(dt.year, num)
+            offset = ((rest * 13 + dt.month) * 32 + dt.day) * self.DAY + time
+        return index, offset
+
+    # -------------------------------------------------------------------------
+    def start_index(self, start):
+        """
+            Get the interval index and offset of a start date (like the
+            recurrence rule, this ignores the microseconds)
+
+            @param start: the start date (datetime)
+            @return: tuple (index, offset)
+        """
+
+        return self.split(start.replace(microsecond=0))
+
+    # -------------------------------------------------------------------------
+    def duration(self, start, end):
+        """
+            Compute the number of recurrences of the interval from
+            start until end, same as S3TimeSeriesPeriod.duration
+
+            @param start: the start date (datetime)
+            @param end: the end date (datetime)
+        """
+
+        if start >= end:
+            return 0
+        if not self.unit:
+            return 1
+
+        if self.regular(start):
+            start_index, start_offset = self.start_index(start)
+            end_index, end_offset = self.split(end)
+            result = end_index - start_index + 1
+            if start_offset > end_offset:
+                result -= 1
+        else:
+            rule = S3TimeSeriesPeriod.get_rule(start, end, self.interval)
+            result = rule.count() if rule else 1
+        return result
+
 # =============================================================================
 class S3TimeSeriesEventFrame(object):
     """ Class representing the whole time frame of a time plot """
@@ -2141,7 +2361,12 @@ class S3TimeSeriesEventFrame(object):
         self.slots = slots
         self.periods = {}
 
+        # Events, as tuples (event, first, last) with the indices of
+        # the first and the last period the event is current in
+        self.events = []
+
         self.rule = self.get_rule()
+        self._bounds = None
 
     # -------------------------------------------------------------------------
     def get_rule(self):
@@ -2155,6 +2380,36 @@ class S3TimeSeriesEventFrame(object):
 
         return S3TimeSeriesPeriod.get_rule(self.start, self.end, slots)
 
+    # -------------------------------------------------------------------------
+    def get_bounds(self):
+        """
+            Get the start and end dates of all periods in this event frame
+
+            @return: tuple of lists (starts, ends)
+
+            @todo: handle self.rule == None
+        """
+
+        bounds = self._bounds
+        if bounds is None:
+
+            rule = self.rule
+            if not rule:
+                # @todo: continuous periods
+                raise NotImplementedError
+
+            end = self.end
+            starts = []
+            for dt in rule:
+                if dt >= end:
+                    break
+                starts.append(dt)
+            ends = starts[1:] + [end] if starts else []
+
+            bounds = self._bounds = (starts, ends)
+
+        return bounds
+
     # -------------------------------------------------------------------------
     def extend(self, events):
         """
@@ -2168,100 +2423,538 @@ class S3TimeSeriesEventFrame(object):
 
         if not events:
             return
+
+        starts, ends = self.get_bounds()
+        numperiods = len(starts)
+
+        # Index the events by the first and the last period they
+        # are current in (rather than adding them to all periods)
         empty = self.empty
+        append = self.events.append
+        for event in events:
 
-        # Order events by start datetime
-        events = sorted(events)
+            # First period which ends after the event start
+            start = event.start
+            if start is None:
+                first = 0
+            else:
+                first = bisect_right(ends, start)
+            if first >= numperiods:
+                # Event starts after the end of the event frame
+                continue
+
+            # Last period which starts before the event end (but the
+            # event is always current in its first period unless it
+            # ended before that period)
+            end = event.end
+            if end is None:
+                last = numperiods - 1
+            else:
+                last = bisect_left(starts, end) - 1
+                if last < first and end >= starts[first]:
+                    last = first
+
+            append((event, first, last))
+            empty = False
+
+        self.empty = empty
+
+        # Periods must look up their events again
+        self.periods = {}
+        return
+
+    # -------------------------------------------------------------------------
+    def __iter__(self):
+        """
+            Iterate over all periods within this event frame
+        """
 
-        rule = self.rule
         periods = self.periods
 
-        # No point to loop over periods before the first event:
-        start = events[0].start
-        if start is None or start <= self.start:
-            first = rule[0]
+        starts, ends = self.get_bounds()
+        for index, start in enumerate(starts):
+            period = periods.get(start)
+            if period is None:
+                period = S3TimeSeriesPeriod(start, end=ends[index])
+                period.frame = self
+                period.index = index
+                periods[start] = period
+            yield period
+
+        return
+
+    # -------------------------------------------------------------------------
+    def aggregate(self, facts):
+        """
+            Group and aggregate the events in all periods of this
+            event frame
+
+            @param facts: list of S3TimeSeriesFacts to aggregate
+        """
+
+        if not isinstance(facts, (list, tuple)):
+            facts = [facts]
+
+        periods = list(self)
+        try:
+            self._sweep(periods, facts)
+        except (TypeError, ValueError):
+            # Values which can not be added up incrementally
+            # => aggregate each period separately
+            for period in periods:
+                period.aggregate(facts)
+
+    # -------------------------------------------------------------------------
+    def _sweep(self, periods, facts):
+        """
+            Aggregate the facts for all periods in a single sweep: events
+            get added to running totals (per row, column and cell) in the
+            period they start, and removed in the period after they end,
+            so every event is visited only twice regardless how many
+            periods it is current in
+
+            @param periods: the periods of this event frame (list)
+            @param facts: the S3TimeSeriesFacts to aggregate
+        """
+
+        numperiods = len(periods)
+        if not numperiods:
+            return
+        ends = [period.end for period in periods]
+
+        cumulative = any(fact.method == "cumulate" for fact in facts)
+
+        # Groups, index 0 being the totals
+        groups = [(None, None)]
+        group_ids = {}
+        def group_id(key):
+            gid = group_ids.get(key)
+            if gid is None:
+                gid = group_ids[key] = len(groups)
+                groups.append(key)
+            return gid
+
+        # Events starting/ceasing to be current, by period index
+        starting = [[] for _ in xrange(numperiods)]
+        ceasing = [[] for _ in xrange(numperiods + 1)]
+
+        for event, first, last in self.events:
+            gids = [0]
+            rows = event.rows
+            cols = event.cols
+            gids.extend(group_id(("r", key)) for key in rows)
+            gids.extend(group_id(("c", key)) for key in cols)
+            gids.extend(group_id(("x", key)) for key in product(rows, cols))
+            item = (event, gids, first, last)
+            starting[first].append(item)
+            if first <= last < numperiods - 1:
+                ceasing[last + 1].append(item)
+
+        numgroups = len(groups)
+
+        # Running totals per fact and group
+        accumulators = [S3TimeSeriesAccumulator(fact, numgroups, ends)
+                        for fact in facts]
+
+        # Number of current events per group
+        ccount = [0] * numgroups
+        present = set()
+
+        for index, period in enumerate(periods):
+
+            for event, gids, first, last in starting[index]:
+                is_current = first <= last
+                for gid in gids:
+                    if is_current:
+                        ccount[gid] += 1
+                    if gid and (is_current or cumulative):
+                        present.add(gid)
+                for accumulator in accumulators:
+                    accumulator.add(event, gids, first, last)
+
+            for event, gids, first, last in ceasing[index]:
+                for gid in gids:
+                    ccount[gid] -= 1
+                    if gid and not ccount[gid] and not cumulative:
+                        present.discard(gid)
+                for accumulator in accumulators:
+                    accumulator.remove(event, gids)
+
+            for accumulator in accumulators:
+                accumulator.update(index)
+
+            # Collect the aggregates
+            rows = {}
+            cols = {}
+            matrix = {}
+            containers = {"r": rows, "c": cols, "x": matrix}
+            for gid in present:
+                group_type, key = groups[gid]
+                containers[group_type][key] = [accumulator.result(gid, index)
+                                               for accumulator in accumulators]
+
+            period._reset()
+            period.rows = rows
+            period.cols = cols
+            period.matrix = matrix
+            period.totals = [accumulator.result(0, index)
+                             for accumulator in accumulators]
+
+# =============================================================================
+class S3TimeSeriesAccumulator(object):
+    """
+        Running totals of a fact per group of events (totals, rows,
+        columns and matrix cells), for S3TimeSeriesEventFrame._sweep
+    """
+
+    def __init__(self, fact, numgroups, ends):
+        """
+            Constructor
+
+            @param fact: the S3TimeSeriesFact
+            @param numgroups: the number of groups
+            @param ends: the end dates of all periods (list)
+        """
+
+        self.fact = fact
+        self.method = method = fact.method
+        self.ends = ends
+
+        if method == "cumulate":
+            self.interval = S3TimeSeriesInterval(fact.interval)
+            # Constant parts of the cumulated values per group
+            self.totals = [0] * numgroups
+            # Constant parts to add from a period, by period index
+            self.pending = [[] for _ in xrange(len(ends))]
+            # Events with duration-dependent parts, as tuples
+            # (slope_value, start, stop, gids, start_index, start_offset)
+            self.ongoing = []
+            self.arrays = None
+            # Duration-dependent parts per group in the current period
+            self.slopes = {}
+        elif method in ("min", "max"):
+            # Heaps of (value, last) per group
+            self.heaps = {}
         else:
-            first = rule.before(start, inc=True)
+            # Number and sum of values per group
+            self.counts = [0] * numgroups
+            self.sums = [0] * numgroups
+            # Number and sum of values per current event
+            self.values = {}
 
-        current_events = {}
-        previous_events = {}
-        for start in rule.between(first, self.end, inc=True):
+    # -------------------------------------------------------------------------
+    def add(self, event, gids, first, last):
+        """
+            Add an event in the period it starts
 
-            # Compute end of this period
-            end = rule.after(start)
-            if not end:
-                if start < self.end:
-                    end = self.end
+            @param event: the S3TimeSeriesEvent
+            @param gids: the IDs of the groups the event belongs to
+            @param first: index of the first period of the event
+            @param last: index of the last period of the event
+        """
+
+        fact = self.fact
+        method = self.method
+
+        if method == "cumulate":
+
+            start = event.start
+            if start is None:
+                return
+            item = fact.cumulate_values(event)
+            if item is None:
+                return
+            base_value, slope_value = item
+
+            if not slope_value or not fact.interval:
+                value = base_value + slope_value
+            else:
+                value = base_value
+
+                ends = self.ends
+                interval = self.interval
+                end = event.end
+                if end is None:
+                    stop = len(ends)
                 else:
-                    # Period start is at the end of the event frame
-                    break
+                    # The duration is constant from the period the event ends
+                    stop = max(first, bisect_left(ends, end))
+                    if stop < len(ends):
+                        duration = interval.duration(start, end)
+                        self.pending[stop].append((slope_value * duration,
+                                                   gids))
+                if stop > first:
+                    if interval.regular(start):
+                        start_index, start_offset = interval.start_index(start)
+                    else:
+                        start_index = start_offset = None
+                    self.ongoing.append((slope_value,
+                                         start,
+                                         stop,
+                                         gids,
+                                         start_index,
+                                         start_offset,
+                                         ))
+                    self.arrays = None
+
+            totals = self.totals
+            for gid in gids:
+                totals[gid] += value
+
+        elif first <= last and fact.base_column:
+
+            values = fact.base_values(event)
+            if not values:
+                return
+
+            if method in ("min", "max"):
+                if method == "min":
+                    value = min(values)
+                else:
+                    value = S3TimeSeriesReverse(max(values))
+                heaps = self.heaps
+                for gid in gids:
+                    heap = heaps.get(gid)
+                    if heap is None:
+                        heaps[gid] = [(value, last)]
+                    else:
+                        heapq.heappush(heap, (value, last))
+            else:
+                numvalues = len(values)
+                if method == "count":
+                    total = 0
+                else:
+                    total = sum(values)
+                self.values[event.event_id] = (numvalues, total)
+                counts = self.counts
+                sums = self.sums
+                for gid in gids:
+                    counts[gid] += numvalues
+                    sums[gid] += total
 
-            # Find all current events
-            for index, event in enumerate(events):
-                if event.end and event.end < start:
-                    # Event ended before this period
-                    previous_events[event.event_id] = event
-                elif event.start is None or event.start < end:
-                    # Event starts before or during this period
-                    current_events[event.event_id] = event
+    # -------------------------------------------------------------------------
+    def remove(self, event, gids):
+        """
+            Remove an event in the period after its last period
+
+            @param event: the S3TimeSeriesEvent
+            @param gids: the IDs of the groups the event belongs to
+        """
+
+        if self.method in ("count", "sum", "avg"):
+            item = self.values.pop(event.event_id, None)
+            if item:
+                numvalues, total = item
+                counts = self.counts
+                sums = self.sums
+                for gid in gids:
+                    counts[gid] -= numvalues
+                    sums[gid] -= total
+
+        # Values in min/max heaps are discarded when they reach the top
+
+    # -------------------------------------------------------------------------
+    def update(self, index):
+        """
+            Update the cumulated values for a period
+
+            @param index: the period index
+        """
+
+        if self.method != "cumulate":
+            return
+
+        totals = self.totals
+        for value, gids in self.pending[index]:
+            for gid in gids:
+                totals[gid] += value
+
+        # Drop events with constant durations from now on
+        ongoing = self.ongoing
+        if any(item[2] <= index for item in ongoing):
+            ongoing = self.ongoing = [item for item in ongoing
+                                      if item[2] > index]
+            self.arrays = None
+
+        self.slopes = {}
+        if not ongoing:
+            return
+
+        end = self.ends[index]
+        if numpy is not None and len(ongoing) > 1:
+            try:
+                self.slopes = self._sum_slopes(end)
+            except (TypeError, ValueError, OverflowError):
+                pass
+            else:
+                return
+
+        interval = self.interval
+        if interval.unit:
+            end_index, end_offset = interval.split(end)
+        duration = interval.duration
+
+        slopes = self.slopes
+        for slope_value, start, stop, gids, start_index, start_offset in ongoing:
+            if start_index is None:
+                value = slope_value * duration(start, end)
+            else:
+                count = end_index - start_index + 1
+                if start_offset > end_offset:
+                    count -= 1
+                value = slope_value * count
+            for gid in gids:
+                if gid in slopes:
+                    slopes[gid] += value
                 else:
-                    # Event starts only after this period
-                    break
+                    slopes[gid] = value
 
-            # Add current events to current period
-            period = periods.get(start)
-            if period is None:
-                period = periods[start] = S3TimeSeriesPeriod(start, end=end)
-            for event in current_events.values():
-                period.add_current(event)
-            for event in previous_events.values():
-                period.add_previous(event)
+    # -------------------------------------------------------------------------
+    def _sum_slopes(self, end):
+        """
+            Compute the duration-dependent parts of the cumulated values
+            per group with numpy arrays
 
-            empty = False
+            @param end: the end date of the period
+            @return: dict {gid: value}
+        """
 
-            # Remaining events
-            events = events[index:]
-            if not events:
-                # No more events
-                break
-
-            # Remove events which end during this period
-            remaining = {}
-            for event_id, event in current_events.items():
-                if not event.end or event.end > end:
-                    remaining[event_id] = event
+        arrays = self.arrays
+        if arrays is None:
+            arrays = self.arrays = self._get_arrays()
+        slope_values, start_indices, start_offsets, positions, gids, \
+        group_positions, irregular = arrays
+
+        slopes = {}
+
+        if len(slope_values):
+            end_index, end_offset = self.interval.split(end)
+            counts = end_index - start_indices + 1 - (start_offsets > end_offset)
+            values = (slope_values * counts)[positions]
+            sums = numpy.add.reduceat(values, group_positions)
+            slopes.update(zip(gids.tolist(), sums.tolist()))
+
+        duration = self.interval.duration
+        for slope_value, start, stop, item_gids, start_index, start_offset in irregular:
+            value = slope_value * duration(start, end)
+            for gid in item_gids:
+                if gid in slopes:
+                    slopes[gid] += value
                 else:
-                    previous_events[event_id] = event
-            current_events = remaining
+                    slopes[gid] = value
 
-        self.empty = empty
-        return
+        return slopes
 
     # -------------------------------------------------------------------------
-    def __iter__(self):
+    def _get_arrays(self):
         """
-            Iterate over all periods within this event frame
+            Convert the ongoing events into numpy arrays, for _sum_slopes
+
+            @return: tuple (slope_values, start_indices, start_offsets,
+                            positions, gids, group_positions, irregular),
+                     where positions are the event positions sorted by
+                     group, gids the unique group IDs, group_positions
+                     the first position of each group, and irregular a
+                     list of the events with irregular intervals
         """
 
-        periods = self.periods
+        regular = []
+        irregular = []
+        for item in self.ongoing:
+            if item[4] is None:
+                irregular.append(item)
+            else:
+                regular.append(item)
+
+        slope_values = [item[0] for item in regular]
+        if all(type(v) in (int, long, bool) and -2**31 < v < 2**31
+               for v in slope_values):
+            dtype = numpy.int64
+        elif all(type(v) in (int, long, bool, float) for v in slope_values):
+            dtype = numpy.float64
+        else:
+            raise TypeError("non-numeric slope values")
+
+        # Event positions per group, sorted by group
+        pairs = sorted((gid, position)
+                       for position, item in enumerate(regular)
+                       for gid in item[3])
+        group_ids = numpy.array([pair[0] for pair in pairs], dtype=numpy.int64)
+        gids, group_positions = numpy.unique(group_ids, return_index=True)
+
+        return (numpy.array(slope_values, dtype=dtype),
+                numpy.array([item[4] for item in regular], dtype=numpy.int64),
+                numpy.array([item[5] for item in regular], dtype=numpy.int64),
+                numpy.array([pair[1] for pair in pairs], dtype=numpy.int64),
+                gids,
+                group_positions,
+                irregular,
+                )
+
+    # -------------------------------------------------------------------------
+    def result(self, gid, index):
+        """
+            Get the aggregated value for a group in a period
+
+            @param gid: the group ID
+            @param index: the period index
+        """
+
+        method = self.method
+
+        if method == "cumulate":
+            result = self.totals[gid]
+            slopes = self.slopes
+            if gid in slopes:
+                result += slopes[gid]
+
+        elif not self.fact.base_column:
+            result = None
+
+        elif method in ("min", "max"):
+            heap = self.heaps.get(gid)
+            # Discard values of events which have ended
+            while heap and heap[0][1] < index:
+                heapq.heappop(heap)
+            if heap:
+                result = heap[0][0]
+                if method == "max":
+                    result = result.value
+            else:
+                result = None
 
-        rule = self.rule
-        if rule:
-            for dt in rule:
-                if dt >= self.end:
-                    break
-                if dt in periods:
-                    yield periods[dt]
-                else:
-                    end = rule.after(dt)
-                    if not end:
-                        end = self.end
-                    yield S3TimeSeriesPeriod(dt, end=end)
         else:
-            # @todo: continuous periods
-            # sort actual periods and iterate over them
-            raise NotImplementedError
+            numvalues = self.counts[gid]
+            if method == "count":
+                result = numvalues
+            elif not numvalues:
+                result = 0 if method == "sum" else None
+            elif method == "sum":
+                result = self.sums[gid]
+            else:
+                result = self.sums[gid] / float(numvalues)
 
-        return
+        return result
+
+# =============================================================================
+class S3TimeSeriesReverse(object):
+    """ Wrapper to reverse the order of values (for max-heaps) """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        """
+            Constructor
+
+            @param value: the value
+        """
+
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return other.value == self.value
 
 # END =========================================================================
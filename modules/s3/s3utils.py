@@ -1085,6 +1085,28 @@ def s3_include_ext():
         s3.jquery_ready.append('''$('link:first').after("%s")''' % main_css)
     s3.ext_included = True
 
+# =============================================================================
+# Pooled connections inherited from the parent process
+_inherited_connections = []
+
+def s3_reconnect_forked():
+    """
+        Open a new database connection in a forked worker process,
+        without closing any inherited connection (which would also
+        terminate the connection of the parent process)
+    """
+
+    adapter = current.db._adapter
+
+    pools = getattr(adapter, "POOLS", None)
+    if pools:
+        # Keep references to the pooled connections of the parent
+        # process, so that they never get closed by this process
+        for uri in pools:
+            _inherited_connections.append(pools[uri])
+            pools[uri] = []
+    adapter.reconnect()
+
 # =============================================================================
 def s3_is_mobile_client(request):
     """
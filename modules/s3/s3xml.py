@@ -39,6 +39,8 @@ import re
 import sys
 import urllib2
 
+from copy import deepcopy
+
 try:
     from lxml import etree
 except ImportError:
@@ -241,6 +243,88 @@ class S3XML(S3Codec):
             self.error = "XML Parse error: %s" % sys.exc_info()[1]
             return None
 
+    # -------------------------------------------------------------------------
+    def iterparse(self, source, chunksize=1000):
+        """
+            Parse an XML source incrementally, yielding element trees with
+            up to chunksize top-level <resource> elements each (under a
+            copy of the original root element), so that large sources can
+            be processed without loading them into memory entirely
+
+            @param source: the XML source -
+                can be a file-like object, a filename or a HTTP/HTTPS/FTP URL
+            @param chunksize: the maximum number of <resource> elements
+                              per tree
+
+            @raise SyntaxError: if the source can not be parsed (the
+                                error message is also stored in self.error)
+        """
+
+        self.error = None
+        if isinstance(source, basestring) and source[:5] == "https":
+            try:
+                source = urllib2.urlopen(source)
+            except:
+                self.error = "XML Source error: %s" % sys.exc_info()[1]
+                raise SyntaxError(self.error)
+
+        RESOURCE = self.TAG.resource
+
+        context = etree.iterparse(source,
+                                  events = ("start", "end"),
+                                  huge_tree = True, # Support large WKT fields
+                                  no_network = False,
+                                  remove_blank_text = True,
+                                  )
+        root = None
+        depth = 0
+        chunk = []
+        try:
+            for event, element in context:
+                if event == "start":
+                    if root is None:
+                        root = element
+                    depth += 1
+                    continue
+
+                depth -= 1
+                if depth != 1:
+                    continue
+
+                # Top-level element complete
+                if element.tag == RESOURCE:
+                    chunk.append(deepcopy(element))
+                # Free the memory of the parsed elements
+                element.clear()
+                while element.getprevious() is not None:
+                    del root[0]
+
+                if len(chunk) >= chunksize:
+                    yield self._chunk_tree(root, chunk)
+                    chunk = []
+        except etree.XMLSyntaxError:
+            self.error = "XML Parse error: %s" % sys.exc_info()[1]
+            raise SyntaxError(self.error)
+
+        if chunk:
+            yield self._chunk_tree(root, chunk)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _chunk_tree(root, elements):
+        """
+            Helper for iterparse to build an element tree for a chunk
+
+            @param root: the original root element
+            @param elements: the elements for the chunk
+
+            @return: an ElementTree
+        """
+
+        chunk_root = etree.Element(root.tag, attrib=root.attrib)
+        chunk_root.extend(elements)
+        return etree.ElementTree(chunk_root)
+
     # -------------------------------------------------------------------------
     def transform(self, tree, stylesheet_path, **args):
         """
@@ -2581,6 +2665,40 @@ class S3XML(S3Codec):
             @todo: add a character encoding parameter to skip the guessing
         """
 
+        for tree in cls.csv2trees(source,
+                                  resourcename = resourcename,
+                                  extra_data = extra_data,
+                                  hashtags = hashtags,
+                                  delimiter = delimiter,
+                                  quotechar = quotechar,
+                                  ):
+            return tree
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def csv2trees(cls, source,
+                  resourcename=None,
+                  extra_data=None,
+                  hashtags=None,
+                  delimiter=",",
+                  quotechar='"',
+                  chunksize=None):
+        """
+            Convert a table-form CSV source into element trees (like
+            csv2tree), reading the source incrementally
+
+            @param source: the source (file-like object)
+            @param resourcename: the resource name
+            @param extra_data: dict of extra cols {key:value} to add to each row
+            @param hashtags: dict of hashtags for extra cols {key:hashtag}
+            @param delimiter: delimiter for values
+            @param quotechar: quotation character
+            @param chunksize: the maximum number of rows per tree
+                              (None = all rows in one tree)
+
+            @return: a generator of element trees
+        """
+
         import csv
 
         # Increase field size to be able to import WKTs
@@ -2594,9 +2712,13 @@ class S3XML(S3Codec):
         COL = TAG.col
         SubElement = etree.SubElement
 
-        root = etree.Element(TAG.table)
-        if resourcename is not None:
-            root.set(ATTRIBUTE.name, resourcename)
+        def new_root():
+            root = etree.Element(TAG.table)
+            if resourcename is not None:
+                root.set(ATTRIBUTE.name, resourcename)
+            return root
+        root = new_root()
+        count = 0
 
         def add_col(row, key, value, hashtags=None):
             col = SubElement(row, COL)
@@ -2671,6 +2793,11 @@ class S3XML(S3Codec):
                     for key in extra_data:
                         if key not in r:
                             add_col(row, key, extra_data[key], hashtags=hashtags)
+                count += 1
+                if chunksize and count >= chunksize:
+                    yield etree.ElementTree(root)
+                    root = new_root()
+                    count = 0
         except csv.Error:
             e = sys.exc_info()[1]
             raise HTTP(400, body=cls.json_message(False, 400, e))
@@ -2678,7 +2805,8 @@ class S3XML(S3Codec):
         # Use this to debug the source tree if needed:
         #print >>sys.stderr, cls.tostring(root, pretty_print=True)
 
-        return  etree.ElementTree(root)
+        if count or not chunksize:
+            yield etree.ElementTree(root)
 
 # =============================================================================
 class S3XMLFormat(object):
@@ -28,11 +28,17 @@
 """
 
 import datetime
+import gzip
 import json
 import sys
 import traceback
 import urllib2
 
+try:
+    from cStringIO import StringIO    # Faster, where available
+except ImportError:
+    from StringIO import StringIO
+
 try:
     from lxml import etree
 except ImportError:
@@ -50,6 +56,16 @@ class S3SyncAdapter(S3SyncBaseAdapter):
         Sahana Eden Synchronization Adapter (default sync adapter)
     """
 
+    # Response header for the continuation cursor of paged transfers
+    CURSOR = "X-Sync-Cursor"
+
+    # Whether the peer accepts gzip-compressed request bodies
+    # (set when it has sent a compressed response)
+    compress_requests = False
+
+    # The URL opener for this repository (built on first request)
+    _opener = None
+
     # -------------------------------------------------------------------------
     # Methods to be implemented by subclasses:
     # -------------------------------------------------------------------------
@@ -179,6 +195,11 @@ class S3SyncAdapter(S3SyncBaseAdapter):
             Fetch updates from the peer repository and import them
             into the local database (active pull)
 
+            Updates are fetched in pages (settings.sync.page_size), and
+            the continuation cursor is stored in the task after each
+            imported page, so that an interrupted pull resumes after
+            the last complete page
+
             @param task: the synchronization task (sync_task Row)
             @param onconflict: callback for automatic conflict resolution
 
@@ -206,6 +227,11 @@ class S3SyncAdapter(S3SyncBaseAdapter):
             url += "&components=None"
         url += "&include_deleted=True"
 
+        # Page size
+        limit = current.deployment_settings.get_sync_page_size()
+        if limit:
+            url += "&limit=%s" % limit
+
         # Send sync filters to peer
         filters = current.sync.get_filters(task.id)
         resource_name = task.resource_name
@@ -220,173 +246,156 @@ class S3SyncAdapter(S3SyncBaseAdapter):
 
         _debug("...pull from URL %s" % url)
 
-        # Figure out the protocol from the URL
-        url_split = url.split("://", 1)
-        if len(url_split) == 2:
-            protocol = url_split[0]
-        else:
-            protocol = "http"
-
-        # Create the request
-        req = urllib2.Request(url=url)
-        handlers = []
-
-        # Proxy handling
-        proxy = repository.proxy or config.proxy or None
-        if proxy:
-            _debug("S3Sync: pull, using proxy=%s" % proxy)
-            proxy_handler = urllib2.ProxyHandler({protocol: proxy})
-            handlers.append(proxy_handler)
-
-        # Authentication handling
-        username = repository.username
-        password = repository.password
-        if username and password:
-            # Send auth data unsolicitedly (the only way with Eden instances):
-            import base64
-            base64string = base64.encodestring('%s:%s' %
-                                               (username, password))[:-1]
-            req.add_header("Authorization", "Basic %s" % base64string)
-            # Just in case the peer does not accept that, add a 401 handler:
-            passwd_manager = urllib2.HTTPPasswordMgrWithDefaultRealm()
-            passwd_manager.add_password(realm=None,
-                                        uri=url,
-                                        user=username,
-                                        passwd=password)
-            auth_handler = urllib2.HTTPBasicAuthHandler(passwd_manager)
-            handlers.append(auth_handler)
+        # Get import strategy and update policy
+        strategy = task.strategy
+        update_policy = task.update_policy
+        conflict_policy = task.conflict_policy
 
-        # Install all handlers
-        if handlers:
-            opener = urllib2.build_opener(*handlers)
-            urllib2.install_opener(opener)
+        # The target resource
+        resource = current.s3db.resource(resource_name)
+        if onconflict:
+            onconflict_callback = lambda item: onconflict(item,
+                                                          repository,
+                                                          resource)
+        else:
+            onconflict_callback = None
 
-        # Execute the request
+        log = repository.log
         remote = False
         action = "fetch"
-        response = None
+        result = log.SUCCESS
+        message = ""
         output = None
+        mtime = None
 
-        log = repository.log
-        try:
-            f = urllib2.urlopen(req)
-        except urllib2.HTTPError, e:
-            result = log.ERROR
-            remote = True # Peer error
-            code = e.code
-            message = e.read()
-            try:
-                # Sahana-Eden would send a JSON message,
-                # try to extract the actual error message:
-                message_json = json.loads(message)
-                message = message_json.get("message", message)
-            except:
-                pass
-            # Prefix as peer error and strip XML markup from the message
-            # @todo: better method to do this?
-            message = "<message>%s</message>" % message
-            try:
-                markup = etree.XML(message)
-                message = markup.xpath(".//text()")
-                if message:
-                    message = " ".join(message)
-                else:
-                    message = ""
-            except etree.XMLSyntaxError:
-                pass
-            output = xml.json_message(False, code, message, tree=None)
-        except:
-            result = log.FATAL
-            code = 400
-            message = sys.exc_info()[1]
-            output = xml.json_message(False, code, message)
-        else:
-            result = log.SUCCESS
-            response = f
+        # Resume after the last complete page of an interrupted pull
+        cursor = task.pull_cursor
 
-        # Process the response
-        mtime = None
-        if response:
-
-            # Get import strategy and update policy
-            strategy = task.strategy
-            update_policy = task.update_policy
-            conflict_policy = task.conflict_policy
-
-            success = True
-            message = ""
-            action = "import"
-
-            # Import the data
-            resource = current.s3db.resource(resource_name)
-            if onconflict:
-                onconflict_callback = lambda item: onconflict(item,
-                                                              repository,
-                                                              resource)
-            else:
-                onconflict_callback = None
-            count = 0
+        while True:
+
+            # Execute the request
+            page_url = url
+            if cursor:
+                page_url += "&cursor=%s" % quote(cursor)
+            response = None
             try:
-                success = resource.import_xml(
-                                response,
-                                ignore_errors=True,
-                                strategy=strategy,
-                                update_policy=update_policy,
-                                conflict_policy=conflict_policy,
-                                last_sync=last_pull,
-                                onconflict=onconflict_callback,
-                                )
-                count = resource.import_count
-            except IOError, e:
-                result = log.FATAL
-                message = "%s" % e
-                output = xml.json_message(False, 400, message)
-            except Exception, e:
-                # If we end up here, an uncaught error during import
-                # has occured which indicates a code defect! We log it
-                # and continue here, however - in order to maintain a
-                # valid sync status, so that developers can restart
-                # the process more easily after fixing the defect.
+                response, headers = self._send_request(page_url)
+            except urllib2.HTTPError, e:
+                result = log.ERROR
+                remote = True # Peer error
+                code = e.code
+                message = e.read()
+                try:
+                    # Sahana-Eden would send a JSON message,
+                    # try to extract the actual error message:
+                    message_json = json.loads(message)
+                    message = message_json.get("message", message)
+                except:
+                    pass
+                # Prefix as peer error and strip XML markup from the message
+                # @todo: better method to do this?
+                message = "<message>%s</message>" % message
+                try:
+                    markup = etree.XML(message)
+                    message = markup.xpath(".//text()")
+                    if message:
+                        message = " ".join(message)
+                    else:
+                        message = ""
+                except etree.XMLSyntaxError:
+                    pass
+                output = xml.json_message(False, code, message, tree=None)
+            except:
                 result = log.FATAL
-                message = "Uncaught Exception During Import: %s" % \
-                          traceback.format_exc()
-                output = xml.json_message(False, 500, sys.exc_info()[1])
-
-            mtime = resource.mtime
+                code = 400
+                message = sys.exc_info()[1]
+                output = xml.json_message(False, code, message)
 
-            # Log all validation errors
-            if resource.error_tree is not None:
-                result = log.WARNING
-                message = "%s" % resource.error
-                for element in resource.error_tree.findall("resource"):
-                    for field in element.findall("data[@error]"):
-                        error_msg = field.get("error", None)
-                        if error_msg:
-                            msg = "(UID: %s) %s.%s=%s: %s" % \
-                                   (element.get("uuid", None),
-                                    element.get("name", None),
-                                    field.get("field", None),
-                                    field.get("value", field.text),
-                                    field.get("error", None))
-                            message = "%s, %s" % (message, msg)
+            if not response:
+                break
 
-            # Check for failure
-            if not success:
-                result = log.FATAL
-                if not message:
-                    message = "%s" % resource.error
-                output = xml.json_message(False, 400, message)
-                mtime = None
+            # Import the data (serialized with concurrent imports into the
+            # same tables, and committed or rolled back before releasing
+            # the lock)
+            with current.sync.table_lock(resource_name):
+                action = "import"
+                success = True
 
-            # ...or report success
-            elif not message:
-                message = "Data imported successfully (%s records)" % count
+                # Errors of previous pages have been logged already
+                resource.error = None
+                resource.error_tree = None
 
-        elif result == log.SUCCESS:
-            # No data received from peer
-            result = log.ERROR
-            remote = True
-            message = "No data received from peer"
+                try:
+                    success = resource.import_xml(
+                                    response,
+                                    ignore_errors=True,
+                                    strategy=strategy,
+                                    update_policy=update_policy,
+                                    conflict_policy=conflict_policy,
+                                    last_sync=last_pull,
+                                    onconflict=onconflict_callback,
+                                    )
+                except IOError, e:
+                    result = log.FATAL
+                    message = "%s" % e
+                    output = xml.json_message(False, 400, message)
+                except Exception, e:
+                    # If we end up here, an uncaught error during import
+                    # has occured which indicates a code defect! We log it
+                    # and continue here, however - in order to maintain a
+                    # valid sync status, so that developers can restart
+                    # the process more easily after fixing the defect.
+                    result = log.FATAL
+                    message = "Uncaught Exception During Import: %s" % \
+                              traceback.format_exc()
+                    output = xml.json_message(False, 500, sys.exc_info()[1])
+
+                if output is not None:
+                    # Discard the failed import
+                    current.db.rollback()
+                    break
+
+                # Log all validation errors
+                if resource.error_tree is not None:
+                    result = log.WARNING
+                    message = "%s%s" % (message and "%s, " % message,
+                                        resource.error,
+                                        )
+                    for element in resource.error_tree.findall("resource"):
+                        for field in element.findall("data[@error]"):
+                            error_msg = field.get("error", None)
+                            if error_msg:
+                                msg = "(UID: %s) %s.%s=%s: %s" % \
+                                       (element.get("uuid", None),
+                                        element.get("name", None),
+                                        field.get("field", None),
+                                        field.get("value", field.text),
+                                        field.get("error", None))
+                                message = "%s, %s" % (message, msg)
+
+                # Check for failure
+                if not success:
+                    result = log.FATAL
+                    if not message:
+                        message = "%s" % resource.error
+                    output = xml.json_message(False, 400, message)
+                    current.db.rollback()
+                    break
+
+                # Checkpoint: store the cursor for the next page (peers which
+                # do not support paging send everything in the first page)
+                cursor = headers.get(self.CURSOR)
+                task.update_record(pull_cursor=cursor)
+                current.db.commit()
+                if not cursor:
+                    break
+
+        if output is None:
+            # Report success
+            mtime = resource.mtime
+            if not message:
+                message = "Data imported successfully (%s records)" % \
+                          resource.import_count
 
         # Log the operation
         log.write(repository_id=repository.id,
@@ -407,6 +416,11 @@ class S3SyncAdapter(S3SyncBaseAdapter):
             Extract new updates from the local database and send
             them to the peer repository (active push)
 
+            Updates are sent in pages (settings.sync.page_size), and
+            the continuation cursor is stored in the task after each
+            page accepted by the peer, so that an interrupted push
+            resumes after the last complete page
+
             @param task: the synchronization task (sync_task Row)
 
             @return: tuple (error, mtime), with error=None if successful,
@@ -447,98 +461,89 @@ class S3SyncAdapter(S3SyncBaseAdapter):
             # Default
             components = None
 
-        # Define the resource
-        resource = current.s3db.resource(resource_name,
-                                         components = components,
-                                         include_deleted = True)
-
-        # Apply sync filters for this task
+        # Sync filters for this task
         filters = current.sync.get_filters(task.id)
 
-        # Export the resource as S3XML
-        data = resource.export_xml(filters=filters,
-                                   msince=last_push)
-        count = resource.results or 0
-        mtime = resource.muntil
+        # Page size, and cursor to resume an interrupted push
+        limit = current.deployment_settings.get_sync_page_size()
+        cursor = task.push_cursor
+        if cursor:
+            after = self.decode_cursor(cursor)
+            if after is None:
+                # Invalid cursor => start over
+                after = ()
+        elif limit:
+            after = ()
+        else:
+            after = None
 
-        # Transmit the data via HTTP
         remote = False
         output = None
+        mtime = None
+        total = 0
         log = repository.log
-        if data and count:
-
-            # Find the protocol
-            url_split = url.split("://", 1)
-            if len(url_split) == 2:
-                protocol = url_split[0]
-            else:
-                protocol = "http"
-
-            # Generate the request
-            req = urllib2.Request(url=url, data=data)
-            req.add_header('Content-Type', "text/xml")
-            handlers = []
-
-            # Proxy handling
-            proxy = repository.proxy or config.proxy or None
-            if proxy:
-                _debug("using proxy=%s" % proxy)
-                proxy_handler = urllib2.ProxyHandler({protocol: proxy})
-                handlers.append(proxy_handler)
-
-            # Authentication
-            username = repository.username
-            password = repository.password
-            if username and password:
-                # send auth credentials unsolicitedly
-                import base64
-                base64string = base64.encodestring('%s:%s' %
-                                                   (username, password))[:-1]
-                req.add_header("Authorization", "Basic %s" % base64string)
-                # Just in case the peer does not accept that
-                # => add a 401 handler:
-                passwd_manager = urllib2.HTTPPasswordMgrWithDefaultRealm()
-                passwd_manager.add_password(realm=None,
-                                            uri=url,
-                                            user=username,
-                                            passwd=password)
-                auth_handler = urllib2.HTTPBasicAuthHandler(passwd_manager)
-                handlers.append(auth_handler)
-
-            # Install all handlers
-            if handlers:
-                opener = urllib2.build_opener(*handlers)
-                urllib2.install_opener(opener)
-
-            # Execute the request
-            try:
-                f = urllib2.urlopen(req)
-            except urllib2.HTTPError, e:
-                result = log.FATAL
-                remote = True # Peer error
-                code = e.code
-                message = e.read()
+        while True:
+
+            # Define the resource
+            resource = current.s3db.resource(resource_name,
+                                             components = components,
+                                             include_deleted = True)
+
+            # Export the next page as S3XML
+            data = resource.export_xml(filters=filters,
+                                       msince=last_push,
+                                       limit=limit or None,
+                                       after=after,
+                                       )
+            count = resource.results or 0
+            after = resource.cursor
+
+            # Transmit the data via HTTP
+            if data and count:
                 try:
-                    # Sahana-Eden sends a JSON message,
-                    # try to extract the actual error message:
-                    message_json = json.loads(message)
-                    message = message_json.get("message", message)
+                    self._send_request(url, data=data)
+                except urllib2.HTTPError, e:
+                    result = log.FATAL
+                    remote = True # Peer error
+                    code = e.code
+                    message = e.read()
+                    try:
+                        # Sahana-Eden sends a JSON message,
+                        # try to extract the actual error message:
+                        message_json = json.loads(message)
+                        message = message_json.get("message", message)
+                    except:
+                        pass
+                    output = xml.json_message(False, code, message)
                 except:
-                    pass
-                output = xml.json_message(False, code, message)
-            except:
-                result = log.FATAL
-                code = 400
-                message = sys.exc_info()[1]
-                output = xml.json_message(False, code, message)
-            else:
+                    result = log.FATAL
+                    code = 400
+                    message = sys.exc_info()[1]
+                    output = xml.json_message(False, code, message)
+                if output is not None:
+                    break
+                total += count
+
+            muntil = resource.muntil
+            if muntil and (mtime is None or muntil > mtime):
+                mtime = muntil
+
+            # Checkpoint: store the cursor for the next page
+            if after is not None or task.push_cursor:
+                cursor = self.encode_cursor(after) if after else None
+                task.update_record(push_cursor=cursor)
+                current.db.commit()
+            if not after:
+                break
+
+        if output is None:
+            if total:
                 result = log.SUCCESS
-                message = "data sent successfully (%s records)" % count
-
-        else:
-            # No data to send
-            result = log.WARNING
-            message = "No data to send"
+                message = "data sent successfully (%s records)" % total
+            else:
+                # No data to send
+                result = log.WARNING
+                message = "No data to send"
 
         # Log the operation
         log.write(repository_id=repository.id,
@@ -560,6 +565,7 @@ class S3SyncAdapter(S3SyncBaseAdapter):
              start=None,
              limit=None,
              msince=None,
+             cursor=None,
              filters=None,
              mixed=False,
              pretty_print=False):
@@ -570,6 +576,7 @@ class S3SyncAdapter(S3SyncBaseAdapter):
             @param start: index of the first record to send
             @param limit: maximum number of records to send
             @param msince: minimum modification date/time for records to send
+            @param cursor: continuation token from the previous page
             @param filters: URL filters for record extraction
             @param mixed: negotiate resource with peer (disregard resource)
             @param pretty_print: make the output human-readable
@@ -588,11 +595,26 @@ class S3SyncAdapter(S3SyncBaseAdapter):
                     "response": current.xml.json_message(False, 400, msg),
                     }
 
+        # Keyset paging if a page size or cursor is given
+        if cursor:
+            after = self.decode_cursor(cursor)
+            if after is None:
+                msg = "Invalid cursor"
+                return {"status": self.log.FATAL,
+                        "message": msg,
+                        "response": current.xml.json_message(False, 400, msg),
+                        }
+        elif limit:
+            after = ()
+        else:
+            after = None
+
         # Export the data as S3XML
         output = resource.export_xml(start=start,
                                      limit=limit,
                                      filters=filters,
                                      msince=msince,
+                                     after=after,
                                      pretty_print=pretty_print,
                                      )
         count = resource.results
@@ -604,6 +626,12 @@ class S3SyncAdapter(S3SyncBaseAdapter):
         headers = current.response.headers
         headers["Content-Type"] = "text/xml"
 
+        # Cursor for the next page
+        if resource.cursor:
+            headers[self.CURSOR] = self.encode_cursor(resource.cursor)
+
+        output = self.compress_response(output)
+
         return {"status": self.log.SUCCESS,
                 "message": msg,
                 "response": output,
@@ -648,6 +676,11 @@ class S3SyncAdapter(S3SyncBaseAdapter):
 
         repository = self.repository
 
+        # Decompress the request body
+        if current.request.env.http_content_encoding == "gzip":
+            source = [gzip.GzipFile(fileobj=s, mode="rb")
+                      if hasattr(s, "read") else s for s in source]
+
         ignore_errors = True
         if onconflict:
             onconflict_callback = lambda item: onconflict(item,
@@ -706,7 +739,177 @@ class S3SyncAdapter(S3SyncBaseAdapter):
         return {"status": result,
                 "remote": remote,
                 "message": message,
-                "response": output,
+                "response": self.compress_response(output),
                 }
 
+    # -------------------------------------------------------------------------
+    # Internal methods:
+    # -------------------------------------------------------------------------
+    def _send_request(self, url, data=None):
+        """
+            Send a request to the peer repository, accepting a
+            gzip-compressed response
+
+            @param url: the URL
+            @param data: the S3XML to send (POST), None for GET
+
+            @return: tuple (response, headers), where response is a
+                     file-like object with the (decompressed) response
+                     body, and headers the response headers
+
+            @raises urllib2.HTTPError: for errors reported by the peer
+        """
+
+        repository = self.repository
+        config = repository.config
+
+        # Figure out the protocol from the URL
+        url_split = url.split("://", 1)
+        if len(url_split) == 2:
+            protocol = url_split[0]
+        else:
+            protocol = "http"
+
+        # Create the request
+        headers = {"Accept-Encoding": "gzip"}
+        if data is not None:
+            headers["Content-Type"] = "text/xml"
+            if self.compress_requests:
+                data = self.compress(data)
+                headers["Content-Encoding"] = "gzip"
+        req = urllib2.Request(url=url, data=data, headers=headers)
+
+        # Authentication handling
+        username = repository.username
+        password = repository.password
+        if username and password:
+            # Send auth data unsolicitedly (the only way with Eden instances):
+            import base64
+            base64string = base64.encodestring('%s:%s' %
+                                               (username, password))[:-1]
+            req.add_header("Authorization", "Basic %s" % base64string)
+
+        # Build the opener once, and re-use it for all requests to
+        # this repository (do not install it globally, as this could
+        # interfere with other repositories)
+        opener = self._opener
+        if opener is None:
+            handlers = []
+
+            # Proxy handling
+            proxy = repository.proxy or config.proxy or None
+            if proxy:
+                current.log.debug("S3Sync: using proxy=%s" % proxy)
+                proxy_handler = urllib2.ProxyHandler({protocol: proxy})
+                handlers.append(proxy_handler)
+
+            # Just in case the peer does not accept the unsolicited
+            # auth data, add a 401 handler:
+            if username and password:
+                passwd_manager = urllib2.HTTPPasswordMgrWithDefaultRealm()
+                passwd_manager.add_password(realm=None,
+                                            uri=repository.url,
+                                            user=username,
+                                            passwd=password)
+                auth_handler = urllib2.HTTPBasicAuthHandler(passwd_manager)
+                handlers.append(auth_handler)
+
+            opener = self._opener = urllib2.build_opener(*handlers)
+
+        # Execute the request
+        f = opener.open(req)
+
+        headers = f.info()
+        if headers.get("Content-Encoding") == "gzip":
+            # Peer supports compression => compress requests too
+            self.compress_requests = True
+            response = gzip.GzipFile(fileobj=StringIO(f.read()), mode="rb")
+        else:
+            response = f
+
+        return response, headers
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def compress(data):
+        """
+            Compress data with gzip
+
+            @param data: the data (str or unicode)
+
+            @return: the compressed data (str)
+        """
+
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+
+        output = StringIO()
+        with gzip.GzipFile(fileobj=output, mode="wb") as f:
+            f.write(data)
+        return output.getvalue()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def compress_response(cls, output):
+        """
+            Compress a response body if the peer accepts gzip encoding
+
+            @param output: the response body
+
+            @return: the response body, compressed if accepted
+        """
+
+        headers = current.response.headers
+        headers["Vary"] = "Accept-Encoding"
+
+        accept = current.request.env.http_accept_encoding
+        if output and accept and "gzip" in accept:
+            output = cls.compress(output)
+            headers["Content-Encoding"] = "gzip"
+        return output
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def encode_cursor(cursor):
+        """
+            Encode a continuation cursor as token for the peer
+
+            @param cursor: the cursor, tuple (mtime, record_id), as
+                           returned from S3Resource.export_tree
+
+            @return: the token (str)
+        """
+
+        mtime, record_id = cursor
+        if mtime:
+            # Keep the microseconds, otherwise records modified within
+            # the same second could be skipped or sent over and over
+            mtime = mtime.strftime("%Y%m%d%H%M%S%f")
+        else:
+            mtime = ""
+        return "%s-%s" % (mtime, record_id)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def decode_cursor(token):
+        """
+            Decode a continuation token
+
+            @param token: the token (str)
+
+            @return: the cursor, tuple (mtime, record_id), or None
+                     if the token is invalid
+        """
+
+        try:
+            mtime, record_id = token.split("-", 1)
+            if mtime:
+                mtime = datetime.datetime.strptime(mtime, "%Y%m%d%H%M%S%f")
+            else:
+                mtime = None
+            record_id = long(record_id)
+        except (AttributeError, ValueError):
+            return None
+        return (mtime, record_id)
+
 # End =========================================================================
@@ -362,6 +362,7 @@ class S3SyncAdapter(S3SyncBaseAdapter):
              start=None,
              limit=None,
              msince=None,
+             cursor=None,
              filters=None,
              mixed=False,
              pretty_print=False):
@@ -372,6 +373,8 @@ class S3SyncAdapter(S3SyncBaseAdapter):
             @param start: index of the first record to send
             @param limit: maximum number of records to send
             @param msince: minimum modification date/time for records to send
+            @param cursor: continuation token from the previous page
+                           (not supported)
             @param filters: URL filters for record extraction
             @param mixed: negotiate resource with peer (disregard resource)
             @param pretty_print: make the output human-readable
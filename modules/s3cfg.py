@@ -119,6 +119,7 @@ class S3Config(Storage):
         # Allow templates to append rather than replace
         self.base.prepopulate = ["default/base"]
         self.cap = Storage()
+        self.climate = Storage()
         self.cms = Storage()
         self.cr = Storage()
         self.database = Storage()
@@ -854,6 +855,14 @@ class S3Config(Storage):
             # Pre-populate off (production mode), don't bother resolving
             return 0
 
+    def get_base_prepopulate_workers(self):
+        """
+            Number of worker processes to execute independent prepopulate
+            tasks concurrently (PostgreSQL only, otherwise serial)
+            - default 1 = serial
+        """
+        return self.base.get("prepopulate_workers", 1)
+
     def get_base_guided_tour(self):
         """ Whether the guided tours are enabled """
         return self.base.get("guided_tour", False)
@@ -931,6 +940,64 @@ class S3Config(Storage):
         """
         return self.base.get("solr_url", False)
 
+    def get_base_export_chunksize(self):
+        """
+            Extract the data for unpaginated exports (e.g. XLS, data
+            tables) in chunks of this number of records, delivered as
+            column arrays (=columnar mode), to limit the memory footprint
+            of large exports
+            - default None = extract all records at once
+        """
+        return self.base.get("export_chunksize", None)
+
+    def get_base_vfilter_chunksize(self):
+        """
+            Paginated requests with virtual field filters extract and
+            filter the records in chunks of this size until the page is
+            filled (streaming post-filter), rather than filtering all
+            matching records at once
+            - None = filter all matching records at once (default)
+            - if the total number of matching records is requested, all
+              chunks are still filtered, so that the number is exact
+        """
+        return self.base.get("vfilter_chunksize", None)
+
+    def get_base_import_deduplicate_chunksize(self):
+        """
+            Look up the duplicates for the items of import jobs with
+            bulk queries for this number of items (per table), if the
+            deduplicator supports it (e.g. S3Duplicate)
+            - None = one query per item
+        """
+        return self.base.get("import_deduplicate_chunksize", 500)
+
+    def get_base_import_commit_chunksize(self):
+        """
+            Commit import jobs for a single table (without components or
+            references) in bulk, inserting up to this number of new records
+            at once (multi-row INSERT on PostgreSQL), and running batch-aware
+            onaccept callbacks (create_bulk_onaccept) per chunk
+            - None = commit item by item
+        """
+        return self.base.get("import_commit_chunksize", None)
+
+    def get_base_represent_cache_size(self):
+        """
+            Maximum number of foreign key representations to cache
+            across requests (per process), see S3RepresentCache
+            - default 0 = do not share representations between requests
+        """
+        return self.base.get("represent_cache_size", 0)
+
+    def get_base_represent_cache_ttl(self):
+        """
+            Time (in seconds) after which shared representations expire,
+            recommended where multiple processes serve requests (as these
+            do not see each other's invalidations)
+            - None = no expiry
+        """
+        return self.base.get("represent_cache_ttl", 300)
+
     def get_import_callback(self, tablename, callback):
         """
             Lookup callback to use for imports in the following order:
@@ -1317,6 +1384,21 @@ class S3Config(Storage):
         """
         return self.gis.get("max_features", 2000)
 
+    def get_gis_mvt_max_features(self):
+        """
+            The maximum number of features in a vector tile (.mvt)
+            - tiles with more features contain only the first
+              features in ID order
+        """
+        return self.gis.get("mvt_max_features", 20000)
+
+    def get_gis_mvt_min_zoom(self):
+        """
+            The minimum zoom level to return features in vector tiles
+            (.mvt) - tiles at lower zoom levels are empty
+        """
+        return self.gis.get("mvt_min_zoom", 0)
+
     def get_gis_legend(self):
         """
             Should we display a Legend on the Map?
@@ -1471,6 +1553,15 @@ class S3Config(Storage):
         else:
             return self.gis.get("spatialdb", False)
 
+    def get_gis_spatial_index(self):
+        """
+            Use an in-process spatial index to speed up spatial queries
+            where the database has no spatial extensions (see
+            S3SpatialIndex), requires memory for the bounding boxes of
+            all locations in each process
+        """
+        return self.gis.get("spatial_index", False)
+
     def get_gis_widget_catalogue_layers(self):
         """
             Should Map Widgets display Catalogue Layers?
@@ -2147,6 +2238,14 @@ class S3Config(Storage):
         """
         return self.ui.get("report_timeout", 10000)
 
+    def get_ui_report_pushdown(self):
+        """
+            Compute pivot table reports with GROUP BY queries in the
+            database whenever all dimensions and facts are real fields,
+            rather than extracting all records
+        """
+        return self.ui.get("report_pushdown", False)
+
     def get_ui_use_button_icons(self):
         """
             Use icons on action buttons (requires corresponding CSS)
@@ -2263,6 +2362,21 @@ class S3Config(Storage):
         """
         return self.msg.get("max_send_retries", 9)
 
+    def get_msg_outbox_chunksize(self):
+        """
+            Number of outbox messages to process per chunk (contact
+            lookup), None to process all pending messages in one chunk
+        """
+        return self.msg.get("outbox_chunksize", 500)
+
+    def get_msg_outbox_rate_limit(self):
+        """
+            Maximum number of messages to send per second when
+            processing the outbox, a dict {contact_method: rate},
+            e.g. {"SMS": 5}
+        """
+        return self.msg.get("outbox_rate_limit", {})
+
     def get_msg_basestation_code_unique(self):
         """
             Validate for Unique Basestations Codes
@@ -2396,6 +2510,23 @@ class S3Config(Storage):
 
         return self.msg.get("notify_send_data")
 
+    def get_msg_notify_shared_queries(self):
+        """
+            Whether to process due subscriptions in batches per resource,
+            sharing the lookup query and the rendered messages between
+            subscribers with the same filter, language and permissions
+            (otherwise each subscription is looked up in a separate
+            POST?format=msg request to its subscription URL, which runs
+            the controller for the lookup)
+
+            NB the shared lookup applies customise_resource, but not the
+               controller (prep) of the subscription URL - so this should
+               only be enabled if no subscribed controller filters the
+               resource in prep or with s3.filter
+        """
+
+        return self.msg.get("notify_shared_queries", False)
+
     # -------------------------------------------------------------------------
     # SMS
     #
@@ -2430,6 +2561,31 @@ class S3Config(Storage):
         """
         return self.search.get("dates_auto_range", False)
 
+    def get_search_facets(self):
+        """
+            Look up the options for the option filters of a filter form
+            with GROUP BY queries over the filtered resource (where
+            possible), see S3FilterFacets
+        """
+        return self.search.get("facets", False)
+
+    def get_search_facet_cache_size(self):
+        """
+            Maximum number of filter option sets to cache across
+            requests (per process), see S3FilterFacetCache
+            - default 0 = do not share filter options between requests
+        """
+        return self.search.get("facet_cache_size", 0)
+
+    def get_search_facet_cache_ttl(self):
+        """
+            Time (in seconds) after which shared filter options expire,
+            recommended where multiple processes serve requests (as these
+            do not see each other's invalidations)
+            - None = no expiry
+        """
+        return self.search.get("facet_cache_ttl", 60)
+
     # -------------------------------------------------------------------------
     # Filter Manager Widget
     def get_search_filter_manager(self):
@@ -2491,6 +2647,24 @@ class S3Config(Storage):
         """
         return self.sync.get("upload_filename", "$s $r")
 
+    def get_sync_page_size(self):
+        """
+            Maximum number of master records per page when pulling
+            from or pushing to Eden repositories, interrupted transfers
+            resume after the last complete page (None to transfer all
+            records in a single request)
+        """
+        return self.sync.get("page_size", 500)
+
+    def get_sync_workers(self):
+        """
+            Maximum number of repositories to synchronize concurrently
+            in the sync_synchronize_all scheduler task (requires
+            PostgreSQL, otherwise repositories are synchronized one
+            after another)
+        """
+        return self.sync.get("workers", 4)
+
     # =========================================================================
     # Modules
 
@@ -2666,6 +2840,23 @@ class S3Config(Storage):
 
         return self.cap.get("area_default", ["geocode", "polygon"])
 
+    # -------------------------------------------------------------------------
+    # Climate: Climate Data Portal
+    #
+    def get_climate_image_cache_folder(self):
+        """
+            Folder for the cache of generated map images and overlay data
+        """
+        return self.climate.get("image_cache_folder",
+                                "/tmp/climate_data_portal/images")
+
+    def get_climate_image_cache_size(self):
+        """
+            Maximum total size (in bytes) of the cache of generated map
+            images and overlay data
+        """
+        return self.climate.get("image_cache_size", 2**24) # 16 MiB
+
     # -------------------------------------------------------------------------
     # CMS: Content Management System
     #
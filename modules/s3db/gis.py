@@ -467,6 +467,9 @@ class S3LocationModel(S3Model):
             db = current.db
             db(db.gis_location.id == id).update(path=None)
 
+        # Update the spatial index (if in use)
+        S3SpatialIndex.update(id)
+
         if not auth.override and \
            not auth.rollback:
             # Update the Path (async if-possible)
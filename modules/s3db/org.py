@@ -1269,6 +1269,8 @@ class S3OrganisationBranchModel(S3Model):
         self.configure(tablename,
                        # An Organisation can only be a branch of one Organisation:
                        deduplicate = S3Duplicate(primary = ("branch_id",)),
+                       # Writes update the org_organisation hierarchy
+                       hierarchy_of = "org_organisation",
                        onaccept = self.org_branch_onaccept,
                        ondelete = self.org_branch_ondelete,
                        onvalidation = self.org_branch_onvalidation,
@@ -5287,6 +5289,30 @@ class org_OrganisationRepresent(S3Represent):
                              translate=translate,
                              multiple=multiple)
 
+    # -------------------------------------------------------------------------
+    def cache_key(self):
+        """
+            Key for the shared representation cache, see
+            S3Represent.cache_key
+        """
+
+        tablenames = ["org_organisation"]
+        if self.parent:
+            tablenames.append("org_organisation_branch")
+        if self.translate:
+            tablenames.append("org_organisation_name")
+            language = self.language
+        else:
+            language = None
+
+        key = ("org_OrganisationRepresent",
+               bool(self.parent),
+               bool(self.acronym),
+               language,
+               s3_str(self.default),
+               )
+        return key, tablenames
+
     # -------------------------------------------------------------------------
     def custom_lookup_rows(self, key, values, fields=[]):
         """
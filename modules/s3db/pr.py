@@ -94,6 +94,7 @@ __all__ = (# PR Base Entities
            "pr_descendants",
            "pr_rebuild_path",
            "pr_role_rebuild_path",
+           "pr_rebuild_ou_closure",
 
            # Helper for ImageLibrary
            "pr_image_modify",
@@ -133,6 +134,7 @@ class PRPersonEntityModel(S3Model):
 
     names = ("pr_pentity",
              "pr_affiliation",
+             "pr_ou_closure",
              "pr_person_user",
              "pr_role",
              "pr_role_types",
@@ -382,6 +384,7 @@ class PRPersonEntityModel(S3Model):
 
         # Resource configuration
         configure(tablename,
+                  onaccept = self.pr_role_onaccept,
                   onvalidation = self.pr_role_onvalidation,
                   )
 
@@ -435,6 +438,21 @@ class PRPersonEntityModel(S3Model):
                   ondelete = self.pr_affiliation_ondelete,
                   )
 
+        # ---------------------------------------------------------------------
+        # OU Hierarchy Closure
+        # - all (ancestor, descendant) pairs in the OU hierarchy, with the
+        #   shortest distance between them and the instance type of the
+        #   descendant, for single-query lookups of ancestors/descendants
+        # - maintained by pr_rebuild_path, do not edit
+        #
+        tablename = "pr_ou_closure"
+        define_table(tablename,
+                     Field("ancestor", "integer"),
+                     Field("descendant", "integer"),
+                     Field("depth", "integer"),
+                     Field("entity_type", length=64),
+                     )
+
         # ---------------------------------------------------------------------
         # Pass names back to global scope (s3.*)
         #
@@ -604,6 +622,23 @@ class PRPersonEntityModel(S3Model):
         except:
             return current.messages.UNKNOWN_OPT
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def pr_role_onaccept(form):
+        """
+            Update the OU hierarchy closure for all affiliates of the role
+            (in case its role type or entity has changed)
+
+            @param form: the CRUD form
+        """
+
+        form_vars = form.vars
+        if form_vars:
+            role_id = form_vars.id
+            if role_id:
+                pr_role_update_ou_closure(role_id)
+        return
+
     # -------------------------------------------------------------------------
     @staticmethod
     def pr_role_onvalidation(form):
@@ -8226,13 +8261,17 @@ def pr_define_role(pe_id,
     else:
         duplicate = None
     if duplicate:
-        if duplicate.role_type != role_type:
+        role_type_changed = duplicate.role_type != role_type
+        if role_type_changed:
             # Clear paths if this changes the role type
             if str(role_type) != str(OU):
                 data["path"] = None
             s3db.pr_role_rebuild_path(duplicate.id, clear=True)
         duplicate.update_record(**data)
         record_id = duplicate.id
+        if role_type_changed:
+            # Update the OU hierarchy closure
+            pr_role_update_ou_closure(record_id)
     else:
         record_id = rtable.insert(**data)
     return record_id
@@ -8454,40 +8493,18 @@ def pr_get_path(pe_id):
 def pr_get_ancestors(pe_id):
     """
         Find all ancestor entities of a person entity in the OU hierarchy
-        (performs a path lookup where paths are available, otherwise rebuilds
-        paths).
+        (performs a lookup in the OU hierarchy closure).
 
         @param pe_id: the person entity ID
 
-        @return: a list of PE-IDs
+        @return: a list of PE-IDs, nearest ancestors first
     """
 
-    s3db = current.s3db
-    atable = s3db.pr_affiliation
-    rtable = s3db.pr_role
-    query = (atable.deleted != True) & \
-            (atable.role_id == rtable.id) & \
-            (atable.pe_id == pe_id) & \
-            (rtable.deleted != True) & \
-            (rtable.role_type == OU)
-
-    roles = current.db(query).select(rtable.id,
-                                     rtable.pe_id,
-                                     rtable.path,
-                                     rtable.role_type)
-    paths = []
-    append = paths.append
-    for role in roles:
-        path = S3MultiPath([role.pe_id])
-        if role.path is None:
-            ppath = pr_role_rebuild_path(role)
-        else:
-            ppath = S3MultiPath(role.path)
-        path.extend(role.pe_id, ppath, cut=pe_id)
-        append(path)
-    ancestors = S3MultiPath.all_nodes(paths)
-
-    return ancestors
+    ctable = pr_ou_closure()
+    query = (ctable.descendant == pe_id)
+    rows = current.db(query).select(ctable.ancestor,
+                                    orderby=ctable.depth)
+    return [str(row.ancestor) for row in rows]
 
 # =============================================================================
 def pr_instance_type(pe_id):
@@ -8625,12 +8642,11 @@ def pr_ancestors(entities):
 def pr_descendants(pe_ids, skip=None, root=True):
     """
         Find descendant entities of a person entity in the OU hierarchy
-        (performs a real search, not a path lookup), grouped by root PE
+        (performs a lookup in the OU hierarchy closure), grouped by root PE
 
         @param pe_ids: set/list of pe_ids
-        @param skip: list of person entity IDs to skip during
-                     descending (internal)
-        @param root: this is the top-node (internal)
+        @param skip: list of person entity IDs to skip (internal, deprecated)
+        @param root: this is the top-node (internal, deprecated)
 
         @return: a dict of lists of descendant PEs per root PE
     """
@@ -8644,58 +8660,22 @@ def pr_descendants(pe_ids, skip=None, root=True):
     if not pe_ids:
         return {}
 
-    s3db = current.s3db
-    etable = s3db.pr_pentity
-    rtable = s3db.pr_role
-    atable = s3db.pr_affiliation
-
-    q = (rtable.pe_id.belongs(pe_ids)) \
-        if len(pe_ids) > 1 else (rtable.pe_id == list(pe_ids)[0])
-
-    query = (q & (rtable.role_type == OU) & (rtable.deleted != True)) & \
-            ((atable.role_id == rtable.id) & (atable.deleted != True)) & \
-            (etable.pe_id == atable.pe_id)
+    ctable = pr_ou_closure()
 
-    rows = current.db(query).select(rtable.pe_id,
-                                    atable.pe_id,
-                                    etable.instance_type)
-    r = rtable._tablename
-    e = etable._tablename
-    a = atable._tablename
-
-    nodes = set()
-    ogetattr = object.__getattribute__
+    q = (ctable.ancestor.belongs(pe_ids)) \
+        if len(pe_ids) > 1 else (ctable.ancestor == list(pe_ids)[0])
+    query = q & (ctable.entity_type != "pr_person")
 
+    rows = current.db(query).select(ctable.ancestor,
+                                    ctable.descendant,
+                                    )
     result = {}
-
-    skip.update(pe_ids)
     for row in rows:
-
-        parent = ogetattr(ogetattr(row, r), "pe_id")
-        child = ogetattr(ogetattr(row, a), "pe_id")
-        instance_type = ogetattr(ogetattr(row, e), "instance_type")
-        if instance_type != "pr_person":
-            if parent not in result:
-                result[parent] = []
-            result[parent].append(child)
-        if child not in skip:
-            nodes.add(child)
-
-    if nodes:
-        descendants = pr_descendants(nodes, skip=skip, root=False)
-        for child, nodes in descendants.iteritems():
-            for parent, children in result.iteritems():
-                if child in children:
-                    for node in nodes:
-                        if node not in children:
-                            children.append(node)
-    if root:
-        for child, nodes in result.iteritems():
-            for parent, children in result.iteritems():
-                if child in children:
-                    for node in nodes:
-                        if node not in children and node != parent:
-                            children.append(node)
+        ancestor = row.ancestor
+        if ancestor in result:
+            result[ancestor].append(row.descendant)
+        else:
+            result[ancestor] = [row.descendant]
 
     return result
 
@@ -8703,13 +8683,12 @@ def pr_descendants(pe_ids, skip=None, root=True):
 def pr_get_descendants(pe_ids, entity_types=None, skip=None, ids=True):
     """
         Find descendant entities of a person entity in the OU hierarchy
-        (performs a real search, not a path lookup).
+        (performs a lookup in the OU hierarchy closure).
 
         @param pe_ids: person entity ID or list of IDs
         @param entity_types: optional filter to a specific entity_type
         @param ids: whether to return a list of ids or nodes (internal)
-        @param skip: list of person entity IDs to skip during
-                     descending (internal)
+        @param skip: list of person entity IDs to skip (internal, deprecated)
 
         @return: a list of PE-IDs
     """
@@ -8720,57 +8699,37 @@ def pr_get_descendants(pe_ids, entity_types=None, skip=None, ids=True):
         pe_ids = set(pe_ids) \
                  if isinstance(pe_ids, (list, tuple)) else set([pe_ids])
 
-    db = current.db
-    s3db = current.s3db
-    etable = s3db.pr_pentity
-    rtable = db.pr_role
-    atable = db.pr_affiliation
-
-    if skip is None:
-        skip = set()
-    skip.update(pe_ids)
+    ctable = pr_ou_closure()
 
     if len(pe_ids) > 1:
-        q = (rtable.pe_id.belongs(pe_ids))
+        query = (ctable.ancestor.belongs(pe_ids))
     else:
-        q = (rtable.pe_id == list(pe_ids)[0])
-
-    query = ((rtable.deleted != True) & q & (rtable.role_type == OU)) & \
-            ((atable.deleted != True) & (atable.role_id == rtable.id))
+        query = (ctable.ancestor == list(pe_ids)[0])
 
     if entity_types is not None:
-        query &= (etable.pe_id == atable.pe_id)
-        rows = db(query).select(etable.pe_id, etable.instance_type)
-        # We still need to support Py 2.6
-        #result = {(r.pe_id, r.instance_type) for r in rows}
-        result = set((r.pe_id, r.instance_type) for r in rows)
+        if type(entity_types) is not set:
+            if not isinstance(entity_types, (tuple, list)):
+                entity_types = set([entity_types])
+            else:
+                entity_types = set(entity_types)
+        if ids:
+            query &= (ctable.entity_type.belongs(entity_types))
+        rows = current.db(query).select(ctable.descendant,
+                                        ctable.entity_type,
+                                        distinct=True)
         # We still need to support Py 2.6
-        #node_ids = {i for i, t in result if i not in skip}
-        node_ids = set(i for i, t in result if i not in skip)
+        #result = {(r.descendant, r.entity_type) for r in rows}
+        result = set((r.descendant, r.entity_type) for r in rows)
     else:
-        rows = db(query).select(atable.pe_id)
-        # We still need to support Py 2.6
-        #result = {r.pe_id for r in rows}
-        result = set(r.pe_id for r in rows)
+        rows = current.db(query).select(ctable.descendant,
+                                        distinct=True)
         # We still need to support Py 2.6
-        #node_ids = {i for i in result if i not in skip}
-        node_ids = set(i for i in result if i not in skip)
-    # Recurse
-    if node_ids:
-        descendants = pr_get_descendants(node_ids,
-                                         skip=skip,
-                                         entity_types=entity_types,
-                                         ids=False)
-        result.update(descendants)
+        #result = {r.descendant for r in rows}
+        result = set(r.descendant for r in rows)
 
     if ids:
         if entity_types is not None:
-            if type(entity_types) is not set:
-                if not isinstance(entity_types, (tuple, list)):
-                    entity_types = set([entity_types])
-                else:
-                    entity_types = set(entity_types)
-            return [n[0] for n in result if n[1] in entity_types]
+            return [n[0] for n in result]
         else:
             return list(result)
     else:
@@ -8805,6 +8764,10 @@ def pr_rebuild_path(pe_id, clear=False):
         if role.path is None:
             pr_role_rebuild_path(role, clear=clear)
 
+    if clear:
+        # Update the OU hierarchy closure
+        pr_update_ou_closure(pe_id)
+
 # =============================================================================
 def pr_role_rebuild_path(role_id, skip=[], clear=False):
     """
@@ -8870,6 +8833,230 @@ def pr_role_rebuild_path(role_id, skip=[], clear=False):
 
     return path
 
+# =============================================================================
+# OU Hierarchy Closure
+# =============================================================================
+#
+def pr_ou_closure():
+    """
+        Get the OU hierarchy closure table, rebuilding the closure if
+        it has never been built (e.g. after an upgrade)
+
+        @return: the pr_ou_closure Table
+    """
+
+    ctable = current.s3db.pr_ou_closure
+
+    # The complete closure contains a (0, 0) marker record
+    query = (ctable.ancestor == 0) & (ctable.descendant == 0)
+    if not current.db(query).select(ctable.id, limitby=(0, 1)).first():
+        pr_rebuild_ou_closure()
+
+    return ctable
+
+# =============================================================================
+def pr_rebuild_ou_closure():
+    """
+        Rebuild the OU hierarchy closure from scratch, e.g. after
+        OU affiliations have been changed in the database directly
+    """
+
+    db = current.db
+    ctable = current.s3db.pr_ou_closure
+
+    parents = pr_ou_parents()
+    ancestors = pr_ou_ancestors(parents.keys(), parents)
+
+    db(ctable.id > 0).delete()
+    pr_ou_closure_insert(ancestors)
+
+    # Mark the closure as complete
+    ctable.insert(ancestor=0, descendant=0, depth=0)
+
+# =============================================================================
+def pr_update_ou_closure(pe_ids):
+    """
+        Update the OU hierarchy closure after the OU affiliations of
+        person entities have changed (incremental update, re-computes
+        the ancestors of these entities and their descendants)
+
+        @param pe_ids: the person entity ID, or list of IDs
+    """
+
+    if not pe_ids:
+        return
+    if not isinstance(pe_ids, (list, tuple, set)):
+        pe_ids = [pe_ids]
+    pe_ids = set(long(pe_id) for pe_id in pe_ids)
+
+    db = current.db
+    ctable = current.s3db.pr_ou_closure
+
+    query = (ctable.ancestor == 0) & (ctable.descendant == 0)
+    if not db(query).select(ctable.id, limitby=(0, 1)).first():
+        # Never been built => build from scratch
+        pr_rebuild_ou_closure()
+        return
+
+    # All entities at or below the changed entities are affected
+    query = (ctable.ancestor.belongs(pe_ids))
+    rows = db(query).select(ctable.descendant, distinct=True)
+    affected = pe_ids | set(row.descendant for row in rows)
+
+    # The ancestors of all other parents remain the same
+    parents = pr_ou_parents(affected)
+    outside = set()
+    for nodes in parents.values():
+        outside |= nodes
+    outside -= affected
+    known = {}
+    if outside:
+        query = (ctable.descendant.belongs(outside))
+        rows = db(query).select(ctable.ancestor,
+                                ctable.descendant,
+                                ctable.depth,
+                                )
+        for row in rows:
+            descendant = row.descendant
+            if descendant in known:
+                known[descendant][row.ancestor] = row.depth
+            else:
+                known[descendant] = {row.ancestor: row.depth}
+
+    ancestors = pr_ou_ancestors(affected, parents, known=known)
+
+    db(ctable.descendant.belongs(affected)).delete()
+    pr_ou_closure_insert(ancestors)
+
+# =============================================================================
+def pr_role_update_ou_closure(role_id):
+    """
+        Update the OU hierarchy closure for all affiliates of a role
+
+        @param role_id: the pr_role record ID
+    """
+
+    atable = current.s3db.pr_affiliation
+    query = (atable.role_id == role_id) & \
+            (atable.deleted != True)
+    rows = current.db(query).select(atable.pe_id)
+    pe_ids = [row.pe_id for row in rows if row.pe_id]
+    if pe_ids:
+        pr_update_ou_closure(pe_ids)
+
+# =============================================================================
+def pr_ou_parents(pe_ids=None):
+    """
+        Get the immediate OU ancestors of person entities
+
+        @param pe_ids: set of person entity IDs (None for all)
+
+        @return: dict {pe_id: set of parent pe_ids}
+    """
+
+    s3db = current.s3db
+    atable = s3db.pr_affiliation
+    rtable = s3db.pr_role
+    query = (atable.deleted != True) & \
+            (atable.role_id == rtable.id) & \
+            (rtable.deleted != True) & \
+            (rtable.role_type == OU)
+    if pe_ids is not None:
+        query &= (atable.pe_id.belongs(pe_ids))
+    rows = current.db(query).select(atable.pe_id,
+                                    rtable.pe_id,
+                                    )
+    a = atable._tablename
+    r = rtable._tablename
+
+    parents = {}
+    for row in rows:
+        child = row[a].pe_id
+        parent = row[r].pe_id
+        if child is None or parent is None or child == parent:
+            continue
+        if child in parents:
+            parents[child].add(parent)
+        else:
+            parents[child] = set([parent])
+    return parents
+
+# =============================================================================
+def pr_ou_ancestors(nodes, parents, known=None):
+    """
+        Compute the ancestors of entities in the OU hierarchy, with
+        the shortest distance to each ancestor
+
+        @param nodes: the entities (pe_ids)
+        @param parents: the immediate OU ancestors of the entities,
+                        dict {pe_id: set of parent pe_ids}
+        @param known: the ancestors of parents which are not themselves
+                      in nodes, dict {pe_id: {ancestor: depth}} (parents
+                      missing here are treated as top-level entities)
+
+        @return: dict {pe_id: {ancestor: depth}}
+    """
+
+    if known is None:
+        known = {}
+
+    ancestors = dict((node, {}) for node in nodes)
+
+    # Propagate along the hierarchy until stable (terminates
+    # also for loops, as depths can only decrease)
+    changed = True
+    while changed:
+        changed = False
+        for node in ancestors:
+            depths = ancestors[node]
+            for parent in parents.get(node, ()):
+                if parent in ancestors:
+                    upper = ancestors[parent]
+                else:
+                    upper = known.get(parent, {})
+                candidates = [(parent, 1)]
+                candidates.extend((a, d + 1) for a, d in upper.items())
+                for ancestor, depth in candidates:
+                    if ancestor == node:
+                        continue
+                    if ancestor not in depths or depth < depths[ancestor]:
+                        depths[ancestor] = depth
+                        changed = True
+
+    return ancestors
+
+# =============================================================================
+def pr_ou_closure_insert(ancestors):
+    """
+        Write closure records
+
+        @param ancestors: dict {pe_id: {ancestor: depth}}, as returned
+                          from pr_ou_ancestors
+    """
+
+    nodes = [node for node in ancestors if ancestors[node]]
+    if not nodes:
+        return
+
+    # Instance types of the descendants
+    etable = current.s3db.pr_pentity
+    rows = current.db(etable.pe_id.belongs(nodes)).select(etable.pe_id,
+                                                          etable.instance_type,
+                                                          )
+    instance_types = dict((row.pe_id, row.instance_type) for row in rows)
+
+    items = []
+    append = items.append
+    for node in nodes:
+        entity_type = instance_types.get(node)
+        for ancestor, depth in ancestors[node].items():
+            append({"ancestor": ancestor,
+                    "descendant": node,
+                    "depth": depth,
+                    "entity_type": entity_type,
+                    })
+    current.s3db.pr_ou_closure.bulk_insert(items)
+
 # -----------------------------------------------------------------------------
 def pr_image_modify(image_file,
                     image_name,
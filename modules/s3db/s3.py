@@ -43,6 +43,7 @@ class S3HierarchyModel(S3Model):
     """ Model for stored object hierarchies """
 
     names = ("s3_hierarchy",
+             "s3_hierarchy_node",
              )
 
     def model(self):
@@ -56,9 +57,37 @@ class S3HierarchyModel(S3Model):
                           Field("dirty", "boolean",
                                 default = False,
                                 ),
+                          # Incremented with every change of the stored nodes
+                          Field("version", "integer",
+                                default = 0,
+                                ),
+                          # Version of the last full save (replacing all nodes)
+                          Field("base_version", "integer",
+                                default = 0,
+                                ),
+                          # Legacy format (whole hierarchy as JSON), no
+                          # longer written
                           Field("hierarchy", "json"),
                           *s3_timestamp())
 
+        # ---------------------------------------------------------------------
+        # Stored Hierarchy Nodes (adjacency list)
+        #
+        tablename = "s3_hierarchy_node"
+        self.define_table(tablename,
+                          Field("tablename", length=64),
+                          Field("node_id", "integer"),
+                          Field("parent_id", "integer"),
+                          Field("category", "json"),
+                          # Version of s3_hierarchy when last changed
+                          Field("version", "integer",
+                                default = 0,
+                                ),
+                          Field("deleted", "boolean",
+                                default = False,
+                                ),
+                          )
+
         # ---------------------------------------------------------------------
         # Return global names to s3.*
         #
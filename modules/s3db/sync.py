@@ -466,6 +466,16 @@ class SyncDataModel(S3Model):
                            readable = True,
                            writable = False,
                            ),
+                     # Continuation cursors to resume interrupted
+                     # paged transfers (Eden repositories)
+                     Field("pull_cursor",
+                           readable = False,
+                           writable = False,
+                           ),
+                     Field("push_cursor",
+                           readable = False,
+                           writable = False,
+                           ),
                      Field("mode", "integer",
                            default = 3,
                            label = T("Mode"),
@@ -841,7 +851,8 @@ class SyncDataModel(S3Model):
     @staticmethod
     def sync_resource_filter_onaccept(form):
         """
-            Reset last_push when adding/changing a filter
+            Reset last_push (and any interrupted paged push) when
+            adding/changing a filter
         """
 
         db = current.db
@@ -876,7 +887,9 @@ class SyncDataModel(S3Model):
             else:
                 task_id = row.task_id
             if task_id:
-                db(ttable.id == task_id).update(last_push=None)
+                db(ttable.id == task_id).update(last_push = None,
+                                                push_cursor = None,
+                                                )
 
         return
 
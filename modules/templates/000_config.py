@@ -45,6 +45,8 @@ settings.base.template = "default"
 #settings.database.pool_size = 30
 # Do we have a spatial DB available? (currently supports PostGIS. Spatialite to come.)
 #settings.gis.spatialdb = True
+# Uncomment to use an in-process spatial index for spatial queries without a spatial DB
+#settings.gis.spatial_index = True
 
 # Base settings
 #settings.base.system_name = T("Sahana Eden Humanitarian Management Platform")
@@ -80,6 +82,33 @@ settings.base.debug = False
 # Uncomment to use Content Delivery Networks to speed up Internet-facing sites
 #settings.base.cdn = True
 
+# Uncomment to extract data for large exports (e.g. XLS) in chunks of records
+# to limit memory usage
+#settings.base.export_chunksize = 1000
+
+# Uncomment to share representations of foreign keys between requests
+# (number of entries per process, and time-to-live in seconds)
+#settings.base.represent_cache_size = 10000
+#settings.base.represent_cache_ttl = 300
+
+# Uncomment to filter paginated requests with virtual field filters in chunks
+# until the page is filled (number of records per chunk)
+#settings.base.vfilter_chunksize = 500
+
+# Uncomment to deduplicate import items with one query per item rather than
+# in bulk (default: look up the duplicates for 500 items per query)
+#settings.base.import_deduplicate_chunksize = None
+
+# Uncomment to commit imports of new records in bulk (e.g. for faster prepopulate)
+#settings.base.import_commit_chunksize = 500
+
+# Uncomment to change the number of records per page for synchronization
+# with Eden repositories (None to transfer everything in a single request)
+#settings.sync.page_size = 100
+# Uncomment to change the number of repositories the sync_synchronize_all
+# scheduler task synchronizes concurrently (PostgreSQL only)
+#settings.sync.workers = 8
+
 # Allow language files to be updated automatically
 #settings.L10n.languages_readonly = False
 
@@ -106,6 +135,11 @@ settings.auth.hmac_key = "akeytochange"
 #settings.mail.approver = "useradmin@example.org"
 # Daily Limit on Sending of emails
 #settings.mail.limit = 1000
+# Uncomment to limit the number of messages sent per second, per contact method
+#settings.msg.outbox_rate_limit = {"SMS": 5}
+# Uncomment to share subscription notification lookups and messages between subscribers
+# (only if no subscribed controller filters the resource in prep)
+#settings.msg.notify_shared_queries = True
 
 # Frontpage settings
 # RSS feeds
@@ -208,8 +242,18 @@ settings.frontpage.rss = [
 # Performance Options
 # Maximum number of search results for an Autocomplete Widget
 #settings.search.max_results = 200
+# Uncomment to look up the options for the option filters of a filter form with GROUP BY queries
+#settings.search.facets = True
+# Share filter options between requests (number of option sets, 0 = disabled)
+#settings.search.facet_cache_size = 0
+#settings.search.facet_cache_ttl = 60
 # Maximum number of features for a Map Layer
 #settings.gis.max_features = 1000
+# Maximum number of features per vector tile, and minimum zoom level for vector tiles
+#settings.gis.mvt_max_features = 20000
+#settings.gis.mvt_min_zoom = 0
+# Uncomment to compute pivot table reports in the database (GROUP BY) where possible
+#settings.ui.report_pushdown = True
 
 # CAP Settings
 # Change for different authority and organisations
@@ -235,6 +279,8 @@ settings.import_template()
 #settings.base.system_name = T("Sahana TEST")
 #settings.base.prepopulate = ("MY_TEMPLATE_ONLY")
 #settings.base.prepopulate += ("default", "default/users")
+# Uncomment to prepopulate with parallel worker processes (PostgreSQL only)
+#settings.base.prepopulate_workers = 4
 #settings.base.theme = "default"
 #settings.L10n.default_language = "en"
 #settings.security.policy = 7 # Organisation-ACLs
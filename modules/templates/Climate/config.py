@@ -14,6 +14,10 @@ settings = current.deployment_settings
 
 settings.base.prepopulate.append("Climate")
 
+# Cache for generated map images and overlay data
+#settings.climate.image_cache_folder = "/tmp/climate_data_portal/images"
+#settings.climate.image_cache_size = 2**24 # 16 MiB
+
 # Comment/uncomment modules here to disable/enable them
 # @ToDo: Have the system automatically enable migrate if a module is enabled
 # Modules menu is defined in modules/eden/menu.py
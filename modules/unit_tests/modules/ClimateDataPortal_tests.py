@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+#
+# Climate Data Portal Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/modules/ClimateDataPortal_tests.py
+#
+import math
+import unittest
+
+from gluon import DAL
+from gluon.storage import Storage
+
+try:
+    from ClimateDataPortal import BulkImport
+except ImportError:
+    # NumPy not installed
+    BulkImport = None
+
+from unit_tests import run_suite
+
+# =============================================================================
+@unittest.skipIf(BulkImport is None, "NumPy not installed")
+class BulkImportTests(unittest.TestCase):
+    """ Tests for the bulk import of climate readings """
+
+    PLACES = (1, 2)
+
+    # Four months of 30 days, the first two in 2011, the others in 2012
+    DAYS = 120
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        # Separate database, so that the tables can be created and dropped
+        db = self.db = DAL("sqlite:memory")
+
+        db.executesql("CREATE TABLE climate_place (id integer PRIMARY KEY);")
+        for place_id in self.PLACES:
+            db.executesql("INSERT INTO climate_place (id) VALUES (%s);" % place_id)
+
+        table_name = "climate_sample_table_test"
+        db.executesql("""
+        CREATE TABLE %s (
+          place_id integer NOT NULL,
+          time_period smallint NOT NULL,
+          value real NOT NULL,
+          PRIMARY KEY (place_id, time_period)
+        );
+        """ % table_name)
+
+        self.sample_table = Storage(db = db,
+                                    table_name = table_name,
+                                    )
+        BulkImport.create_aggregate_tables(self.sample_table)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        self.db.close()
+
+    # -------------------------------------------------------------------------
+    def readings(self, offset=0):
+        """
+            Generate the test readings
+
+            @param offset: value offset, to change the readings
+
+            @return: dict {(place_id, day): value}
+        """
+
+        return dict(((place_id, day), place_id * 10.0 + day % 7 + offset)
+                    for place_id in self.PLACES
+                    for day in range(self.DAYS))
+
+    # -------------------------------------------------------------------------
+    def bulk_import(self, readings):
+        """
+            Import readings like import_NetCDF_readings: in time order,
+            a month at a time, flushing complete months
+
+            @param readings: the readings, dict {(place_id, day): value}
+        """
+
+        np = BulkImport.np
+
+        bulk_readings = BulkImport.BulkReadings(self.sample_table)
+        for month in range(self.DAYS // 30):
+            keys = sorted((place_id, day) for place_id, day in readings
+                          if day // 30 == month)
+            place_ids = np.array([k[0] for k in keys], dtype=np.int64)
+            days = np.array([k[1] for k in keys], dtype=np.int64)
+            values = np.array([readings[k] for k in keys])
+            bulk_readings.add(place_ids, days, days // 30, values)
+            bulk_readings.flush(before_month=month + 1)
+        bulk_readings.done()
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def expected(readings, period):
+        """
+            Compute the expected aggregates
+
+            @param readings: the readings, dict {(place_id, day): value}
+            @param period: function to compute the period from the day
+
+            @return: dict {function: {(place_id, period): value}}
+        """
+
+        groups = {}
+        for (place_id, day), value in readings.items():
+            groups.setdefault((place_id, period(day)), []).append(value)
+
+        expected = {}
+        for key, values in groups.items():
+            count = len(values)
+            mean = sum(values) / count
+            m2 = sum((v - mean) ** 2 for v in values)
+            for function, value in (("MAX", max(values)),
+                                    ("MIN", min(values)),
+                                    ("AVG", mean),
+                                    ("STDDEV", math.sqrt(m2 / (count - 1))),
+                                    ("SUM", sum(values)),
+                                    ("COUNT", count),
+                                    ):
+                expected.setdefault(function, {})[key] = value
+        return expected
+
+    # -------------------------------------------------------------------------
+    def assertAggregates(self, readings):
+        """
+            Assert that the sample and aggregate tables contain the
+            readings and their aggregates
+
+            @param readings: the readings, dict {(place_id, day): value}
+        """
+
+        db = self.db
+        sample_table = self.sample_table
+
+        rows = db.executesql("SELECT place_id, time_period, value FROM %s;" %
+                             sample_table.table_name)
+        self.assertEqual(len(rows), len(readings))
+        for place_id, day, value in rows:
+            self.assertAlmostEqual(value, readings[(place_id, day)], places=4)
+
+        year = lambda day: \
+               int(BulkImport.month_numbers_to_years(BulkImport.np.array([day // 30]))[0])
+
+        for period, key, to_period in (("monthly", "month", lambda day: day // 30),
+                                       ("yearly", "year", year),
+                                       ):
+            expected = self.expected(readings, to_period)
+            for function in BulkImport.AGGREGATIONS:
+                table_name = BulkImport.aggregate_table_name(sample_table,
+                                                             period,
+                                                             function,
+                                                             )
+                rows = db.executesql('SELECT place_id, "%s", value FROM %s;' %
+                                     (key, table_name))
+                values = dict(((place_id, p), value) for place_id, p, value in rows)
+                self.assertEqual(set(values), set(expected[function]))
+                for k, value in expected[function].items():
+                    self.assertAlmostEqual(values[k], value, places=3,
+                                           msg="%s %s" % (table_name, k))
+
+    # -------------------------------------------------------------------------
+    def testImport(self):
+        """ Test readings and aggregates of a first import """
+
+        readings = self.readings()
+        self.bulk_import(readings)
+        self.assertAggregates(readings)
+
+    # -------------------------------------------------------------------------
+    def testReimport(self):
+        """ Test that a repeated import replaces readings and aggregates """
+
+        readings = self.readings()
+        self.bulk_import(readings)
+
+        # Same readings
+        self.bulk_import(readings)
+        self.assertAggregates(readings)
+
+        # Corrected readings
+        readings = self.readings(offset=1.5)
+        self.bulk_import(readings)
+        self.assertAggregates(readings)
+
+# =============================================================================
+if __name__ == "__main__":
+
+    run_suite(
+        BulkImportTests,
+    )
+
+# END ========================================================================
@@ -1 +1,2 @@
 from unit_tests.modules.s3layouts_tests import *
+from unit_tests.modules.ClimateDataPortal_tests import *
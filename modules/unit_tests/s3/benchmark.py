@@ -143,6 +143,65 @@ class S3PerformanceTests(unittest.TestCase):
         print "S3Model.get_config = %s µs" % mlt
         self.assertTrue(mlt<10)
 
+    def testS3ModelSetup(self):
+        """ Per-request overhead of the model setup """
+
+        from gluon.shell import env
+        from s3.s3fields import s3_meta_fields, s3_all_meta_field_names
+        from s3.s3model import S3Model
+
+        appname = current.request.application
+        tablenames = ("org_organisation",
+                      "pr_person",
+                      "hrm_human_resource",
+                      "gis_location",
+                      "project_project",
+                      )
+
+        def setup():
+            # Execute the model files in a new environment (=request)
+            environment = env(appname, c=None, import_models=True)
+            environment["db"].rollback()
+            return environment
+
+        def load():
+            # Load a typical set of tables in a new environment
+            s3db = setup()["s3db"]
+            for tablename in tablenames:
+                s3db.table(tablename)
+
+        print ""
+
+        # Restore the current environment after the test
+        saved = dict(current.__dict__)
+        index = S3Model._index
+        try:
+            mlt = timeit.Timer(setup).timeit(number=20) * 50
+            print "Model setup = %s ms/request" % mlt
+
+            # Without the per-process index of model names
+            S3Model._index = {}
+            mlt = timeit.Timer(load).timeit(number=20) * 50
+            print "Model setup + table loading (scan) = %s ms/request" % mlt
+
+            # With the per-process index of model names
+            S3Model._index = None
+            mlt = timeit.Timer(load).timeit(number=20) * 50
+            print "Model setup + table loading (index) = %s ms/request" % mlt
+        finally:
+            S3Model._index = index
+            current.__dict__.clear()
+            current.__dict__.update(saved)
+
+        x = lambda: [field.name for field in s3_meta_fields()]
+        mlt = timeit.Timer(x).timeit(number=1000)
+        print "Meta-field names (build) = %s ms" % mlt
+
+        x = lambda: s3_all_meta_field_names()
+        mlt = timeit.Timer(x).timeit(number=1000)
+        print "Meta-field names (per-process) = %s ms" % mlt
+        self.assertTrue(mlt<1)
+
     def testS3ResourceInit(self):
 
         print ""
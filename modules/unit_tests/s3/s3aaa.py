@@ -6,6 +6,7 @@
 # python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3aaa.py
 #
 import unittest
+from uuid import uuid4
 
 from gluon import *
 from gluon.storage import Storage
@@ -1393,6 +1394,101 @@ class ACLManagementTests(unittest.TestCase):
             auth.s3_delete_role("TESTGROUP")
             db.rollback()
 
+# =============================================================================
+class ACLCacheTests(unittest.TestCase):
+    """ Test caching of ACLs across requests """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        auth = current.auth
+        self.group_id = auth.s3_create_role("Test Role", uid="TESTCACHE")
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        auth = current.auth
+        auth.s3_delete_role("TESTCACHE")
+        current.db.rollback()
+        auth.permission = S3Permission(auth)
+
+    # -------------------------------------------------------------------------
+    def testVersion(self):
+        """ Test that the ACL version changes when ACLs are updated """
+
+        permission = current.auth.permission
+
+        version = permission.get_version()
+        self.assertNotEqual(version, None)
+        self.assertEqual(permission.get_version(), version)
+
+        permission.update_acl(self.group_id,
+                              t = "pr_person",
+                              uacl = permission.READ,
+                              oacl = permission.READ,
+                              )
+        self.assertNotEqual(permission.get_version(), version)
+
+    # -------------------------------------------------------------------------
+    def testVersionSameAggregate(self):
+        """ Test that the ACL version changes even if the aggregate does not """
+
+        db = current.db
+        permission = current.auth.permission
+        table = permission.table
+
+        permission.update_acl(self.group_id,
+                              t = "pr_person",
+                              uacl = permission.READ,
+                              oacl = permission.READ,
+                              )
+        query = (table.group_id == self.group_id) & \
+                (table.tablename == "pr_person")
+        mtime = db(query).select(table.modified_on,
+                                 limitby = (0, 1),
+                                 ).first().modified_on
+
+        permission.clear_cache()
+        version = permission.get_version()
+
+        # Same row count, modification time and ACLs, different table
+        db(query).update(tablename = "pr_address",
+                         modified_on = mtime,
+                         )
+        permission.clear_cache()
+        self.assertNotEqual(permission.get_version(), version)
+
+    # -------------------------------------------------------------------------
+    def testCachedLookup(self):
+        """ Test re-use and invalidation of cached lookups """
+
+        auth = current.auth
+        permission = auth.permission
+        assertEqual = self.assertEqual
+
+        calls = []
+        def lookup():
+            calls.append(None)
+            return len(calls)
+
+        key = "test_%s" % uuid4()
+
+        # First lookup
+        assertEqual(permission.cached(key, lookup), 1)
+        assertEqual(permission.cached(key, lookup), 1)
+
+        # Re-used in subsequent requests
+        assertEqual(S3Permission(auth).cached(key, lookup), 1)
+
+        # Invalidated when the ACLs change
+        permission.update_acl(self.group_id,
+                              t = "pr_person",
+                              uacl = permission.READ,
+                              oacl = permission.READ,
+                              )
+        assertEqual(permission.cached(key, lookup), 2)
+        assertEqual(S3Permission(auth).cached(key, lookup), 2)
+
 # =============================================================================
 class HasPermissionTests(unittest.TestCase):
     """ Test permission check method """
@@ -4478,6 +4574,7 @@ if __name__ == "__main__":
         RoleAssignmentTests,
         RecordOwnershipTests,
         ACLManagementTests,
+        ACLCacheTests,
         HasPermissionTests,
         AccessibleQueryTests,
         DelegationTests,
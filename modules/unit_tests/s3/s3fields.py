@@ -168,6 +168,22 @@ class S3RepresentTests(unittest.TestCase):
         self.assertTrue(isinstance(result, lazyT))
         self.assertEqual(result, current.T(self.name1))
 
+    # -------------------------------------------------------------------------
+    def testBulkProtocol(self):
+        """ Test bulk representation with and without bulk-renderer """
+
+        # Renderer with bulk-method: single lookup for all values
+        r = S3Represent(lookup="org_organisation")
+        result = s3_represent_bulk(r, [self.id1, self.id2])
+        self.assertEqual(result[self.id1], self.name1)
+        self.assertEqual(result[self.id2], self.name2)
+        self.assertEqual(r.queries, 1)
+
+        # Plain function: represent value by value
+        renderer = lambda value: "Value %s" % value
+        result = s3_represent_bulk(renderer, [1, 2])
+        self.assertEqual(result, {1: "Value 1", 2: "Value 2"})
+
     def testRowsPrecedence(self):
 
         # Check that rows get preferred over values
@@ -303,6 +319,162 @@ class S3RepresentTests(unittest.TestCase):
         current.db.rollback()
         current.auth.override = False
 
+# =============================================================================
+class S3RepresentCacheTests(unittest.TestCase):
+    """ Tests for the shared representation cache """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        s3db = current.s3db
+
+        otable = s3db.org_organisation
+        org = Storage(name="Represent Cache Test Organisation")
+        org_id = otable.insert(**org)
+        org.update(id=org_id)
+        s3db.update_super(otable, org)
+
+        self.org_id = org_id
+        self.name = org.name
+
+        # Replace the shared instance
+        self.instance = S3RepresentCache.instance
+        S3RepresentCache.instance = S3RepresentCache(size=10)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        S3RepresentCache.instance = self.instance
+
+        current.db.rollback()
+        current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    def testGetSet(self):
+        """ Test storing and retrieving representations """
+
+        assertEqual = self.assertEqual
+
+        cache = S3RepresentCache(size=2)
+
+        cache.set("key", ["test_table"], {1: "One", 2: "Two"})
+        assertEqual(cache.get("key", ["test_table"], [1, 2, 3]),
+                    {1: "One", 2: "Two"})
+
+        # Other configuration key => miss
+        assertEqual(cache.get("other", ["test_table"], [1]), {})
+
+        stats = cache.stats()
+        assertEqual(stats.hits, 2)
+        assertEqual(stats.misses, 2)
+        assertEqual(stats.entries, 2)
+
+        # Only plain strings are shared
+        cache.set("key", ["test_table"], {4: DIV("Four")})
+        assertEqual(cache.get("key", ["test_table"], [4]), {})
+
+    # -------------------------------------------------------------------------
+    def testEviction(self):
+        """ Test that least recently used entries get discarded """
+
+        assertEqual = self.assertEqual
+
+        cache = S3RepresentCache(size=2)
+
+        cache.set("key", ["test_table"], {1: "One", 2: "Two"})
+
+        # Use 1 => 2 is least recently used
+        cache.get("key", ["test_table"], [1])
+        cache.set("key", ["test_table"], {3: "Three"})
+
+        assertEqual(cache.get("key", ["test_table"], [1, 2, 3]),
+                    {1: "One", 3: "Three"})
+        assertEqual(cache.stats().entries, 2)
+
+    # -------------------------------------------------------------------------
+    def testExpiry(self):
+        """ Test that entries expire after TTL """
+
+        cache = S3RepresentCache(size=2, ttl=-1)
+
+        cache.set("key", ["test_table"], {1: "One"})
+        self.assertEqual(cache.get("key", ["test_table"], [1]), {})
+
+    # -------------------------------------------------------------------------
+    def testInvalidate(self):
+        """ Test invalidation of all entries depending on a table """
+
+        assertEqual = self.assertEqual
+
+        cache = S3RepresentCache.instance
+
+        cache.set("key", ["test_table", "test_link"], {1: "One"})
+        cache.set("other", ["test_other"], {1: "Other"})
+
+        S3RepresentCache.invalidate("test_link")
+
+        assertEqual(cache.get("key", ["test_table", "test_link"], [1]), {})
+        assertEqual(cache.get("other", ["test_other"], [1]), {1: "Other"})
+
+    # -------------------------------------------------------------------------
+    def testSharedRepresentation(self):
+        """ Test sharing of representations between S3Represent instances """
+
+        assertEqual = self.assertEqual
+
+        org_id = self.org_id
+
+        r = S3Represent(lookup="org_organisation")
+        assertEqual(r(org_id), self.name)
+        assertEqual(r.queries, 1)
+
+        # Another instance uses the shared representation
+        r = S3Represent(lookup="org_organisation")
+        assertEqual(r(org_id), self.name)
+        assertEqual(r.queries, 0)
+
+        # Different configuration requires a new lookup
+        r = S3Represent(lookup="org_organisation", fields=["name", "acronym"])
+        assertEqual(r(org_id), self.name)
+        assertEqual(r.queries, 1)
+
+        # Updating the record invalidates the shared representation
+        otable = current.s3db.org_organisation
+        current.db(otable.id == org_id).update(name="Updated Name")
+        r = S3Represent(lookup="org_organisation")
+        assertEqual(r(org_id), "Updated Name")
+        assertEqual(r.queries, 1)
+
+    # -------------------------------------------------------------------------
+    def testOverriddenLink(self):
+        """ Test that representations with overridden link are not shared """
+
+        assertEqual = self.assertEqual
+
+        org_id = self.org_id
+
+        rows = []
+        class LinkRepresent(S3Represent):
+            def link(self, k, v, row=None):
+                # Links built from the looked-up row
+                rows.append(row)
+                return A(v, _href="/%s" % row["org_organisation.id"])
+
+        # Populate the shared cache
+        r = S3Represent(lookup="org_organisation")
+        assertEqual(r(org_id), self.name)
+
+        r = LinkRepresent(lookup="org_organisation", show_link=True)
+        assertEqual(r.cache_key(), None)
+        for i in range(2):
+            r = LinkRepresent(lookup="org_organisation", show_link=True)
+            output = r(org_id)
+            assertEqual(r.queries, 1)
+            assertEqual(output["_href"], "/%s" % org_id)
+        self.assertFalse(None in rows)
+
 # =============================================================================
 class S3ExtractLazyFKRepresentationTests(unittest.TestCase):
     """ Test lazy representation of foreign keys in datatables """
@@ -1269,6 +1441,7 @@ if __name__ == "__main__":
 
     run_suite(
         S3RepresentTests,
+        S3RepresentCacheTests,
         S3ExtractLazyFKRepresentationTests,
         S3ExportLazyFKRepresentationTests,
         S3ReusableFieldTests,
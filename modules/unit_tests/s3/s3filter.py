@@ -128,11 +128,148 @@ class S3FilterWidgetTests(unittest.TestCase):
         self.assertTrue("2" in values)
         self.assertTrue("3" in values)
 
+# =============================================================================
+class S3FilterFacetsTests(unittest.TestCase):
+    """ Tests for filter options lookup with S3FilterFacets """
+
+    def setUp(self):
+
+        current.auth.override = True
+
+        settings = current.deployment_settings
+        self.facets = settings.search.get("facets")
+
+    def tearDown(self):
+
+        settings = current.deployment_settings
+        if self.facets is None:
+            settings.search.pop("facets", None)
+        else:
+            settings.search.facets = self.facets
+
+        current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    def testOptions(self):
+        """ Test that facets produce the same options as separate lookups """
+
+        settings = current.deployment_settings
+        s3db = current.s3db
+
+        def options(facets):
+            settings.search.facets = facets
+            widgets = [S3OptionsFilter("organisation_id"),
+                       S3LocationFilter("location_id"),
+                       ]
+            resource = s3db.resource("org_office")
+            S3FilterForm(widgets).facets(resource)
+            if facets:
+                self.assertNotEqual(widgets[0].facet, None)
+                self.assertNotEqual(widgets[1].facet, None)
+            else:
+                self.assertEqual(widgets[0].facet, None)
+                self.assertEqual(widgets[1].facet, None)
+            return (widgets[0]._options(resource),
+                    widgets[1]._options(resource, inject_hierarchy=False),
+                    )
+
+        self.assertEqual(options(True), options(False))
+
+    # -------------------------------------------------------------------------
+    def testNotApplicable(self):
+        """ Test that facets are not used for multi-valued fields """
+
+        settings = current.deployment_settings
+        settings.search.facets = True
+
+        widget = S3OptionsFilter("office.organisation_id")
+        resource = current.s3db.resource("org_organisation")
+        S3FilterForm([widget]).facets(resource)
+        self.assertEqual(widget.facet, None)
+
+# =============================================================================
+class S3FilterFacetCacheTests(unittest.TestCase):
+    """ Tests for the shared filter options cache """
+
+    def testGetSet(self):
+        """ Test storing and retrieving filter options """
+
+        cache = S3FilterFacetCache(size=10)
+        version = cache.version(["org_office"])
+
+        self.assertEqual(cache.get("key", version), None)
+        cache.set("key", version, {"a": 1})
+        self.assertEqual(cache.get("key", version), {"a": 1})
+
+    def testInvalidate(self):
+        """ Test invalidation of filter options upon write """
+
+        cache = S3FilterFacetCache(size=10)
+        instance = S3FilterFacetCache.instance
+        S3FilterFacetCache.instance = cache
+        try:
+            version = cache.version(["org_office", "org_organisation"])
+            cache.set("key", version, {"a": 1})
+
+            S3FilterFacetCache.invalidate("pr_person")
+            self.assertEqual(cache.version(["org_office", "org_organisation"]),
+                             version)
+
+            S3FilterFacetCache.invalidate("org_organisation")
+            version = cache.version(["org_office", "org_organisation"])
+            self.assertEqual(cache.get("key", version), None)
+        finally:
+            S3FilterFacetCache.instance = instance
+
+    def testInvalidateOnWrite(self):
+        """ Test invalidation of filter options when a table gets written to """
+
+        settings = current.deployment_settings
+        cache_size = settings.search.get("facet_cache_size")
+
+        instance = S3FilterFacetCache.instance
+        S3FilterFacetCache.instance = None
+        settings.search.facet_cache_size = 10
+        try:
+            cache = S3FilterFacetCache.shared()
+            self.assertNotEqual(cache, None)
+
+            version = cache.version(["org_organisation"])
+            current.s3db.org_organisation.insert(name="Facet Cache Test")
+            self.assertNotEqual(cache.version(["org_organisation"]), version)
+        finally:
+            current.db.rollback()
+            S3FilterFacetCache.instance = instance
+            if cache_size is None:
+                settings.search.pop("facet_cache_size", None)
+            else:
+                settings.search.facet_cache_size = cache_size
+
+    def testLimits(self):
+        """ Test eviction of least recently used and expired entries """
+
+        cache = S3FilterFacetCache(size=2)
+        version = cache.version([])
+
+        cache.set("a", version, 1)
+        cache.set("b", version, 2)
+        self.assertEqual(cache.get("a", version), 1)
+        cache.set("c", version, 3)
+        self.assertEqual(cache.get("b", version), None)
+        self.assertEqual(cache.get("a", version), 1)
+        self.assertEqual(cache.get("c", version), 3)
+
+        cache = S3FilterFacetCache(size=2, ttl=-1)
+        cache.set("a", version, 1)
+        self.assertEqual(cache.get("a", version), None)
+
 # =============================================================================
 if __name__ == "__main__":
 
     run_suite(
         S3FilterWidgetTests,
+        S3FilterFacetsTests,
+        S3FilterFacetCacheTests,
     )
 
 # END ========================================================================
@@ -10,6 +10,7 @@ import datetime
 from gluon import *
 from gluon.storage import Storage
 from s3 import *
+from s3.s3codecs.mvt import S3VectorTile
 
 from unit_tests import run_suite
 
@@ -308,6 +309,117 @@ class S3LocationTreeTests(unittest.TestCase):
         # Did we get the recursion error?
         self.assertNotIn("too much recursion", log_messages)
 
+    # -------------------------------------------------------------------------
+    def testULT5_update_location_tree_bulk(self):
+        """ Test bulk update of the location tree, and resuming with a level """
+
+        from s3.s3gis import GIS
+
+        table = self.table
+        db = current.db
+
+        # Insert a country
+        L0_lat = 20.0
+        L0_lon = -20.0
+        L0_id = table.insert(level = "L0",
+                             name = "s3gis.testULT5.L0",
+                             lat = L0_lat,
+                             lon = L0_lon,
+                             )
+        # Insert a child location
+        L1_id = table.insert(level = "L1",
+                             name = "s3gis.testULT5.L1",
+                             parent = L0_id,
+                             )
+        # And a child of that child
+        L2_id = table.insert(level = "L2",
+                             name = "s3gis.testULT5.L2",
+                             parent = L1_id,
+                             )
+
+        reported = []
+        def progress(level, done, total):
+            reported.append(level)
+
+        results = GIS.update_location_tree_bulk(progress = progress,
+                                                commit = False,
+                                                )
+        self.assertTrue(results["L2"] >= 1)
+        self.assertTrue("L0" in reported)
+        self.assertTrue(None in reported)
+
+        L2_record = db(table.id == L2_id).select(*self.fields,
+                                                 limitby=(0, 1)
+                                                 ).first()
+        self.assertEqual(L2_record.inherited, True)
+        self.assertEqual(L2_record.path, "%s/%s/%s" % (L0_id, L1_id, L2_id))
+        self.assertEqual(L2_record.L0, "s3gis.testULT5.L0")
+        self.assertEqual(L2_record.L1, "s3gis.testULT5.L1")
+        self.assertEqual(L2_record.L2, "s3gis.testULT5.L2")
+        self.assertEqual(L2_record.lat, L0_lat)
+        self.assertEqual(L2_record.lon, L0_lon)
+
+        # Run again => nothing to update
+        results = GIS.update_location_tree_bulk(progress = progress,
+                                                commit = False,
+                                                )
+        self.assertEqual(results["L2"], 0)
+
+        # Break the L2, then resume with L2
+        db(table.id == L2_id).update(path = None, L1 = None)
+        reported = []
+        results = GIS.update_location_tree_bulk(start = "L2",
+                                                progress = progress,
+                                                commit = False,
+                                                )
+        self.assertFalse("L0" in reported)
+        self.assertFalse("L1" in results)
+        self.assertTrue(results["L2"] >= 1)
+
+        L2_record = db(table.id == L2_id).select(*self.fields,
+                                                 limitby=(0, 1)
+                                                 ).first()
+        self.assertEqual(L2_record.path, "%s/%s/%s" % (L0_id, L1_id, L2_id))
+        self.assertEqual(L2_record.L1, "s3gis.testULT5.L1")
+
+    # -------------------------------------------------------------------------
+    def testULT6_update_location_tree_bulk_invalid_geometry(self):
+        """ Test that bulk update continues with the descendants of locations with invalid geometry """
+
+        from s3.s3gis import GIS
+
+        table = self.table
+        db = current.db
+
+        # Insert a country with an incomplete Lat/Lon
+        L0_id = table.insert(level = "L0",
+                             name = "s3gis.testULT6.L0",
+                             lat = 20.0,
+                             )
+        # Insert a child location
+        L1_id = table.insert(level = "L1",
+                             name = "s3gis.testULT6.L1",
+                             parent = L0_id,
+                             )
+
+        GIS.update_location_tree_bulk(progress = lambda *args: None,
+                                      commit = False,
+                                      )
+
+        L0_record = db(table.id == L0_id).select(*self.fields,
+                                                 limitby=(0, 1)
+                                                 ).first()
+        self.assertEqual(L0_record.path, str(L0_id))
+        self.assertEqual(L0_record.lat, 20.0)
+        self.assertEqual(L0_record.lon, None)
+
+        L1_record = db(table.id == L1_id).select(*self.fields,
+                                                 limitby=(0, 1)
+                                                 ).first()
+        self.assertEqual(L1_record.path, "%s/%s" % (L0_id, L1_id))
+        self.assertEqual(L1_record.L0, "s3gis.testULT6.L0")
+        self.assertEqual(L1_record.L1, "s3gis.testULT6.L1")
+
     # -------------------------------------------------------------------------
     def testULT4_get_parents(self):
         """ Test get_parents in a case that causes it to call update_location_tree. """
@@ -773,11 +885,244 @@ class S3LocationTreeTests(unittest.TestCase):
         current.auth.override = False
         current.db.rollback()
 
+# =============================================================================
+class S3SpatialIndexTests(unittest.TestCase):
+    """ Tests for the in-process spatial index """
+
+    # -------------------------------------------------------------------------
+    def testGridIndex(self):
+        """ Test insert, update, remove and intersection with the grid index """
+
+        assertEqual = self.assertEqual
+
+        index = S3SpatialIndex()
+
+        # Force grid index
+        index.rtree = None
+        index.cells = {}
+        index.large = set()
+
+        # Points, a small polygon and a large polygon
+        index.insert(1, (10.5, 20.5, 10.5, 20.5))
+        index.insert(2, (-3.2, 51.1, -3.2, 51.1))
+        index.insert(3, (10.0, 20.0, 12.0, 22.0))
+        index.insert(4, (-20.0, -30.0, 40.0, 60.0))
+        assertEqual(index.large, set([4]))
+
+        ids = index.intersection(10.4, 20.4, 10.6, 20.6)
+        assertEqual(ids, set([1, 3, 4]))
+
+        ids = index.intersection(-4, 51, -3, 52)
+        assertEqual(ids, set([2, 4]))
+
+        ids = index.intersection(100, 10, 120, 20)
+        assertEqual(ids, set())
+
+        # Whole world
+        ids = index.intersection(-180, -90, 180, 90)
+        assertEqual(ids, set([1, 2, 3, 4]))
+
+        # Move an entry
+        index.insert(1, (100.5, 15.0, 100.5, 15.0))
+        ids = index.intersection(10.4, 20.4, 10.6, 20.6)
+        assertEqual(ids, set([3, 4]))
+        ids = index.intersection(100, 10, 120, 20)
+        assertEqual(ids, set([1]))
+
+        # Remove entries
+        index.remove(3)
+        index.remove(4)
+        ids = index.intersection(10.4, 20.4, 10.6, 20.6)
+        assertEqual(ids, set())
+        assertEqual(index.large, set())
+        assertEqual(set(index.bounds.keys()), set([1, 2]))
+
+        # Invalid bbox
+        ids = index.intersection(120, 20, 100, 10)
+        assertEqual(ids, set())
+
+# =============================================================================
+class S3VectorTileTests(unittest.TestCase):
+    """ Tests for the Mapbox Vector Tile encoder """
+
+    # -------------------------------------------------------------------------
+    def testTileGrid(self):
+        """ Test conversion between WGS84 and tile grid coordinates """
+
+        assertEqual = self.assertEqual
+        assertAlmostEqual = self.assertAlmostEqual
+
+        tile = S3VectorTile(2, 2, 1)
+
+        lon_min, lat_min, lon_max, lat_max = tile.lonlat_bounds(buffer=False)
+        assertAlmostEqual(lon_min, 0.0)
+        assertAlmostEqual(lat_min, 0.0)
+        assertAlmostEqual(lon_max, 90.0)
+        assertAlmostEqual(lat_max, 66.5132604, places=6)
+
+        # Buffer included
+        lon_min, lat_min, lon_max, lat_max = tile.lonlat_bounds()
+        assertAlmostEqual(lon_min, -90.0 * tile.BUFFER / tile.EXTENT)
+        assertAlmostEqual(lon_max, 90.0 + 90.0 * tile.BUFFER / tile.EXTENT)
+
+        x, y = tile.to_grid(45.0, 0.0)
+        assertAlmostEqual(x, 2048.0)
+        assertAlmostEqual(y, 4096.0)
+
+        # Invalid tile coordinates
+        with self.assertRaises(ValueError):
+            S3VectorTile(2, 4, 1)
+        with self.assertRaises(ValueError):
+            S3VectorTile(0, 0, -1)
+
+    # -------------------------------------------------------------------------
+    def testEncodeGeometry(self):
+        """ Test encoding of geometries (examples from the MVT spec) """
+
+        assertEqual = self.assertEqual
+        encode = S3VectorTile.encode_geometry
+
+        geom_type, commands = encode({"type": "Point",
+                                      "coordinates": (25, 17),
+                                      })
+        assertEqual(geom_type, 1)
+        assertEqual(commands, [9, 50, 34])
+
+        geom_type, commands = encode({"type": "MultiPoint",
+                                      "coordinates": [(5, 7), (3, 2)],
+                                      })
+        assertEqual(geom_type, 1)
+        assertEqual(commands, [17, 10, 14, 3, 9])
+
+        # Coordinates are quantised, repeated points dropped
+        geom_type, commands = encode({"type": "LineString",
+                                      "coordinates": [(2, 2),
+                                                      (2.2, 1.9),
+                                                      (2, 10),
+                                                      (10, 10),
+                                                      ],
+                                      })
+        assertEqual(geom_type, 2)
+        assertEqual(commands, [9, 4, 4, 18, 0, 16, 16, 0])
+
+        # Exterior ring with wrong winding order is reversed
+        polygon = [(3, 6), (8, 12), (20, 34), (3, 6)]
+        for ring in (polygon, list(reversed(polygon))):
+            geom_type, commands = encode({"type": "Polygon",
+                                          "coordinates": [ring],
+                                          })
+            assertEqual(geom_type, 3)
+            if ring is polygon:
+                assertEqual(commands, [9, 6, 12, 18, 10, 12, 24, 44, 15])
+            else:
+                assertEqual(len(commands), 9)
+                assertEqual(commands[-1], 15)
+
+        # Polygons which collapse on the grid are dropped
+        geom_type, commands = encode({"type": "Polygon",
+                                      "coordinates": [[(0, 0),
+                                                       (0.1, 0.1),
+                                                       (0.2, 0),
+                                                       (0, 0),
+                                                       ]],
+                                      })
+        assertEqual(commands, [])
+
+    # -------------------------------------------------------------------------
+    def testEncodeTile(self):
+        """ Test encoding of a tile """
+
+        assertEqual = self.assertEqual
+
+        tile = S3VectorTile(0, 0, 0)
+        success = tile.add("test",
+                           1,
+                           {"type": "Point", "coordinates": (25, 17)},
+                           {"name": "A"},
+                           )
+        assertEqual(success, True)
+        success = tile.add("test",
+                           2,
+                           {"type": "Point", "coordinates": (1, 1)},
+                           {"name": "A", "value": 3},
+                           )
+        assertEqual(success, True)
+
+        # Keys and values are shared between features
+        layer = tile.layers["test"]
+        assertEqual(len(layer.features), 2)
+        assertEqual(sorted(layer.key_index.keys()), ["name", "value"])
+        assertEqual(len(layer.value_index), 2)
+
+        output = tile.encode()
+        # Tile.layers (field 3, length-delimited)
+        assertEqual(output[0], "\x1a")
+        # Layer.version = 2
+        assertEqual(output[2:4], "\x78\x02")
+
+    # -------------------------------------------------------------------------
+    def testFeatureLimit(self):
+        """ Test the limit for the number of features per tile """
+
+        assertEqual = self.assertEqual
+
+        db = current.db
+        s3db = current.s3db
+        settings = current.deployment_settings
+
+        current.auth.override = True
+
+        # Use the Python encoder (the_geom is not set by table.insert)
+        gis = settings.gis
+        spatialdb = gis.get("spatialdb")
+        gis.spatialdb = False
+
+        try:
+            table = s3db.gis_location
+            location_ids = []
+            for i in range(3):
+                lat, lon = 10.0 + i, 20.0 + i
+                location_ids.append(table.insert(name = "MVT Test %s" % i,
+                                                 gis_feature_type = 1,
+                                                 lat = lat,
+                                                 lon = lon,
+                                                 lat_min = lat,
+                                                 lat_max = lat,
+                                                 lon_min = lon,
+                                                 lon_max = lon,
+                                                 ))
+            resource = s3db.resource("gis_location", id=location_ids)
+
+            tile = S3VectorTile(0, 0, 0)
+            features = tile.features(resource)
+            assertEqual(set(f[0] for f in features), set(location_ids))
+
+            features = tile.features(resource, limit=3)
+            assertEqual(len(features), 3)
+
+            # More features than the limit => first features in ID order
+            features = tile.features(resource, limit=2)
+            assertEqual([f[0] for f in features], sorted(location_ids)[:2])
+
+            # Features outside of the tile are not counted
+            tile = S3VectorTile(2, 0, 0)
+            features = tile.features(resource, limit=2)
+            assertEqual(features, [])
+        finally:
+            if spatialdb is None:
+                gis.pop("spatialdb", None)
+            else:
+                gis.spatialdb = spatialdb
+            current.auth.override = False
+            db.rollback()
+
 # =============================================================================
 if __name__ == "__main__":
 
     run_suite(
         S3LocationTreeTests,
+        S3SpatialIndexTests,
+        S3VectorTileTests,
     )
 
 # END ========================================================================
@@ -376,6 +376,180 @@ class S3HierarchyTests(unittest.TestCase):
             # Cleanup
             db(table.uuid.like("HIERARCHY1-4%")).delete()
 
+    # -------------------------------------------------------------------------
+    def testStoredHierarchy(self):
+        """ Test storing and re-loading of the hierarchy """
+
+        assertEqual = self.assertEqual
+        assertTrue = self.assertTrue
+
+        db = current.db
+        hierarchies = current.model.hierarchies
+        snapshots = S3Hierarchy.snapshots
+
+        # Rebuild from the target table
+        h = S3Hierarchy("test_hierarchy")
+        h.dirty("test_hierarchy")
+        expected = dict((node_id, (node["p"], node["c"]))
+                        for node_id, node in h.theset.items())
+        assertEqual(len(expected), len(self.uids))
+
+        # Reading does not store the hierarchy
+        htable = current.s3db.s3_hierarchy
+        row = db(htable.tablename == "test_hierarchy").select(
+                                            htable.dirty,
+                                            limitby = (0, 1),
+                                            ).first()
+        assertTrue(row.dirty)
+        h.save()
+
+        # Verify the stored nodes
+        ntable = current.s3db.s3_hierarchy_node
+        query = (ntable.tablename == "test_hierarchy") & \
+                (ntable.deleted != True)
+        rows = db(query).select(ntable.node_id,
+                                ntable.parent_id,
+                                ntable.category,
+                                )
+        stored = dict((row.node_id, (row.parent_id, row.category))
+                      for row in rows)
+        assertEqual(stored, expected)
+
+        # Re-load from the stored nodes
+        hierarchies.pop("test_hierarchy", None)
+        snapshots.pop("test_hierarchy", None)
+        h = S3Hierarchy("test_hierarchy")
+        loaded = dict((node_id, (node["p"], node["c"]))
+                      for node_id, node in h.theset.items())
+        assertEqual(loaded, expected)
+        assertTrue("test_hierarchy" in snapshots)
+
+        # Re-load from the snapshot
+        hierarchies.pop("test_hierarchy", None)
+        h = S3Hierarchy("test_hierarchy")
+        theset = h.theset
+        nodes = snapshots["test_hierarchy"][1]
+        assertTrue(all(theset[node_id] is nodes[node_id]
+                       for node_id in expected))
+
+        # Changes must not affect the snapshot
+        node_id = self.uids["HIERARCHY1-1"]
+        h.move(node_id, parent_id=self.uids["HIERARCHY2"])
+        assertEqual(nodes[node_id]["p"], self.uids["HIERARCHY1"])
+        assertTrue(node_id in nodes[self.uids["HIERARCHY1"]]["s"])
+        assertTrue(node_id not in nodes[self.uids["HIERARCHY2"]]["s"])
+
+        # Discard the change
+        hierarchies.pop("test_hierarchy", None)
+
+    # -------------------------------------------------------------------------
+    def testFullReload(self):
+        """ Test that a full save invalidates older snapshots """
+
+        assertEqual = self.assertEqual
+        assertTrue = self.assertTrue
+        assertFalse = self.assertFalse
+
+        hierarchies = current.model.hierarchies
+        snapshots = S3Hierarchy.snapshots
+
+        # Store the hierarchy, and load it into the snapshot
+        h = S3Hierarchy("test_hierarchy")
+        h.dirty("test_hierarchy")
+        h.save()
+        hierarchies.pop("test_hierarchy", None)
+        snapshots.pop("test_hierarchy", None)
+        h = S3Hierarchy("test_hierarchy")
+        node_id = self.uids["HIERARCHY1-1"]
+        assertTrue(node_id in h.theset)
+        version = snapshots["test_hierarchy"][0]
+
+        try:
+            # Replace the stored nodes without the node (as another
+            # process would), retaining the older snapshot
+            hierarchies.pop("test_hierarchy", None)
+            h = S3Hierarchy("test_hierarchy")
+            h.theset
+            h.read()
+            h.remove(node_id)
+            h.save()
+            assertEqual(snapshots["test_hierarchy"][0], version)
+
+            # Loading must not apply the changes to the older snapshot
+            hierarchies.pop("test_hierarchy", None)
+            h = S3Hierarchy("test_hierarchy")
+            assertFalse(node_id in h.theset)
+            assertTrue(snapshots["test_hierarchy"][0] > version)
+            assertFalse(node_id in snapshots["test_hierarchy"][1])
+        finally:
+            # Restore the hierarchy
+            hierarchies.pop("test_hierarchy", None)
+            S3Hierarchy.dirty("test_hierarchy")
+
+    # -------------------------------------------------------------------------
+    def testIncrementalUpdate(self):
+        """ Test incremental update of the stored hierarchy upon write """
+
+        assertEqual = self.assertEqual
+        assertTrue = self.assertTrue
+        assertFalse = self.assertFalse
+
+        uids = self.uids
+
+        db = current.db
+        table = db.test_hierarchy
+
+        # Rebuild from the target table
+        h = S3Hierarchy("test_hierarchy")
+        h.dirty("test_hierarchy")
+        h.theset
+
+        try:
+            # Add a node
+            parent_id = uids["HIERARCHY1-1"]
+            node_id = table.insert(uuid = "HIERARCHY1-1-3",
+                                   name = "Type 1-1-3",
+                                   category = "Cat 2",
+                                   parent = parent_id,
+                                   )
+            h = S3Hierarchy("test_hierarchy")
+            assertTrue(node_id in h.children(parent_id))
+            assertEqual(h.category(node_id), "Cat 2")
+
+            # Move the node
+            new_parent_id = uids["HIERARCHY2-1"]
+            db(table.id == node_id).update(parent = new_parent_id)
+            h = S3Hierarchy("test_hierarchy")
+            assertFalse(node_id in h.children(parent_id))
+            assertTrue(node_id in h.children(new_parent_id))
+            assertEqual(h.path(node_id),
+                        [uids["HIERARCHY2"], new_parent_id, node_id])
+
+            # Remove the node
+            db(table.id == node_id).update(deleted = True)
+            h = S3Hierarchy("test_hierarchy")
+            assertFalse(node_id in h.children(new_parent_id))
+            assertEqual(h.parent(node_id), None)
+
+            # Verify that the stored hierarchy has been updated, too
+            htable = current.s3db.s3_hierarchy
+            row = db(htable.tablename == "test_hierarchy").select(
+                                                htable.dirty,
+                                                limitby = (0, 1),
+                                                ).first()
+            assertFalse(row.dirty)
+
+            ntable = current.s3db.s3_hierarchy_node
+            query = (ntable.tablename == "test_hierarchy") & \
+                    (ntable.node_id == node_id)
+            row = db(query).select(ntable.deleted,
+                                   limitby = (0, 1),
+                                   ).first()
+            assertTrue(row.deleted)
+        finally:
+            # Cleanup
+            db(table.uuid == "HIERARCHY1-1-3").delete()
+
     # -------------------------------------------------------------------------
     def testCategory(self):
         """ Test node category lookup """
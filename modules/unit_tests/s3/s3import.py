@@ -7,12 +7,13 @@
 #
 import datetime
 import json
+import os
 import unittest
 
 from gluon import *
 from gluon.storage import Storage
 
-from s3 import S3Duplicate, S3ImportItem, S3ImportJob, s3_meta_fields
+from s3 import S3BulkImporter, S3Duplicate, S3ImportItem, S3ImportJob, s3_meta_fields
 
 from unit_tests import run_suite
 
@@ -536,6 +537,60 @@ class DuplicateDetectionTests(unittest.TestCase):
         assertEqual(item.id, None)
         assertEqual(item.method, item.METHOD.CREATE)
 
+    # -------------------------------------------------------------------------
+    def testBulkMatch(self):
+        """ Test match with prefetched duplicates """
+
+        assertEqual = self.assertEqual
+
+        deduplicate = S3Duplicate(primary=("name",),
+                                  secondary=("secondary",),
+                                  )
+
+        ids = self.ids
+        table = current.db.dedup_test
+
+        samples = ((Storage(name="Test0"), ids["TEST0"]),
+                   (Storage(name="Test2", secondary="secondaryX"), ids["TEST2"]),
+                   (Storage(name="test4", secondary="secondaryX"), None),
+                   (Storage(name="Test"), None),
+                   )
+        items = []
+        for data, record_id in samples:
+            item = S3ImportItem(self.job)
+            item.table = table
+            item.tablename = table._tablename
+            item.method = item.METHOD.CREATE
+            item.data = data
+            items.append(item)
+
+        index = deduplicate.prefetch(items)
+        self.assertNotEqual(index, None)
+        self.job.duplicates[table._tablename] = index
+
+        # All items are indexed
+        for item in items:
+            indexed, record_id = index.lookup(item.data)
+            self.assertTrue(indexed)
+
+        # Same results as with per-item queries
+        for item, (data, record_id) in zip(items, samples):
+            deduplicate(item)
+            assertEqual(item.id, record_id)
+            if record_id:
+                assertEqual(item.method, item.METHOD.UPDATE)
+            else:
+                assertEqual(item.method, item.METHOD.CREATE)
+
+        # Records created by the job are matched too
+        item = items[-1]
+        item.id = ids["TEST1"] + 1000
+        item.committed = True
+        index.update(item)
+        indexed, record_id = index.lookup(Storage(name="TEST"))
+        self.assertTrue(indexed)
+        assertEqual(record_id, item.id)
+
     # -------------------------------------------------------------------------
     def testExceptions(self):
         """ Test S3Duplicate exceptions for nonexistent fields """
@@ -571,6 +626,145 @@ class DuplicateDetectionTests(unittest.TestCase):
         with assertRaises(TypeError):
             deduplicate = S3Duplicate(secondary=17)
 
+# =============================================================================
+class BulkCommitTests(unittest.TestCase):
+    """ Test cases for bulk commit of import jobs """
+
+    def setUp(self):
+
+        current.auth.override = True
+
+        settings = current.deployment_settings
+        self.chunksize = settings.get_base_import_commit_chunksize()
+        settings.base.import_commit_chunksize = 2
+
+    def tearDown(self):
+
+        current.deployment_settings.base.import_commit_chunksize = self.chunksize
+
+        current.auth.override = False
+        current.db.rollback()
+
+    # -------------------------------------------------------------------------
+    def testBulkCommit(self):
+        """ Test bulk commit with duplicates within the import """
+
+        assertEqual = self.assertEqual
+
+        xmlstr = """
+<s3xml>
+    <resource name="org_region">
+        <data field="name">BulkTestRegion1</data>
+    </resource>
+    <resource name="org_region">
+        <data field="name">BulkTestRegion1</data>
+        <data field="comments">Updated</data>
+    </resource>
+    <resource name="org_region">
+        <data field="name">BulkTestRegion2</data>
+    </resource>
+    <resource name="org_region">
+        <data field="name">BulkTestRegion3</data>
+    </resource>
+</s3xml>"""
+
+        from lxml import etree
+        tree = etree.ElementTree(etree.fromstring(xmlstr))
+
+        resource = current.s3db.resource("org_region")
+        resource.import_xml(tree)
+        assertEqual(resource.error, None)
+        assertEqual(resource.import_count, 4)
+        assertEqual(len(resource.import_created), 3)
+        assertEqual(len(resource.import_updated), 1)
+
+        # Check the records
+        db = current.db
+        table = resource.table
+        query = (table.name.like("BulkTestRegion%")) & \
+                (table.deleted != True)
+        rows = db(query).select(table.id,
+                                table.name,
+                                table.comments,
+                                orderby = table.id,
+                                )
+        assertEqual([row.name for row in rows],
+                    ["BulkTestRegion1", "BulkTestRegion2", "BulkTestRegion3"])
+        assertEqual(rows[0].comments, "Updated")
+
+# =============================================================================
+class BulkImporterTests(unittest.TestCase):
+    """ Test cases for S3BulkImporter task scheduling """
+
+    def setUp(self):
+
+        import tempfile
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+
+        import shutil
+        shutil.rmtree(self.folder)
+
+    def write(self, filename, text):
+
+        path = os.path.join(self.folder, filename)
+        with open(path, "w") as stylesheet:
+            stylesheet.write(text)
+        return path
+
+    # -------------------------------------------------------------------------
+    def testStylesheetResources(self):
+        """ Test detection of the tables written and read by a task """
+
+        assertEqual = self.assertEqual
+        assertTrue = self.assertTrue
+
+        self.write("commons.xsl", """<xsl:stylesheet>
+    <xsl:template name="Location"><resource name="gis_location"/></xsl:template>
+</xsl:stylesheet>""")
+        path = self.write("office.xsl", """<xsl:stylesheet>
+    <xsl:include href="commons.xsl"/>
+    <xsl:template match="row">
+        <resource name="org_office">
+            <reference field="organisation_id" resource="org_organisation"/>
+        </resource>
+        <resource name="org_organisation"/>
+    </xsl:template>
+</xsl:stylesheet>""")
+
+        resources = S3BulkImporter.stylesheet_resources(path)
+        assertEqual(resources, set(["org_office",
+                                    "org_organisation",
+                                    "gis_location",
+                                    ]))
+
+        references = S3BulkImporter.stylesheet_references(path)
+        assertEqual(references, set(["org_organisation"]))
+
+        # Tables written by onaccept are included in the writes
+        importer = S3BulkImporter()
+        task = [1, "org", "office", "office.csv", path, None]
+        writes, reads = importer.task_tables(task)
+        assertTrue(set(["org_office",
+                        "org_organisation",
+                        "gis_location",
+                        "org_site",
+                        "pr_pentity",
+                        "pr_affiliation",
+                        ]).issubset(writes))
+        assertEqual(reads, set(["org_organisation"]))
+
+        # Dynamic resource names can not be determined
+        path = self.write("dynamic.xsl", """<xsl:stylesheet>
+    <resource name="{$resource}"/>
+</xsl:stylesheet>""")
+        assertEqual(S3BulkImporter.stylesheet_resources(path), None)
+
+        # Special tasks depend on all other tasks
+        assertEqual(importer.task_tables((2, "import_role", "auth_roles.csv", None)),
+                    None)
+
 # =============================================================================
 class MtimeImportTests(unittest.TestCase):
 
@@ -636,6 +830,8 @@ if __name__ == "__main__":
         PostParseTests,
         FailedReferenceTests,
         DuplicateDetectionTests,
+        BulkCommitTests,
+        BulkImporterTests,
         MtimeImportTests,
     )
 
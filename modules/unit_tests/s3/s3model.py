@@ -12,8 +12,8 @@ from gluon import current, IS_EMPTY_OR, IS_FLOAT_IN_RANGE, IS_INT_IN_RANGE, IS_I
 from gluon.languages import lazyT
 from gluon.storage import Storage
 
-from s3.s3fields import s3_meta_fields
-from s3.s3model import DYNAMIC_PREFIX, S3DynamicModel
+from s3.s3fields import s3_all_meta_field_names, s3_meta_fields
+from s3.s3model import DYNAMIC_PREFIX, S3DynamicModel, S3Model
 from s3.s3validators import IS_NOT_ONE_OF, IS_ONE_OF, IS_UTC_DATE, IS_UTC_DATETIME
 
 from unit_tests import run_suite
@@ -21,7 +21,49 @@ from unit_tests import run_suite
 # =============================================================================
 class S3ModelTests(unittest.TestCase):
 
-    pass
+    # -------------------------------------------------------------------------
+    def testIndex(self):
+        """ Test the per-process index of model names """
+
+        assertEqual = self.assertEqual
+
+        index = S3Model.index()
+        if index is None:
+            # Not used in debug mode
+            return
+
+        # Index is built only once
+        self.assertTrue(S3Model.index() is index)
+
+        # Names map to the model classes defining them
+        models = current.models
+        for name in ("org_organisation", "pr_person", "org_organisation_id"):
+            classname = index.get(name)
+            self.assertNotEqual(classname, None)
+            prefix = name.split("_", 1)[0]
+            model = models.__dict__[prefix].__dict__[classname]
+            self.assertTrue(name in model.names)
+
+        # Other objects are not indexed
+        assertEqual(index.get("S3OrganisationModel"), None)
+
+        # Tables load with the index
+        table = S3Model.table("org_organisation")
+        assertEqual(table._tablename, "org_organisation")
+
+    # -------------------------------------------------------------------------
+    def testMetaFieldNames(self):
+        """ Test the per-process meta-field names """
+
+        assertEqual = self.assertEqual
+
+        expected = [field.name for field in s3_meta_fields()]
+        names = s3_all_meta_field_names()
+        assertEqual(names, expected)
+
+        # Callers can modify the returned list
+        names.append("id")
+        assertEqual(s3_all_meta_field_names(), expected)
 
 # =============================================================================
 class S3SuperEntityTests(unittest.TestCase):
@@ -1091,7 +1133,7 @@ class S3DynamicComponentTests(unittest.TestCase):
 if __name__ == "__main__":
 
     run_suite(
-        #S3ModelTests,
+        S3ModelTests,
         S3SuperEntityTests,
         S3DynamicModelTests,
         S3DynamicComponentTests,
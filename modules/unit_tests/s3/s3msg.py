@@ -369,11 +369,105 @@ class S3OutboxTests(unittest.TestCase):
         else:
             return False
 
+# =============================================================================
+class S3SMTPPoolTests(unittest.TestCase):
+    """ Tests for SMTP connection re-use """
+
+    def setUp(self):
+
+        import smtplib
+
+        connections = self.connections = []
+
+        class DummySMTP(object):
+            """ Dummy SMTP connection """
+
+            def __init__(self, host, port):
+                self.calls = []
+                connections.append(self)
+            def ehlo(self, *args):
+                self.calls.append("ehlo")
+            def login(self, *args):
+                self.calls.append("login")
+            def sendmail(self, *args):
+                self.calls.append("sendmail")
+            def quit(self):
+                self.calls.append("quit")
+
+        self.classes = smtplib.SMTP, smtplib.SMTP_SSL
+        smtplib.SMTP = DummySMTP
+
+    def tearDown(self):
+
+        import smtplib
+
+        smtplib.SMTP, smtplib.SMTP_SSL = self.classes
+
+    # -------------------------------------------------------------------------
+    def testConnectionReuse(self):
+        """ Test that connections are set up once and re-used """
+
+        import smtplib
+
+        from s3.s3msg import S3SMTPPool
+
+        def send():
+            # Same sequence as gluon.tools.Mail
+            server = smtplib.SMTP("localhost", 25)
+            server.ehlo()
+            server.login("user", "password")
+            server.sendmail("sender", ["recipient"], "message")
+            server.quit()
+
+        with S3SMTPPool(max_messages=2):
+            for i in range(3):
+                send()
+
+        connections = self.connections
+        self.assertEqual(len(connections), 2)
+        self.assertEqual(connections[0].calls,
+                         ["ehlo", "login", "sendmail", "sendmail", "quit"])
+        self.assertEqual(connections[1].calls,
+                         ["ehlo", "login", "sendmail", "quit"])
+
+        # Original class restored
+        send()
+        self.assertEqual(len(connections), 3)
+
+    # -------------------------------------------------------------------------
+    def testNoNestedActivation(self):
+        """ Test that inactive or nested pools leave smtplib unchanged """
+
+        import smtplib
+
+        from s3.s3msg import S3SMTPPool
+
+        assertTrue = self.assertTrue
+        assertFalse = self.assertFalse
+
+        SMTP = smtplib.SMTP
+
+        # Inactive pool
+        with S3SMTPPool(active=False):
+            assertTrue(smtplib.SMTP is SMTP)
+        assertFalse(S3SMTPPool.active)
+
+        # Nested pool must not capture the patched classes
+        with S3SMTPPool():
+            patched = smtplib.SMTP
+            assertFalse(patched is SMTP)
+            with S3SMTPPool():
+                assertTrue(smtplib.SMTP is patched)
+            assertTrue(smtplib.SMTP is patched)
+        assertTrue(smtplib.SMTP is SMTP)
+        assertFalse(S3SMTPPool.active)
+
 # =============================================================================
 if __name__ == "__main__":
 
     run_suite(
         S3OutboxTests,
+        S3SMTPPoolTests,
     )
 
 # END ========================================================================
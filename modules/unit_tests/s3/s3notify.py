@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+#
+# Notifications Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3notify.py
+#
+import datetime
+import unittest
+
+from gluon import *
+from s3.s3notify import S3Notifications
+
+from unit_tests import run_suite
+
+# =============================================================================
+class NotifySharedTests(unittest.TestCase):
+    """ Tests for notifications with shared lookup queries """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        db = current.db
+        s3db = current.s3db
+
+        current.auth.override = True
+
+        # Backup the original methods
+        self.lookup = S3Notifications.__dict__["_lookup"]
+        self.compose = S3Notifications.__dict__["_compose"]
+        self.deliver = S3Notifications.__dict__["_deliver"]
+
+        # Record lookups, renders and deliveries
+        lookups = self.lookups = []
+        composed = self.composed = []
+        delivered = self.delivered = []
+
+        lookup = self.lookup.__func__
+        def _lookup(tablename, url, filter_query, timestamp, since):
+            if since is not None:
+                # Not just constructing the resource (see _tables)
+                lookups.append((tablename, url, filter_query))
+            return lookup(tablename, url, filter_query, timestamp, since)
+        S3Notifications._lookup = staticmethod(_lookup)
+
+        compose = self.compose.__func__
+        def _compose(cls, resource, data, subscription):
+            message = compose(cls, resource, data, subscription)
+            composed.append(message)
+            return message
+        S3Notifications._compose = classmethod(_compose)
+
+        def _deliver(pe_id, methods, message):
+            delivered.append((pe_id, message))
+            return True, "Success"
+        S3Notifications._deliver = staticmethod(_deliver)
+
+        # Keep the test data out of the database
+        self.commit = db.commit
+        db.commit = lambda: None
+
+        # Subscribers
+        ptable = s3db.pr_person
+        pe_ids = self.pe_ids = []
+        for i in range(3):
+            person = {"first_name": "Notify", "last_name": "Test %s" % i}
+            person["id"] = ptable.insert(**person)
+            s3db.update_super(ptable, person)
+            pe_ids.append(person["pe_id"])
+
+        # Subscriptions to new organisations
+        now = datetime.datetime.utcnow()
+        last_check_time = now - datetime.timedelta(minutes=10)
+
+        stable = s3db.pr_subscription
+        rtable = s3db.pr_subscription_resource
+        resource_ids = self.resource_ids = []
+        for pe_id, email_format in ((pe_ids[0], "text"),
+                                    (pe_ids[1], "text"),
+                                    (pe_ids[2], "html"),
+                                    ):
+            subscription_id = stable.insert(pe_id = pe_id,
+                                            notify_on = ["new"],
+                                            method = ["EMAIL"],
+                                            frequency = "immediately",
+                                            email_format = email_format,
+                                            )
+            resource_ids.append(rtable.insert(subscription_id = subscription_id,
+                                              resource = "org_organisation",
+                                              url = "org/organisation",
+                                              last_check_time = last_check_time,
+                                              locked = True,
+                                              ))
+
+        # A new organisation
+        otable = s3db.org_organisation
+        self.organisation_id = otable.insert(name = "Notify Test Organisation",
+                                             created_on = now,
+                                             modified_on = now,
+                                             )
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        S3Notifications._lookup = self.lookup
+        S3Notifications._compose = self.compose
+        S3Notifications._deliver = self.deliver
+
+        db = current.db
+        db.commit = self.commit
+        db.rollback()
+        current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    def testSharedLookup(self):
+        """ Test grouping of subscriptions and sharing of messages """
+
+        assertEqual = self.assertEqual
+
+        S3Notifications.notify_shared(self.resource_ids)
+
+        # Same resource, filter, language and permissions => one lookup
+        assertEqual(len(self.lookups), 1)
+
+        # All subscribers have been notified
+        delivered = dict(self.delivered)
+        assertEqual(set(delivered), set(self.pe_ids))
+
+        # Same options => same message, different email format => separate
+        pe_ids = self.pe_ids
+        assertEqual(len(self.composed), 2)
+        self.assertTrue(delivered[pe_ids[0]] is delivered[pe_ids[1]])
+        self.assertFalse(delivered[pe_ids[0]] is delivered[pe_ids[2]])
+
+        # Subscriptions are unlocked and their check times advanced
+        rtable = current.s3db.pr_subscription_resource
+        rows = current.db(rtable.id.belongs(self.resource_ids)).select(
+                                                    rtable.locked,
+                                                    rtable.last_check_time,
+                                                    )
+        assertEqual(len(rows), 3)
+        assertEqual(len(set(row.last_check_time for row in rows)), 1)
+        for row in rows:
+            self.assertFalse(row.locked)
+
+    # -------------------------------------------------------------------------
+    def testSeparateFilters(self):
+        """ Test that subscriptions with different filters are looked up separately """
+
+        db = current.db
+        s3db = current.s3db
+
+        # Filter for one of the subscriptions
+        ftable = s3db.pr_filter
+        filter_id = ftable.insert(pe_id = self.pe_ids[0],
+                                  resource = "org_organisation",
+                                  query = '[["organisation.name__like", "Notify*"]]',
+                                  )
+        stable = s3db.pr_subscription
+        rtable = s3db.pr_subscription_resource
+        query = (rtable.id == self.resource_ids[0]) & \
+                (stable.id == rtable.subscription_id)
+        subscription_id = db(query).select(stable.id,
+                                           limitby = (0, 1),
+                                           ).first().id
+        db(stable.id == subscription_id).update(filter_id=filter_id)
+
+        S3Notifications.notify_shared(self.resource_ids)
+
+        self.assertEqual(len(self.lookups), 2)
+        self.assertEqual(set(dict(self.delivered)), set(self.pe_ids))
+
+    # -------------------------------------------------------------------------
+    def testTables(self):
+        """ Test the tables included in the lookup signature """
+
+        s3db = current.s3db
+
+        tablename = "org_office"
+        notify_fields = s3db.get_config(tablename, "notify_fields")
+        s3db.configure(tablename,
+                       notify_fields = ["name",
+                                        "organisation_id$name",
+                                        ],
+                       )
+        try:
+            tables = S3Notifications._tables(tablename, "org/office")
+        finally:
+            if notify_fields is None:
+                s3db.clear_config(tablename, "notify_fields")
+            else:
+                s3db.configure(tablename, notify_fields=notify_fields)
+
+        # Subscribed table first, then the joined tables
+        self.assertEqual(tables, ["org_office", "org_organisation"])
+
+# =============================================================================
+if __name__ == "__main__":
+
+    run_suite(
+        NotifySharedTests,
+    )
+
+# END ========================================================================
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+#
+# Pivot Table Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3report.py
+#
+import unittest
+
+from gluon import *
+from s3.s3report import S3PivotTable, S3PivotTableFact
+
+from unit_tests import run_suite
+
+# =============================================================================
+class PivotTableAggregateTests(unittest.TestCase):
+    """ Tests for S3PivotTable aggregation in the database (pushdown) """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        settings = current.deployment_settings
+        self.pushdown = settings.ui.get("report_pushdown")
+
+        # Values which can be summed up without rounding errors
+        table = current.s3db.gis_location
+        location_ids = []
+        for i, (level, ftype, lat, lon) in enumerate((("L1", 1, 1.5, 2.25),
+                                                      ("L1", 1, 2.5, 2.25),
+                                                      ("L1", 3, 1.5, 4.75),
+                                                      ("L2", 1, 3.0, 0.5),
+                                                      ("L2", 3, 0.5, 0.5),
+                                                      ("L2", 3, 0.5, 1.25),
+                                                      )):
+            location_ids.append(table.insert(name = "Pivot Test %s" % (i % 4),
+                                             level = level,
+                                             gis_feature_type = ftype,
+                                             lat = lat,
+                                             lon = lon,
+                                             ))
+        self.location_ids = location_ids
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        settings = current.deployment_settings
+        if self.pushdown is None:
+            settings.ui.pop("report_pushdown", None)
+        else:
+            settings.ui.report_pushdown = self.pushdown
+
+        current.db.rollback()
+        current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    def pivottable(self, facts, pushdown):
+        """
+            Compute a pivot table over the test records
+
+            @param facts: the facts, tuples (method, selector)
+            @param pushdown: aggregate in the database
+
+            @return: the S3PivotTable
+        """
+
+        current.deployment_settings.ui.report_pushdown = pushdown
+
+        resource = current.s3db.resource("gis_location",
+                                         id = self.location_ids,
+                                         )
+        facts = [S3PivotTableFact(method, selector)
+                 for method, selector in facts]
+
+        return S3PivotTable(resource, "level", "gis_feature_type", facts)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def results(pt):
+        """
+            Extract the aggregates from a pivot table, independently of
+            the order of rows, columns and list values
+
+            @param pt: the S3PivotTable
+
+            @return: dict {(row value, col value, layer): aggregate}
+        """
+
+        layers = [fact.layer for fact in pt.facts]
+
+        def normalize(value):
+            return sorted(value) if type(value) is list else value
+
+        results = {}
+        for layer in layers:
+            results[(None, None, layer)] = normalize(pt.totals[layer])
+            for r, row in enumerate(pt.row):
+                results[(row.value, None, layer)] = normalize(row[layer])
+                for c, col in enumerate(pt.col):
+                    cell = pt.cell[r][c]
+                    if not cell.numrecords:
+                        continue
+                    results[(row.value, col.value, layer)] = \
+                                                normalize(cell[layer])
+            for col in pt.col:
+                results[(None, col.value, layer)] = normalize(col[layer])
+        return results
+
+    # -------------------------------------------------------------------------
+    def testEquivalence(self):
+        """ Test that aggregation in the database gives the same results """
+
+        assertEqual = self.assertEqual
+
+        facts = (("count", "id"),
+                 ("count", "name"),
+                 ("list", "name"),
+                 ("sum", "lat"),
+                 ("avg", "lon"),
+                 ("min", "lat"),
+                 ("max", "lon"),
+                 )
+
+        pt = self.pivottable(facts, False)
+        self.assertNotEqual(pt.records, None)
+        expected = self.results(pt)
+
+        pt = self.pivottable(facts, True)
+        assertEqual(pt.records, None)
+        assertEqual(pt.numrecords, len(self.location_ids))
+        results = self.results(pt)
+
+        assertEqual(set(results), set(expected))
+        for key in expected:
+            assertEqual(results[key], expected[key],
+                        msg = "%s: %s != %s" % (key, results[key], expected[key]))
+
+        # Distinct values are counted only once per cell
+        layer = ("name", "count")
+        assertEqual(results[(None, None, layer)], 6)
+        assertEqual(results[("L1", 1, layer)], 2)
+
+        # JSON looks up the same values
+        pushdown = pt.json()["lookups"]
+        records = self.pivottable(facts, False).json()["lookups"]
+        assertEqual(set(pushdown), set(records))
+        for selector in records:
+            assertEqual(sorted(pushdown[selector].values()),
+                        sorted(records[selector].values()))
+
+    # -------------------------------------------------------------------------
+    def testMultipleValues(self):
+        """ Test that multi-valued facts fall back to the records """
+
+        pt = self.pivottable((("count", "tag.value"),), True)
+        self.assertNotEqual(pt.records, None)
+
+        pt = self.pivottable((("list", "name"),), True)
+        self.assertEqual(pt.records, None)
+
+# =============================================================================
+if __name__ == "__main__":
+
+    run_suite(
+        PivotTableAggregateTests,
+    )
+
+# END ========================================================================
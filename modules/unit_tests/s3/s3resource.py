@@ -2134,6 +2134,89 @@ class ResourceSelectTests(unittest.TestCase):
         for index, row in enumerate(rows):
             assertEqual(row["select_master.id"], ids[index])
 
+    # -------------------------------------------------------------------------
+    def testSelectColumnar(self):
+        """ Test columnar (chunked) selection """
+
+        s3db = current.s3db
+
+        assertTrue = self.assertTrue
+        assertEqual = self.assertEqual
+
+        fields = ["id", "name", "status", "code"]
+        orderby = "select_master.name"
+
+        # Regular select for comparison
+        resource = s3db.resource("select_master")
+        expected = resource.select(fields,
+                                   count = True,
+                                   orderby = orderby,
+                                   represent = True,
+                                   ).rows
+
+        # Columnar select
+        resource = s3db.resource("select_master")
+        data = resource.select(fields,
+                               count = True,
+                               orderby = orderby,
+                               represent = True,
+                               columnar = True,
+                               chunksize = 3,
+                               )
+        assertEqual(data.numrows, len(self.test_data))
+        assertEqual(len(data), len(self.test_data))
+
+        # Verify chunks
+        chunks = list(data.chunks())
+        assertEqual(len(chunks), 4)
+        ids = []
+        for chunk in chunks:
+            assertTrue(len(chunk.ids) <= 3)
+            for colname, values in chunk.columns.items():
+                # Value arrays match the record index
+                assertEqual(len(values), len(chunk.ids))
+            ids.extend(chunk.ids)
+        assertEqual(ids, [row["select_master.id"] for row in expected])
+
+        # Records are the same as with regular select, and in order
+        rows = list(data.rows)
+        assertEqual(len(rows), len(expected))
+        for index, row in enumerate(rows):
+            for colname in expected[index]:
+                assertEqual(row[colname], expected[index][colname])
+
+        # Subset of records
+        rows = list(data.records(2, 5))
+        assertEqual(len(rows), 3)
+        assertEqual(rows[0]["select_master.id"], expected[2]["select_master.id"])
+
+    # -------------------------------------------------------------------------
+    def testSelectColumnarFilter(self):
+        """ Test columnar selection with virtual filter and pagination """
+
+        s3db = current.s3db
+
+        assertEqual = self.assertEqual
+
+        numitems = len([item for item in self.test_data if item[1] == "A"])
+
+        query = FS("code") == "A"
+        resource = s3db.resource("select_master", filter=query)
+        data = resource.select(["name", "code"],
+                               start = 1,
+                               limit = 2,
+                               count = True,
+                               orderby = "select_master.name",
+                               columnar = True,
+                               chunksize = 1,
+                               )
+        assertEqual(data.numrows, numitems)
+
+        rows = list(data.rows)
+        assertEqual(len(rows), 2)
+        for row in rows:
+            assertEqual(row["select_master.code"], "A")
+
     # -------------------------------------------------------------------------
     def testSelectSubset(self):
         """ Test selection of unfiltered subset (pagination) """
@@ -2425,6 +2508,54 @@ class ResourceSelectTests(unittest.TestCase):
         # - returns all matching record ids, however
         assertEqual(len(data.ids), numitems)
 
+    # -------------------------------------------------------------------------
+    def testSelectSubsetVirtualFilterStream(self):
+        """ Test selection of subset with virtual filter in chunks """
+
+        s3db = current.s3db
+        settings = current.deployment_settings
+
+        assertEqual = self.assertEqual
+
+        subset = [item for item in self.test_data if item[1] == "A"]
+        numitems = len(subset)
+        names = [item[0] for item in subset]
+
+        query = (FS("code") == "A")
+        resource = s3db.resource("select_master",
+                                 filter = query,
+                                 )
+
+        chunksize = settings.base.get("vfilter_chunksize")
+        settings.base.vfilter_chunksize = 2
+        try:
+            # Without count, the page is filled before all chunks are filtered
+            data = resource.select(["name", "status"],
+                                   start = 0,
+                                   limit = 2,
+                                   count = False,
+                                   orderby = "select_master.name",
+                                   )
+            # - returns the rows in the page, in order
+            assertEqual([row["select_master.name"] for row in data.rows],
+                        names[:2])
+
+            # With count, the number of matching records is exact
+            data = resource.select(["name", "status"],
+                                   start = 1,
+                                   limit = 2,
+                                   count = True,
+                                   orderby = "select_master.name",
+                                   )
+            assertEqual([row["select_master.name"] for row in data.rows],
+                        names[1:3])
+            assertEqual(data.numrows, numitems)
+        finally:
+            if chunksize is None:
+                settings.base.pop("vfilter_chunksize", None)
+            else:
+                settings.base.vfilter_chunksize = chunksize
+
     # -------------------------------------------------------------------------
     def testSelectSubsetExtraFilter(self):
         """ Test selection of subset (pagination) with extra filter """
@@ -5,6 +5,7 @@
 # To run this script use:
 # python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3sync.py
 #
+import datetime
 import json
 import unittest
 
@@ -434,6 +435,163 @@ class ImportMergeWithoutExistingRecords(unittest.TestCase):
         current.auth.override = False
         current.db.rollback()
 
+# =============================================================================
+class PagedExportTests(unittest.TestCase):
+    """ Test keyset paging of sync exports """
+
+    def setUp(self):
+
+        current.auth.override = True
+
+        # Records with identical modification dates, so that the
+        # cursor must fall back to the record ID
+        table = current.s3db.org_organisation
+        mtime = datetime.datetime(2017, 1, 1, 12, 0, 0, 500)
+        self.uids = ["TESTPAGEDEXPORTORG%s" % i for i in range(5)]
+        for uid in self.uids:
+            table.insert(uuid=uid, name=uid, modified_on=mtime)
+
+    def testPagedExport(self):
+        """ Test that paged export visits each record exactly once """
+
+        from s3.sync_adapter.eden import S3SyncAdapter
+
+        s3db = current.s3db
+
+        exported = []
+        after = ()
+        pages = 0
+        while True:
+            resource = s3db.resource("org_organisation", uid=self.uids)
+            tree = resource.export_tree(limit=2, after=after)
+            elements = tree.getroot().findall("resource[@name='org_organisation']")
+            exported.extend(e.get("uuid") for e in elements)
+            pages += 1
+            if not resource.cursor:
+                break
+            # Round-trip through the token
+            token = S3SyncAdapter.encode_cursor(resource.cursor)
+            after = S3SyncAdapter.decode_cursor(token)
+            self.assertEqual(after, resource.cursor)
+
+        self.assertEqual(pages, 3)
+        self.assertEqual(sorted(exported), self.uids)
+
+    def testPagedExportNullMtime(self):
+        """ Test that paged export visits records without modified_on exactly once """
+
+        from s3.sync_adapter.eden import S3SyncAdapter
+
+        db = current.db
+        s3db = current.s3db
+
+        table = s3db.org_organisation
+        db(table.uuid.belongs(self.uids[1:4:2])).update(modified_on=None)
+
+        exported = []
+        after = ()
+        while True:
+            resource = s3db.resource("org_organisation", uid=self.uids)
+            tree = resource.export_tree(limit=2, after=after)
+            elements = tree.getroot().findall("resource[@name='org_organisation']")
+            exported.extend(e.get("uuid") for e in elements)
+            if not resource.cursor:
+                break
+            token = S3SyncAdapter.encode_cursor(resource.cursor)
+            after = S3SyncAdapter.decode_cursor(token)
+
+        # Records without modified_on come first
+        self.assertEqual(exported[:2], self.uids[1:4:2])
+        self.assertEqual(sorted(exported), self.uids)
+
+    def testInvalidCursor(self):
+        """ Test that invalid continuation tokens are rejected """
+
+        from s3.sync_adapter.eden import S3SyncAdapter
+
+        decode_cursor = S3SyncAdapter.decode_cursor
+        self.assertEqual(decode_cursor("invalid"), None)
+        self.assertEqual(decode_cursor("2017-1"), None)
+        self.assertEqual(decode_cursor(None), None)
+        self.assertEqual(decode_cursor("-5"), (None, 5))
+
+    def tearDown(self):
+
+        current.auth.override = False
+        current.db.rollback()
+
+# =============================================================================
+class TableLockTests(unittest.TestCase):
+    """ Test per-table locks for concurrent synchronization """
+
+    def testTableLock(self):
+        """ Test that table_lock holds the lock for the table """
+
+        import threading
+
+        from s3 import S3Sync
+
+        sync = S3Sync()
+
+        # No locks outside of concurrent synchronization
+        with sync.table_lock("org_organisation"):
+            pass
+
+        lock = threading.Lock()
+        sync.locks = {"org_organisation": lock}
+        try:
+            with sync.table_lock("org_organisation"):
+                self.assertFalse(lock.acquire(False))
+            self.assertTrue(lock.acquire(False))
+            lock.release()
+
+            # Tables without lock
+            with sync.table_lock("org_office"):
+                pass
+        finally:
+            sync.locks = None
+
+    def testTaskTableLocks(self):
+        """ Test that table_lock holds the locks for all tables of a task """
+
+        import threading
+
+        from s3 import S3Sync
+
+        sync = S3Sync()
+
+        # Tables the task writes to
+        tablenames = sync.task_tables("org_office")
+        self.assertTrue("org_office" in tablenames)
+        self.assertTrue("org_organisation" in tablenames)
+        self.assertTrue("gis_location" in tablenames)
+        self.assertFalse("auth_user" in tablenames)
+
+        tablenames = sync.task_tables("org_organisation", components=False)
+        self.assertFalse("org_office" in tablenames)
+
+        locks = {"org_office": threading.Lock(),
+                 "org_organisation": threading.Lock(),
+                 "pr_person": threading.Lock(),
+                 }
+        sync.locks = locks
+        sync.lock_tables = {"org_office": set(["org_office",
+                                               "org_organisation",
+                                               ]),
+                            }
+        try:
+            with sync.table_lock("org_office"):
+                self.assertFalse(locks["org_office"].acquire(False))
+                self.assertFalse(locks["org_organisation"].acquire(False))
+                self.assertTrue(locks["pr_person"].acquire(False))
+                locks["pr_person"].release()
+            for lock in locks.values():
+                self.assertTrue(lock.acquire(False))
+                lock.release()
+        finally:
+            sync.locks = None
+            sync.lock_tables = None
+
 # =============================================================================
 if __name__ == "__main__":
 
@@ -443,7 +601,9 @@ if __name__ == "__main__":
         ImportMergeWithExistingRecords,
         ImportMergeWithExistingOriginal,
         ImportMergeWithExistingDuplicate,
-        ImportMergeWithoutExistingRecords
+        ImportMergeWithoutExistingRecords,
+        PagedExportTests,
+        TableLockTests,
     )
 
 # END ========================================================================
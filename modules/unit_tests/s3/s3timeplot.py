@@ -12,7 +12,7 @@ import dateutil.tz
 
 from gluon import *
 from s3.s3timeplot import *
-from s3.s3timeplot import tp_datetime
+from s3.s3timeplot import tp_datetime, S3TimeSeriesInterval
 from s3.s3query import FS
 
 from unit_tests import run_suite
@@ -1128,6 +1128,84 @@ class EventFrameTests(unittest.TestCase):
                                        ])
             assertEqual(result, expected_result)
 
+    # -------------------------------------------------------------------------
+    def testAggregate(self):
+        """ Test aggregation of facts for all periods at once """
+
+        # Create event frame and add events
+        ef = S3TimeSeriesEventFrame(tp_datetime(2012,1,1),
+                                    tp_datetime(2012,12,15),
+                                    slots="3 months")
+        ef.extend(self.events)
+
+        facts = [S3TimeSeriesFact("sum", "test"),
+                 S3TimeSeriesFact("max", "test"),
+                 S3TimeSeriesFact("cumulate",
+                                  None,
+                                  slope="test",
+                                  interval="months",
+                                  ),
+                 ]
+        ef.aggregate(facts)
+
+        # Expected totals
+        expected = [[10, 5, 117],
+                    [20, 8, 150],
+                    [13, 8, 176],
+                    [20, 9, 211],
+                    ]
+
+        # Check
+        assertEqual = self.assertEqual
+        for i, period in enumerate(ef):
+            assertEqual(period.totals, expected[i])
+
+    # -------------------------------------------------------------------------
+    def testAggregateGroups(self):
+        """ Test aggregation for all periods against per-period aggregation """
+
+        assertEqual = self.assertEqual
+
+        events = []
+        for event in self.events:
+            row = ["A", "B"][event.event_id % 2]
+            col = ["X", "Y", "Z"][event.event_id % 3]
+            events.append(S3TimeSeriesEvent(event.event_id,
+                                            start=event.start,
+                                            end=event.end,
+                                            values=event.values,
+                                            row=row,
+                                            col=col,
+                                            ))
+
+        for facts in ([S3TimeSeriesFact("count", "test"),
+                       S3TimeSeriesFact("min", "test"),
+                       S3TimeSeriesFact("avg", "test"),
+                       ],
+                      [S3TimeSeriesFact("cumulate",
+                                        "test",
+                                        slope="test",
+                                        interval="2 weeks",
+                                        ),
+                       ],
+                      ):
+
+            ef = S3TimeSeriesEventFrame(tp_datetime(2012,1,1),
+                                        tp_datetime(2012,12,15),
+                                        slots="months")
+            ef.extend(events)
+            ef.aggregate(facts)
+
+            for period in ef:
+                rows, cols, matrix = period.rows, period.cols, period.matrix
+                totals = period.totals
+
+                period.aggregate(facts)
+                assertEqual(totals, period.totals)
+                assertEqual(rows, period.rows)
+                assertEqual(cols, period.cols)
+                assertEqual(matrix, period.matrix)
+
     # -------------------------------------------------------------------------
     def testPeriodsDays(self):
         """ Test iteration over periods (days) """
@@ -1209,6 +1287,39 @@ class EventFrameTests(unittest.TestCase):
             assertEqual(period.start, expected[i][0])
             assertEqual(period.end, expected[i][1])
 
+# =============================================================================
+class IntervalTests(unittest.TestCase):
+    """ Tests for S3TimeSeriesInterval class """
+
+    def testDuration(self):
+        """ Test computation of durations against recurrence rules """
+
+        assertEqual = self.assertEqual
+
+        rnd = random.Random(1234)
+        for interval in ("hours", "3 days", "weeks", "months", "2 months", "years"):
+            helper = S3TimeSeriesInterval(interval)
+            for i in xrange(20):
+                start = tp_datetime(2012, 1, 1) + \
+                        datetime.timedelta(seconds=rnd.randint(0, 86400 * 400))
+                end = start + \
+                      datetime.timedelta(seconds=rnd.randint(1, 86400 * 200))
+                rule = S3TimeSeriesPeriod.get_rule(start, end, interval)
+                assertEqual(helper.duration(start, end), rule.count())
+
+        # Start date which does not recur in every month
+        helper = S3TimeSeriesInterval("months")
+        start = tp_datetime(2013, 1, 31)
+        end = tp_datetime(2013, 8, 1)
+        assertEqual(helper.duration(start, end), 4)
+
+        # End before start
+        assertEqual(helper.duration(end, start), 0)
+
+        # Unsupported interval
+        helper = S3TimeSeriesInterval("fortnights")
+        assertEqual(helper.duration(start, end), 1)
+
 # =============================================================================
 class DtParseTests(unittest.TestCase):
     """ Test Parsing of Datetime Options """
@@ -1857,6 +1968,7 @@ if __name__ == "__main__":
         PeriodTestsSingleAxis,
         PeriodTestsNoGroups,
         EventFrameTests,
+        IntervalTests,
         DtParseTests,
         TimeSeriesTests,
         FactParserTests,
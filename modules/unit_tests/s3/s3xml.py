@@ -1002,6 +1002,49 @@ class LookupListRepresentTests(unittest.TestCase):
         assertEqual(elem.get("uuid"), row.uuid)
         assertEqual(elem.get(LLREPR), expected)
 
+# =============================================================================
+class IncrementalParsingTests(unittest.TestCase):
+    """ Test incremental parsing of import sources """
+
+    # -------------------------------------------------------------------------
+    def testIterparse(self):
+        """ Test incremental parsing of XML sources """
+
+        assertEqual = self.assertEqual
+
+        xmlstr = """<s3xml domain="test">%s</s3xml>""" % \
+                 "".join("""<resource name="org_region" tuid="R%s">"""
+                         """<data field="name">Region%s</data>"""
+                         """</resource>""" % (i, i) for i in range(5))
+
+        trees = list(current.xml.iterparse(StringIO(xmlstr), chunksize=2))
+        assertEqual(len(trees), 3)
+
+        names = []
+        for tree in trees:
+            root = tree.getroot()
+            assertEqual(root.tag, "s3xml")
+            assertEqual(root.get("domain"), "test")
+            names.extend(e.findtext("data") for e in root)
+        assertEqual(names, ["Region%s" % i for i in range(5)])
+
+    # -------------------------------------------------------------------------
+    def testCSVChunks(self):
+        """ Test incremental parsing of CSV sources """
+
+        assertEqual = self.assertEqual
+
+        csvstr = "Name,Comments\n%s" % \
+                 "".join("Region%s,Test\n" % i for i in range(5))
+
+        trees = list(current.xml.csv2trees(StringIO(csvstr), chunksize=2))
+        assertEqual(len(trees), 3)
+        assertEqual([len(tree.getroot()) for tree in trees], [2, 2, 1])
+
+        # Single tree without chunksize
+        tree = current.xml.csv2tree(StringIO(csvstr))
+        assertEqual(len(tree.getroot()), 5)
+
 # =============================================================================
 if __name__ == "__main__":
 
@@ -1012,6 +1055,7 @@ if __name__ == "__main__":
         GetFieldOptionsTests,
         S3JSONParsingTests,
         LookupListRepresentTests,
+        IncrementalParsingTests,
     )
 
 # END ========================================================================
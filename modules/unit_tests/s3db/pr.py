@@ -146,6 +146,103 @@ class PRTests(unittest.TestCase):
         current.db.rollback()
         current.auth.override = False
 
+# =============================================================================
+class OUClosureTests(unittest.TestCase):
+    """ Tests for the OU hierarchy closure """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+        """ Set up organisation records """
+
+        auth = current.auth
+        s3db = current.s3db
+
+        auth.override = True
+
+        otable = s3db.org_organisation
+
+        pe_ids = []
+        for index in range(3):
+            org = Storage(name="Test OU Organisation %s" % index)
+            org_id = otable.insert(**org)
+            org.update(id=org_id)
+            s3db.update_super(otable, org)
+            pe_ids.append(s3db.pr_get_pe_id("org_organisation", org_id))
+
+        self.pe_ids = pe_ids
+
+    # -------------------------------------------------------------------------
+    def testIncrementalUpdate(self):
+        """ Test lookups after affiliation changes """
+
+        s3db = current.s3db
+        assertEqual = self.assertEqual
+
+        org1, org2, org3 = self.pe_ids
+
+        s3db.pr_add_affiliation(org1, org2, role="TestOrgUnit")
+        s3db.pr_add_affiliation(org2, org3, role="TestOrgUnit")
+
+        descendants = s3db.pr_get_descendants(org1)
+        assertEqual(set(descendants), set([org2, org3]))
+        descendants = s3db.pr_get_descendants(org1,
+                                              entity_types="org_organisation")
+        assertEqual(set(descendants), set([org2, org3]))
+        descendants = s3db.pr_get_descendants(org1,
+                                              entity_types="pr_person")
+        assertEqual(descendants, [])
+
+        descendants = s3db.pr_descendants([org1, org2])
+        assertEqual(set(descendants[org1]), set([org2, org3]))
+        assertEqual(descendants[org2], [org3])
+
+        ancestors = s3db.pr_get_ancestors(org3)
+        assertEqual(ancestors, [str(org2), str(org1)])
+
+        # Remove the intermediate affiliation
+        s3db.pr_remove_affiliation(org1, org2, role="TestOrgUnit")
+
+        assertEqual(s3db.pr_get_descendants(org1), [])
+        assertEqual(s3db.pr_get_descendants(org2), [org3])
+        assertEqual(s3db.pr_get_ancestors(org3), [str(org2)])
+
+        # Non-OU roles are not part of the hierarchy
+        s3db.pr_add_affiliation(org1, org2, role="TestPartner", role_type=9)
+        assertEqual(s3db.pr_get_descendants(org1), [])
+
+    # -------------------------------------------------------------------------
+    def testRebuild(self):
+        """ Test that a rebuild produces the same closure """
+
+        db = current.db
+        s3db = current.s3db
+
+        org1, org2, org3 = self.pe_ids
+
+        s3db.pr_add_affiliation(org1, org2, role="TestOrgUnit")
+        s3db.pr_add_affiliation(org2, org3, role="TestOrgUnit")
+        s3db.pr_add_affiliation(org1, org3, role="TestOrgUnit")
+
+        ctable = s3db.pr_ou_closure
+        fields = (ctable.ancestor, ctable.descendant, ctable.depth)
+        query = (ctable.descendant.belongs(self.pe_ids))
+
+        rows = db(query).select(*fields)
+        closure = set((row.ancestor, row.descendant, row.depth) for row in rows)
+        self.assertTrue((org1, org3, 1) in closure)
+
+        s3db.pr_rebuild_ou_closure()
+
+        rows = db(query).select(*fields)
+        rebuilt = set((row.ancestor, row.descendant, row.depth) for row in rows)
+        self.assertEqual(rebuilt, closure)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
 # =============================================================================
 class PersonDeduplicateTests(unittest.TestCase):
     """ PR Tests """
@@ -606,6 +703,7 @@ if __name__ == "__main__":
 
     run_suite(
         PRTests,
+        OUClosureTests,
         PersonDeduplicateTests,
         ContactValidationTests,
     )
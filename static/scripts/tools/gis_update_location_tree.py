@@ -4,7 +4,20 @@
 
 # Needs to be run in the web2py environment
 # python web2py.py -S eden -M -R applications/eden/static/scripts/tools/gis_update_location_tree.py
+#
+# An interrupted run can be resumed with the level it was processing, e.g.:
+# python web2py.py -S eden -M -R applications/eden/static/scripts/tools/gis_update_location_tree.py -A L3
+# ("specific" to resume with the specific locations)
+
+import sys
+
+if len(sys.argv) > 1:
+    start = sys.argv[1]
+    if start == "specific":
+        start = None
+else:
+    start = "L0"
 
 s3db.gis_location
-gis.update_location_tree()
+gis.update_location_tree_bulk(start=start)
 db.commit()
@@ -30,6 +30,12 @@ except:
     # Index already present
     pass
 
+try:
+    db.executesql("CREATE INDEX s3_hierarchy_node__idx on s3_hierarchy_node(tablename,node_id);")
+except:
+    # Index already present
+    pass
+
 tablename = "gis_location"
 field = "name"
 try: